@@ -0,0 +1,389 @@
+"""Benchmark de descoberta com hosts simulados em loopback.
+
+Sobe listeners em endereços 127.x.y.z (o Linux roteia todo 127.0.0.0/8 para lo, sem aliases),
+cada host com um perfil: banner SSH, HTTP, /metrics de node_exporter, Docker Engine API, Redis,
+porta "filtrada" (fila de accept cheia, SYN descartado) ou host offline. Os listeners rodam em um
+processo separado para que threads, FDs e RSS medidos sejam apenas os do scanner.
+
+Uso:
+    python bench_discovery.py --scales 16,64,256 --out bench.json
+    python bench_discovery.py --scales 1024 --mode network --workers 4
+
+Saída: JSON com hosts/s, latência por host (p50/p99), pico de threads, FDs e RSS por cenário.
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import platform
+import socket
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+# PostgreSQL inexistente (recusa imediata) e sem cache entre rodadas, antes de importar main
+os.environ.setdefault("POSTGRES_HOST", "127.0.0.1")
+os.environ.setdefault("POSTGRES_PORT", "1")
+os.environ.setdefault("PROBE_CACHE_TTL", "0")
+os.environ.setdefault("PROBE_CACHE_NEGATIVE_TTL", "0")
+
+BASE_IP = (127, 1, 0, 1)
+PROFILES = ["linux", "docker", "web", "filtered", "offline"]
+FILTERED_PORT = 3000
+NODE_EXPORTER_PORT = 9100
+DOCKER_PORT = 2375
+REDIS_PORT = 6379
+
+
+def host_ip(index: int) -> str:
+    n = (BASE_IP[0] << 24 | BASE_IP[1] << 16 | BASE_IP[2] << 8 | BASE_IP[3]) + index
+    return socket.inet_ntoa(n.to_bytes(4, "big"))
+
+
+def privileged_ports_available() -> bool:
+    s = socket.socket()
+    try:
+        s.bind(("127.255.255.254", 22))
+        return True
+    except OSError:
+        return False
+    finally:
+        s.close()
+
+
+def raise_fd_limit() -> None:
+    try:
+        import resource
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except Exception:
+        pass
+
+
+# ----------------------
+# Simulated hosts (child process)
+# ----------------------
+
+def node_exporter_metrics(padding_kb: int) -> bytes:
+    lines = [
+        "# HELP node_memory_MemTotal_bytes Memory information field MemTotal_bytes.",
+        "node_memory_MemTotal_bytes 8.253e+09",
+        "node_memory_MemAvailable_bytes 4.1e+09",
+    ]
+    for cpu in range(4):
+        for mode, value in (("idle", 91234.5), ("user", 2345.6), ("system", 1234.5), ("iowait", 12.3)):
+            lines.append(f'node_cpu_seconds_total{{cpu="{cpu}",mode="{mode}"}} {value}')
+    lines += [
+        'node_network_receive_bytes_total{device="eth0"} 1.2345e+09',
+        'node_network_transmit_bytes_total{device="eth0"} 9.876e+08',
+        'node_filesystem_size_bytes{device="/dev/sda1",fstype="ext4",mountpoint="/"} 1.0e+11',
+        'node_filesystem_avail_bytes{device="/dev/sda1",fstype="ext4",mountpoint="/"} 4.0e+10',
+        'node_uname_info{machine="x86_64",nodename="sim",release="6.1.0",sysname="Linux"} 1',
+    ]
+    i = 0
+    while sum(len(x) + 1 for x in lines) < padding_kb * 1024:
+        lines.append(f'node_bench_padding_metric{{index="{i}"}} {i}')
+        i += 1
+    return ("\n".join(lines) + "\n").encode()
+
+
+def docker_routes(path: str) -> Tuple[int, bytes]:
+    if path.startswith("/version"):
+        return 200, json.dumps({"Version": "24.0.7", "ApiVersion": "1.43", "Os": "linux"}).encode()
+    if path.startswith("/info"):
+        return 200, json.dumps({"Containers": 3, "Images": 5, "Name": "sim"}).encode()
+    if path.startswith("/containers/json"):
+        return 200, json.dumps([
+            {"Id": f"c{i:063d}", "Names": [f"/app{i}"], "Image": "nginx:alpine", "State": "running", "Status": "Up",
+             "Ports": [{"PrivatePort": 80, "PublicPort": 8080 + i, "Type": "tcp"}], "Labels": {}}
+            for i in range(3)
+        ]).encode()
+    if "/logs" in path:
+        return 200, b"".join(f"2026-01-01T00:00:{i:02d}Z request served\n".encode() for i in range(100))
+    return 404, b'{"message":"page not found"}'
+
+
+async def serve_http(reader, writer, routes: Callable[[str], Tuple[int, bytes]]) -> None:
+    try:
+        while True:
+            head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), timeout=10)
+            request_line = head.split(b"\r\n", 1)[0].decode(errors="ignore")
+            parts = request_line.split(" ")
+            path = parts[1] if len(parts) > 1 else "/"
+            status, body = routes(path)
+            writer.write(
+                f"HTTP/1.1 {status} {'OK' if status == 200 else 'Not Found'}\r\nServer: sim-http/1.0\r\n"
+                f"Content-Type: text/plain\r\nContent-Length: {len(body)}\r\n\r\n".encode() + body
+            )
+            await writer.drain()
+            if request_line.endswith("HTTP/1.0") or b"connection: close" in head.lower():
+                break
+    except (Exception, asyncio.CancelledError):
+        # CancelledError: asyncio.run cancela as conexões abertas ao encerrar o simulador
+        pass
+    finally:
+        writer.close()
+
+
+async def serve_ssh(reader, writer) -> None:
+    try:
+        writer.write(b"SSH-2.0-OpenSSH_9.6p1 Simulated\r\n")
+        await writer.drain()
+        await asyncio.wait_for(reader.read(1024), timeout=5)
+    except (Exception, asyncio.CancelledError):
+        pass
+    finally:
+        writer.close()
+
+
+async def serve_redis(reader, writer) -> None:
+    try:
+        while True:
+            data = await asyncio.wait_for(reader.read(1024), timeout=10)
+            if not data:
+                break
+            if b"INFO" in data.upper():
+                body = b"# Server\r\nredis_version:7.2.4\r\n"
+                writer.write(b"$" + str(len(body)).encode() + b"\r\n" + body + b"\r\n")
+            else:
+                writer.write(b"+PONG\r\n")
+            await writer.drain()
+    except (Exception, asyncio.CancelledError):
+        pass
+    finally:
+        writer.close()
+
+
+def filtered_listener(ip: str, port: int) -> List[socket.socket]:
+    """Listening socket whose accept queue is full: further SYNs are dropped (looks filtered)."""
+    srv = socket.socket()
+    srv.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    srv.bind((ip, port))
+    srv.listen(0)
+    held = [srv]
+    for _ in range(4):
+        c = socket.socket()
+        c.setblocking(False)
+        try:
+            c.connect((ip, port))
+        except (BlockingIOError, OSError):
+            pass
+        held.append(c)
+    return held
+
+
+def host_services(profile: str, ssh_port: int, http_port: int) -> List[Tuple[int, str]]:
+    if profile == "linux":
+        return [(ssh_port, "ssh"), (NODE_EXPORTER_PORT, "node_exporter")]
+    if profile == "docker":
+        return [(ssh_port, "ssh"), (DOCKER_PORT, "docker"), (http_port, "http")]
+    if profile == "web":
+        return [(http_port, "http"), (REDIS_PORT, "redis")]
+    if profile == "filtered":
+        return [(ssh_port, "ssh"), (FILTERED_PORT, "filtered")]
+    return []
+
+
+def run_simulated_hosts(count: int, ssh_port: int, http_port: int, metrics_kb: int, ready, stop) -> None:
+    raise_fd_limit()
+    metrics = node_exporter_metrics(metrics_kb)
+    handlers = {
+        "ssh": serve_ssh,
+        "redis": serve_redis,
+        "http": lambda r, w: serve_http(r, w, lambda p: (200, b"<html><title>sim</title></html>")),
+        "node_exporter": lambda r, w: serve_http(r, w, lambda p: (200, metrics) if p.startswith("/metrics") else (404, b"")),
+        "docker": lambda r, w: serve_http(r, w, docker_routes),
+    }
+
+    async def main_loop() -> None:
+        held: List[Any] = []
+        for i in range(count):
+            ip = host_ip(i)
+            for port, kind in host_services(PROFILES[i % len(PROFILES)], ssh_port, http_port):
+                if kind == "filtered":
+                    held.extend(filtered_listener(ip, port))
+                else:
+                    held.append(await asyncio.start_server(handlers[kind], ip, port, backlog=512, reuse_address=True))
+        ready.set()
+        while not stop.is_set():
+            await asyncio.sleep(0.2)
+
+    asyncio.run(main_loop())
+
+
+# ----------------------
+# Measurement
+# ----------------------
+
+class PeakSampler(threading.Thread):
+    """Samples thread count, open FDs and RSS of this process until stopped."""
+
+    def __init__(self, interval: float = 0.02):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.peak = {"threads": 0, "fds": 0, "rss_mb": 0.0}
+        self._stop_event = threading.Event()
+
+    def run(self) -> None:
+        page = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+        while not self._stop_event.is_set():
+            self.peak["threads"] = max(self.peak["threads"], threading.active_count())
+            try:
+                self.peak["fds"] = max(self.peak["fds"], len(os.listdir("/proc/self/fd")))
+                with open("/proc/self/statm") as f:
+                    rss = int(f.read().split()[1]) * page / (1024 * 1024)
+                self.peak["rss_mb"] = max(self.peak["rss_mb"], round(rss, 1))
+            except Exception:
+                pass
+            self._stop_event.wait(self.interval)
+
+    def stop(self) -> Dict[str, Any]:
+        self._stop_event.set()
+        self.join()
+        return self.peak
+
+
+def percentile(values: List[float], q: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    return round(ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))], 2)
+
+
+def summarize(mode: str, scale: int, elapsed: float, latencies: List[float], online: int, peak: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "mode": mode,
+        "hosts": scale,
+        "online": online,
+        "elapsed_s": round(elapsed, 3),
+        "hosts_per_s": round(scale / elapsed, 2) if elapsed > 0 else None,
+        "latency_ms": {"p50": percentile(latencies, 0.5), "p99": percentile(latencies, 0.99),
+                       "max": round(max(latencies), 2) if latencies else None},
+        "peak_threads": peak["threads"],
+        "peak_fds": peak["fds"],
+        "peak_rss_mb": peak["rss_mb"],
+    }
+
+
+def bench_hosts(main, scale: int, ports: List[int], concurrency: int) -> Dict[str, Any]:
+    """discover_host_with_ports over each simulated host, `concurrency` hosts at a time."""
+    latencies: List[float] = []
+    online = 0
+
+    def one(ip: str) -> Tuple[float, bool]:
+        start = time.perf_counter()
+        res = main.discover_host_with_ports(ip, ports, persist=False, fresh=True)
+        return (time.perf_counter() - start) * 1000, res["status"] == "Online"
+
+    main.probe_cache_invalidate()
+    sampler = PeakSampler()
+    sampler.start()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for ms, is_online in executor.map(one, [host_ip(i) for i in range(scale)]):
+            latencies.append(ms)
+            online += int(is_online)
+    elapsed = time.perf_counter() - start
+    return summarize("discover_host_with_ports", scale, elapsed, latencies, online, sampler.stop())
+
+
+def bench_network(main, scale: int, method: str, workers: int) -> Dict[str, Any]:
+    """run_discovery_network over the simulated range (same path as POST /api/discovery/network)."""
+    latencies: List[float] = []
+    original = main.discover_network_host
+
+    def timed(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return original(*args, **kwargs)
+        finally:
+            latencies.append((time.perf_counter() - start) * 1000)
+
+    main.probe_cache_invalidate()
+    main.discover_network_host = timed
+    sampler = PeakSampler()
+    sampler.start()
+    start = time.perf_counter()
+    try:
+        res = main.run_discovery_network({
+            "target": f"{host_ip(0)}-{host_ip(scale - 1)}",
+            "method": method,
+            "fresh": True,
+            "workers": workers,
+        })
+    finally:
+        main.discover_network_host = original
+    elapsed = time.perf_counter() - start
+    online = sum(1 for d in res.get("discoveredDevices", []) if d.get("status") == "Online")
+    # Com workers > 1 os hosts rodam em outros processos e a latência por host não é observável aqui
+    result = summarize("discovery_network", scale, elapsed, latencies, online, sampler.stop())
+    result["workers"] = workers
+    return result
+
+
+def main_cli(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Discovery benchmark against simulated loopback hosts")
+    parser.add_argument("--scales", default="16,64,256", help="comma separated host counts")
+    parser.add_argument("--mode", choices=["both", "host", "network"], default="both")
+    parser.add_argument("--method", default="tcp", help="discovery method (port list) for network mode")
+    parser.add_argument("--workers", type=int, default=1, help="process workers for network mode")
+    parser.add_argument("--concurrency", type=int, default=32, help="concurrent hosts in host mode")
+    parser.add_argument("--metrics-kb", type=int, default=64, help="size of the simulated /metrics body")
+    parser.add_argument("--out", help="write JSON here instead of stdout")
+    args = parser.parse_args(argv)
+
+    scales = sorted({int(x) for x in args.scales.split(",") if x.strip()})
+    raise_fd_limit()
+    privileged = privileged_ports_available()
+    ssh_port, http_port = (22, 80) if privileged else (8022, 8080)
+
+    ctx = multiprocessing.get_context("spawn")
+    ready, stop = ctx.Event(), ctx.Event()
+    server = ctx.Process(target=run_simulated_hosts, args=(max(scales), ssh_port, http_port, args.metrics_kb, ready, stop), daemon=True)
+    server.start()
+    if not ready.wait(timeout=120):
+        server.terminate()
+        print("simulated hosts did not start", file=sys.stderr)
+        return 1
+
+    import main  # noqa: E402 - depende das variáveis de ambiente acima
+
+    ports = main.get_ports_for_method(args.method)
+    runs: List[Dict[str, Any]] = []
+    try:
+        for scale in scales:
+            if args.mode in ("both", "host"):
+                runs.append(bench_hosts(main, scale, ports, args.concurrency))
+            if args.mode in ("both", "network"):
+                runs.append(bench_network(main, scale, args.method, args.workers))
+    finally:
+        stop.set()
+        server.join(timeout=5)
+        if server.is_alive():
+            server.terminate()
+
+    report = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "cpus": os.cpu_count(),
+        "method": args.method,
+        "ports_per_host": len(ports),
+        "profiles": PROFILES,
+        "ssh_port": ssh_port,
+        "http_port": http_port,
+        "runs": runs,
+    }
+    text = json.dumps(report, indent=2)
+    if args.out:
+        with open(args.out, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
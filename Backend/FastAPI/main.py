@@ -1,18 +1,38 @@
 from fastapi import FastAPI, Body, Query, Request, Response, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 from typing import List, Dict, Any, Tuple, Optional
 import socket
+import ssl
+import struct
 import ipaddress
 import time
 import requests
+import hashlib
+import base64
+from requests.adapters import HTTPAdapter
+from http.cookiejar import DefaultCookiePolicy
 import datetime
 import xml.etree.ElementTree as ET
+import http.client
+import urllib.parse
 
 import json
 import re
 import os
+import sys
+import threading
+import uuid
+import itertools
+import zlib
+import math
+import random
+import shlex
+import queue
+import multiprocessing
 from pathlib import Path
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, as_completed, wait
 from prometheus_fastapi_instrumentator import Instrumentator
 from opentelemetry import trace
 from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
@@ -35,6 +55,10 @@ try:
     import psycopg
 except Exception:
     psycopg = None
+try:
+    from cryptography import x509
+except Exception:
+    x509 = None
 
 app = FastAPI(title="CMM Analytics API")
 
@@ -71,6 +95,133 @@ def health():
 def performance():
     return {"summary": {"requests_per_min": 120, "avg_latency_ms": 85}}
 
+# ----------------------
+# Shared HTTP client (keep-alive pools for probes and upstream APIs)
+# ----------------------
+
+HTTP_POOL_HOSTS = int(os.environ.get("HTTP_POOL_HOSTS", "256"))  # pools por host mantidos (LRU)
+HTTP_POOL_MAXSIZE = int(os.environ.get("HTTP_POOL_MAXSIZE", "8"))  # conexões ociosas guardadas por host
+
+
+def make_http_session() -> requests.Session:
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=HTTP_POOL_HOSTS, pool_maxsize=HTTP_POOL_MAXSIZE, max_retries=0)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    # Sessão compartilhada entre hosts: não guarda cookies de um alvo para outro
+    session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+    return session
+
+
+HTTP_SESSION = make_http_session()
+
+
+HTTP_PROBE_MAX_BYTES = int(os.environ.get("HTTP_PROBE_MAX_BYTES", "65536"))  # teto padrão por sonda
+HTTP_PROBE_MAX_TIME = float(os.environ.get("HTTP_PROBE_MAX_TIME", "5"))  # segundos por sonda (total)
+HTTP_PROBE_CHUNK = 8192
+
+
+def http_iter_bounded(r: requests.Response, timeout: float, deadline: float):
+    """Body chunks of a streamed response until EOF; yields None once when the deadline passes.
+    Each socket read waits at most the time left, and read1 returns after a single read,
+    so a server trickling bytes cannot hold the caller past the deadline.
+    """
+    sock = getattr(getattr(r.raw, "connection", None), "sock", None)
+    read = getattr(r.raw, "read1", None) or r.raw.read
+    while True:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            yield None
+            return
+        if sock is not None:
+            sock.settimeout(min(timeout, remaining))
+        try:
+            chunk = read(HTTP_PROBE_CHUNK, decode_content=True)
+        except Exception as e:
+            if time.time() >= deadline:
+                yield None
+                return
+            raise requests.exceptions.ConnectionError(e)
+        if not chunk:
+            return
+        yield chunk
+
+
+def http_get_bounded(url: str, timeout: float = 0.8, max_bytes: int = HTTP_PROBE_MAX_BYTES,
+                     max_time: float = HTTP_PROBE_MAX_TIME, verify: bool = True) -> Dict[str, Any]:
+    """GET that streams the body and stops at max_bytes or max_time.
+    A fully read response returns its connection to the pool; a truncated one is closed.
+    Connection errors propagate like requests.get.
+    """
+    deadline = time.time() + max_time
+    r = HTTP_SESSION.get(url, timeout=timeout, verify=verify, stream=True)
+    chunks: List[bytes] = []
+    size = 0
+    truncated = False
+    try:
+        for chunk in http_iter_bounded(r, timeout, deadline):
+            if chunk is None:
+                truncated = True
+                break
+            chunks.append(chunk)
+            size += len(chunk)
+            if size >= max_bytes:
+                truncated = True
+                break
+    finally:
+        r.close()
+    body = b"".join(chunks)
+    if len(body) > max_bytes:
+        body = body[:max_bytes]
+    return {
+        "status_code": r.status_code,
+        "headers": r.headers,
+        "body": body,
+        "text": body.decode(r.encoding or "utf-8", errors="replace"),
+        "truncated": truncated,
+    }
+
+
+def bounded_json(resp: Dict[str, Any]) -> Any:
+    """JSON body of an http_get_bounded response, or None when truncated or invalid."""
+    if resp["truncated"]:
+        return None
+    try:
+        return json.loads(resp["body"])
+    except Exception:
+        return None
+
+
+def http_pool_stats() -> Dict[str, Any]:
+    """Connection reuse per host pool (requests served vs. connections opened)."""
+    pools: List[Dict[str, Any]] = []
+    for adapter in {id(a): a for a in HTTP_SESSION.adapters.values()}.values():
+        manager = adapter.poolmanager
+        for key in list(manager.pools.keys()):
+            pool = manager.pools.get(key)
+            if pool is None:
+                continue
+            pools.append({
+                "scheme": pool.scheme,
+                "host": pool.host,
+                "port": pool.port,
+                "connections_opened": pool.num_connections,
+                "requests": pool.num_requests,
+                "idle": pool.pool.qsize() if pool.pool is not None else 0,
+            })
+    opened = sum(p["connections_opened"] for p in pools)
+    served = sum(p["requests"] for p in pools)
+    return {
+        "pool_hosts": HTTP_POOL_HOSTS,
+        "pool_maxsize": HTTP_POOL_MAXSIZE,
+        "pools": len(pools),
+        "connections_opened": opened,
+        "requests": served,
+        "reused": max(0, served - opened),
+        "hosts": sorted(pools, key=lambda p: p["requests"], reverse=True),
+    }
+
+
 # ----------------------
 # IA Proxy - Google Gemini
 # ----------------------
@@ -124,7 +275,7 @@ async def ai_gemini_chat(request: Request, model: str = Query("gemini-1.5-pro-la
         f"https://generativelanguage.googleapis.com/v1beta/models/{resolved_model}:generateContent?key={GEMINI_API_KEY}"
     )
     try:
-        r = requests.post(endpoint, json=payload, timeout=30)
+        r = HTTP_SESSION.post(endpoint, json=payload, timeout=30)
     except Exception as e:
         raise HTTPException(status_code=502, detail=f"Upstream error: {e}")
 
@@ -337,6 +488,13 @@ def ensure_pg_extensions():
 def _startup_init():
     ensure_pg_extensions()
     ensure_pg_schema()
+    pg_fail_interrupted_discovery_jobs()
+    if DOCKER_WATCH_ENABLED:
+        threading.Thread(target=docker_watch_autostart, name="docker-watch-autostart", daemon=True).start()
+    if DOCKER_STATS_INTERVAL > 0:
+        threading.Thread(target=docker_stats_loop, name="docker-stats", daemon=True).start()
+    if AGENTLESS_ENABLED:
+        threading.Thread(target=agentless_autostart, name="agentless-autostart", daemon=True).start()
 
 def ensure_pg_schema():
     conn = get_pg_conn()
@@ -402,9 +560,28 @@ def ensure_pg_schema():
                     metric_labels JSONB DEFAULT '{}'::jsonb,
                     value DOUBLE PRECISION NOT NULL,
                     ts TIMESTAMPTZ DEFAULT NOW(),
-                    UNIQUE(device_id, metric_name, ts)
+                    UNIQUE(device_id, metric_name, metric_labels, ts)
                 )
             ''')
+            # Séries por container/rótulo no mesmo instante: a unicidade antiga ignorava os rótulos.
+            # Migração única: só altera a tabela quando o catálogo ainda mostra a chave antiga.
+            cur.execute('''
+                SELECT
+                    EXISTS (SELECT 1 FROM pg_constraint
+                            WHERE conrelid = '"AUTOMACAO"."Metrics"'::regclass
+                              AND conname = 'Metrics_device_id_metric_name_ts_key'),
+                    to_regclass('"AUTOMACAO"."Metrics_device_metric_labels_ts"') IS NOT NULL
+            ''')
+            legacy_key, legacy_index = cur.fetchone()
+            if legacy_key:
+                cur.execute('''
+                    ALTER TABLE "AUTOMACAO"."Metrics"
+                        DROP CONSTRAINT "Metrics_device_id_metric_name_ts_key",
+                        ADD CONSTRAINT "Metrics_device_id_metric_name_metric_labels_ts_key"
+                            UNIQUE (device_id, metric_name, metric_labels, ts)
+                ''')
+            if legacy_index:
+                cur.execute('DROP INDEX "AUTOMACAO"."Metrics_device_metric_labels_ts";')
             cur.execute('''
                 CREATE TABLE IF NOT EXISTS "AUTOMACAO"."Events" (
                     id BIGSERIAL PRIMARY KEY,
@@ -420,6 +597,67 @@ def ensure_pg_schema():
             ''')
             cur.execute('ALTER TABLE IF NOT EXISTS "AUTOMACAO"."Events" ADD COLUMN IF NOT EXISTS actor VARCHAR(128);')
             cur.execute('ALTER TABLE IF NOT EXISTS "AUTOMACAO"."Events" ADD COLUMN IF NOT EXISTS source VARCHAR(64);')
+            cur.execute('''
+                CREATE TABLE IF NOT EXISTS "AUTOMACAO"."DiscoveryJobs" (
+                    id VARCHAR(64) PRIMARY KEY,
+                    kind VARCHAR(32) DEFAULT 'network',
+                    status VARCHAR(32) NOT NULL,
+                    target VARCHAR(255),
+                    method VARCHAR(64),
+                    params JSONB DEFAULT '{}'::jsonb,
+                    total INTEGER DEFAULT 0,
+                    done INTEGER DEFAULT 0,
+                    results JSONB DEFAULT '[]'::jsonb,
+                    error TEXT,
+                    created_at TIMESTAMPTZ DEFAULT NOW(),
+                    started_at TIMESTAMPTZ,
+                    finished_at TIMESTAMPTZ,
+                    updated_at TIMESTAMPTZ DEFAULT NOW()
+                )
+            ''')
+            cur.execute('''
+                CREATE TABLE IF NOT EXISTS "AUTOMACAO"."Containers" (
+                    id SERIAL PRIMARY KEY,
+                    device_id INTEGER REFERENCES "AUTOMACAO"."Devices"(id) ON DELETE CASCADE,
+                    container_id VARCHAR(128) NOT NULL,
+                    name VARCHAR(255),
+                    image VARCHAR(512),
+                    state VARCHAR(32),
+                    status VARCHAR(255),
+                    ports JSONB DEFAULT '[]'::jsonb,
+                    labels JSONB DEFAULT '{}'::jsonb,
+                    first_seen TIMESTAMPTZ DEFAULT NOW(),
+                    last_seen TIMESTAMPTZ DEFAULT NOW(),
+                    updated_at TIMESTAMPTZ DEFAULT NOW(),
+                    UNIQUE(device_id, container_id)
+                )
+            ''')
+            cur.execute('''
+                CREATE TABLE IF NOT EXISTS "AUTOMACAO"."ScanProfiles" (
+                    name VARCHAR(64) PRIMARY KEY,
+                    description TEXT,
+                    ports JSONB NOT NULL,
+                    timeouts JSONB DEFAULT '{}'::jsonb,
+                    default_timeout DOUBLE PRECISION DEFAULT 0.35,
+                    port_order VARCHAR(16) DEFAULT 'learned',
+                    early_stop JSONB,
+                    created_at TIMESTAMPTZ DEFAULT NOW(),
+                    updated_at TIMESTAMPTZ DEFAULT NOW()
+                )
+            ''')
+            cur.execute('''
+                CREATE TABLE IF NOT EXISTS "AUTOMACAO"."SshKnownHosts" (
+                    host VARCHAR(255) NOT NULL,
+                    port INTEGER NOT NULL DEFAULT 22,
+                    key_type VARCHAR(64) NOT NULL,
+                    key_data TEXT NOT NULL,
+                    fingerprint VARCHAR(128),
+                    first_seen TIMESTAMPTZ DEFAULT NOW(),
+                    last_seen TIMESTAMPTZ DEFAULT NOW(),
+                    changed_at TIMESTAMPTZ,
+                    PRIMARY KEY (host, port, key_type)
+                )
+            ''')
         conn.close()
         return True
     except Exception:
@@ -488,6 +726,37 @@ def record_metric(ip: str, metric: str, value: float, ts: int | None = None):
         except Exception:
             pass
 
+def record_metrics_batch(ip: str, samples: List[Tuple[str, float, Dict[str, Any], Optional[int]]]) -> int:
+    """Persist many (metric, value, labels, ts) samples for one host in a single round trip.
+    Returns how many samples were sent (0 when the device or PostgreSQL is unavailable).
+    """
+    if not samples:
+        return 0
+    ensure_pg_schema()
+    device = pg_get_device(ip=ip)
+    if not device:
+        return 0
+    conn = get_pg_conn()
+    if not conn:
+        return 0
+    now = int(time.time())
+    try:
+        with conn.cursor() as cur:
+            cur.executemany('''
+                INSERT INTO "AUTOMACAO"."Metrics" (device_id, metric_name, metric_labels, value, ts)
+                VALUES (%s, %s, %s::jsonb, %s, to_timestamp(%s))
+                ON CONFLICT DO NOTHING
+            ''', [(device["id"], metric, json.dumps(labels or {}, sort_keys=True), float(value), int(ts or now))
+                  for metric, value, labels, ts in samples])
+        return len(samples)
+    except Exception:
+        return 0
+    finally:
+        try:
+            conn.close()
+        except Exception:
+            pass
+
 def get_series(ip: str, metric: str, limit: int = 60) -> List[Dict[str, Any]]:
     ensure_pg_schema()
     conn = get_pg_conn()
@@ -516,6 +785,80 @@ def get_series(ip: str, metric: str, limit: int = 60) -> List[Dict[str, Any]]:
     return [{"time": time.strftime("%H:%M:%S", time.localtime(int(row[1]))), "value": float(row[0])} for row in rows]
 
 
+# ----------------------
+# Probe cache (shared across discovery endpoints)
+# ----------------------
+
+PROBE_CACHE_TTL = float(os.environ.get("PROBE_CACHE_TTL", "60"))  # segundos, resultados positivos
+PROBE_CACHE_NEGATIVE_TTL = float(os.environ.get("PROBE_CACHE_NEGATIVE_TTL", "30"))  # portas fechadas/sondas sem resposta
+PROBE_CACHE_MAX_ENTRIES = int(os.environ.get("PROBE_CACHE_MAX_ENTRIES", "50000"))
+PROBE_CACHE: "OrderedDict[Tuple[str, int, str], Tuple[float, Any]]" = OrderedDict()  # key -> (expires_at, value)
+PROBE_CACHE_LOCK = threading.Lock()
+PROBE_CACHE_STATS = {"hits": 0, "misses": 0, "evictions": 0}
+
+
+def probe_is_negative(value: Any) -> bool:
+    """Closed port (False) or a probe dict that found nothing."""
+    if value is None or value is False:
+        return True
+    if isinstance(value, dict):
+        return not (value.get("reachable") or value.get("present"))
+    return False
+
+
+def probe_cache_get(ip: str, port: int, kind: str) -> Tuple[bool, Any]:
+    key = (ip, int(port), kind)
+    with PROBE_CACHE_LOCK:
+        entry = PROBE_CACHE.get(key)
+        if entry is None:
+            PROBE_CACHE_STATS["misses"] += 1
+            return False, None
+        if entry[0] < time.time():
+            del PROBE_CACHE[key]
+            PROBE_CACHE_STATS["misses"] += 1
+            return False, None
+        PROBE_CACHE.move_to_end(key)
+        PROBE_CACHE_STATS["hits"] += 1
+        return True, entry[1]
+
+
+def probe_cache_put(ip: str, port: int, kind: str, value: Any, ttl: Optional[float] = None) -> None:
+    if ttl is None:
+        ttl = PROBE_CACHE_NEGATIVE_TTL if probe_is_negative(value) else PROBE_CACHE_TTL
+    if ttl <= 0:
+        return
+    key = (ip, int(port), kind)
+    with PROBE_CACHE_LOCK:
+        PROBE_CACHE[key] = (time.time() + ttl, value)
+        PROBE_CACHE.move_to_end(key)
+        while len(PROBE_CACHE) > PROBE_CACHE_MAX_ENTRIES:
+            PROBE_CACHE.popitem(last=False)
+            PROBE_CACHE_STATS["evictions"] += 1
+
+
+def probe_cache_invalidate(ip: Optional[str] = None) -> int:
+    with PROBE_CACHE_LOCK:
+        if ip is None:
+            removed = len(PROBE_CACHE)
+            PROBE_CACHE.clear()
+            return removed
+        keys = [k for k in PROBE_CACHE if k[0] == ip]
+        for k in keys:
+            del PROBE_CACHE[k]
+        return len(keys)
+
+
+def cached_probe(ip: str, port: int, kind: str, fn, fresh: bool = False) -> Any:
+    """Return a cached probe result for (ip, port, kind), running fn() on miss or when fresh=True."""
+    if not fresh:
+        hit, value = probe_cache_get(ip, port, kind)
+        if hit:
+            return value
+    value = fn()
+    probe_cache_put(ip, port, kind, value)
+    return value
+
+
 def tcp_check(ip: str, port: int, timeout: float = 0.35) -> bool:
     try:
         with socket.create_connection((ip, port), timeout=timeout):
@@ -524,34 +867,176 @@ def tcp_check(ip: str, port: int, timeout: float = 0.35) -> bool:
         return False
 
 
-def reverse_dns(ip: str) -> str:
+FINGERPRINT_BANNER_WAIT = float(os.environ.get("FINGERPRINT_BANNER_WAIT", "0.3"))  # espera por banner passivo
+FINGERPRINT_BANNER_BYTES = 1024
+# Portas em que o servidor fala primeiro (assinaturas de FINGERPRINT_PASSIVE: SSH, FTP, SMTP, POP3/IMAP,
+# MySQL, VNC, autenticação VMware). Só nelas a varredura e o fingerprint esperam pelo banner.
+FINGERPRINT_BANNER_PORTS = {21, 22, 25, 110, 143, 587, 902, 2222, 3306, 5900, 5901, 8022}
+
+
+def tcp_check_banner(ip: str, port: int, timeout: float = 0.35) -> bool:
+    """tcp_check that, on ports in FINGERPRINT_BANNER_PORTS, keeps the scan connection briefly
+    to capture a server-first banner.
+    """
+    if port not in FINGERPRINT_BANNER_PORTS:
+        return tcp_check(ip, port, timeout)
+    try:
+        with socket.create_connection((ip, port), timeout=timeout) as s:
+            s.settimeout(FINGERPRINT_BANNER_WAIT)
+            try:
+                banner = s.recv(FINGERPRINT_BANNER_BYTES)
+            except Exception:
+                banner = b""
+    except Exception:
+        return False
+    probe_cache_put(ip, port, "banner", banner.decode("latin-1"))
+    return True
+
+
+# ----------------------
+# DNS resolution (cached, off the scan critical path)
+# ----------------------
+
+DNS_CACHE_TTL = float(os.environ.get("DNS_CACHE_TTL", "300"))
+DNS_NEGATIVE_TTL = float(os.environ.get("DNS_NEGATIVE_TTL", "60"))
+DNS_LOOKUP_TIMEOUT = float(os.environ.get("DNS_LOOKUP_TIMEOUT", "1.0"))  # prazo por consulta
+DNS_RESOLVER_WORKERS = int(os.environ.get("DNS_RESOLVER_WORKERS", "32"))
+DNS_EXECUTOR = ThreadPoolExecutor(max_workers=max(1, DNS_RESOLVER_WORKERS), thread_name_prefix="dns")
+DNS_INFLIGHT: Dict[Tuple[str, str], Future] = {}
+DNS_INFLIGHT_LOCK = threading.Lock()
+
+
+def _dns_lookup(kind: str, name: str) -> Optional[str]:
+    try:
+        if kind == "rdns":
+            value: Optional[str] = socket.gethostbyaddr(name)[0]
+        else:
+            value = socket.gethostbyname(name)
+    except Exception:
+        value = None
+    probe_cache_put(name, 0, kind, value, DNS_CACHE_TTL if value else DNS_NEGATIVE_TTL)
+    with DNS_INFLIGHT_LOCK:
+        DNS_INFLIGHT.pop((kind, name), None)
+    return value
+
+
+def dns_lookup_async(kind: str, name: str) -> Future:
+    """Start (or join) a cached lookup; kind is "rdns" (ip -> name) or "dns" (name -> ip)."""
+    hit, value = probe_cache_get(name, 0, kind)
+    if hit:
+        done: Future = Future()
+        done.set_result(value)
+        return done
+    with DNS_INFLIGHT_LOCK:
+        fut = DNS_INFLIGHT.get((kind, name))
+        if fut is None:
+            fut = DNS_EXECUTOR.submit(_dns_lookup, kind, name)
+            DNS_INFLIGHT[(kind, name)] = fut
+        return fut
+
+
+def dns_result(fut: Future, timeout: float = DNS_LOOKUP_TIMEOUT) -> Optional[str]:
+    """Wait at most `timeout` for a lookup; a late answer still lands in the cache."""
+    try:
+        return fut.result(timeout=max(0.0, timeout))
+    except Exception:
+        return None
+
+
+def reverse_dns(ip: str, timeout: float = DNS_LOOKUP_TIMEOUT) -> str:
+    return dns_result(dns_lookup_async("rdns", ip), timeout) or ip
+
+
+def resolve_host(name: Optional[str], timeout: float = DNS_LOOKUP_TIMEOUT) -> Optional[str]:
+    """Forward resolution with cache; IP literals are returned as-is."""
+    if not name:
+        return None
     try:
-        return socket.gethostbyaddr(ip)[0]
+        return str(ipaddress.ip_address(name.strip()))
     except Exception:
-        return ip
+        pass
+    return dns_result(dns_lookup_async("dns", name.strip()), timeout)
 
 
-def scan_ports(ip: str, ports: List[int]) -> Dict[int, bool]:
+def scan_ports(ip: str, ports: List[int], fresh: bool = False, banners: bool = False,
+               profile: Optional[Dict[str, Any]] = None, info: Optional[Dict[str, Any]] = None) -> Dict[int, bool]:
+    """TCP connect scan. With a resolved scan profile, ports are tried in its learned order with
+    per-port timeouts, and the scan ends early once its earlyStop rule holds (unscanned ports are
+    absent from the result). `info`, when given, receives scan statistics.
+    """
+    started = time.time()
     results: Dict[int, bool] = {}
-    with ThreadPoolExecutor(max_workers=64) as executor:
-        future_map = {executor.submit(tcp_check, ip, p): p for p in ports}
-        for fut in as_completed(future_map):
-            port = future_map[fut]
-            try:
-                results[port] = fut.result()
-            except Exception:
-                results[port] = False
-    return results
+    pending: List[int] = []
+    for p in ports:
+        hit, value = (False, None) if fresh else probe_cache_get(ip, p, "tcp")
+        if hit:
+            results[p] = bool(value)
+        else:
+            pending.append(p)
+    rule = profile.get("earlyStop") if profile else None
+    open_set = {p for p, ok in results.items() if ok}
+    stopped = scan_early_stop(rule, open_set)
+    first_open: Optional[float] = 0.0 if open_set else None
+    if pending and not stopped:
+        timeouts: Dict[int, float] = {}
+        default_timeout = SCAN_DEFAULT_TIMEOUT
+        if profile:
+            rank = profile.get("scanRank") or {}
+            pending.sort(key=lambda p: rank.get(p, len(rank)))
+            timeouts = profile.get("timeouts") or {}
+            default_timeout = profile.get("defaultTimeout", SCAN_DEFAULT_TIMEOUT)
+        check = tcp_check_banner if banners else tcp_check
+        executor = ThreadPoolExecutor(max_workers=64)
+        try:
+            future_map = {executor.submit(check, ip, p, timeouts.get(p, default_timeout)): p for p in pending}
+            for fut in as_completed(future_map):
+                port = future_map[fut]
+                try:
+                    results[port] = fut.result()
+                except Exception:
+                    results[port] = False
+                probe_cache_put(ip, port, "tcp", results[port])
+                if results[port]:
+                    open_set.add(port)
+                    if first_open is None:
+                        first_open = time.time() - started
+                    if scan_early_stop(rule, open_set):
+                        stopped = True
+                        break
+        finally:
+            executor.shutdown(wait=not stopped, cancel_futures=stopped)
+    if info is not None:
+        info.update({
+            "profile": profile.get("name") if profile else None,
+            "scanned": len(results),
+            "skipped": len(ports) - len(results),
+            "early_stop": stopped,
+            "first_open_ms": round(first_open * 1000, 1) if first_open is not None else None,
+            "elapsed_ms": round((time.time() - started) * 1000, 1),
+        })
+        if stopped:
+            info["unscanned"] = [p for p in ports if p not in results]
+    # Ordem estável: a mesma da lista de portas pedida
+    return {p: results[p] for p in ports if p in results}
+
+
+NODE_EXPORTER_MAX_BYTES = int(os.environ.get("NODE_EXPORTER_MAX_BYTES", str(4 * 1024 * 1024)))
+DOCKER_API_MAX_BYTES = int(os.environ.get("DOCKER_API_MAX_BYTES", str(2 * 1024 * 1024)))
+DOCKER_LOGS_MAX_BYTES = int(os.environ.get("DOCKER_LOGS_MAX_BYTES", "65536"))
 
 
 def probe_node_exporter(ip: str, timeout: float = 0.8) -> Dict[str, Any]:
     url = f"http://{ip}:9100/metrics"
     info: Dict[str, Any] = {"present": False}
     try:
-        resp = requests.get(url, timeout=timeout)
-        if resp.status_code == 200 and "node_" in resp.text:
+        resp = http_get_bounded(url, timeout=timeout, max_bytes=NODE_EXPORTER_MAX_BYTES)
+        if resp["status_code"] == 200 and "node_" in resp["text"]:
             info["present"] = True
-            lines = [ln for ln in resp.text.splitlines() if ln and not ln.startswith('#')]
+            lines = [ln for ln in resp["text"].splitlines() if ln and not ln.startswith('#')]
+            if resp["truncated"] and lines:
+                # última linha pode ter sido cortada no meio
+                lines.pop()
+                info["truncated"] = True
 
             def parse_simple_value(name: str) -> float | None:
                 for ln in lines:
@@ -648,176 +1133,934 @@ def probe_node_exporter(ip: str, timeout: float = 0.8) -> Dict[str, Any]:
     return info
 
 
-def probe_docker(ip: str, timeout: float = 1.5) -> Dict[str, Any]:
+def docker_api_container(c: Dict[str, Any]) -> Dict[str, Any]:
+    """Entry of /containers/json in the shape returned by /api/discovery/docker."""
+    # Classificar serviços a partir das portas expostas
+    svc_tags: List[str] = []
+    try:
+        ports = c.get("Ports")
+        if isinstance(ports, list):
+            for p in ports:
+                pub = p.get("PublicPort")
+                priv = p.get("PrivatePort")
+                num = pub or priv
+                if isinstance(num, int):
+                    svc = SERVICE_MAP.get(num, f"port-{num}")
+                    svc_tags.append(f"{svc}:{num}")
+    except Exception:
+        pass
+    return {
+        "id": c.get("Id"),
+        "name": (c.get("Names") or [None])[0],
+        "image": c.get("Image"),
+        "state": c.get("State"),
+        "status": c.get("Status"),
+        "ports": c.get("Ports"),
+        "labels": c.get("Labels"),
+        "services_classified": svc_tags,
+        "running": c.get("State") == "running",
+    }
+
+
+def probe_docker(ip: str, timeout: float = 1.5, closed_ports: Optional[set] = None) -> Dict[str, Any]:
+    """Docker Engine API / metrics / Portainer hint. Endpoints on closed_ports are not attempted."""
+    closed = closed_ports or set()
     result: Dict[str, Any] = {"present": False}
     bases = [
-        (f"http://{ip}:2375", False),
-        (f"https://{ip}:2376", True),
+        (f"http://{ip}:2375", False, 2375),
+        (f"https://{ip}:2376", True, 2376),
     ]
-    for base, is_https in bases:
+    for base, is_https, base_port in bases:
+        if base_port in closed:
+            continue
         try:
-            v = requests.get(base + "/version", timeout=timeout, verify=False if is_https else True)
-            if v.status_code == 200:
+            v = http_get_bounded(base + "/version", timeout=timeout, max_bytes=DOCKER_API_MAX_BYTES, verify=not is_https)
+            if v["status_code"] == 200:
                 result["present"] = True
-                result["version"] = v.json()
-                info = requests.get(base + "/info", timeout=timeout, verify=False if is_https else True)
-                if info.status_code == 200:
-                    result["info"] = info.json()
-                containers = requests.get(base + "/containers/json?all=0", timeout=timeout, verify=False if is_https else True)
-                if containers.status_code == 200:
-                    conts = containers.json()
+                result["version"] = bounded_json(v)
+                info = http_get_bounded(base + "/info", timeout=timeout, max_bytes=DOCKER_API_MAX_BYTES, verify=not is_https)
+                if info["status_code"] == 200:
+                    result["info"] = bounded_json(info)
+                containers = http_get_bounded(base + "/containers/json?all=1", timeout=timeout,
+                                              max_bytes=DOCKER_API_MAX_BYTES, verify=not is_https)
+                conts = bounded_json(containers) if containers["status_code"] == 200 else None
+                if isinstance(conts, list):
                     result["containers"] = []
                     for c in conts:
-                        cid = c.get("Id")
-                        name = (c.get("Names") or [None])[0]
-                        logs = None
-                        try:
-                            lg = requests.get(base + f"/containers/{cid}/logs?stdout=1&stderr=1&tail=100", timeout=timeout, verify=False if is_https else True)
-                            if lg.status_code == 200:
-                                logs = lg.text[-4000:]
-                        except Exception:
-                            logs = None
-                        # Classificar serviços a partir das portas expostas
-                        svc_tags: List[str] = []
-                        try:
-                            ports = c.get("Ports")
-                            if isinstance(ports, list):
-                                for p in ports:
-                                    pub = p.get("PublicPort")
-                                    priv = p.get("PrivatePort")
-                                    num = pub or priv
-                                    if isinstance(num, int):
-                                        svc = SERVICE_MAP.get(num, f"port-{num}")
-                                        svc_tags.append(f"{svc}:{num}")
-                        except Exception:
-                            pass
-                        result["containers"].append({
-                            "id": cid,
-                            "name": name,
-                            "image": c.get("Image"),
-                            "state": c.get("State"),
-                            "status": c.get("Status"),
-                            "ports": c.get("Ports"),
-                            "labels": c.get("Labels"),
-                            "logs_tail": logs,
-                            "services_classified": svc_tags,
-                        })
+                        result["containers"].append(docker_api_container(c))
                 # Se obtivemos dados via API, não precisa testar outras bases
                 break
         except Exception:
             continue
     # Fallback: tentar métricas do Docker Engine
     try:
-        m = requests.get(f"http://{ip}:9323/metrics", timeout=timeout)
-        if m.status_code == 200 and ("engine_daemon" in m.text or "dockerd" in m.text):
-            result["present"] = True
-            result["metrics_present"] = True
+        if 9323 not in closed:
+            m = http_get_bounded(f"http://{ip}:9323/metrics", timeout=timeout)
+            if m["status_code"] == 200 and ("engine_daemon" in m["text"] or "dockerd" in m["text"]):
+                result["present"] = True
+                result["metrics_present"] = True
     except Exception:
         pass
     # Fallback adicional: detectar Portainer em 9443 apenas como dica, sem marcar presença
     try:
-        https_probe = probe_https(ip, 9443)
-        text = (https_probe.get("text_snippet") or "").lower()
-        server = (https_probe.get("server") or "").lower()
-        if ("portainer" in text) or ("portainer" in server):
-            result["hint_portainer"] = True
+        if 9443 not in closed:
+            if fingerprint_port(ip, 9443).get("service") == "portainer":
+                result["hint_portainer"] = True
     except Exception:
         pass
     return result
 
 
-def probe_http(ip: str, port: int, timeout: float = 0.8) -> Dict[str, Any]:
-    url = f"http://{ip}:{port}/"
+# ----------------------
+# Service fingerprinting (probe/match table)
+# ----------------------
+
+FINGERPRINT_TIMEOUT = float(os.environ.get("FINGERPRINT_TIMEOUT", "0.8"))
+FINGERPRINT_READ_BYTES = int(os.environ.get("FINGERPRINT_READ_BYTES", "4096"))  # leitura máxima por sonda
+FINGERPRINT_MAX_PROBES = int(os.environ.get("FINGERPRINT_MAX_PROBES", "3"))  # sondas ativas por porta
+FINGERPRINT_WORKERS = int(os.environ.get("FINGERPRINT_WORKERS", "16"))
+FINGERPRINT_MIN_CONFIDENCE = float(os.environ.get("FINGERPRINT_MIN_CONFIDENCE", "0.7"))
+FINGERPRINT_PASSIVE_BANNERS = os.environ.get("FINGERPRINT_PASSIVE_BANNERS", "1") == "1"
+FINGERPRINT_HOST_DEADLINE = float(os.environ.get("FINGERPRINT_HOST_DEADLINE", "3"))  # prazo por host (0 = sem prazo)
+
+
+def _fp(service: str, pattern: bytes, product: str = "", version: str = "", confidence: float = 0.9,
+        ports: Optional[List[int]] = None, extract=None) -> Dict[str, Any]:
+    """One match rule: regex over the response; product/version are \\N templates or extract(data, m)."""
+    return {"service": service, "pattern": re.compile(pattern, re.S), "product": product, "version": version,
+            "confidence": confidence, "ports": ports, "extract": extract}
+
+
+def _tds_prelogin() -> bytes:
+    # PRELOGIN com as opções VERSION e ENCRYPTION (não suportada)
+    body = b"\x00" + struct.pack(">HH", 11, 6) + b"\x01" + struct.pack(">HH", 17, 1) + b"\xff" + b"\x00" * 6 + b"\x02"
+    return b"\x12\x01" + struct.pack(">H", 8 + len(body)) + b"\x00\x00\x00\x00" + body
+
+
+def _tds_version(data: bytes, m) -> Optional[str]:
+    body = data[8:]
+    i = 0
+    while i + 5 <= len(body) and body[i] != 0xFF:
+        token, offset, length = body[i], *struct.unpack(">HH", body[i + 1:i + 5])
+        if token == 0x00 and length >= 4 and offset + 4 <= len(body):
+            major, minor, build = body[offset], body[offset + 1], struct.unpack(">H", body[offset + 2:offset + 4])[0]
+            return f"{major}.{minor}.{build}"
+        i += 5
+    return None
+
+
+def _mongo_ismaster() -> bytes:
+    doc = b"\x10isMaster\x00" + struct.pack("<i", 1) + b"\x00"
+    doc = struct.pack("<i", len(doc) + 4) + doc
+    body = struct.pack("<i", 0) + b"admin.$cmd\x00" + struct.pack("<ii", 0, -1) + doc
+    return struct.pack("<iiii", 16 + len(body), 1, 0, 2004) + body  # OP_QUERY
+
+
+# Banners enviados pelo servidor assim que a conexão abre (lidos na própria conexão da varredura)
+FINGERPRINT_PASSIVE: List[Dict[str, Any]] = [
+    _fp("ssh", rb"^SSH-[\d.]+-OpenSSH_([\w.]+)", "OpenSSH", r"\1", 0.95),
+    _fp("ssh", rb"^SSH-[\d.]+-dropbear_([\w.]+)", "Dropbear", r"\1", 0.95),
+    _fp("ssh", rb"^SSH-[\d.]+-([^\s]+)", r"\1", "", 0.85),
+    _fp("vmware-vim", rb"^220 VMware Authentication Daemon Version ([\d.]+)", "VMware Authentication Daemon", r"\1", 0.95),
+    _fp("mysql", rb"^.\x00\x00\x00\x0a(?:5\.5\.5-)?([\d.]+)-MariaDB", "MariaDB", r"\1", 0.95),
+    _fp("mysql", rb"^.\x00\x00\x00\x0a([\d.]+)[^\x00]*\x00", "MySQL", r"\1", 0.9),
+    _fp("mysql", rb"^.\x00\x00\x00\xff..Host .{0,80} is not allowed to connect to this (MySQL|MariaDB) server", r"\1", "", 0.85),
+    _fp("ftp", rb"^220[ -][^\r\n]*?(vsFTPd|ProFTPD|FileZilla Server|Pure-FTPd)[ v]*([\d.]*)", r"\1", r"\2", 0.9),
+    _fp("smtp", rb"^220[ -][^\r\n]*?\b(Postfix|Exim|Sendmail|Microsoft ESMTP MAIL Service)[ /]?([\d.]*)", r"\1", r"\2", 0.9),
+    _fp("smtp", rb"^220[ -][^\r\n]*E?SMTP", "", "", 0.8),
+    _fp("ftp", rb"^220[ -][^\r\n]*(?i:ftp)", "", "", 0.8),
+    _fp("vnc", rb"^RFB (\d{3}\.\d{3})\n", "VNC", r"\1", 0.9),
+    _fp("imap", rb"^\* OK", "", "", 0.7),
+    _fp("pop3", rb"^\+OK", "", "", 0.6),
+]
+
+FINGERPRINT_HTTP: List[Dict[str, Any]] = [
+    _fp("docker-api", rb'\{.*?"Version"\s*:\s*"([^"]+)".*"ApiVersion"', "Docker Engine", r"\1", 0.95),
+    _fp("portainer", rb"(?i)portainer", "Portainer", "", 0.9),
+    _fp("grafana", rb"(?i)<title>Grafana", "Grafana", "", 0.9),
+    _fp("node-exporter", rb"(?i)<title>Node Exporter", "Prometheus Node Exporter", "", 0.9),
+    _fp("prometheus", rb"(?i)<title>Prometheus", "Prometheus", "", 0.9),
+    _fp("elasticsearch", rb'"cluster_name"\s*:.*?"number"\s*:\s*"([\d.]+)"', "Elasticsearch", r"\1", 0.95),
+    _fp("kibana", rb"(?i)kbn-name:", "Kibana", "", 0.9),
+    _fp("rabbitmq-admin", rb"(?i)<title>RabbitMQ Management", "RabbitMQ Management", "", 0.9),
+    _fp("winrm", rb"^HTTP/\d\.\d \d{3}[^\r\n]*\r\n(?:[^\r\n]*\r\n)*?Server:[ \t]*Microsoft-HTTPAPI/([\d.]+)",
+        "Microsoft WinRM", r"\1", 0.85, ports=[5985, 5986]),
+    _fp("http", rb"^HTTP/\d\.\d \d{3}[^\r\n]*\r\n(?:[^\r\n]*\r\n)*?(?i:server):[ \t]*([^\r\n/ ]+)(?:/([^\s]+))?", r"\1", r"\2", 0.85),
+    _fp("http", rb"^HTTP/\d\.\d \d{3}", "", "", 0.7),
+]
+
+_HTTP_GET = b"GET / HTTP/1.0\r\nHost: {host}\r\nUser-Agent: itfact-discovery\r\nAccept: */*\r\nConnection: close\r\n\r\n"
+_HTTP_PORTS = [80, 3000, 3001, 4000, 4001, 5000, 5001, 5601, 7001, 8000, 8001, 8080, 8081, 8082, 8090, 8181, 8888,
+               9090, 9091, 9093, 9094, 9100, 9200, 15672, 5985]
+_HTTPS_PORTS = [443, 8443, 8880, 9443, 9440, 5480, 5986]
+
+# Sondas ativas: payload enviado numa conexão nova; "ports" indica onde são tentadas primeiro,
+# "fallback" marca as que valem para portas sem dica e sem banner; "early" encerra a leitura
+# no primeiro casamento (protocolos que não fecham a conexão após responder).
+FINGERPRINT_PROBES: List[Dict[str, Any]] = [
+    {"name": "redis", "payload": b"*2\r\n$4\r\nINFO\r\n$6\r\nserver\r\n", "ports": [6379, 6380], "early": True,
+     "matches": [_fp("redis", rb"redis_version:([\d.]+)", "Redis", r"\1", 0.95),
+                 _fp("redis", rb"^-(?:NOAUTH|DENIED)", "Redis", "", 0.9)]},
+    {"name": "postgres", "payload": (8).to_bytes(4, "big") + (80877103).to_bytes(4, "big"), "ports": [5432, 5433],
+     "early": True, "matches": [_fp("postgresql", rb"^[SN]\Z", "PostgreSQL", "", 0.8)]},
+    {"name": "mongodb", "payload": _mongo_ismaster(), "ports": [27017, 27018], "early": False,
+     "matches": [_fp("mongodb", rb"maxWireVersion", "MongoDB", "", 0.9)]},
+    {"name": "amqp", "payload": b"AMQP\x00\x00\x09\x01", "ports": [5672], "early": False,
+     "matches": [_fp("rabbitmq", rb"product[Ss]\x00\x00\x00.RabbitMQ.*?version[Ss]\x00\x00\x00.([\d.]+)", "RabbitMQ", r"\1", 0.95),
+                 _fp("amqp", rb"^(?:\x01\x00\x00|AMQP)", "", "", 0.75)]},
+    {"name": "mssql", "payload": _tds_prelogin(), "ports": [1433], "early": True,
+     "matches": [_fp("mssql", rb"^\x04\x01", "Microsoft SQL Server", "", 0.85, extract=_tds_version)]},
+    {"name": "docker", "payload": b"GET /version HTTP/1.0\r\nHost: {host}\r\n\r\n", "ports": [2375], "early": False,
+     "matches": FINGERPRINT_HTTP},
+    {"name": "docker_tls", "payload": b"GET /version HTTP/1.0\r\nHost: {host}\r\n\r\n", "ports": [2376], "tls": True,
+     "early": False, "matches": FINGERPRINT_HTTP},
+    {"name": "http", "payload": _HTTP_GET, "ports": _HTTP_PORTS, "fallback": True, "early": False, "matches": FINGERPRINT_HTTP},
+    {"name": "https", "payload": _HTTP_GET, "ports": _HTTPS_PORTS, "tls": True, "fallback": True, "early": False,
+     "matches": FINGERPRINT_HTTP},
+]
+
+
+def fingerprint_match(data: bytes, matches: List[Dict[str, Any]], port: int, tls: bool = False) -> Optional[Dict[str, Any]]:
+    for rule in matches:
+        if rule["ports"] and port not in rule["ports"]:
+            continue
+        m = rule["pattern"].search(data)
+        if not m:
+            continue
+
+        def expand(template: str) -> Optional[str]:
+            if not template:
+                return None
+            try:
+                value = m.expand(template.encode()).decode("utf-8", errors="ignore").strip()
+            except Exception:
+                return None
+            return value or None
+
+        version = rule["extract"](data, m) if rule["extract"] else expand(rule["version"])
+        service = "https" if tls and rule["service"] == "http" else rule["service"]
+        return {"service": service, "product": expand(rule["product"]), "version": version,
+                "confidence": rule["confidence"]}
+    return None
+
+
+def _fingerprint_exchange(ip: str, port: int, payload: Optional[bytes], tls: bool, matches: List[Dict[str, Any]],
+                          early: bool, wait: float) -> Tuple[bool, bytes]:
+    """Connect, optionally send payload and read until close, deadline, byte cap or (early) a match."""
+    deadline = time.time() + wait
+    data = b""
+    try:
+        with socket.create_connection((ip, port), timeout=FINGERPRINT_TIMEOUT) as raw:
+            s = raw
+            if tls:
+                ctx = ssl.create_default_context()
+                ctx.check_hostname = False
+                ctx.verify_mode = ssl.CERT_NONE
+                s = ctx.wrap_socket(raw)
+                tls_record(ip, port, s)
+            if payload:
+                s.sendall(payload.replace(b"{host}", ip.encode()))
+            while len(data) < FINGERPRINT_READ_BYTES:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                s.settimeout(remaining)
+                try:
+                    chunk = s.recv(FINGERPRINT_READ_BYTES - len(data))
+                except (socket.timeout, ssl.SSLError):
+                    break
+                if not chunk:
+                    break
+                data += chunk
+                if early and fingerprint_match(data, matches, port, tls):
+                    break
+    except Exception:
+        return bool(data), data
+    return True, data
+
+
+def _fingerprint_port(ip: str, port: int, fresh: bool = False) -> Dict[str, Any]:
+    result: Dict[str, Any] = {"port": port, "reachable": False, "service": SERVICE_MAP.get(port, f"port-{port}"),
+                              "product": None, "version": None, "confidence": 0.3 if port in SERVICE_MAP else 0.1,
+                              "method": "port"}
+    probes = [p for p in FINGERPRINT_PROBES if port in p["ports"]]
+    data = b""
+    # 1) banner passivo, só em portas de banner ou sem sonda própria (serviço desconhecido): reaproveita o que
+    # a varredura capturou; senão abre uma conexão e só escuta
+    if port in FINGERPRINT_BANNER_PORTS or not probes:
+        hit, banner = (False, None) if fresh else probe_cache_get(ip, port, "banner")
+        if hit and banner is not None:
+            data = banner.encode("latin-1")
+            result["reachable"] = True
+        else:
+            result["reachable"], data = _fingerprint_exchange(ip, port, None, False, FINGERPRINT_PASSIVE, True,
+                                                              FINGERPRINT_BANNER_WAIT)
+            if result["reachable"]:
+                probe_cache_put(ip, port, "banner", data.decode("latin-1"))
+    if data:
+        result["banner"] = re.sub(r"[^\x20-\x7e]", ".", data[:64].decode("latin-1")).strip(" .") or None
+        found = fingerprint_match(data, FINGERPRINT_PASSIVE, port)
+        if found:
+            result.update(found, method="banner")
+            return result
+    # 2) sondas ativas: primeiro as indicadas para a porta; sem dica e sem banner, as genéricas (HTTP/HTTPS)
+    if not probes and not data:
+        probes = [p for p in FINGERPRINT_PROBES if p.get("fallback")]
+    for probe in probes[:FINGERPRINT_MAX_PROBES]:
+        tls = bool(probe.get("tls"))
+        ok, resp = _fingerprint_exchange(ip, port, probe["payload"], tls, probe["matches"], probe["early"],
+                                         FINGERPRINT_TIMEOUT)
+        result["reachable"] = result["reachable"] or ok
+        found = fingerprint_match(resp, probe["matches"], port, tls) if resp else None
+        if found:
+            result.update(found, method=f"probe:{probe['name']}", tls=tls)
+            break
+    # Portas TLS: certificado (já capturado pela sonda HTTPS ou por um handshake próprio) refina o produto
+    if result["reachable"] and (port in TLS_PROBE_PORTS or result.get("tls")):
+        cert = probe_tls(ip, port, fresh=fresh)
+        if cert.get("fingerprint"):
+            result["tls_cert"] = {k: cert.get(k) for k in ("subject", "issuer", "san", "not_after", "expires_in_days",
+                                                            "protocol", "fingerprint")}
+            hint = tls_service_hint(cert)
+            if hint and result["confidence"] < 0.9:
+                result.update(service=hint[0], product=hint[1], confidence=0.9, method="tls-cert")
+    return result
+
+
+def fingerprint_port(ip: str, port: int, fresh: bool = False) -> Dict[str, Any]:
+    return cached_probe(ip, port, "fingerprint", lambda: _fingerprint_port(ip, port, fresh), fresh)
+
+
+def fingerprint_host(ip: str, ports: List[int], fresh: bool = False,
+                     deadline: Optional[float] = None) -> Dict[int, Dict[str, Any]]:
+    """Fingerprint the ports of a host concurrently (at most FINGERPRINT_WORKERS at a time).
+    At the per-host deadline, ports still running are reported with method "timeout" (they finish in the
+    background and still fill the cache) and ports not yet started are dropped and reported as "unprobed".
+    Results come back in the order of `ports`.
+    """
+    if not ports:
+        return {}
+    if deadline is None:
+        deadline = FINGERPRINT_HOST_DEADLINE
+    results: Dict[int, Dict[str, Any]] = {}
+    executor = ThreadPoolExecutor(max_workers=max(1, min(FINGERPRINT_WORKERS, len(ports))))
     try:
-        r = requests.get(url, timeout=timeout)
-        return {
-            "reachable": True,
-            "status_code": r.status_code,
-            "server": r.headers.get("Server"),
-        }
-    except Exception as e:
-        return {"reachable": False, "error": str(e)}
+        future_map = {executor.submit(fingerprint_port, ip, p, fresh): p for p in ports}
+        done, _ = wait(future_map, timeout=deadline if deadline > 0 else None)
+        for fut, port in future_map.items():
+            if fut in done:
+                try:
+                    results[port] = fut.result()
+                    continue
+                except Exception as e:
+                    error, method = str(e), "error"
+            elif fut.cancel():
+                error, method = "not probed before the verification deadline", "unprobed"
+            else:
+                error, method = "verification deadline exceeded", "timeout"
+            results[port] = {"port": port, "reachable": False, "service": SERVICE_MAP.get(port, f"port-{port}"),
+                             "product": None, "version": None, "confidence": 0.0, "method": method, "error": error}
+    finally:
+        # Sondas em andamento terminam em segundo plano (com timeout próprio) e ainda alimentam o cache
+        executor.shutdown(wait=False, cancel_futures=True)
+    return {p: results[p] for p in ports}
 
 
-def probe_https(ip: str, port: int, timeout: float = 0.8) -> Dict[str, Any]:
-    url = f"https://{ip}:{port}/"
+# Serviços identificados com precisão suficiente para substituir o nome da porta no SERVICE_MAP
+FINGERPRINT_REFINED_SERVICES = {"portainer", "vcenter", "vmware-esxi", "nutanix-prism"}
+
+
+def fingerprint_service_name(port: int, fp: Optional[Dict[str, Any]], open_ports: List[int]) -> str:
+    """Service label for a port: the static map, refined by a confident fingerprint."""
+    name = SERVICE_MAP.get(port, f"port-{port}")
+    if fp and fp.get("confidence", 0) >= FINGERPRINT_MIN_CONFIDENCE and (port not in SERVICE_MAP or fp["service"] in FINGERPRINT_REFINED_SERVICES):
+        return fp["service"]
+    # Heurística: 9443 junto com 8000 costuma ser Portainer
+    if port == 9443 and 8000 in open_ports:
+        return "portainer"
+    return name
+
+
+def fingerprint_label(fp: Optional[Dict[str, Any]]) -> Optional[str]:
+    if not fp:
+        return None
+    label = " ".join(x for x in (fp.get("product"), fp.get("version")) if x)
+    return label or fp.get("banner") or fp.get("error")
+
+
+# ----------------------
+# TLS certificate metadata (cached by certificate fingerprint)
+# ----------------------
+
+TLS_CACHE_TTL = float(os.environ.get("TLS_CACHE_TTL", "3600"))  # handshake por (ip, porta)
+TLS_CERT_CACHE_MAX = int(os.environ.get("TLS_CERT_CACHE_MAX", "4096"))
+TLS_PROBE_PORTS = [443, 8443, 9443, 9440, 5480, 5986, 2376]
+TLS_CERT_CACHE: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()  # sha256 -> metadados do certificado
+TLS_CERT_CACHE_LOCK = threading.Lock()
+
+# Palavras em subject/SAN/issuer que identificam o produto; ordem importa (mais específico primeiro)
+TLS_CERT_HINTS: List[Tuple[str, str, str]] = [
+    ("portainer", "portainer", "Portainer"),
+    ("nutanix", "nutanix-prism", "Nutanix Prism"),
+    ("vmca", "vcenter", "VMware vCenter"),
+    ("vcenter", "vcenter", "VMware vCenter"),
+    ("vmware", "vmware-esxi", "VMware ESXi"),
+]
+
+
+def parse_tls_certificate(der: bytes) -> Dict[str, Any]:
+    meta: Dict[str, Any] = {"fingerprint": hashlib.sha256(der).hexdigest()}
+    if x509 is None:
+        return meta
     try:
-        r = requests.get(url, timeout=timeout, verify=False)
-        # Captura breve do conteúdo para heurísticas (ex.: Portainer)
-        text_snippet: str | None = None
+        cert = x509.load_der_x509_certificate(der)
+        meta["subject"] = cert.subject.rfc4514_string()
+        meta["issuer"] = cert.issuer.rfc4514_string()
+        meta["self_signed"] = cert.subject == cert.issuer
         try:
-            # Limita para evitar overhead
-            text_snippet = r.text[:256]
+            san = cert.extensions.get_extension_for_class(x509.SubjectAlternativeName).value
+            meta["san"] = san.get_values_for_type(x509.DNSName) + [str(a) for a in san.get_values_for_type(x509.IPAddress)]
         except Exception:
-            text_snippet = None
-        return {
-            "reachable": True,
-            "status_code": r.status_code,
-            "server": r.headers.get("Server"),
-            "text_snippet": text_snippet,
-        }
+            meta["san"] = []
+        not_before = getattr(cert, "not_valid_before_utc", None) or cert.not_valid_before.replace(tzinfo=datetime.timezone.utc)
+        not_after = getattr(cert, "not_valid_after_utc", None) or cert.not_valid_after.replace(tzinfo=datetime.timezone.utc)
+        meta["not_before"] = not_before.isoformat()
+        meta["not_after"] = not_after.isoformat()
+        meta["expires_in_days"] = int((not_after - datetime.datetime.now(datetime.timezone.utc)).total_seconds() // 86400)
     except Exception as e:
-        return {"reachable": False, "error": str(e)}
+        meta["parse_error"] = str(e)
+    return meta
+
+
+def tls_certificate_meta(der: bytes) -> Dict[str, Any]:
+    """Certificate metadata, parsed once per distinct certificate."""
+    fingerprint = hashlib.sha256(der).hexdigest()
+    with TLS_CERT_CACHE_LOCK:
+        meta = TLS_CERT_CACHE.get(fingerprint)
+        if meta is not None:
+            TLS_CERT_CACHE.move_to_end(fingerprint)
+            return meta
+    meta = parse_tls_certificate(der)
+    with TLS_CERT_CACHE_LOCK:
+        TLS_CERT_CACHE[fingerprint] = meta
+        while len(TLS_CERT_CACHE) > TLS_CERT_CACHE_MAX:
+            TLS_CERT_CACHE.popitem(last=False)
+    return meta
+
+
+def tls_record(ip: str, port: int, sock) -> None:
+    """Store handshake results of an already established TLS socket (ip, port) -> fingerprint."""
+    try:
+        der = sock.getpeercert(binary_form=True)
+    except Exception:
+        der = None
+    if not der:
+        return
+    meta = tls_certificate_meta(der)
+    cipher = sock.cipher()
+    probe_cache_put(ip, port, "tls", {
+        "reachable": True,
+        "fingerprint": meta["fingerprint"],
+        "protocol": sock.version(),
+        "cipher": cipher[0] if cipher else None,
+    }, TLS_CACHE_TTL)
+
+
+def probe_tls(ip: str, port: int, timeout: float = 0.8, fresh: bool = False) -> Dict[str, Any]:
+    """Handshake metadata plus certificate subject/SAN/issuer/expiry; skipped while a recent entry exists."""
+    hit, value = (False, None) if fresh else probe_cache_get(ip, port, "tls")
+    if not hit:
+        try:
+            ctx = ssl.create_default_context()
+            ctx.check_hostname = False
+            ctx.verify_mode = ssl.CERT_NONE
+            with socket.create_connection((ip, port), timeout=timeout) as raw:
+                with ctx.wrap_socket(raw) as s:
+                    tls_record(ip, port, s)
+        except Exception as e:
+            probe_cache_put(ip, port, "tls", {"reachable": False, "error": str(e)})
+        hit, value = probe_cache_get(ip, port, "tls")
+    if not value or not value.get("fingerprint"):
+        return dict(value or {"reachable": False})
+    with TLS_CERT_CACHE_LOCK:
+        meta = TLS_CERT_CACHE.get(value["fingerprint"], {})
+    return {**meta, **value}
+
+
+def tls_service_hint(tls: Optional[Dict[str, Any]]) -> Optional[Tuple[str, str]]:
+    """(service, product) suggested by the certificate names, if any."""
+    if not tls or not tls.get("fingerprint"):
+        return None
+    text = " ".join([tls.get("subject") or "", tls.get("issuer") or ""] + list(tls.get("san") or [])).lower()
+    for needle, service, product in TLS_CERT_HINTS:
+        if needle in text:
+            return service, product
+    return None
 
 
 # ----------------------
-# SSH helpers (Linux-only enrichment)
+# Probe plan (service probes justified by the port scan)
 # ----------------------
 
-def ssh_run_command(ip: str, user: str, password: Optional[str] = None, key_path: Optional[str] = None,
-                    port: int = 22, timeout: float = 2.5) -> Tuple[bool, str | None, str | None]:
-    """Run a remote command via SSH. Returns (ok, stdout, stderr)."""
-    if not paramiko:
-        return (False, None, "Paramiko not available")
-    try:
-        ssh = paramiko.SSHClient()
-        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        if key_path:
-            try:
-                pkey = paramiko.RSAKey.from_private_key_file(key_path)
-            except Exception:
-                pkey = None
-        else:
-            pkey = None
-        ssh.connect(ip, port=port, username=user, password=password, pkey=pkey, timeout=timeout)
-        # We'll not execute here; caller will call .exec_command via wrapper below
-        return (True, None, None)
-    except Exception as e:
-        return (False, None, str(e))
+# Cada sonda declara as portas de que depende. Ela só roda se alguma dessas portas estiver
+# aberta ou não tiver sido varrida (estado desconhecido); "requires" permite condições extras
+# sobre as portas abertas. "cache" é a chave (porta, tipo) usada no cache de sondagens.
+PROBE_PLAN: List[Dict[str, Any]] = [
+    {
+        "name": "node_exporter",
+        "ports": [9100],
+        "cache": (9100, "node_exporter"),
+        "run": lambda ip, open_ports, closed: probe_node_exporter(ip),
+    },
+    {
+        "name": "docker",
+        "ports": [2375, 2376, 9323, 9443],
+        "cache": (0, "docker"),
+        "run": lambda ip, open_ports, closed: probe_docker(ip, closed_ports=closed),
+    },
+]
+PROBE_PLAN_STATS: Dict[str, Dict[str, int]] = {p["name"]: {"run": 0, "skipped": 0} for p in PROBE_PLAN}
+PROBE_PLAN_LOCK = threading.Lock()
 
-def ssh_exec(ip: str, user: str, cmd: str, password: Optional[str] = None, key_path: Optional[str] = None,
-             port: int = 22, timeout: float = 3.0) -> Tuple[bool, str | None, str | None]:
-    if not paramiko:
-        return (False, None, "Paramiko not available")
-    try:
-        ssh = paramiko.SSHClient()
-        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        pkey = None
-        if key_path:
-            try:
-                pkey = paramiko.RSAKey.from_private_key_file(key_path)
-            except Exception:
-                pkey = None
-        ssh.connect(ip, port=port, username=user, password=password, pkey=pkey, timeout=timeout)
-        stdin, stdout, stderr = ssh.exec_command(cmd, timeout=timeout)
-        out = stdout.read().decode(errors="ignore")
-        err = stderr.read().decode(errors="ignore")
-        ssh.close()
-        return (True, out, err)
-    except Exception as e:
-        return (False, None, str(e))
 
-def parse_ss_tulnp_output(text: str) -> List[Dict[str, Any]]:
-    """Parse 'ss -tulnp' output into entries: protocol, state, addr, port, process."""
-    entries: List[Dict[str, Any]] = []
-    if not text:
-        return entries
-    lines = [ln.strip() for ln in text.splitlines() if ln.strip()]
-    # Skip header line (starts with Netid)
-    for ln in lines:
-        if ln.lower().startswith("netid"):
+def probe_plan_should_run(probe: Dict[str, Any], ports_scan: Dict[int, bool]) -> bool:
+    open_ports = [p for p, ok in ports_scan.items() if ok]
+    requires = probe.get("requires")
+    if requires is not None and not requires(open_ports):
+        return False
+    return any(ports_scan.get(p, True) for p in probe["ports"])
+
+
+def evaluate_probe_plan(ip: str, ports_scan: Dict[int, bool], fresh: bool = False) -> Tuple[Dict[str, Any], Dict[str, str]]:
+    """Run only the probes whose preconditions hold for this scan.
+    Returns (results by probe name, decision by probe name); skipped probes yield {"present": False}.
+    """
+    open_ports = [p for p, ok in ports_scan.items() if ok]
+    closed = {p for p, ok in ports_scan.items() if not ok}
+    results: Dict[str, Any] = {}
+    decisions: Dict[str, str] = {}
+    for probe in PROBE_PLAN:
+        name = probe["name"]
+        run = probe_plan_should_run(probe, ports_scan)
+        with PROBE_PLAN_LOCK:
+            PROBE_PLAN_STATS.setdefault(name, {"run": 0, "skipped": 0})["run" if run else "skipped"] += 1
+        if not run:
+            results[name] = {"present": False}
+            decisions[name] = "skipped"
             continue
-        # Split into tokens; last tokens include users:("proc",pid=...,fd=...)
+        cache_port, cache_kind = probe["cache"]
+        results[name] = cached_probe(ip, cache_port, cache_kind, lambda: probe["run"](ip, open_ports, closed), fresh)
+        decisions[name] = "run"
+    return results, decisions
+
+
+def verify_host(ip: str, ports_scan: Dict[int, bool], open_ports: List[int],
+                fresh: bool = False) -> Tuple[Dict[int, Dict[str, Any]], Dict[str, Any], Dict[str, str]]:
+    """Fingerprint the open ports and run the probe plan side by side, both within FINGERPRINT_HOST_DEADLINE.
+    A plan still running at the deadline is reported as "timeout" for every probe and finishes in the background.
+    Returns (fingerprints, plan results, plan decisions).
+    """
+    deadline = time.time() + FINGERPRINT_HOST_DEADLINE
+    plan_executor = ThreadPoolExecutor(max_workers=1)
+    try:
+        plan_future = plan_executor.submit(evaluate_probe_plan, ip, ports_scan, fresh)
+        fingerprints = fingerprint_host(ip, open_ports, fresh)
+        try:
+            planned, decisions = plan_future.result(
+                timeout=max(0.0, deadline - time.time()) if FINGERPRINT_HOST_DEADLINE > 0 else None)
+        except TimeoutError:
+            planned = {p["name"]: {"present": False} for p in PROBE_PLAN}
+            decisions = {p["name"]: "timeout" for p in PROBE_PLAN}
+    finally:
+        plan_executor.shutdown(wait=False)
+    return fingerprints, planned, decisions
+
+
+# ----------------------
+# SSH helpers (Linux-only enrichment)
+# ----------------------
+
+SSH_POOL_IDLE_TIMEOUT = float(os.environ.get("SSH_POOL_IDLE_TIMEOUT", "120"))  # fecha sessões ociosas
+SSH_POOL_MAX_SESSIONS = int(os.environ.get("SSH_POOL_MAX_SESSIONS", "2"))  # sessões autenticadas por host
+SSH_POOL_MAX_CHANNELS = int(os.environ.get("SSH_POOL_MAX_CHANNELS", "8"))  # canais simultâneos por sessão (sshd MaxSessions=10)
+SSH_POOL_HEALTH_INTERVAL = float(os.environ.get("SSH_POOL_HEALTH_INTERVAL", "30"))  # sessão parada há mais que isso é testada
+SSH_KEEPALIVE = int(os.environ.get("SSH_KEEPALIVE", "30"))
+SSH_POOL_REAP_INTERVAL = float(os.environ.get("SSH_POOL_REAP_INTERVAL", "30"))  # varredura de sessões ociosas (0 = desliga)
+
+# (ip, porta, usuário, impressão da credencial) -> sessões abertas
+SSH_POOL: Dict[Tuple[str, int, str, str], List[Dict[str, Any]]] = {}
+SSH_POOL_LOCK = threading.Lock()
+SSH_POOL_REAPER: Dict[str, Any] = {"thread": None}
+SSH_POOL_COUNTERS = {"connects": 0, "commands": 0, "reused": 0, "closed_idle": 0, "closed_broken": 0,
+                     "key_loads": 0, "key_cache_hits": 0, "hostkey_changed": 0}
+
+
+def ssh_credential_fingerprint(password: Optional[str], key_path: Optional[str]) -> str:
+    """Digest identifying a credential without keeping it in the pool key (key file changes count)."""
+    try:
+        mtime = os.stat(key_path).st_mtime if key_path else 0
+    except OSError:
+        mtime = 0
+    raw = f"{password or ''}\0{key_path or ''}\0{mtime}"
+    return hashlib.sha256(raw.encode("utf-8", errors="ignore")).hexdigest()[:16]
+
+
+SSH_HOSTKEY_POLICY = os.environ.get("SSH_HOSTKEY_POLICY", "warn").lower()  # warn | strict | off
+
+# caminho -> ((mtime_ns, tamanho), chave já lida); falha de leitura também fica em cache
+SSH_KEY_CACHE: Dict[str, Tuple[Tuple[int, int], Any]] = {}
+SSH_KEY_CACHE_LOCK = threading.Lock()
+# (host, porta, tipo) -> {"key_data", "fingerprint"}; espelho local de "AUTOMACAO"."SshKnownHosts"
+SSH_KNOWN_HOSTS: Dict[Tuple[str, int, str], Dict[str, str]] = {}
+SSH_KNOWN_HOSTS_LOCK = threading.Lock()
+
+
+def ssh_load_key(key_path: str) -> Any:
+    """Private key (RSA, ECDSA or Ed25519) parsed once per (path, mtime, size); None if unreadable."""
+    try:
+        st = os.stat(key_path)
+    except OSError:
+        return None
+    sig = (st.st_mtime_ns, st.st_size)
+    with SSH_KEY_CACHE_LOCK:
+        cached = SSH_KEY_CACHE.get(key_path)
+    if cached and cached[0] == sig:
+        with SSH_POOL_LOCK:
+            SSH_POOL_COUNTERS["key_cache_hits"] += 1
+        return cached[1]
+    try:
+        pkey = paramiko.PKey.from_path(key_path)
+    except Exception:
+        pkey = None
+    with SSH_KEY_CACHE_LOCK:
+        SSH_KEY_CACHE[key_path] = (sig, pkey)
+    with SSH_POOL_LOCK:
+        SSH_POOL_COUNTERS["key_loads"] += 1
+    return pkey
+
+
+def ssh_key_fingerprint(key: Any) -> str:
+    """OpenSSH-style SHA256 fingerprint of a public key."""
+    return "SHA256:" + base64.b64encode(hashlib.sha256(key.asbytes()).digest()).decode("ascii").rstrip("=")
+
+
+def ssh_check_host_key(host: str, port: int, key: Any) -> None:
+    """Trust-on-first-use check against the known-hosts store shared by all workers.
+    A key that differs from the stored one — or whose type was never seen while other types are
+    stored for the host — counts as changed: it raises an event, and with SSH_HOSTKEY_POLICY=strict
+    the connection is refused.
+    """
+    key_type = key.get_name()
+    key_data = key.get_base64()
+    ident = (host, int(port), key_type)
+    with SSH_KNOWN_HOSTS_LOCK:
+        if (SSH_KNOWN_HOSTS.get(ident) or {}).get("key_data") == key_data:
+            return
+    # cache local ausente ou diferente: o PG decide (outro worker pode já ter registrado a chave)
+    known = pg_get_known_hosts(host, int(port))
+    if known is None:
+        with SSH_KNOWN_HOSTS_LOCK:
+            known = {k[2]: v for k, v in SSH_KNOWN_HOSTS.items() if k[0] == host and k[1] == int(port)}
+    stored = known.get(key_type)
+    if known and (stored is None or stored["key_data"] != key_data):
+        strict = SSH_HOSTKEY_POLICY == "strict"
+        previous = stored["fingerprint"] if stored else ", ".join(f"{t} {v['fingerprint']}" for t, v in sorted(known.items()))
+        with SSH_POOL_LOCK:
+            SSH_POOL_COUNTERS["hostkey_changed"] += 1
+        device = pg_get_device(ip=host)
+        if device and device.get("id"):
+            pg_add_event(device["id"], "SSH_HOSTKEY_CHANGED", "critical" if strict else "warning",
+                         f"Chave SSH de {host}:{port} mudou ({key_type})",
+                         {"port": int(port), "key_type": key_type, "previous": previous,
+                          "current": ssh_key_fingerprint(key), "rejected": strict}, source="ssh")
+        if strict:
+            raise paramiko.SSHException(
+                f"host key for {host}:{port} changed ({previous} -> {key_type} {ssh_key_fingerprint(key)})")
+    fingerprint = ssh_key_fingerprint(key)
+    pg_save_known_host(host, int(port), key_type, key_data, fingerprint)
+    with SSH_KNOWN_HOSTS_LOCK:
+        SSH_KNOWN_HOSTS[ident] = {"key_data": key_data, "fingerprint": fingerprint}
+
+
+def ssh_forget_host(host: str, port: Optional[int] = None) -> int:
+    with SSH_KNOWN_HOSTS_LOCK:
+        for ident in [k for k in SSH_KNOWN_HOSTS if k[0] == host and (port is None or k[1] == port)]:
+            del SSH_KNOWN_HOSTS[ident]
+    return pg_delete_known_hosts(host, port)
+
+
+if paramiko:
+    class SshKnownHostsPolicy(paramiko.MissingHostKeyPolicy):
+        """Host-key policy backed by ssh_check_host_key (the client starts with no known keys)."""
+
+        def __init__(self, host: str, port: int):
+            self.host = host
+            self.port = port
+
+        def missing_host_key(self, client, hostname, key):
+            ssh_check_host_key(self.host, self.port, key)
+
+
+def _ssh_connect(ip: str, user: str, password: Optional[str], key_path: Optional[str],
+                 port: int, timeout: float) -> "paramiko.SSHClient":
+    ssh = paramiko.SSHClient()
+    if SSH_HOSTKEY_POLICY == "off":
+        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    else:
+        ssh.set_missing_host_key_policy(SshKnownHostsPolicy(ip, port))
+    pkey = ssh_load_key(key_path) if key_path else None
+    ssh.connect(ip, port=port, username=user, password=password, pkey=pkey, timeout=timeout,
+                banner_timeout=timeout, auth_timeout=timeout)
+    transport = ssh.get_transport()
+    if transport is not None and SSH_KEEPALIVE > 0:
+        transport.set_keepalive(SSH_KEEPALIVE)
+    return ssh
+
+
+def _ssh_session_alive(entry: Dict[str, Any]) -> bool:
+    transport = entry["client"].get_transport()
+    if transport is None or not transport.is_active():
+        return False
+    if time.time() - entry["last_used"] > SSH_POOL_HEALTH_INTERVAL:
+        try:
+            transport.send_ignore()
+        except Exception:
+            return False
+    return True
+
+
+def _ssh_close(entry: Dict[str, Any]) -> None:
+    try:
+        entry["client"].close()
+    except Exception:
+        pass
+
+
+def ssh_pool_prune() -> None:
+    """Close idle sessions and drop dead ones (sessions with channels in use are kept)."""
+    now = time.time()
+    doomed: List[Dict[str, Any]] = []
+    with SSH_POOL_LOCK:
+        for key in list(SSH_POOL.keys()):
+            keep = []
+            for entry in SSH_POOL[key]:
+                transport = entry["client"].get_transport() if entry["client"] is not None else None
+                if entry["client"] is None:
+                    keep.append(entry)  # conectando
+                elif entry["channels"] == 0 and (transport is None or not transport.is_active()):
+                    SSH_POOL_COUNTERS["closed_broken"] += 1
+                    doomed.append(entry)
+                elif entry["channels"] == 0 and now - entry["last_used"] > SSH_POOL_IDLE_TIMEOUT:
+                    SSH_POOL_COUNTERS["closed_idle"] += 1
+                    doomed.append(entry)
+                else:
+                    keep.append(entry)
+            if keep:
+                SSH_POOL[key] = keep
+            else:
+                del SSH_POOL[key]
+    for entry in doomed:
+        _ssh_close(entry)
+
+
+def ssh_pool_reaper_loop() -> None:
+    """Prune the pool periodically so idle sessions close even when no new command arrives."""
+    while True:
+        time.sleep(SSH_POOL_REAP_INTERVAL)
+        try:
+            ssh_pool_prune()
+        except Exception:
+            pass
+
+
+def ssh_pool_reaper_start() -> None:
+    if SSH_POOL_REAP_INTERVAL <= 0:
+        return
+    with SSH_POOL_LOCK:
+        thread = SSH_POOL_REAPER["thread"]
+        if thread is None or not thread.is_alive():
+            thread = threading.Thread(target=ssh_pool_reaper_loop, name="ssh-pool-reaper", daemon=True)
+            SSH_POOL_REAPER["thread"] = thread
+            thread.start()
+
+
+def ssh_pool_acquire(ip: str, user: str, password: Optional[str] = None, key_path: Optional[str] = None,
+                     port: int = 22, timeout: float = 3.0) -> Dict[str, Any]:
+    """Reserve a channel slot on a pooled, authenticated session (connecting if needed).
+    Release with ssh_pool_release. Connection/auth errors propagate.
+    """
+    ssh_pool_prune()
+    ssh_pool_reaper_start()
+    key = (ip, int(port), user, ssh_credential_fingerprint(password, key_path))
+    deadline = time.time() + timeout
+    while True:
+        created = False
+        with SSH_POOL_LOCK:
+            sessions = SSH_POOL.setdefault(key, [])
+            ready = [e for e in sessions if e["client"] is not None and e["channels"] < SSH_POOL_MAX_CHANNELS]
+            entry = min(ready, key=lambda e: e["channels"]) if ready else None
+            if entry is None and len(sessions) < SSH_POOL_MAX_SESSIONS:
+                # reserva a vaga antes de conectar para que threads concorrentes não abram sessões a mais
+                entry = {"key": key, "client": None, "channels": 0, "created": time.time(), "last_used": time.time(), "commands": 0}
+                sessions.append(entry)
+                created = True
+            if entry is not None:
+                entry["channels"] += 1
+        if entry is None:
+            # sessões cheias ou ainda conectando: espera liberar um canal
+            if time.time() > deadline:
+                raise TimeoutError(f"no free SSH channel for {ip}:{port}")
+            time.sleep(0.05)
+            continue
+        if created:
+            try:
+                client = _ssh_connect(ip, user, password, key_path, port, timeout)
+            except Exception:
+                with SSH_POOL_LOCK:
+                    if entry in SSH_POOL.get(key, []):
+                        SSH_POOL[key].remove(entry)
+                raise
+            with SSH_POOL_LOCK:
+                entry["client"] = client
+                SSH_POOL_COUNTERS["connects"] += 1
+            return entry
+        if _ssh_session_alive(entry):
+            with SSH_POOL_LOCK:
+                SSH_POOL_COUNTERS["reused"] += 1
+            return entry
+        ssh_pool_release(entry, broken=True)
+
+
+def ssh_pool_release(entry: Dict[str, Any], broken: bool = False) -> None:
+    with SSH_POOL_LOCK:
+        entry["channels"] = max(0, entry["channels"] - 1)
+        entry["last_used"] = time.time()
+        sessions = SSH_POOL.get(entry["key"], [])
+        if broken and entry in sessions:
+            sessions.remove(entry)
+            SSH_POOL_COUNTERS["closed_broken"] += 1
+        else:
+            broken = False
+    if broken:
+        _ssh_close(entry)
+
+
+def ssh_pool_stats() -> Dict[str, Any]:
+    ssh_pool_prune()
+    now = time.time()
+    with SSH_POOL_LOCK:
+        hosts = [{
+            "host": key[0], "port": key[1], "user": key[2],
+            "sessions": len(sessions),
+            "channels_in_use": sum(e["channels"] for e in sessions),
+            "commands": sum(e["commands"] for e in sessions),
+            "idle_seconds": round(min(now - e["last_used"] for e in sessions), 1) if sessions else None,
+        } for key, sessions in SSH_POOL.items()]
+        counters = dict(SSH_POOL_COUNTERS)
+    return {
+        "idle_timeout": SSH_POOL_IDLE_TIMEOUT,
+        "max_sessions": SSH_POOL_MAX_SESSIONS,
+        "max_channels": SSH_POOL_MAX_CHANNELS,
+        "hostkey_policy": SSH_HOSTKEY_POLICY,
+        **counters,
+        "hosts": hosts,
+    }
+
+
+def ssh_run_command(ip: str, user: str, password: Optional[str] = None, key_path: Optional[str] = None,
+                    port: int = 22, timeout: float = 2.5) -> Tuple[bool, str | None, str | None]:
+    """Check SSH connectivity/auth (the session stays in the pool). Returns (ok, stdout, stderr)."""
+    if not paramiko:
+        return (False, None, "Paramiko not available")
+    try:
+        entry = ssh_pool_acquire(ip, user, password=password, key_path=key_path, port=port, timeout=timeout)
+        ssh_pool_release(entry)
+        return (True, None, None)
+    except Exception as e:
+        return (False, None, str(e))
+
+def ssh_exec(ip: str, user: str, cmd: str, password: Optional[str] = None, key_path: Optional[str] = None,
+             port: int = 22, timeout: float = 3.0) -> Tuple[bool, str | None, str | None]:
+    """Run cmd on a new channel of a pooled session. Returns (ok, stdout, stderr).
+    A session that fails to open a channel is discarded and the command retried once on a new one.
+    """
+    if not paramiko:
+        return (False, None, "Paramiko not available")
+    last_error = None
+    for _ in range(2):
+        try:
+            entry = ssh_pool_acquire(ip, user, password=password, key_path=key_path, port=port, timeout=timeout)
+        except Exception as e:
+            return (False, None, str(e))
+        try:
+            stdin, stdout, stderr = entry["client"].exec_command(cmd, timeout=timeout)
+        except Exception as e:
+            last_error = e
+            ssh_pool_release(entry, broken=True)
+            continue
+        try:
+            stdin.close()
+            out = stdout.read().decode(errors="ignore")
+            err = stderr.read().decode(errors="ignore")
+            with SSH_POOL_LOCK:
+                entry["commands"] += 1
+                SSH_POOL_COUNTERS["commands"] += 1
+            return (True, out, err)
+        except Exception as e:
+            return (False, None, str(e))
+        finally:
+            try:
+                stdout.channel.close()
+            except Exception:
+                pass
+            ssh_pool_release(entry)
+    return (False, None, str(last_error))
+
+def ssh_sftp_put(ip: str, user: str, local_path: str, remote_path: str, password: Optional[str] = None,
+                 key_path: Optional[str] = None, port: int = 22, timeout: float = 30.0) -> Tuple[bool, str | None]:
+    """Upload a file over an SFTP channel of a pooled session. Returns (ok, error)."""
+    if not paramiko:
+        return (False, "Paramiko not available")
+    last_error = None
+    for _ in range(2):
+        try:
+            entry = ssh_pool_acquire(ip, user, password=password, key_path=key_path, port=port, timeout=min(timeout, 10.0))
+        except Exception as e:
+            return (False, str(e))
+        try:
+            sftp = entry["client"].open_sftp()
+        except Exception as e:
+            last_error = e
+            ssh_pool_release(entry, broken=True)
+            continue
+        try:
+            sftp.get_channel().settimeout(timeout)
+            sftp.put(local_path, remote_path, confirm=True)
+            with SSH_POOL_LOCK:
+                entry["commands"] += 1
+                SSH_POOL_COUNTERS["commands"] += 1
+            return (True, None)
+        except Exception as e:
+            return (False, str(e))
+        finally:
+            try:
+                sftp.close()
+            except Exception:
+                pass
+            ssh_pool_release(entry)
+    return (False, str(last_error))
+
+def parse_ss_tulnp_output(text: str) -> List[Dict[str, Any]]:
+    """Parse 'ss -tulnp' output into entries: protocol, state, addr, port, process."""
+    entries: List[Dict[str, Any]] = []
+    if not text:
+        return entries
+    lines = [ln.strip() for ln in text.splitlines() if ln.strip()]
+    # Skip header line (starts with Netid)
+    for ln in lines:
+        if ln.lower().startswith("netid"):
+            continue
+        # Split into tokens; last tokens include users:("proc",pid=...,fd=...)
         # We'll try to capture protocol, state, local address:port, process name
         parts = re.split(r"\s+", ln)
         if len(parts) < 5:
@@ -881,19 +2124,6 @@ def map_service_from_process_or_port(proc: Optional[str], port: Optional[int]) -
     return "unknown"
 
 
-def probe_ssh_banner(ip: str, port: int = 22, timeout: float = 0.8) -> Dict[str, Any]:
-    try:
-        with socket.create_connection((ip, port), timeout=timeout) as s:
-            s.settimeout(timeout)
-            banner = s.recv(128)
-            return {
-                "reachable": True,
-                "banner": banner.decode(errors="ignore").strip(),
-            }
-    except Exception as e:
-        return {"reachable": False, "error": str(e)}
-
-
 def guess_os_from_ports(open_ports: List[int]) -> str | None:
     # Heurística refinada:
     # - WinRM (5985/5986) indica fortemente Windows
@@ -922,25 +2152,29 @@ def guess_virtualization_from_ports(open_ports: List[int]) -> str | None:
     return None
 
 
-def discover_host(ip: str) -> Dict[str, Any]:
-    rdns = reverse_dns(ip)
-    ports_scan = scan_ports(ip, COMMON_PORTS)
+def guess_virtualization_from_fingerprints(fingerprints: Dict[int, Dict[str, Any]]) -> str | None:
+    """Plataforma indicada pelos certificados TLS, mais confiável que a combinação de portas."""
+    found = {fp.get("service") for fp in fingerprints.values() if fp.get("method") == "tls-cert"}
+    if "nutanix-prism" in found:
+        return "Nutanix Prism/AHV (certificado)"
+    if "vcenter" in found or "vmware-esxi" in found:
+        return "VMware ESXi/vCenter (certificado)"
+    return None
+
+
+def discover_host(ip: str, fresh: bool = False) -> Dict[str, Any]:
+    rdns_deadline = time.time() + DNS_LOOKUP_TIMEOUT
+    rdns_future = dns_lookup_async("rdns", ip)
+    ports_scan = scan_ports(ip, COMMON_PORTS, fresh=fresh, banners=FINGERPRINT_PASSIVE_BANNERS)
+    rdns = dns_result(rdns_future, rdns_deadline - time.time()) or ip
     open_ports = [p for p, ok in ports_scan.items() if ok]
-    # Refina nomes de serviços (especialmente 9443 -> Portainer)
-    services: List[str] = []
-    for p in open_ports:
-        name = SERVICE_MAP.get(p, f"port-{p}")
-        if p in (443, 9443, 9440, 5480):
-            res = probe_https(ip, p)
-            text = (res.get("text_snippet") or "").lower()
-            server = (res.get("server") or "").lower()
-            if p == 9443 and (("portainer" in text) or ("portainer" in server) or (8000 in open_ports)):
-                name = "portainer"
-        services.append(name)
-    node = probe_node_exporter(ip)
-    docker = probe_docker(ip)
+    # Refina nomes de serviços (especialmente 9443 -> Portainer); plano de sondas roda em paralelo
+    fingerprints, planned, plan_decisions = verify_host(ip, ports_scan, open_ports, fresh)
+    services = [fingerprint_service_name(p, fingerprints.get(p), open_ports) for p in open_ports]
+    node = planned["node_exporter"]
+    docker = planned["docker"]
     os_guess = guess_os_from_ports(open_ports) or (node.get("uname") if node.get("present") else None)
-    virt_guess = guess_virtualization_from_ports(open_ports)
+    virt_guess = guess_virtualization_from_fingerprints(fingerprints) or guess_virtualization_from_ports(open_ports)
     os_label = os_guess or "Unknown"
     status = "Online" if open_ports else "Offline"
     # persist discovery
@@ -957,57 +2191,217 @@ def discover_host(ip: str) -> Dict[str, Any]:
         "virtualization": virt_guess,
         "node_exporter": node,
         "docker": docker,
+        "probe_plan": plan_decisions,
         "timestamp": time.strftime("%Y-%m-%d %H:%M:%S"),
     }
 
 
+# ----------------------
+# Scan profiles (named port lists, learned ordering, early stop)
+# ----------------------
+
+SCAN_PROFILE_CACHE_TTL = float(os.environ.get("SCAN_PROFILE_CACHE_TTL", "60"))  # perfis gravados no PG
+PORT_STATS_TTL = float(os.environ.get("PORT_STATS_TTL", "600"))  # taxa de acerto aprendida do inventário
+SCAN_DEFAULT_TIMEOUT = 0.35
+SCAN_PROFILE_NAME_RE = re.compile(r"^[A-Za-z0-9_.-]{1,64}$")
+
+
+def _aggressive_ports() -> List[int]:
+    # Varredura mais ampla: 1-1023 + blocos populares + portas comuns
+    expanded = set(COMMON_PORTS)
+    expanded.update(TOP_EXTRA_PORTS)
+    expanded.update(range(1, 1024))
+    expanded.update(range(3000, 3101))
+    expanded.update(range(8000, 8101))
+    return sorted(expanded)
+
+
+AGGRESSIVE_PORTS: List[int] = _aggressive_ports()  # calculada uma vez
+
+BUILTIN_SCAN_PROFILES: Dict[str, Dict[str, Any]] = {
+    "tcp": {"name": "tcp", "ports": COMMON_PORTS, "order": "learned", "description": "Portas comuns"},
+    "aggressive": {"name": "aggressive", "ports": AGGRESSIVE_PORTS, "order": "learned",
+                   "description": "1-1023, 3000-3100, 8000-8100 e portas comuns"},
+    "classify": {"name": "classify", "ports": COMMON_PORTS, "order": "learned",
+                 "earlyStop": {"anyOf": [22, 135, 3389, 5985, 5986, 902, 9440], "minOpen": 1},
+                 "description": "Portas comuns, encerrando assim que o tipo do host é identificado"},
+}
+BUILTIN_SCAN_PROFILES["nmap"] = dict(BUILTIN_SCAN_PROFILES["aggressive"], name="nmap")
+
+SCAN_PROFILES: Dict[str, Dict[str, Any]] = {}  # perfis gravados (cache do PG)
+SCAN_PROFILES_LOCK = threading.Lock()
+SCAN_PROFILES_STATE = {"loaded_at": 0.0}
+PORT_STATS: Dict[str, Any] = {"at": 0.0, "devices": 0, "counts": {}}
+PORT_STATS_LOCK = threading.Lock()
+
+
+def expand_port_spec(spec: List[Any]) -> List[int]:
+    """Expand [22, "8000-8100", "443"] into a de-duplicated port list (spec order)."""
+    ports: List[int] = []
+    seen = set()
+    for item in spec or []:
+        if isinstance(item, str) and "-" in item:
+            start, end = (int(x) for x in item.split("-", 1))
+            values = range(start, end + 1)
+        else:
+            values = [int(item)]
+        for p in values:
+            if not 1 <= p <= 65535:
+                raise ValueError(f"port out of range: {p}")
+            if p not in seen:
+                seen.add(p)
+                ports.append(p)
+    return ports
+
+
+def normalize_scan_profile(data: Dict[str, Any]) -> Dict[str, Any]:
+    """Validate a profile payload; raises HTTPException(400) on invalid input."""
+    name = str(data.get("name") or "").strip()
+    if not SCAN_PROFILE_NAME_RE.match(name):
+        raise HTTPException(status_code=400, detail="name must match [A-Za-z0-9_.-]{1,64}")
+    if name.lower() in BUILTIN_SCAN_PROFILES:
+        raise HTTPException(status_code=400, detail=f"'{name}' is a built-in profile")
+    try:
+        ports = expand_port_spec(data.get("ports") or [])
+        timeouts = {int(k): float(v) for k, v in (data.get("timeouts") or {}).items()}
+        default_timeout = float(data.get("defaultTimeout", SCAN_DEFAULT_TIMEOUT))
+    except (TypeError, ValueError) as e:
+        raise HTTPException(status_code=400, detail=f"invalid ports/timeouts: {e}")
+    if not ports:
+        raise HTTPException(status_code=400, detail="ports must not be empty")
+    if any(not 0.05 <= t <= 10 for t in list(timeouts.values()) + [default_timeout]):
+        raise HTTPException(status_code=400, detail="timeouts must be between 0.05 and 10 seconds")
+    order = data.get("order", "learned")
+    if order not in ("learned", "numeric", "given"):
+        raise HTTPException(status_code=400, detail="order must be learned, numeric or given")
+    early = data.get("earlyStop")
+    if early:
+        try:
+            early = {k: v for k, v in {
+                "anyOf": [int(p) for p in early.get("anyOf") or []] or None,
+                "minOpen": int(early.get("minOpen", 1)) if early.get("anyOf") else None,
+                "maxOpen": int(early["maxOpen"]) if early.get("maxOpen") else None,
+            }.items() if v}
+        except (AttributeError, TypeError, ValueError):
+            raise HTTPException(status_code=400, detail="earlyStop must be {anyOf: [...], minOpen} or {maxOpen}")
+    return {
+        "name": name,
+        "description": data.get("description"),
+        "ports": data.get("ports"),
+        "timeouts": {str(k): v for k, v in timeouts.items()},
+        "defaultTimeout": default_timeout,
+        "order": order,
+        "earlyStop": early or None,
+    }
+
+
+def load_scan_profiles(force: bool = False) -> Dict[str, Dict[str, Any]]:
+    with SCAN_PROFILES_LOCK:
+        if not force and time.time() - SCAN_PROFILES_STATE["loaded_at"] < SCAN_PROFILE_CACHE_TTL:
+            return dict(SCAN_PROFILES)
+    stored = pg_list_scan_profiles()
+    with SCAN_PROFILES_LOCK:
+        # falha no PG mantém o cache anterior até o próximo SCAN_PROFILE_CACHE_TTL
+        if stored is not None:
+            SCAN_PROFILES.clear()
+            SCAN_PROFILES.update({p["name"]: p for p in stored})
+        SCAN_PROFILES_STATE["loaded_at"] = time.time()
+        return dict(SCAN_PROFILES)
+
+
+def port_hit_counts() -> Tuple[int, Dict[int, int]]:
+    """(devices, {port: devices with it open}) from the inventory, refreshed every PORT_STATS_TTL."""
+    with PORT_STATS_LOCK:
+        if time.time() - PORT_STATS["at"] < PORT_STATS_TTL:
+            return PORT_STATS["devices"], PORT_STATS["counts"]
+        PORT_STATS["at"] = time.time()  # evita recargas concorrentes; falha mantém os valores antigos
+    loaded = pg_port_hit_counts()
+    with PORT_STATS_LOCK:
+        if loaded is not None:
+            PORT_STATS["devices"], PORT_STATS["counts"] = loaded
+        return PORT_STATS["devices"], PORT_STATS["counts"]
+
+
+def order_ports(ports: List[int], order: str = "learned") -> List[int]:
+    if order == "given":
+        return list(ports)
+    if order == "numeric":
+        return sorted(ports)
+    # Mais vistas abertas no inventário primeiro; sem histórico, portas conhecidas (SERVICE_MAP) antes
+    _, counts = port_hit_counts()
+    return sorted(ports, key=lambda p: (-counts.get(p, 0), 0 if p in SERVICE_MAP else 1, p))
+
+
+def resolve_scan_profile(method: Optional[str]) -> Dict[str, Any]:
+    """Built-in or stored profile by name, ready for scan_ports; raises HTTPException(400) for unknown names."""
+    name = (method or "tcp").strip()
+    builtin = BUILTIN_SCAN_PROFILES.get(name.lower())
+    stored = None if builtin else load_scan_profiles().get(name)
+    profile = builtin or stored
+    if profile is None:
+        raise HTTPException(status_code=400, detail=f"unknown scan profile '{name}'")
+    ports = expand_port_spec(profile["ports"]) if stored else profile["ports"]
+    scan_order = order_ports(ports, profile.get("order", "learned"))
+    return {
+        "name": profile["name"],
+        "ports": ports,
+        "scanOrder": scan_order,
+        "scanRank": {p: i for i, p in enumerate(scan_order)},
+        "timeouts": {int(k): float(v) for k, v in (profile.get("timeouts") or {}).items()},
+        "defaultTimeout": float(profile.get("defaultTimeout", SCAN_DEFAULT_TIMEOUT)),
+        "earlyStop": profile.get("earlyStop"),
+    }
+
+
+def scan_early_stop(rule: Optional[Dict[str, Any]], open_ports: set) -> bool:
+    if not rule:
+        return False
+    if rule.get("anyOf") and len(open_ports.intersection(rule["anyOf"])) >= int(rule.get("minOpen", 1)):
+        return True
+    return bool(rule.get("maxOpen")) and len(open_ports) >= int(rule["maxOpen"])
+
+
 def get_ports_for_method(method: str) -> List[int]:
-    """Retorna lista de portas para varredura conforme método informado."""
-    m = (method or "tcp").lower()
-    if m in ("nmap", "aggressive"):
-        # Varredura mais ampla: 1-1023 + blocos populares + portas comuns
-        expanded = set(COMMON_PORTS)
-        expanded.update(TOP_EXTRA_PORTS)
-        expanded.update(range(1, 1024))
-        expanded.update(range(3000, 3101))
-        expanded.update(range(8000, 8101))
-        return sorted(expanded)
-    return COMMON_PORTS
-
-
-def discover_host_with_ports(ip: str, ports: List[int]) -> Dict[str, Any]:
-    rdns = reverse_dns(ip)
-    ports_scan = scan_ports(ip, ports)
+    """Retorna lista de portas para varredura conforme método (ou perfil) informado."""
+    return resolve_scan_profile(method)["ports"]
+
+
+def discover_host_with_ports(ip: str, ports: List[int], persist: bool = True, fresh: bool = False,
+                             profile: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    # DNS reverso corre em paralelo à varredura; após ela, espera no máximo o que restar do prazo
+    rdns_deadline = time.time() + DNS_LOOKUP_TIMEOUT
+    rdns_future = dns_lookup_async("rdns", ip)
+    scan_info: Dict[str, Any] = {}
+    ports_scan = scan_ports(ip, ports, fresh=fresh, banners=FINGERPRINT_PASSIVE_BANNERS, profile=profile, info=scan_info)
+    rdns = dns_result(rdns_future, rdns_deadline - time.time()) or ip
     open_ports = [p for p, ok in ports_scan.items() if ok]
     services = [SERVICE_MAP.get(p, f"port-{p}") for p in open_ports]
-    node = probe_node_exporter(ip)
-    docker = probe_docker(ip)
+    # Verificação em paralelo: fingerprint das portas abertas (limite e prazo por host) junto com o plano de sondas
+    fingerprints, planned, plan_decisions = verify_host(ip, ports_scan, open_ports, fresh)
+    node = planned["node_exporter"]
+    docker = planned["docker"]
     os_guess = guess_os_from_ports(open_ports) or (node.get("uname") if node.get("present") else None)
-    virt_guess = guess_virtualization_from_ports(open_ports)
+    virt_guess = guess_virtualization_from_fingerprints(fingerprints) or guess_virtualization_from_ports(open_ports)
     os_label = os_guess or "Unknown"
     status = "Online" if open_ports else "Offline"
     # Build detailed services list with lightweight verification
     services_detailed: List[Dict[str, Any]] = []
     updated_services: List[str] = []
     for p in open_ports:
-        name = SERVICE_MAP.get(p, f"port-{p}")
-        det: Dict[str, Any] = {"service": name, "port": p, "verified": False}
-        if p == 22:
-            res = probe_ssh_banner(ip, 22)
-            det.update({"verified": res.get("reachable", False), "detail": res.get("banner") or res.get("error")})
-        elif p in (80, 8080, 3000, 5000):
-            res = probe_http(ip, p)
-            det.update({"verified": res.get("reachable", False), "detail": res.get("server") or res.get("error")})
-        elif p in (443, 9443, 9440, 5480):
-            res = probe_https(ip, p)
-            # Heurística: 9443 pode ser Portainer; ajuste o nome quando detectado
-            text = (res.get("text_snippet") or "").lower()
-            server = (res.get("server") or "").lower()
-            if p == 9443 and (("portainer" in text or "portainer" in server) or (8000 in open_ports)):
-                name = "portainer"
-                det["service"] = name
-            det.update({"verified": res.get("reachable", False), "detail": res.get("server") or res.get("error")})
-        elif p in (2375, 2376):
+        fp = fingerprints.get(p) or {}
+        name = fingerprint_service_name(p, fp, open_ports)
+        det: Dict[str, Any] = {
+            "service": name,
+            "port": p,
+            "verified": bool(fp.get("reachable")),
+            "detail": fingerprint_label(fp),
+            "product": fp.get("product"),
+            "version": fp.get("version"),
+            "confidence": fp.get("confidence"),
+        }
+        if fp.get("tls_cert"):
+            det["tls_cert"] = fp["tls_cert"]
+        if p in (2375, 2376):
             # probe_docker already ran; mark verified if present
             det.update({"verified": docker.get("present", False), "detail": "Docker Engine API" if docker.get("present") else None})
         elif p == 9100:
@@ -1017,7 +2411,10 @@ def discover_host_with_ports(ip: str, ports: List[int]) -> Dict[str, Any]:
 
     # Atualiza serviços com nomes refinados e persiste
     services = updated_services
-    record_discovery_host(ip, rdns, os_label, status, list(zip(services, open_ports)))
+    if persist:
+        record_discovery_host(ip, rdns, os_label, status, list(zip(services, open_ports)))
+        if docker.get("containers"):
+            persist_docker_containers(ip, docker)
 
     return {
         "ip": ip,
@@ -1030,78 +2427,217 @@ def discover_host_with_ports(ip: str, ports: List[int]) -> Dict[str, Any]:
         "virtualization": virt_guess,
         "node_exporter": node,
         "docker": docker,
+        "probe_plan": plan_decisions,
+        "scan": scan_info,
         "timestamp": time.strftime("%Y-%m-%d %H:%M:%S"),
     }
 
 
+def parse_docker_ps_json_lines(text: Optional[str]) -> List[Dict[str, Any]]:
+    """Containers from `docker ps -a --no-trunc --format '{{json .}}'` (one JSON object per line)."""
+    containers: List[Dict[str, Any]] = []
+    for ln in (text or "").splitlines():
+        ln = ln.strip()
+        if not ln:
+            continue
+        try:
+            obj = json.loads(ln)
+        except Exception:
+            obj = None
+        if not obj:
+            continue
+        # Classificar serviços do container a partir da string Ports
+        svc_tags: List[str] = []
+        try:
+            ports_str = obj.get("Ports") or ""
+            for part in re.split(r",\s*", ports_str):
+                m = re.search(r"(?:(\d+)->)?(\d+)/(tcp|udp)?", part)
+                if m:
+                    pub = m.group(1)
+                    priv = m.group(2)
+                    num = int(pub or priv)
+                    svc = SERVICE_MAP.get(num, f"port-{num}")
+                    svc_tags.append(f"{svc}:{num}")
+        except Exception:
+            pass
+        containers.append({
+            "id": obj.get("ID"),
+            "name": obj.get("Names"),
+            "image": obj.get("Image"),
+            "ports": obj.get("Ports"),
+            "state": obj.get("State"),
+            "status": obj.get("Status"),
+            "services_classified": svc_tags,
+            "running": bool(str(obj.get("Status") or "").lower().startswith("up")),
+        })
+    return containers
+
+
+def parse_compose_ls_output(out: str) -> List[Dict[str, Any]]:
+    try:
+        data = json.loads(out)
+    except Exception:
+        data = None
+    if not isinstance(data, list):
+        # formato texto; apenas guardar snippet
+        return [{"raw": out[:512]}]
+    return [{
+        "name": p.get("Name") or p.get("name") or p.get("project"),
+        "status": p.get("Status") or p.get("status"),
+        "created": p.get("Created") or p.get("created"),
+    } for p in data if isinstance(p, dict)]
+
+
+# ----------------------
+# Linux collector (single SSH round trip)
+# ----------------------
+
+SSH_COLLECT_MODE = os.environ.get("SSH_COLLECT_MODE", "script").lower()  # script | commands
+SSH_COLLECT_MAX_SECTION = int(os.environ.get("SSH_COLLECT_MAX_SECTION", "262144"))  # bytes por seção
+SSH_COLLECT_TIMEOUT = float(os.environ.get("SSH_COLLECT_TIMEOUT", "8"))
+
+# POSIX sh: cada seção vira uma string JSON (escape com tr/sed/awk); ferramenta ausente => seção vazia
+LINUX_COLLECTOR_SCRIPT = r'''
+q() { tr -d '\000-\010\013-\037' | tr '\t' ' ' | sed -e 's/\\/\\\\/g' -e 's/"/\\"/g' | awk 'NR > 1 { printf "\\n" } { printf "%s", $0 }'; }
+s() { printf ',"%s":"' "$1"; shift; (eval "$*") 2>/dev/null | head -c "$MAX" | q; printf '"'; }
+t() { command -v "$1" >/dev/null 2>&1 && printf true || printf false; }
+MAX=__MAX__
+printf '{"version":1,"tools":{"ss":%s,"docker":%s,"docker_compose":%s}' "$(t ss)" "$(t docker)" "$(t docker-compose)"
+s os_release 'cat /etc/os-release'
+s uname 'uname -srm'
+s listeners 'ss -tulnp'
+s compose 'docker compose ls --all --format json || docker-compose ls --all --format json'
+s containers "docker ps -a --no-trunc --format '{{json .}}'"
+s loadavg 'cat /proc/loadavg'
+s meminfo 'grep -E "^(MemTotal|MemAvailable|MemFree|SwapTotal|SwapFree):" /proc/meminfo'
+s cpu 'getconf _NPROCESSORS_ONLN; head -n 1 /proc/stat; sleep 0.2; head -n 1 /proc/stat'
+printf '}\n'
+'''
+
+LINUX_COLLECTOR_CMD = "sh -c " + shlex.quote(LINUX_COLLECTOR_SCRIPT.replace("__MAX__", str(SSH_COLLECT_MAX_SECTION)))
+
+
+def parse_os_release(text: str) -> Dict[str, str]:
+    out: Dict[str, str] = {}
+    for ln in (text or "").splitlines():
+        key, sep, value = ln.partition("=")
+        if sep and key.strip():
+            out[key.strip()] = value.strip().strip('"').strip("'")
+    return out
+
+
+def parse_collector_snapshot(doc: Dict[str, Any]) -> Dict[str, Any]:
+    """CPU/memória/load do coletor: CPU% entre as duas leituras de /proc/stat."""
+    snap: Dict[str, Any] = {}
+    load = (doc.get("loadavg") or "").split()
+    if len(load) >= 3:
+        try:
+            snap["load"] = [float(x) for x in load[:3]]
+        except ValueError:
+            pass
+    mem: Dict[str, int] = {}
+    for ln in (doc.get("meminfo") or "").splitlines():
+        m = re.match(r"(\w+):\s+(\d+)", ln)
+        if m:
+            mem[m.group(1)] = int(m.group(2))
+    if mem.get("MemTotal"):
+        avail = mem.get("MemAvailable", mem.get("MemFree", 0))
+        snap["mem_total_kb"] = mem["MemTotal"]
+        snap["mem_available_kb"] = avail
+        snap["mem_used_percent"] = round(100.0 * (mem["MemTotal"] - avail) / mem["MemTotal"], 2)
+    cpu_lines = (doc.get("cpu") or "").splitlines()
+    if cpu_lines and cpu_lines[0].strip().isdigit():
+        snap["cpus"] = int(cpu_lines[0].strip())
+    samples = [[int(x) for x in ln.split()[1:]] for ln in cpu_lines if ln.startswith("cpu ")]
+    if len(samples) == 2:
+        total = sum(samples[1]) - sum(samples[0])
+        idle = sum(samples[1][3:5]) - sum(samples[0][3:5])  # idle + iowait
+        if total > 0:
+            snap["cpu_usage_percent"] = round(100.0 * (total - idle) / total, 2)
+    return snap
+
+
+def ssh_collect_linux(ip: str, ssh_user: str, ssh_pass: Optional[str] = None, ssh_key: Optional[str] = None,
+                      ssh_port: int = 22, ssh_timeout: float = 3.0) -> Optional[Dict[str, Any]]:
+    """Run the composite collector once and parse every section; None if the host could not run it."""
+    ok, out, err = ssh_exec(ip, ssh_user, LINUX_COLLECTOR_CMD, password=ssh_pass, key_path=ssh_key,
+                            port=ssh_port, timeout=max(ssh_timeout, SSH_COLLECT_TIMEOUT))
+    if not ok or not out:
+        return None
+    try:
+        doc = json.loads(out[out.find("{"):])
+    except Exception:
+        return None
+    if not isinstance(doc, dict) or doc.get("version") != 1:
+        return None
+    tools = doc.get("tools") or {}
+    compose_raw = (doc.get("compose") or "").strip()
+    return {
+        "tools": tools,
+        "os_release": parse_os_release(doc.get("os_release") or ""),
+        "uname": (doc.get("uname") or "").strip() or None,
+        "listeners": parse_ss_tulnp_output(doc.get("listeners") or ""),
+        "compose_projects": parse_compose_ls_output(compose_raw) if compose_raw else [],
+        "containers": parse_docker_ps_json_lines(doc.get("containers")),
+        "docker_present": bool(tools.get("docker")) or bool(compose_raw),
+        "snapshot": parse_collector_snapshot(doc),
+    }
+
+
 def enrich_linux_details(ip: str, base: Dict[str, Any], ssh_user: Optional[str] = None,
                          ssh_pass: Optional[str] = None, ssh_key: Optional[str] = None,
                          ssh_port: int = 22, ssh_timeout: float = 3.0) -> Dict[str, Any]:
-    """If host looks like Linux and SSH creds provided, run 'ss -tulnp' and (optionally) 'docker ps'."""
+    """If host looks like Linux and SSH creds provided, collect listeners and containers.
+    SSH_COLLECT_MODE=script does it in one round trip; "commands" (or a host that cannot run the
+    collector) falls back to separate 'ss -tulnp' and 'docker ps' calls.
+    """
     os_label = (base.get("os") or "").lower()
     open_ports = base.get("open_ports") or []
     # Only proceed if Linux and SSH port seems open and we have credentials
-    if ("linux" in os_label) and (22 in open_ports) and ssh_user and (ssh_pass or ssh_key):
+    if not (("linux" in os_label) and (22 in open_ports) and ssh_user and (ssh_pass or ssh_key)):
+        return base
+    collected = None
+    if SSH_COLLECT_MODE == "script":
+        collected = ssh_collect_linux(ip, ssh_user, ssh_pass, ssh_key, ssh_port, ssh_timeout)
+    if collected is not None:
+        entries = collected["listeners"]
+        containers = collected["containers"]
+        docker_present_via_ssh = collected["docker_present"]
+        if collected["os_release"].get("PRETTY_NAME"):
+            base["os_release"] = collected["os_release"]["PRETTY_NAME"]
+        base["host_snapshot"] = collected["snapshot"]
+        base["ssh_collect"] = "script"
+    else:
         ok, out, err = ssh_exec(ip, ssh_user, "ss -tulnp", password=ssh_pass, key_path=ssh_key, port=ssh_port, timeout=ssh_timeout)
-        if ok and out:
-            entries = parse_ss_tulnp_output(out)
-            base["linux_ports"] = entries
-            # Add into services_detailed
-            dets = base.get("services_detailed") or []
-            for e in entries:
-                svc_name = map_service_from_process_or_port(e.get("process"), e.get("port"))
-                dets.append({"service": svc_name, "port": e.get("port"), "verified": True, "detail": e.get("process")})
-            base["services_detailed"] = dets
-            # Sempre tentar coletar containers via SSH (sem depender de Portainer/heurísticas)
-            ok2, out2, err2 = ssh_exec(ip, ssh_user, "docker ps -a --format '{{json .}}'", password=ssh_pass, key_path=ssh_key, port=ssh_port, timeout=ssh_timeout)
-            containers: List[Dict[str, Any]] = []
-            docker_present_via_ssh = False
-            if ok2:
-                if (err2 or "") and ("not found" in (err2 or "").lower() or "docker: command not found" in (err2 or "").lower()):
-                    docker_present_via_ssh = False
-                else:
-                    docker_present_via_ssh = True
-            if ok2 and out2:
-                for ln in out2.splitlines():
-                    ln = ln.strip()
-                    if not ln:
-                        continue
-                    try:
-                        obj = json.loads(ln)
-                    except Exception:
-                        obj = None
-                    if obj:
-                        # Classificar serviços do container a partir da string Ports
-                        svc_tags: List[str] = []
-                        try:
-                            ports_str = obj.get("Ports") or ""
-                            for part in re.split(r",\s*", ports_str):
-                                m = re.search(r"(?:(\d+)->)?(\d+)/(tcp|udp)?", part)
-                                if m:
-                                    pub = m.group(1)
-                                    priv = m.group(2)
-                                    num = int(pub or priv)
-                                    svc = SERVICE_MAP.get(num, f"port-{num}")
-                                    svc_tags.append(f"{svc}:{num}")
-                        except Exception:
-                            pass
-                        containers.append({
-                            "id": obj.get("ID"),
-                            "name": obj.get("Names"),
-                            "image": obj.get("Image"),
-                            "ports": obj.get("Ports"),
-                            "status": obj.get("Status"),
-                            "services_classified": svc_tags,
-                            "running": bool(str(obj.get("Status") or "").lower().startswith("up")),
-                        })
-            # Merge with existing docker info if present
-            docker_info = base.get("docker") or {}
-            if docker_present_via_ssh:
-                docker_info["present"] = True
-                docker_info.setdefault("hint_ssh", True)
-            if containers is not None:
-                docker_info["containers"] = containers
-            base["docker"] = docker_info
+        if not (ok and out):
+            return base
+        entries = parse_ss_tulnp_output(out)
+        # Sempre tentar coletar containers via SSH (sem depender de Portainer/heurísticas)
+        ok2, out2, err2 = ssh_exec(ip, ssh_user, "docker ps -a --no-trunc --format '{{json .}}'", password=ssh_pass, key_path=ssh_key, port=ssh_port, timeout=ssh_timeout)
+        docker_present_via_ssh = False
+        if ok2:
+            if (err2 or "") and ("not found" in (err2 or "").lower() or "docker: command not found" in (err2 or "").lower()):
+                docker_present_via_ssh = False
+            else:
+                docker_present_via_ssh = True
+        containers = parse_docker_ps_json_lines(out2) if ok2 else []
+        base["ssh_collect"] = "commands"
+    # Merge with existing docker info if present (containers count even when no listener was reported)
+    docker_info = base.get("docker") or {}
+    if docker_present_via_ssh:
+        docker_info["present"] = True
+        docker_info.setdefault("hint_ssh", True)
+    docker_info["containers"] = containers
+    base["docker"] = docker_info
+    if not entries:
+        return base
+    base["linux_ports"] = entries
+    # Add into services_detailed
+    dets = base.get("services_detailed") or []
+    for e in entries:
+        svc_name = map_service_from_process_or_port(e.get("process"), e.get("port"))
+        dets.append({"service": svc_name, "port": e.get("port"), "verified": True, "detail": e.get("process")})
+    base["services_detailed"] = dets
     return base
 
 # Docker via SSH (compose + containers)
@@ -1110,82 +2646,37 @@ def probe_docker_via_ssh(ip: str, ssh_user: Optional[str] = None, ssh_pass: Opti
     result: Dict[str, Any] = {"present": False}
     if not (ssh_user and (ssh_pass or ssh_key)):
         return result
-    # 1) Tentar docker compose ls (como sugerido)
-    compose_ok = False
-    compose_projects: List[Dict[str, Any]] = []
-    for cmd in ["docker compose ls --format json", "docker compose ls", "docker-compose ls --format json", "docker-compose ls"]:
-        ok, out, err = ssh_exec(ip, ssh_user, cmd, password=ssh_pass, key_path=ssh_key, port=ssh_port, timeout=ssh_timeout)
-        if ok:
-            if (err or "") and ("not found" in (err or "").lower() or "command not found" in (err or "").lower() or "unknown" in (err or "").lower()):
-                compose_ok = False
-                continue
-            if out:
-                compose_ok = True
-                # tentar parse json
-                try:
-                    data = json.loads(out)
-                    if isinstance(data, list):
-                        for p in data:
-                            compose_projects.append({
-                                "name": p.get("Name") or p.get("name") or p.get("project"),
-                                "status": p.get("Status") or p.get("status"),
-                                "created": p.get("Created") or p.get("created"),
-                            })
-                    else:
-                        # formato texto; apenas guardar snippet
-                        compose_projects.append({"raw": out[:512]})
-                except Exception:
-                    compose_projects.append({"raw": out[:512]})
-                break
-    # 2) docker ps -a para listar containers e decidir presença
-    ok2, out2, err2 = ssh_exec(ip, ssh_user, "docker ps -a --format '{{json .}}'", password=ssh_pass, key_path=ssh_key, port=ssh_port, timeout=ssh_timeout)
-    containers: List[Dict[str, Any]] = []
-    docker_present_via_ssh = False
-    if ok2:
-        if (err2 or "") and ("not found" in (err2 or "").lower() or "docker: command not found" in (err2 or "").lower()):
-            docker_present_via_ssh = False
-        else:
-            docker_present_via_ssh = True
-    if ok2 and out2:
-        for ln in out2.splitlines():
-            ln = ln.strip()
-            if not ln:
-                continue
-            try:
-                obj = json.loads(ln)
-            except Exception:
-                obj = None
-            if obj:
-                svc_tags: List[str] = []
-                try:
-                    ports_str = obj.get("Ports") or ""
-                    for part in re.split(r",\s*", ports_str):
-                        m = re.search(r"(?:(\d+)->)?(\d+)/(tcp|udp)?", part)
-                        if m:
-                            pub = m.group(1)
-                            priv = m.group(2)
-                            num = int(pub or priv)
-                            svc = SERVICE_MAP.get(num, f"port-{num}")
-                            svc_tags.append(f"{svc}:{num}")
-                except Exception:
-                    pass
-                # logs por ID (tail 100)
-                logs_tail: str | None = None
-                cid = obj.get("ID")
-                if cid:
-                    ok3, out3, err3 = ssh_exec(ip, ssh_user, f"docker logs {cid} --tail 100", password=ssh_pass, key_path=ssh_key, port=ssh_port, timeout=ssh_timeout)
-                    if ok3 and out3:
-                        logs_tail = out3[-4000:]
-                containers.append({
-                    "id": cid,
-                    "name": obj.get("Names"),
-                    "image": obj.get("Image"),
-                    "ports": obj.get("Ports"),
-                    "status": obj.get("Status"),
-                    "services_classified": svc_tags,
-                    "running": bool(str(obj.get("Status") or "").lower().startswith("up")),
-                    "logs_tail": logs_tail,
-                })
+    collected = None
+    if SSH_COLLECT_MODE == "script":
+        collected = ssh_collect_linux(ip, ssh_user, ssh_pass, ssh_key, ssh_port, ssh_timeout)
+    if collected is not None:
+        compose_projects = collected["compose_projects"]
+        compose_ok = bool(compose_projects)
+        containers = collected["containers"]
+        docker_present_via_ssh = collected["docker_present"]
+    else:
+        # 1) Tentar docker compose ls (como sugerido)
+        compose_ok = False
+        compose_projects: List[Dict[str, Any]] = []
+        for cmd in ["docker compose ls --format json", "docker compose ls", "docker-compose ls --format json", "docker-compose ls"]:
+            ok, out, err = ssh_exec(ip, ssh_user, cmd, password=ssh_pass, key_path=ssh_key, port=ssh_port, timeout=ssh_timeout)
+            if ok:
+                if (err or "") and ("not found" in (err or "").lower() or "command not found" in (err or "").lower() or "unknown" in (err or "").lower()):
+                    compose_ok = False
+                    continue
+                if out:
+                    compose_ok = True
+                    compose_projects = parse_compose_ls_output(out)
+                    break
+        # 2) docker ps -a para listar containers e decidir presença
+        ok2, out2, err2 = ssh_exec(ip, ssh_user, "docker ps -a --no-trunc --format '{{json .}}'", password=ssh_pass, key_path=ssh_key, port=ssh_port, timeout=ssh_timeout)
+        docker_present_via_ssh = False
+        if ok2:
+            if (err2 or "") and ("not found" in (err2 or "").lower() or "docker: command not found" in (err2 or "").lower()):
+                docker_present_via_ssh = False
+            else:
+                docker_present_via_ssh = True
+        containers = parse_docker_ps_json_lines(out2) if ok2 else []
     # Decisão de presença:
     # - Se compose falhou (erro), considerar sem Docker conforme sugestão
     # - Caso contrário, se docker ps funcionou, considerar presente
@@ -1199,1448 +2690,4253 @@ def probe_docker_via_ssh(ip: str, ssh_user: Optional[str] = None, ssh_pass: Opti
     result["compose_projects"] = compose_projects
     result["containers"] = containers
     result["source"] = "ssh"
+    if collected is not None:
+        result["collect"] = "script"
+        result["host"] = {"os_release": collected["os_release"].get("PRETTY_NAME"), "uname": collected["uname"], **collected["snapshot"]}
     return result
 
 
-def winrm_exec(ip: str, user: str, ps_script: str, password: Optional[str] = None,
-               use_tls: bool = False, port: int = 5985, timeout: float = 4.0) -> Tuple[bool, str | None, str | None]:
-    """Execute PowerShell script remotely via WinRM. Returns (ok, stdout, stderr)."""
-    if not winrm:
-        return False, None, "pywinrm not installed"
-    endpoint = f"{'https' if use_tls else 'http'}://{ip}:{port}/wsman"
-    try:
-        session = winrm.Session(endpoint, auth=(user, password))
-        r = session.run_ps(ps_script)
-        out = (r.std_out or b"").decode(errors="ignore")
-        err = (r.std_err or b"").decode(errors="ignore")
-        return (r.status_code == 0, out, err)
-    except Exception as e:
-        return False, None, str(e)
-
+# ----------------------
+# Container logs (on demand)
+# ----------------------
 
-def enrich_windows_details(ip: str, base: Dict[str, Any], winrm_user: Optional[str] = None,
-                           winrm_pass: Optional[str] = None, winrm_use_tls: bool = False,
-                           winrm_port: int = 5985, winrm_timeout: float = 4.0) -> Dict[str, Any]:
-    """If host looks like Windows and WinRM creds provided, collect listening ports and OS info."""
-    os_label = (base.get("os") or "").lower()
-    open_ports: List[int] = base.get("open_ports") or []
-    looks_windows = ("windows" in os_label) or (5985 in open_ports) or (5986 in open_ports)
-    if looks_windows and winrm_user and winrm_pass:
-        # Collect listeners and map to processes
-        ps_collect = r"""
-        $cons = @()
-        try {
-          $cons = Get-NetTCPConnection -State Listen | Select-Object -Property LocalAddress,LocalPort,OwningProcess
-        } catch {
-          $cons = @()
-        }
-        $procs = Get-Process | Select-Object -Property Id, ProcessName, Path
-        $results = @()
-        foreach ($c in $cons) {
-          $p = $procs | Where-Object { $_.Id -eq $c.OwningProcess } | Select-Object -First 1
-          $name = if ($p) { $p.ProcessName } else { $null }
-          $path = if ($p) { $p.Path } else { $null }
-          $results += [pscustomobject]@{ addr = $c.LocalAddress; port = [int]$c.LocalPort; pid = [int]$c.OwningProcess; process = $name; path = $path }
-        }
-        $results | ConvertTo-Json
-        """
-        ok1, out1, err1 = winrm_exec(ip, winrm_user, ps_collect, password=winrm_pass, use_tls=winrm_use_tls, port=winrm_port, timeout=winrm_timeout)
-        windows_ports: List[Dict[str, Any]] = []
-        if ok1 and out1:
-            try:
-                data = json.loads(out1)
-                if isinstance(data, dict):
-                    data = [data]
-                for e in (data or []):
-                    try:
-                        windows_ports.append({
-                            "addr": e.get("addr"),
-                            "port": int(e.get("port")) if e.get("port") is not None else None,
-                            "pid": int(e.get("pid")) if e.get("pid") is not None else None,
-                            "process": e.get("process"),
-                            "path": e.get("path"),
-                        })
-                    except Exception:
-                        pass
-            except Exception:
-                pass
-        base["windows_ports"] = windows_ports
-        # Add into services_detailed respecting open_ports filter on frontend
-        dets = base.get("services_detailed") or []
-        for e in windows_ports:
-            svc_name = map_service_from_process_or_port(e.get("process"), e.get("port"))
-            dets.append({"service": svc_name, "port": e.get("port"), "verified": True, "detail": e.get("process")})
-        base["services_detailed"] = dets
-        # OS info from CIM
-        ps_os = r"""
-        $os = Get-CimInstance Win32_OperatingSystem | Select-Object -Property Caption,Version,BuildNumber
-        $os | ConvertTo-Json
-        """
-        ok2, out2, err2 = winrm_exec(ip, winrm_user, ps_os, password=winrm_pass, use_tls=winrm_use_tls, port=winrm_port, timeout=winrm_timeout)
-        if ok2 and out2:
-            try:
-                os_obj = json.loads(out2)
-                caption = os_obj.get("Caption") or None
-                if caption:
-                    base["os"] = caption
-            except Exception:
-                pass
-    return base
+DOCKER_LOGS_TAIL = int(os.environ.get("DOCKER_LOGS_TAIL", "100"))
+DOCKER_LOGS_CACHE_TTL = float(os.environ.get("DOCKER_LOGS_CACHE_TTL", "10"))
+DOCKER_LOGS_CACHE_MAX = int(os.environ.get("DOCKER_LOGS_CACHE_MAX", "512"))
+DOCKER_LOGS_WORKERS = int(os.environ.get("DOCKER_LOGS_WORKERS", "8"))  # containers buscados em paralelo
+DOCKER_LOGS_MAX_CONTAINERS = 100
+DOCKER_CONTAINER_REF_RE = re.compile(r"^[A-Za-z0-9][A-Za-z0-9_.-]{0,127}$")
 
+# (ip, origem, container, tail, max_bytes) -> (quando, resultado)
+DOCKER_LOGS_CACHE: "OrderedDict[Tuple[str, str, str, int, int], Tuple[float, Dict[str, Any]]]" = OrderedDict()
+DOCKER_LOGS_LOCK = threading.Lock()
 
-def compose_os_label(base: Dict[str, Any]) -> str:
-    """Compose OS label prioritizing real sources (Node Exporter uname, Docker info, Windows Caption)."""
-    node = base.get("node_exporter") or {}
-    docker = base.get("docker") or {}
-    node_uname = node.get("uname") if node.get("present") else None
-    docker_os = ((docker.get("info") or {}).get("OperatingSystem")) if docker.get("present") else None
-    current = base.get("os")
-    return node_uname or docker_os or current or "Unknown"
+
+def docker_api_base(ip: str, timeout: float = 1.5) -> Optional[Tuple[str, bool]]:
+    """First Docker Engine API endpoint answering /_ping: (base_url, is_https)."""
+    for base, is_https in ((f"http://{ip}:2375", False), (f"https://{ip}:2376", True)):
+        try:
+            r = http_get_bounded(base + "/_ping", timeout=timeout, max_bytes=64, verify=not is_https)
+            if r["status_code"] == 200:
+                return base, is_https
+        except Exception:
+            continue
+    return None
+
+
+def docker_logs_via_api(base: str, is_https: bool, cid: str, tail: int, max_bytes: int,
+                        timeout: float = 1.5, max_time: float = HTTP_PROBE_MAX_TIME) -> Dict[str, Any]:
+    """Container logs from the Engine API keeping the last max_bytes, like `tail -c` on the SSH path.
+    Frames are demultiplexed as they arrive so only max_bytes of output are held in memory.
+    """
+    deadline = time.time() + max_time
+    r = HTTP_SESSION.get(base + f"/containers/{cid}/logs?stdout=1&stderr=1&tail={tail}", timeout=timeout,
+                         verify=not is_https, stream=True)
+    try:
+        if r.status_code != 200:
+            return {"text": None, "error": f"HTTP {r.status_code}"}
+        pending = bytearray()
+        out = bytearray()
+        framed: Optional[bool] = None  # containers sem TTY têm cabeçalho de 8 bytes por frame
+        truncated = False
+        for chunk in http_iter_bounded(r, timeout, deadline):
+            if chunk is None:
+                truncated = True
+                break
+            pending += chunk
+            if framed is None and len(pending) >= 8:
+                framed = pending[0] in (0, 1, 2) and pending[1:4] == b"\0\0\0"
+            while framed and len(pending) >= 8:
+                if pending[0] not in (0, 1, 2) or pending[1:4] != b"\0\0\0":
+                    framed = False
+                    break
+                size = struct.unpack(">I", pending[4:8])[0]
+                if len(pending) < 8 + size:
+                    break
+                out += pending[8:8 + size]
+                del pending[:8 + size]
+            if framed is False:
+                out += pending
+                pending.clear()
+            if len(out) > max_bytes:
+                del out[:len(out) - max_bytes]
+                truncated = True
+        out += pending[8:] if framed else pending
+        if len(out) > max_bytes:
+            del out[:len(out) - max_bytes]
+            truncated = True
+    finally:
+        r.close()
+    return {"text": bytes(out).decode("utf-8", errors="replace"), "truncated": truncated}
+
+
+def docker_logs_via_ssh(ip: str, cid: str, tail: int, max_bytes: int, ssh_user: str, ssh_pass: Optional[str] = None,
+                        ssh_key: Optional[str] = None, ssh_port: int = 22, ssh_timeout: float = 3.0) -> Dict[str, Any]:
+    # tail -c no host remoto: só max_bytes atravessam a rede
+    cmd = f"docker logs --tail {int(tail)} {shlex.quote(cid)} 2>&1 | tail -c {int(max_bytes) + 1}"
+    ok, out, err = ssh_exec(ip, ssh_user, cmd, password=ssh_pass, key_path=ssh_key, port=ssh_port, timeout=ssh_timeout)
+    if not ok:
+        return {"text": None, "error": err}
+    out = out or ""
+    truncated = len(out.encode("utf-8", errors="ignore")) > max_bytes
+    return {"text": out[-max_bytes:] if truncated else out, "truncated": truncated}
+
+
+def fetch_container_logs(ip: str, container_ids: List[str], tail: int = DOCKER_LOGS_TAIL,
+                         max_bytes: int = DOCKER_LOGS_MAX_BYTES, ssh: Optional[Dict[str, Any]] = None,
+                         fresh: bool = False) -> Dict[str, Any]:
+    """Logs of the selected containers, fetched concurrently (SSH when credentials are given, else the Engine API).
+    Results are cached for DOCKER_LOGS_CACHE_TTL seconds.
+    """
+    source = "ssh" if ssh else "api"
+    # logs via SSH ficam em cache por credencial: outra credencial (ou uma inválida) não lê o cache
+    scope = (f"ssh:{ssh['ssh_user']}:{ssh.get('ssh_port', 22)}:"
+             f"{ssh_credential_fingerprint(ssh.get('ssh_pass'), ssh.get('ssh_key'))}") if ssh else "api"
+    now = time.time()
+    logs: Dict[str, Dict[str, Any]] = {}
+    missing: List[str] = []
+    with DOCKER_LOGS_LOCK:
+        for cid in container_ids:
+            key = (ip, scope, cid, tail, max_bytes)
+            hit = DOCKER_LOGS_CACHE.get(key)
+            if hit and not fresh and now - hit[0] < DOCKER_LOGS_CACHE_TTL:
+                DOCKER_LOGS_CACHE.move_to_end(key)
+                logs[cid] = dict(hit[1], cached=True)
+            else:
+                missing.append(cid)
+    if missing:
+        if ssh:
+            fetch = lambda cid: docker_logs_via_ssh(ip, cid, tail, max_bytes, **ssh)
+        else:
+            api = docker_api_base(ip)
+            if api is None:
+                return {"ip": ip, "source": source, "error": "Docker API não acessível (2375/2376)", "logs": logs}
+            fetch = lambda cid: docker_logs_via_api(api[0], api[1], cid, tail, max_bytes)
+
+        def run(cid: str) -> Dict[str, Any]:
+            try:
+                return fetch(cid)
+            except Exception as e:
+                return {"text": None, "error": str(e)}
+
+        with ThreadPoolExecutor(max_workers=max(1, min(DOCKER_LOGS_WORKERS, len(missing)))) as ex:
+            fetched = dict(zip(missing, ex.map(run, missing)))
+        with DOCKER_LOGS_LOCK:
+            for cid, res in fetched.items():
+                if res.get("text") is not None:
+                    DOCKER_LOGS_CACHE[(ip, scope, cid, tail, max_bytes)] = (time.time(), res)
+            while len(DOCKER_LOGS_CACHE) > DOCKER_LOGS_CACHE_MAX:
+                DOCKER_LOGS_CACHE.popitem(last=False)
+        for cid, res in fetched.items():
+            logs[cid] = dict(res, cached=False)
+    return {"ip": ip, "source": source, "tail": tail, "max_bytes": max_bytes,
+            "logs": {cid: logs[cid] for cid in container_ids if cid in logs}}
 
 
 # ----------------------
-# Discovery Endpoints
+# Docker event watcher (inventário de containers)
 # ----------------------
 
-@app.post("/api/discovery/network")
-def discovery_network(payload: Dict[str, Any] = Body(...)):
-    target = payload.get("target")  # expected "start-end" or CIDR
-    method = payload.get("method", "tcp")
-    sshUser = payload.get("sshUser")
-    sshPass = payload.get("sshPass")
-    sshKey = payload.get("sshKey")
-    sshPort = int(payload.get("sshPort", 22))
-    sshTimeout = float(payload.get("sshTimeout", 3.0))
-    winrmUser = payload.get("winrmUser")
-    winrmPass = payload.get("winrmPass")
-    winrmUseTls = bool(payload.get("winrmUseTls", False))
-    winrmPort = int(payload.get("winrmPort", 5985))
-    winrmTimeout = float(payload.get("winrmTimeout", 4.0))
-    discovered: List[Dict[str, Any]] = []
-    ips: List[str] = []
-    ports: List[int] = get_ports_for_method(method)
+DOCKER_WATCH_ENABLED = os.environ.get("DOCKER_WATCH_ENABLED", "0").lower() in ("1", "true", "yes")
+# "10.0.0.5" (Engine API 2375/2376) ou "ssh:10.0.0.6[:porta]" (docker events via SSH)
+DOCKER_WATCH_TARGETS = [t.strip() for t in os.environ.get("DOCKER_WATCH_TARGETS", "").split(",") if t.strip()]
+DOCKER_WATCH_SSH_USER = os.environ.get("DOCKER_WATCH_SSH_USER")
+DOCKER_WATCH_SSH_KEY = os.environ.get("DOCKER_WATCH_SSH_KEY")
+DOCKER_WATCH_IDLE = float(os.environ.get("DOCKER_WATCH_IDLE", "300"))  # sem eventos por esse tempo: reconecta
+DOCKER_WATCH_BACKOFF_MAX = float(os.environ.get("DOCKER_WATCH_BACKOFF_MAX", "60"))
+DOCKER_WATCH_MIN_UPTIME = float(os.environ.get("DOCKER_WATCH_MIN_UPTIME", "30"))  # stream estável: zera o backoff
+
+# Ação do evento -> estado do container; "destroy" remove, "rename"/"health_status" só atualizam atributos
+DOCKER_EVENT_STATES = {
+    "create": "created", "start": "running", "restart": "running", "unpause": "running",
+    "pause": "paused", "die": "exited", "stop": "exited",
+}
+DOCKER_EVENT_ACTIONS = set(DOCKER_EVENT_STATES) | {"destroy", "rename", "health_status"}
 
-    if not target:
-        return {"discoveredDevices": []}
+CONTAINER_INVENTORY: Dict[str, Dict[str, Dict[str, Any]]] = {}  # ip -> id -> container
+DOCKER_WATCHERS: Dict[str, Dict[str, Any]] = {}
+DOCKER_WATCH_LOCK = threading.Lock()
 
-    # Parse target
-    if "/" in target:
-        try:
-            net = ipaddress.ip_network(target, strict=False)
-            ips = [str(ip) for ip in net.hosts()]
-        except Exception:
-            ips = []
-    elif "-" in target:
+
+def _docker_time(value: Any) -> Optional[float]:
+    """Epoch of a Docker RFC 3339 timestamp (nanoseconds are dropped)."""
+    if not value:
+        return None
+    try:
+        text = re.sub(r"\.\d+", "", str(value)).replace("Z", "+00:00")
+        return datetime.datetime.fromisoformat(text).timestamp()
+    except ValueError:
+        return None
+
+
+def docker_inventory_replace(ip: str, containers: List[Dict[str, Any]], device_id: Optional[int]) -> None:
+    with DOCKER_WATCH_LOCK:
+        CONTAINER_INVENTORY[ip] = {c["id"]: dict(c) for c in containers if c.get("id")}
+    if device_id:
+        pg_sync_containers(device_id, containers)
+
+
+def docker_apply_event(ip: str, ev: Dict[str, Any], device_id: Optional[int] = None) -> Optional[str]:
+    """Apply one container event to the inventory (and PG); returns the action applied, if any."""
+    if (ev.get("Type") or "container") != "container":
+        return None
+    action = str(ev.get("Action") or ev.get("status") or "").split(":")[0].strip()
+    if action not in DOCKER_EVENT_ACTIONS:
+        return None
+    actor = ev.get("Actor") or {}
+    attrs = actor.get("Attributes") or {}
+    cid = actor.get("ID") or ev.get("id")
+    if not cid:
+        return None
+    with DOCKER_WATCH_LOCK:
+        host = CONTAINER_INVENTORY.setdefault(ip, {})
+        if action == "destroy":
+            host.pop(cid, None)
+            container = None
+        else:
+            container = host.get(cid) or {"id": cid, "ports": None, "labels": None, "services_classified": []}
+            state = DOCKER_EVENT_STATES.get(action)
+            if state:
+                container["state"] = state
+                container["running"] = state == "running"
+                if action == "die" and attrs.get("exitCode") is not None:
+                    container["status"] = f"Exited ({attrs['exitCode']})"
+                else:
+                    container["status"] = state.capitalize() if state != "running" else "Up"
+            if action == "health_status":
+                container["health"] = str(ev.get("Action") or ev.get("status") or "").partition(":")[2].strip() or None
+            if attrs.get("name"):
+                container["name"] = attrs["name"]
+            if attrs.get("image"):
+                container["image"] = attrs["image"]
+            container["event_at"] = ev.get("time") or int(time.time())
+            host[cid] = container
+            container = dict(container)
+    if device_id:
+        if container is None:
+            pg_delete_container(device_id, cid)
+        else:
+            pg_upsert_container(device_id, container)
+    return action
+
+
+def _docker_watch_api(ip: str, watch: Dict[str, Any]) -> None:
+    api = docker_api_base(ip)
+    if api is None:
+        raise RuntimeError("Docker API não acessível (2375/2376)")
+    base, is_https = api
+    version = bounded_json(http_get_bounded(base + "/version", timeout=2.0, max_bytes=DOCKER_API_MAX_BYTES, verify=not is_https))
+    info = bounded_json(http_get_bounded(base + "/info", timeout=2.0, max_bytes=DOCKER_API_MAX_BYTES, verify=not is_https))
+    # "since" no relógio do daemon: eventos entre a listagem e a assinatura são reaplicados
+    since = _docker_time((info or {}).get("SystemTime")) or time.time()
+    listing = http_get_bounded(base + "/containers/json?all=1", timeout=2.0, max_bytes=DOCKER_API_MAX_BYTES, verify=not is_https)
+    conts = bounded_json(listing)
+    if listing["status_code"] != 200 or not isinstance(conts, list):
+        raise RuntimeError(f"listagem de containers falhou (HTTP {listing['status_code']})")
+    containers = [docker_api_container(c) for c in conts]
+    docker_inventory_replace(ip, containers, watch["device_id"])
+    watch.update(source="api", version=version, info=info, synced_at=time.time(), error=None)
+    # Conexão própria (fora do pool compartilhado): o stream fica aberto por horas
+    port = 2376 if is_https else 2375
+    if is_https:
+        conn = http.client.HTTPSConnection(ip, port, timeout=DOCKER_WATCH_IDLE, context=ssl._create_unverified_context())
+    else:
+        conn = http.client.HTTPConnection(ip, port, timeout=DOCKER_WATCH_IDLE)
+    query = urllib.parse.urlencode({"since": str(int(since)), "filters": json.dumps({"type": ["container"]})})
+    try:
+        conn.request("GET", "/events?" + query)
+        resp = conn.getresponse()
+        if resp.status != 200:
+            raise RuntimeError(f"/events HTTP {resp.status}")
+        watch.update(state="streaming", streamed_at=time.time())
+        # shutdown do socket interrompe a leitura bloqueada quando o watcher é parado
+        sock = conn.sock
+        watch["close"] = lambda: sock.shutdown(socket.SHUT_RDWR)
+        while not watch["stop"].is_set():
+            line = resp.readline()
+            if not line:
+                break
+            if line.strip():
+                _docker_watch_event(ip, watch, line)
+    except socket.timeout:
+        pass
+    finally:
+        watch["close"] = None
+        conn.close()
+
+
+def _docker_watch_ssh(ip: str, watch: Dict[str, Any]) -> None:
+    ssh = watch["ssh"]
+    ok, out, err = ssh_exec(ip, ssh["user"], "date +%s; docker ps -a --no-trunc --format '{{json .}}'",
+                            password=ssh.get("password"), key_path=ssh.get("key_path"), port=ssh["port"], timeout=10.0)
+    if not ok or not out:
+        raise RuntimeError(err or "docker ps via SSH falhou")
+    first, _, rest = out.partition("\n")
+    since = int(first.strip()) if first.strip().isdigit() else int(time.time())
+    docker_inventory_replace(ip, parse_docker_ps_json_lines(rest), watch["device_id"])
+    watch.update(source="ssh", synced_at=time.time(), error=None)
+    entry = ssh_pool_acquire(ip, ssh["user"], password=ssh.get("password"), key_path=ssh.get("key_path"), port=ssh["port"], timeout=10.0)
+    broken = False
+    try:
+        stdin, stdout, stderr = entry["client"].exec_command(
+            f"docker events --since {since} --filter type=container --format '{{{{json .}}}}'")
+        stdout.channel.settimeout(DOCKER_WATCH_IDLE)
+        watch["close"] = stdout.channel.close
+        watch.update(state="streaming", streamed_at=time.time())
+        for line in stdout:
+            if watch["stop"].is_set():
+                break
+            if line.strip():
+                _docker_watch_event(ip, watch, line)
+    except socket.timeout:
+        pass
+    except Exception:
+        broken = True
+        raise
+    finally:
+        watch["close"] = None
         try:
-            start, end = target.split("-")
-            start_ip = ipaddress.ip_address(start.strip())
-            end_ip = ipaddress.ip_address(end.strip())
-            cur = int(start_ip)
-            end_i = int(end_ip)
-            while cur <= end_i:
-                ips.append(str(ipaddress.ip_address(cur)))
-                cur += 1
+            stdout.channel.close()
         except Exception:
-            ips = []
+            pass
+        ssh_pool_release(entry, broken=broken)
 
-    # Scan ips com lista de portas conforme método
-    with ThreadPoolExecutor(max_workers=64) as executor:
-        future_map = {executor.submit(discover_host_with_ports, ip, ports): ip for ip in ips}
-        for fut in as_completed(future_map):
-            host = fut.result()
-            # Linux enrichment if SSH creds provided
-            host = enrich_linux_details(host["ip"], host, ssh_user=sshUser, ssh_pass=sshPass, ssh_key=sshKey, ssh_port=sshPort, ssh_timeout=sshTimeout)
-            # Windows enrichment if WinRM creds provided
-            host = enrich_windows_details(host["ip"], host, winrm_user=winrmUser, winrm_pass=winrmPass, winrm_use_tls=winrmUseTls, winrm_port=winrmPort, winrm_timeout=winrmTimeout)
-            host["os"] = compose_os_label(host)
-            discovered.append({
-                "ip": host["ip"],
-                "hostname": host["hostname"],
-                "status": host["status"],
-                "services": [{"service": s} for s in host["services"]],
-                "services_detailed": host.get("services_detailed", []),
-                "linux_ports": host.get("linux_ports"),
-                "windows_ports": host.get("windows_ports"),
-                "os": host["os"],
-                "virtualization": host.get("virtualization"),
-                "timestamp": host["timestamp"],
-            })
 
-    return {"method": method, "discoveredDevices": discovered}
+def _docker_watch_event(ip: str, watch: Dict[str, Any], line: Any) -> None:
+    try:
+        ev = json.loads(line)
+    except Exception:
+        return
+    if isinstance(ev, dict) and docker_apply_event(ip, ev, watch["device_id"]):
+        watch["events"] += 1
+        watch["last_event_at"] = time.time()
 
 
-@app.post("/api/discovery/cross-platform")
-def discovery_cross_platform(payload: Dict[str, Any] = Body(...)):
-    targets: List[str] = payload.get("targets", [])
-    check_ports: bool = bool(payload.get("checkPorts", True))
-    discovered: List[Dict[str, Any]] = []
-    for t in targets:
-        ip = None
+def _docker_watch_loop(ip: str, watch: Dict[str, Any]) -> None:
+    backoff = 1.0
+    while not watch["stop"].is_set():
+        watch.update(state="connecting", streamed_at=None)
+        events_before = watch["events"]
+        try:
+            if watch["device_id"] is None:
+                device = pg_get_device(ip=ip)
+                watch["device_id"] = device.get("id") if device else None
+            if watch["ssh"]:
+                _docker_watch_ssh(ip, watch)
+            else:
+                _docker_watch_api(ip, watch)
+        except Exception as e:
+            watch["error"] = str(e)
+        if watch["stop"].is_set():
+            break
+        watch["reconnects"] += 1
+        # stream que entregou eventos ou ficou aberto DOCKER_WATCH_MIN_UPTIME volta logo; ressincronizar e cair
+        # em seguida (ou falhar) dobra a espera (com jitter)
+        streamed_at = watch.get("streamed_at")
+        healthy = watch["events"] > events_before or (
+            streamed_at is not None and time.time() - streamed_at >= DOCKER_WATCH_MIN_UPTIME)
+        backoff = 1.0 if healthy else min(backoff * 2, DOCKER_WATCH_BACKOFF_MAX)
+        watch["state"] = "backoff"
+        watch["stop"].wait(backoff * random.uniform(0.8, 1.2))
+    watch["state"] = "stopped"
+
+
+def docker_watch_start(ip: str, ssh: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    with DOCKER_WATCH_LOCK:
+        current = DOCKER_WATCHERS.get(ip)
+        if current and current["thread"].is_alive():
+            return docker_watch_view(current)
+        watch: Dict[str, Any] = {
+            "ip": ip, "ssh": ssh, "source": "ssh" if ssh else "api", "state": "starting", "device_id": None,
+            "events": 0, "reconnects": 0, "started_at": time.time(), "synced_at": None, "last_event_at": None,
+            "streamed_at": None, "error": None, "version": None, "info": None, "close": None, "stop": threading.Event(),
+        }
+        watch["thread"] = threading.Thread(target=_docker_watch_loop, args=(ip, watch), name=f"docker-watch-{ip}", daemon=True)
+        DOCKER_WATCHERS[ip] = watch
+    watch["thread"].start()
+    return docker_watch_view(watch)
+
+
+def docker_watch_stop(ip: str) -> bool:
+    with DOCKER_WATCH_LOCK:
+        watch = DOCKER_WATCHERS.pop(ip, None)
+    if not watch:
+        return False
+    watch["stop"].set()
+    close = watch.get("close")
+    if close is not None:
         try:
-            ip = socket.gethostbyname(t)
+            close()
         except Exception:
             pass
-        if not ip:
-            continue
-        host = discover_host(ip) if check_ports else {
-            "ip": ip,
-            "hostname": t,
-            "status": "Unknown",
-            "services": [],
-            "os": "Unknown",
-            "virtualization": None,
-            "timestamp": time.strftime("%Y-%m-%d %H:%M:%S"),
-        }
-        discovered.append(host)
-    return {"discoveredDevices": discovered}
+    return True
+
+
+def docker_watch_view(watch: Dict[str, Any]) -> Dict[str, Any]:
+    containers = len(CONTAINER_INVENTORY.get(watch["ip"], {}))
+    return {k: watch.get(k) for k in ("ip", "source", "state", "events", "reconnects", "started_at", "synced_at",
+                                      "last_event_at", "error")} | {"containers": containers}
+
+
+def docker_inventory_view(ip: str) -> Optional[Dict[str, Any]]:
+    """Container view served from a streaming watcher (None when the host is not being watched)."""
+    with DOCKER_WATCH_LOCK:
+        watch = DOCKER_WATCHERS.get(ip)
+        if not watch or watch["state"] != "streaming":
+            return None
+        containers = [dict(c) for c in CONTAINER_INVENTORY.get(ip, {}).values()]
+    result: Dict[str, Any] = {"present": True, "containers": containers, "source": "watch:" + watch["source"],
+                              "watch": docker_watch_view(watch)}
+    if watch.get("version") is not None:
+        result["version"] = watch["version"]
+    if watch.get("info") is not None:
+        result["info"] = watch["info"]
+    return result
+
+
+def docker_watch_targets() -> List[Tuple[str, Optional[Dict[str, Any]]]]:
+    """DOCKER_WATCH_TARGETS plus inventoried devices with the Engine API (2375/2376) open."""
+    targets: Dict[str, Optional[Dict[str, Any]]] = {}
+    for t in DOCKER_WATCH_TARGETS:
+        if t.startswith("ssh:"):
+            host, _, port = t[4:].partition(":")
+            if DOCKER_WATCH_SSH_USER:
+                targets[host] = {"user": DOCKER_WATCH_SSH_USER, "key_path": DOCKER_WATCH_SSH_KEY, "password": None,
+                                 "port": int(port or 22)}
+        else:
+            targets[t] = None
+    for d in pg_list_devices():
+        ports = {s.get("port") for s in (d.get("services") or []) if isinstance(s, dict)}
+        if d.get("ip") and ports & {2375, 2376}:
+            targets.setdefault(d["ip"], None)
+    return list(targets.items())
+
+
+def docker_watch_autostart() -> None:
+    for ip, ssh in docker_watch_targets():
+        docker_watch_start(ip, ssh)
 
 
 # ----------------------
-# SNMP (pysnmp)
+# Container inventory and resource metrics
 # ----------------------
-try:
-    from pysnmp.hlapi import (
-        SnmpEngine,
-        CommunityData,
-        UdpTransportTarget,
-        ContextData,
-        ObjectType,
-        ObjectIdentity,
-        getCmd,
-        nextCmd,
-        setCmd,
-        OctetString,
-        Integer,
-        IpAddress,
-        Gauge32,
-        Counter32,
-        ObjectIdentifier,
-    )
-    # v3 auth imports (optional)
-    try:
-        from pysnmp.hlapi import (
-            UsmUserData,
-            usmHMACMD5AuthProtocol,
-            usmHMACSHAAuthProtocol,
-            usmHMACSHA256AuthProtocol,
-            usmHMACSHA384AuthProtocol,
-            usmHMACSHA512AuthProtocol,
-            usmNoAuthProtocol,
-            usmDESPrivProtocol,
-            usmAesCfb128Protocol,
-            usmAesCfb192Protocol,
-            usmAesCfb256Protocol,
-            usmNoPrivProtocol,
-        )
-    except Exception:
-        UsmUserData = None  # type: ignore
-        usmHMACMD5AuthProtocol = None  # type: ignore
-        usmHMACSHAAuthProtocol = None  # type: ignore
-        usmHMACSHA256AuthProtocol = None  # type: ignore
-        usmHMACSHA384AuthProtocol = None  # type: ignore
-        usmHMACSHA512AuthProtocol = None  # type: ignore
-        usmNoAuthProtocol = None  # type: ignore
-        usmDESPrivProtocol = None  # type: ignore
-        usmAesCfb128Protocol = None  # type: ignore
-        usmAesCfb192Protocol = None  # type: ignore
-        usmAesCfb256Protocol = None  # type: ignore
-        usmNoPrivProtocol = None  # type: ignore
-    HAS_PYSNMP = True
-except Exception:
-    HAS_PYSNMP = False
 
-# --- LLDP/CDP OIDs ---
-LLDP_REM_SYSNAME = "1.0.8802.1.1.2.1.4.1.1.9"
-LLDP_REM_PORTID = "1.0.8802.1.1.2.1.4.1.1.7"
-LLDP_REM_LOCAL_PORTNUM = "1.0.8802.1.1.2.1.4.1.1.2"
-LLDP_LOC_PORT_DESC = "1.0.8802.1.1.2.1.3.7.1.3"
-LLDP_LOC_PORT_ID = "1.0.8802.1.1.2.1.3.7.1.1"
-IF_NAME = "1.3.6.1.2.1.31.1.1.1.1"
-IF_DESCR = "1.3.6.1.2.1.2.2.1.2"
+DOCKER_STATS_WORKERS = int(os.environ.get("DOCKER_STATS_WORKERS", "16"))  # containers amostrados em paralelo
+DOCKER_STATS_TIMEOUT = float(os.environ.get("DOCKER_STATS_TIMEOUT", "5"))  # stream=false espera ~1 s pelo precpu
+DOCKER_STATS_INTERVAL = float(os.environ.get("DOCKER_STATS_INTERVAL", "0"))  # coleta periódica dos hosts com watcher (0 = desligada)
 
-CDP_CACHE_DEVICEID = "1.3.6.1.4.1.9.9.23.1.2.1.1.6"
-CDP_CACHE_DEVICEPORT = "1.3.6.1.4.1.9.9.23.1.2.1.1.7"
-CDP_CACHE_PLATFORM = "1.3.6.1.4.1.9.9.23.1.2.1.1.8"
-CDP_CACHE_ADDRESS = "1.3.6.1.4.1.9.9.23.1.2.1.1.4"
-CDP_CACHE_IFINDEX = "1.3.6.1.4.1.9.9.23.1.2.1.1.2"
 
+def persist_docker_containers(ip: str, docker: Dict[str, Any]) -> Optional[Dict[str, int]]:
+    """Diff a probe's full container listing into the Containers table of the device."""
+    if not docker.get("present") or not isinstance(docker.get("containers"), list):
+        return None
+    device = pg_get_device(ip=ip)
+    if not device:
+        return None
+    return pg_sync_containers(device["id"], docker["containers"])
+
+
+def docker_stats_sample(stats: Dict[str, Any]) -> Dict[str, Any]:
+    """CPU%, memory, network and block I/O from one /containers/{id}/stats?stream=false document."""
+    cpu = stats.get("cpu_stats") or {}
+    pre = stats.get("precpu_stats") or {}
+    out: Dict[str, Any] = {}
+    cpu_delta = ((cpu.get("cpu_usage") or {}).get("total_usage") or 0) - ((pre.get("cpu_usage") or {}).get("total_usage") or 0)
+    sys_delta = (cpu.get("system_cpu_usage") or 0) - (pre.get("system_cpu_usage") or 0)
+    online = cpu.get("online_cpus") or len((cpu.get("cpu_usage") or {}).get("percpu_usage") or []) or 1
+    if cpu_delta > 0 and sys_delta > 0:
+        out["cpu_percent"] = round(cpu_delta / sys_delta * online * 100.0, 3)
+    elif pre.get("system_cpu_usage"):
+        out["cpu_percent"] = 0.0
+    mem = stats.get("memory_stats") or {}
+    if mem.get("usage") is not None:
+        detail = mem.get("stats") or {}
+        # cgroup v2 expõe inactive_file, v1 expõe cache; o docker stats desconta o mesmo
+        cache = detail.get("inactive_file", detail.get("total_inactive_file", detail.get("cache", 0))) or 0
+        used = max(0, mem["usage"] - cache)
+        out["mem_used_bytes"] = used
+        if mem.get("limit"):
+            out["mem_limit_bytes"] = mem["limit"]
+            out["mem_used_percent"] = round(used / mem["limit"] * 100.0, 3)
+    nets = stats.get("networks") or {}
+    if nets:
+        out["net_rx_bytes"] = sum((n or {}).get("rx_bytes", 0) for n in nets.values())
+        out["net_tx_bytes"] = sum((n or {}).get("tx_bytes", 0) for n in nets.values())
+    blk = (stats.get("blkio_stats") or {}).get("io_service_bytes_recursive") or []
+    if blk:
+        out["blk_read_bytes"] = sum(e.get("value", 0) for e in blk if str(e.get("op", "")).lower() == "read")
+        out["blk_write_bytes"] = sum(e.get("value", 0) for e in blk if str(e.get("op", "")).lower() == "write")
+    return out
+
+
+def collect_container_stats(ip: str, container_ids: Optional[List[str]] = None, persist: bool = True) -> Dict[str, Any]:
+    """Sample stats of the running containers (or the given ids) concurrently and store them
+    as container_* metrics labelled with the container id and name.
+    """
+    api = docker_api_base(ip)
+    if api is None:
+        return {"ip": ip, "error": "Docker API não acessível (2375/2376)", "containers": []}
+    base, is_https = api
+    with DOCKER_WATCH_LOCK:
+        known = {cid: dict(c) for cid, c in CONTAINER_INVENTORY.get(ip, {}).items()}
+    if not known:
+        listing = http_get_bounded(base + "/containers/json?all=0", timeout=2.0, max_bytes=DOCKER_API_MAX_BYTES, verify=not is_https)
+        known = {c["id"]: c for c in (docker_api_container(x) for x in (bounded_json(listing) or [])) if c.get("id")}
+    targets = container_ids or [cid for cid, c in known.items() if c.get("running") or c.get("state") == "running"]
+
+    def sample(cid: str) -> Dict[str, Any]:
+        try:
+            r = http_get_bounded(base + f"/containers/{cid}/stats?stream=false", timeout=DOCKER_STATS_TIMEOUT,
+                                 max_bytes=DOCKER_API_MAX_BYTES, verify=not is_https)
+            doc = bounded_json(r) if r["status_code"] == 200 else None
+            if not isinstance(doc, dict):
+                return {"id": cid, "error": f"HTTP {r['status_code']}"}
+            return {"id": cid, "name": (known.get(cid) or {}).get("name") or doc.get("name"), **docker_stats_sample(doc)}
+        except Exception as e:
+            return {"id": cid, "error": str(e)}
 
-def _snmp_decode(val: Any) -> str:
+    results: List[Dict[str, Any]] = []
+    if targets:
+        with ThreadPoolExecutor(max_workers=max(1, min(DOCKER_STATS_WORKERS, len(targets)))) as ex:
+            results = list(ex.map(sample, targets))
+    stored = 0
+    if persist:
+        now = int(time.time())
+        samples: List[Tuple[str, float, Dict[str, Any], Optional[int]]] = []
+        for res in results:
+            labels = {"container": (res.get("name") or "").lstrip("/"), "id": res["id"][:12]}
+            for key in ("cpu_percent", "mem_used_bytes", "mem_used_percent", "net_rx_bytes", "net_tx_bytes",
+                        "blk_read_bytes", "blk_write_bytes"):
+                if res.get(key) is not None:
+                    samples.append((f"container_{key}", res[key], labels, now))
+        stored = record_metrics_batch(ip, samples)
+    return {"ip": ip, "containers": results, "stored": stored}
+
+
+def get_container_series(ip: str, metric: str, container: str, limit: int = 60) -> List[Dict[str, Any]]:
+    conn = get_pg_conn()
+    if not conn:
+        return []
     try:
-        s = str(val)
-        return s.strip('"')
+        with conn.cursor() as cur:
+            cur.execute('''
+                SELECT m.value, EXTRACT(EPOCH FROM m.ts)::bigint
+                FROM "AUTOMACAO"."Metrics" m
+                JOIN "AUTOMACAO"."Devices" d ON m.device_id = d.id
+                WHERE d.ip = %s AND m.metric_name = %s
+                  AND (m.metric_labels->>'container' = %s OR m.metric_labels->>'id' = %s)
+                ORDER BY m.ts DESC
+                LIMIT %s
+            ''', (ip, metric, container, container[:12], limit))
+            rows = cur.fetchall()
+        conn.close()
+        return [{"time": int(r[1]), "value": float(r[0])} for r in reversed(rows)]
     except Exception:
         try:
-            return val.prettyPrint()  # type: ignore
+            conn.close()
         except Exception:
-            return str(val)
+            pass
+        return []
 
-def snmp_get(ip: str, community: str, oid: str, timeout: int = 1, retries: int = 0) -> Any:
-    if not HAS_PYSNMP:
-        return None
-    try:
-        iterator = getCmd(
-            SnmpEngine(),
-            CommunityData(community, mpModel=0),
-            UdpTransportTarget((ip, 161), timeout=timeout, retries=retries),
-            ContextData(),
-            ObjectType(ObjectIdentity(oid))
-        )
-        errorIndication, errorStatus, errorIndex, varBinds = next(iterator)
-        if errorIndication or errorStatus:
-            return None
-        for varBind in varBinds:
-            return varBind[1].prettyPrint()
-    except Exception:
-        return None
 
-def snmp_walk(ip: str, community: str, oid: str, timeout: int = 1, retries: int = 0) -> List[Tuple[str, Any]]:
-    results: List[Tuple[str, Any]] = []
-    if not HAS_PYSNMP:
-        return results
-    try:
-        for (errorIndication, errorStatus, errorIndex, varBinds) in nextCmd(
-            SnmpEngine(),
-            CommunityData(community, mpModel=0),
-            UdpTransportTarget((ip, 161), timeout=timeout, retries=retries),
-            ContextData(),
-            ObjectType(ObjectIdentity(oid)),
-            lexicographicMode=False
-        ):
-            if errorIndication or errorStatus:
+def docker_stats_loop() -> None:
+    while True:
+        time.sleep(DOCKER_STATS_INTERVAL)
+        with DOCKER_WATCH_LOCK:
+            hosts = [ip for ip, w in DOCKER_WATCHERS.items() if w["source"] == "api" and w["state"] == "streaming"]
+        for ip in hosts:
+            try:
+                collect_container_stats(ip)
+            except Exception:
+                pass
+
+
+WINRM_TRANSPORT = os.environ.get("WINRM_TRANSPORT", "plaintext")  # plaintext | ntlm | kerberos | credssp | ssl
+WINRM_POOL_IDLE_TIMEOUT = float(os.environ.get("WINRM_POOL_IDLE_TIMEOUT", "300"))  # fecha shells ociosos
+WINRM_POOL_MAX = int(os.environ.get("WINRM_POOL_MAX", "256"))  # sessões mantidas (LRU)
+
+# (endpoint, usuário, impressão da credencial) -> sessão autenticada + shell remoto aberto
+WINRM_POOL: "OrderedDict[Tuple[str, str, str], Dict[str, Any]]" = OrderedDict()
+WINRM_POOL_LOCK = threading.Lock()
+WINRM_POOL_COUNTERS = {"sessions": 0, "shells": 0, "commands": 0, "reused": 0, "closed_idle": 0, "closed_broken": 0}
+
+
+def _winrm_close(entry: Dict[str, Any]) -> None:
+    if entry.get("shell_id"):
+        try:
+            entry["session"].protocol.close_shell(entry["shell_id"])
+        except Exception:
+            pass
+        entry["shell_id"] = None
+
+
+def winrm_pool_prune() -> None:
+    """Close idle shells and trim the pool to WINRM_POOL_MAX (least recently used first).
+    Busy entries are never evicted, so the pool may stay above the limit while they run.
+    """
+    now = time.time()
+    doomed: List[Dict[str, Any]] = []
+    with WINRM_POOL_LOCK:
+        for key in list(WINRM_POOL.keys()):
+            entry = WINRM_POOL[key]
+            if not entry["lock"].locked() and now - entry["last_used"] > WINRM_POOL_IDLE_TIMEOUT:
+                doomed.append(WINRM_POOL.pop(key))
+                WINRM_POOL_COUNTERS["closed_idle"] += 1
+        for key in list(WINRM_POOL.keys()):
+            if len(WINRM_POOL) <= WINRM_POOL_MAX:
                 break
-            for varBind in varBinds:
-                results.append((str(varBind[0]), varBind[1].prettyPrint()))
-    except Exception:
-        pass
-    return results
+            if not WINRM_POOL[key]["lock"].locked():
+                doomed.append(WINRM_POOL.pop(key))
+    for entry in doomed:
+        # quem pegou a entrada antes da remoção confere a posse sob este lock e desiste dela
+        with entry["lock"]:
+            _winrm_close(entry)
 
-# Extended SNMP (v1/v2c/v3)
-def _snmp_auth(version: str, community: str, v3: Dict[str, Any] | None):
-    if version in ("v1", "v2c"):
-        mp = 0 if version == "v1" else 1
-        return CommunityData(community, mpModel=mp)
-    if version == "v3" and UsmUserData:
-        user = (v3 or {}).get("user") or ""
-        auth_pass = (v3 or {}).get("authPassword")
-        priv_pass = (v3 or {}).get("privPassword")
-        auth_proto_name = ((v3 or {}).get("authProtocol") or "").upper()
-        priv_proto_name = ((v3 or {}).get("privProtocol") or "").upper()
-        auth_proto = {
-            "MD5": usmHMACMD5AuthProtocol,
-            "SHA": usmHMACSHAAuthProtocol,
-            "SHA256": usmHMACSHA256AuthProtocol,
-            "SHA384": usmHMACSHA384AuthProtocol,
-            "SHA512": usmHMACSHA512AuthProtocol,
-        }.get(auth_proto_name, usmNoAuthProtocol)
-        priv_proto = {
-            "DES": usmDESPrivProtocol,
-            "AES128": usmAesCfb128Protocol,
-            "AES192": usmAesCfb192Protocol,
-            "AES256": usmAesCfb256Protocol,
-        }.get(priv_proto_name, usmNoPrivProtocol)
-        return UsmUserData(user, auth_pass, auth_proto, priv_pass, priv_proto)
-    # default v2c
-    return CommunityData(community, mpModel=1)
 
-def snmp_get_ext(ip: str, version: str, community: str, oid: str, v3: Dict[str, Any] | None = None, timeout: int = 1, retries: int = 0) -> Any:
-    if not HAS_PYSNMP:
-        return None
-    try:
-        iterator = getCmd(
-            SnmpEngine(),
-            _snmp_auth(version, community, v3),
-            UdpTransportTarget((ip, 161), timeout=timeout, retries=retries),
-            ContextData(),
-            ObjectType(ObjectIdentity(oid))
-        )
-        errorIndication, errorStatus, errorIndex, varBinds = next(iterator)
-        if errorIndication or errorStatus:
-            return None
-        for varBind in varBinds:
-            return varBind[1].prettyPrint()
-    except Exception:
-        return None
+def _winrm_entry(ip: str, user: str, password: Optional[str], use_tls: bool, port: int,
+                 timeout: float) -> Dict[str, Any]:
+    endpoint = f"{'https' if use_tls else 'http'}://{ip}:{port}/wsman"
+    key = (endpoint, user, ssh_credential_fingerprint(password, None))
+    with WINRM_POOL_LOCK:
+        entry = WINRM_POOL.get(key)
+        if entry is None:
+            operation = max(5, int(math.ceil(timeout)))
+            # Sessão (transporte HTTP + autenticação) reaproveitada entre comandos
+            session = winrm.Session(endpoint, auth=(user, password), transport=WINRM_TRANSPORT,
+                                    operation_timeout_sec=operation, read_timeout_sec=operation + 10)
+            entry = {"key": key, "session": session, "shell_id": None, "lock": threading.Lock(),
+                     "created": time.time(), "last_used": time.time(), "commands": 0}
+            WINRM_POOL[key] = entry
+            WINRM_POOL_COUNTERS["sessions"] += 1
+        else:
+            WINRM_POOL.move_to_end(key)
+        entry["last_used"] = time.time()
+    return entry
 
-def snmp_walk_ext(ip: str, version: str, community: str, oid: str, v3: Dict[str, Any] | None = None, timeout: int = 1, retries: int = 0) -> List[Tuple[str, Any]]:
-    results: List[Tuple[str, Any]] = []
-    if not HAS_PYSNMP:
-        return results
-    try:
-        for (errorIndication, errorStatus, errorIndex, varBinds) in nextCmd(
-            SnmpEngine(),
-            _snmp_auth(version, community, v3),
-            UdpTransportTarget((ip, 161), timeout=timeout, retries=retries),
-            ContextData(),
-            ObjectType(ObjectIdentity(oid)),
-            lexicographicMode=False
-        ):
-            if errorIndication or errorStatus:
-                break
-            for varBind in varBinds:
-                results.append((str(varBind[0]), varBind[1].prettyPrint()))
-    except Exception:
-        pass
-    return results
 
-# SNMP SET seguro (v1/v2c/v3)
-def snmp_set_ext(ip: str, version: str, community: str, oid: str, value_type: str, value: Any, v3: Dict[str, Any] | None = None, timeout: int = 2, retries: int = 0) -> Dict[str, Any]:
-    if not HAS_PYSNMP:
-        return {"ok": False, "error": "pysnmp não disponível"}
-    if not oid:
-        return {"ok": False, "error": "OID ausente"}
-    type_map = {
-        "OctetString": OctetString,
-        "Integer": Integer,
-        "IpAddress": IpAddress,
-        "Gauge32": Gauge32,
-        "Counter32": Counter32,
-        "ObjectIdentifier": ObjectIdentifier,
-    }
-    tcls = type_map.get(str(value_type))
-    if not tcls:
-        return {"ok": False, "error": f"Tipo inválido: {value_type}"}
-    try:
-        if tcls in (Integer, Gauge32, Counter32):
-            vobj = tcls(int(value))
-        elif tcls is IpAddress:
-            vobj = tcls(str(value))
-        else:
-            vobj = tcls(value)
-    except Exception as e:
-        return {"ok": False, "error": f"Falha convertendo valor: {e}"}
-    try:
-        iterator = setCmd(
-            SnmpEngine(),
-            _snmp_auth(version, community, v3),
-            UdpTransportTarget((ip, 161), timeout=timeout, retries=retries),
-            ContextData(),
-            ObjectType(ObjectIdentity(oid), vobj)
-        )
-        errorIndication, errorStatus, errorIndex, varBinds = next(iterator)
-        if errorIndication:
-            return {"ok": False, "error": str(errorIndication)}
-        if errorStatus:
-            return {"ok": False, "error": f"{errorStatus.prettyPrint()} at {errorIndex}"}
-        result_binds: List[Tuple[str, str]] = []
-        for varBind in varBinds:
-            result_binds.append((str(varBind[0]), varBind[1].prettyPrint()))
-        return {"ok": True, "response": result_binds}
-    except Exception as e:
-        return {"ok": False, "error": str(e)}
+def _winrm_drop(entry: Dict[str, Any]) -> None:
+    with WINRM_POOL_LOCK:
+        if WINRM_POOL.get(entry["key"]) is entry:
+            del WINRM_POOL[entry["key"]]
+            WINRM_POOL_COUNTERS["closed_broken"] += 1
+    _winrm_close(entry)
 
-# Execução de comandos via Netmiko
 
-def run_netmiko_command(host: str, device_type: str, username: str, password: str, command: str, secret: Optional[str] = None, port: int = 22, timeout: int = 8) -> Dict[str, Any]:
-    if ConnectHandler is None:
-        return {"ok": False, "error": "netmiko não disponível"}
-    if not host or not device_type or not username or not command:
-        return {"ok": False, "error": "Parâmetros obrigatórios ausentes"}
-    try:
-        params: Dict[str, Any] = {
-            "device_type": device_type,
-            "host": host,
-            "username": username,
-            "password": password,
-            "port": port,
-            "timeout": timeout,
-        }
-        if secret:
-            params["secret"] = secret
-        conn = ConnectHandler(**params)
-        if secret:
+def winrm_exec(ip: str, user: str, ps_script: str, password: Optional[str] = None,
+               use_tls: bool = False, port: int = 5985, timeout: float = 4.0) -> Tuple[bool, str | None, str | None]:
+    """Execute PowerShell script remotely via WinRM. Returns (ok, stdout, stderr).
+    Commands to the same endpoint/credential share one authenticated session and one open shell
+    (serialized per shell); a failing shell is discarded and the command retried once on a new one.
+    """
+    if not winrm:
+        return False, None, "pywinrm not installed"
+    winrm_pool_prune()
+    encoded = base64.b64encode(ps_script.encode("utf_16_le")).decode("ascii")
+    last_error = None
+    attempts = 0
+    while attempts < 2:
+        try:
+            entry = _winrm_entry(ip, user, password, use_tls, port, timeout)
+        except Exception as e:
+            return False, None, str(e)
+        with entry["lock"]:
+            with WINRM_POOL_LOCK:
+                pooled = WINRM_POOL.get(entry["key"]) is entry
+            if not pooled:
+                # removida pelo prune entre a busca e o lock: um shell aberto aqui nunca seria fechado
+                continue
+            attempts += 1
+            protocol = entry["session"].protocol
+            reused = entry["shell_id"] is not None
             try:
-                conn.enable()
-            except Exception:
-                pass
-        output = conn.send_command(command)
+                if not reused:
+                    entry["shell_id"] = protocol.open_shell()
+                    with WINRM_POOL_LOCK:
+                        WINRM_POOL_COUNTERS["shells"] += 1
+                command_id = protocol.run_command(entry["shell_id"], "powershell",
+                                                  ["-NoProfile", "-NonInteractive", "-EncodedCommand", encoded])
+                std_out, std_err, status = protocol.get_command_output(entry["shell_id"], command_id)
+                protocol.cleanup_command(entry["shell_id"], command_id)
+            except Exception as e:
+                last_error = e
+                _winrm_drop(entry)
+                continue
+            entry["commands"] += 1
+            entry["last_used"] = time.time()
+        with WINRM_POOL_LOCK:
+            WINRM_POOL_COUNTERS["commands"] += 1
+            WINRM_POOL_COUNTERS["reused"] += int(reused)
+        if std_err:
+            std_err = entry["session"]._clean_error_msg(std_err)
+        return (status == 0, (std_out or b"").decode(errors="ignore"), (std_err or b"").decode(errors="ignore"))
+    return False, None, str(last_error)
+
+
+def winrm_pool_stats() -> Dict[str, Any]:
+    winrm_pool_prune()
+    now = time.time()
+    with WINRM_POOL_LOCK:
+        hosts = [{
+            "endpoint": key[0], "user": key[1], "shell_open": bool(e["shell_id"]), "busy": e["lock"].locked(),
+            "commands": e["commands"], "idle_seconds": round(now - e["last_used"], 1),
+        } for key, e in WINRM_POOL.items()]
+        counters = dict(WINRM_POOL_COUNTERS)
+    return {"transport": WINRM_TRANSPORT, "idle_timeout": WINRM_POOL_IDLE_TIMEOUT, **counters, "hosts": hosts}
+
+
+# Uma ida e volta: tabela PID -> processo montada uma vez (evita Where-Object por conexão),
+# listeners, dados do SO e contadores básicos num único JSON
+WINDOWS_COLLECT_PS = r"""
+$ErrorActionPreference = 'SilentlyContinue'
+$procById = @{}
+foreach ($p in Get-Process) { $procById[[int]$p.Id] = $p }
+$listeners = @()
+foreach ($c in @(Get-NetTCPConnection -State Listen)) {
+  $p = $procById[[int]$c.OwningProcess]
+  $listeners += [pscustomobject]@{ addr = $c.LocalAddress; port = [int]$c.LocalPort; pid = [int]$c.OwningProcess;
+    process = $(if ($p) { $p.ProcessName } else { $null }); path = $(if ($p) { $p.Path } else { $null }) }
+}
+$os = Get-CimInstance Win32_OperatingSystem
+$cpu = (Get-CimInstance Win32_Processor | Measure-Object -Property LoadPercentage -Average).Average
+$disks = @(Get-CimInstance Win32_LogicalDisk -Filter 'DriveType=3' | ForEach-Object {
+  [pscustomobject]@{ name = $_.DeviceID; size = [double]$_.Size; free = [double]$_.FreeSpace } })
+[pscustomobject]@{
+  listeners = $listeners
+  os = [pscustomobject]@{ caption = $os.Caption; version = $os.Version; build = $os.BuildNumber;
+    last_boot = $(if ($os.LastBootUpTime) { $os.LastBootUpTime.ToUniversalTime().ToString('o') } else { $null }) }
+  perf = [pscustomobject]@{ cpu_percent = $cpu; mem_total_kb = [double]$os.TotalVisibleMemorySize;
+    mem_free_kb = [double]$os.FreePhysicalMemory; processes = $procById.Count; disks = $disks }
+} | ConvertTo-Json -Depth 4 -Compress
+"""
+
+
+def parse_windows_collect(out: str) -> Optional[Dict[str, Any]]:
+    try:
+        doc = json.loads(out[out.find("{"):])
+    except Exception:
+        return None
+    if not isinstance(doc, dict):
+        return None
+    listeners = doc.get("listeners") or []
+    if isinstance(listeners, dict):
+        listeners = [listeners]
+    windows_ports: List[Dict[str, Any]] = []
+    for e in listeners:
         try:
-            conn.disconnect()
+            windows_ports.append({
+                "addr": e.get("addr"),
+                "port": int(e.get("port")) if e.get("port") is not None else None,
+                "pid": int(e.get("pid")) if e.get("pid") is not None else None,
+                "process": e.get("process"),
+                "path": e.get("path"),
+            })
         except Exception:
             pass
-        return {"ok": True, "output": output}
+    perf = doc.get("perf") or {}
+    snapshot: Dict[str, Any] = {"cpu_usage_percent": perf.get("cpu_percent"), "processes": perf.get("processes")}
+    if perf.get("mem_total_kb"):
+        snapshot["mem_total_kb"] = perf["mem_total_kb"]
+        snapshot["mem_used_percent"] = round(100.0 * (perf["mem_total_kb"] - (perf.get("mem_free_kb") or 0)) / perf["mem_total_kb"], 2)
+    disks = perf.get("disks") or []
+    if isinstance(disks, dict):
+        disks = [disks]
+    size = sum(d.get("size") or 0 for d in disks)
+    if size:
+        snapshot["fs_used_percent"] = round(100.0 * (size - sum(d.get("free") or 0 for d in disks)) / size, 2)
+    return {"windows_ports": windows_ports, "os": doc.get("os") or {}, "snapshot": snapshot}
+
+
+def enrich_windows_details(ip: str, base: Dict[str, Any], winrm_user: Optional[str] = None,
+                           winrm_pass: Optional[str] = None, winrm_use_tls: bool = False,
+                           winrm_port: int = 5985, winrm_timeout: float = 4.0) -> Dict[str, Any]:
+    """If host looks like Windows and WinRM creds provided, collect listening ports, OS info and
+    basic performance counters in a single PowerShell call."""
+    os_label = (base.get("os") or "").lower()
+    open_ports: List[int] = base.get("open_ports") or []
+    looks_windows = ("windows" in os_label) or (5985 in open_ports) or (5986 in open_ports)
+    if looks_windows and winrm_user and winrm_pass:
+        ok, out, err = winrm_exec(ip, winrm_user, WINDOWS_COLLECT_PS, password=winrm_pass, use_tls=winrm_use_tls, port=winrm_port, timeout=winrm_timeout)
+        collected = parse_windows_collect(out) if ok and out else None
+        windows_ports = collected["windows_ports"] if collected else []
+        base["windows_ports"] = windows_ports
+        # Add into services_detailed respecting open_ports filter on frontend
+        dets = base.get("services_detailed") or []
+        for e in windows_ports:
+            svc_name = map_service_from_process_or_port(e.get("process"), e.get("port"))
+            dets.append({"service": svc_name, "port": e.get("port"), "verified": True, "detail": e.get("process")})
+        base["services_detailed"] = dets
+        if collected:
+            if collected["os"].get("caption"):
+                base["os"] = collected["os"]["caption"]
+            base["os_version"] = collected["os"].get("version")
+            base["host_snapshot"] = collected["snapshot"]
+    return base
+
+
+def compose_os_label(base: Dict[str, Any]) -> str:
+    """Compose OS label prioritizing real sources (Node Exporter uname, Docker info, Windows Caption)."""
+    node = base.get("node_exporter") or {}
+    docker = base.get("docker") or {}
+    node_uname = node.get("uname") if node.get("present") else None
+    docker_os = ((docker.get("info") or {}).get("OperatingSystem")) if docker.get("present") else None
+    current = base.get("os")
+    return node_uname or docker_os or current or "Unknown"
+
+
+# ----------------------
+# Agentless host metrics (hosts sem node_exporter)
+# ----------------------
+
+AGENTLESS_ENABLED = os.environ.get("AGENTLESS_ENABLED", "0").lower() in ("1", "true", "yes")
+# "ip[:porta]" via SSH (AGENTLESS_SSH_USER/AGENTLESS_SSH_KEY) ou "winrm:ip[:porta]" (AGENTLESS_WINRM_USER/AGENTLESS_WINRM_PASS)
+AGENTLESS_TARGETS = [t.strip() for t in os.environ.get("AGENTLESS_TARGETS", "").split(",") if t.strip()]
+AGENTLESS_SSH_USER = os.environ.get("AGENTLESS_SSH_USER")
+AGENTLESS_SSH_KEY = os.environ.get("AGENTLESS_SSH_KEY")
+AGENTLESS_WINRM_USER = os.environ.get("AGENTLESS_WINRM_USER")
+AGENTLESS_WINRM_PASS = os.environ.get("AGENTLESS_WINRM_PASS")
+AGENTLESS_INTERVAL = float(os.environ.get("AGENTLESS_INTERVAL", "30"))
+AGENTLESS_WORKERS = int(os.environ.get("AGENTLESS_WORKERS", "16"))  # hosts coletados ao mesmo tempo (frota toda)
+AGENTLESS_TIMEOUT = float(os.environ.get("AGENTLESS_TIMEOUT", "10"))
+AGENTLESS_BACKOFF_MAX = float(os.environ.get("AGENTLESS_BACKOFF_MAX", "600"))  # host com falhas seguidas: espera dobra até aqui
+
+# mesmos filesystems ignorados pelo node_exporter (padrão) + tmpfs/aufs, como em probe_node_exporter
+AGENTLESS_FS_EXCLUDE = frozenset((
+    "autofs", "binfmt_misc", "bpf", "cgroup", "cgroup2", "configfs", "debugfs", "devpts", "devtmpfs", "fusectl",
+    "hugetlbfs", "iso9660", "mqueue", "nsfs", "overlay", "proc", "procfs", "pstore", "rpc_pipefs", "securityfs",
+    "selinuxfs", "squashfs", "erofs", "sysfs", "tracefs", "tmpfs", "aufs",
+))
+AGENTLESS_MOUNT_EXCLUDE_RE = re.compile(r"^/(dev|proc|run/credentials/.+|sys|var/lib/docker/.+|var/lib/containers/storage/.+)($|/)")
+
+AGENTLESS_LINUX_CMD = (
+    "echo @@uptime; cat /proc/uptime; "
+    "echo @@stat; head -n1 /proc/stat; "
+    "echo @@meminfo; cat /proc/meminfo; "
+    "echo @@netdev; cat /proc/net/dev; "
+    "echo @@mounts; cat /proc/mounts; "
+    "echo @@df; if command -v timeout >/dev/null 2>&1; then timeout 5 df -P -k; else df -P -k; fi 2>/dev/null"
+)
+
+# ip -> alvo (tipo, credenciais, intervalo, estado do agendamento e última amostra bruta)
+AGENTLESS_HOSTS: Dict[str, Dict[str, Any]] = {}
+AGENTLESS_LOCK = threading.Lock()
+AGENTLESS_SCHEDULER: Dict[str, Any] = {"thread": None}
+
+
+def parse_proc_sample(out: str) -> Dict[str, Any]:
+    """Parse AGENTLESS_LINUX_CMD output into cumulative counters (uptime, cpu, net) and gauges (mem, fs)."""
+    sections: Dict[str, List[str]] = {}
+    current: Optional[List[str]] = None
+    for ln in out.splitlines():
+        if ln.startswith("@@"):
+            current = sections.setdefault(ln[2:].strip(), [])
+        elif current is not None:
+            current.append(ln)
+    sample: Dict[str, Any] = {}
+    up = (sections.get("uptime") or [""])[0].split()
+    if up:
+        sample["uptime"] = float(up[0])
+    stat = (sections.get("stat") or [""])[0].split()
+    if len(stat) >= 5 and stat[0] == "cpu":
+        # user nice system idle iowait irq softirq steal: os modos de node_cpu_seconds_total
+        vals = [int(v) for v in stat[1:9]]
+        sample["cpu_total"] = sum(vals)
+        sample["cpu_idle"] = vals[3]
+    mem: Dict[str, int] = {}
+    for ln in sections.get("meminfo", []):
+        key, _, rest = ln.partition(":")
+        parts = rest.split()
+        if parts and parts[0].isdigit():
+            mem[key.strip()] = int(parts[0])
+    mem_total = mem.get("MemTotal")
+    mem_available = mem.get("MemAvailable")
+    if mem_available is None and mem_total:
+        # kernels < 3.14 não têm MemAvailable
+        mem_available = mem.get("MemFree", 0) + mem.get("Buffers", 0) + mem.get("Cached", 0)
+    if mem_total:
+        sample["mem_used_percent"] = (mem_total - mem_available) / mem_total * 100.0
+    rx = tx = 0
+    for ln in sections.get("netdev", []):
+        name, sep, data = ln.partition(":")
+        fields = data.split()
+        if not sep or name.strip() == "lo" or len(fields) < 9 or not fields[0].isdigit():
+            continue
+        rx += int(fields[0])
+        tx += int(fields[8])
+    if sections.get("netdev"):
+        sample["net_rx_bytes"] = rx
+        sample["net_tx_bytes"] = tx
+    fstypes: Dict[str, str] = {}
+    for ln in sections.get("mounts", []):
+        parts = ln.split()
+        if len(parts) >= 3:
+            fstypes[parts[1].replace("\\040", " ")] = parts[2]
+    size = avail = 0
+    for ln in sections.get("df", [])[1:]:
+        fields = ln.split()
+        if len(fields) < 6 or not fields[1].isdigit() or not fields[3].isdigit():
+            continue
+        mount = " ".join(fields[5:])
+        fstype = fstypes.get(mount)
+        if fstype is None or fstype in AGENTLESS_FS_EXCLUDE or AGENTLESS_MOUNT_EXCLUDE_RE.match(mount):
+            continue
+        size += int(fields[1]) * 1024
+        avail += int(fields[3]) * 1024
+    if size > 0:
+        sample["fs_used_percent"] = (size - avail) / size * 100.0
+    return sample
+
+
+def agentless_values(prev: Optional[Dict[str, Any]], cur: Dict[str, Any]) -> Dict[str, float]:
+    """Series of /api/discovery/metrics from two consecutive samples (rates need the previous one)."""
+    values = {k: cur[k] for k in ("mem_used_percent", "fs_used_percent") if k in cur}
+    if not prev or "uptime" not in prev or "uptime" not in cur or cur["uptime"] <= prev["uptime"]:
+        return values  # primeira amostra ou host reiniciado
+    dt = cur["uptime"] - prev["uptime"]
+    if "cpu_total" in cur and "cpu_total" in prev:
+        total_delta = cur["cpu_total"] - prev["cpu_total"]
+        idle_delta = cur["cpu_idle"] - prev["cpu_idle"]
+        if total_delta > 0 and idle_delta >= 0:
+            values["cpu_usage_percent"] = max(0.0, min(100.0, (1.0 - idle_delta / total_delta) * 100.0))
+    for direction in ("rx", "tx"):
+        key = f"net_{direction}_bytes"
+        if key in cur and key in prev and cur[key] >= prev[key]:
+            values[f"net_{direction}_bps"] = (cur[key] - prev[key]) / dt
+    return values
+
+
+def agentless_collect_linux(ip: str, target: Dict[str, Any]) -> Dict[str, float]:
+    creds = target["creds"]
+    ok, out, err = ssh_exec(ip, creds["user"], AGENTLESS_LINUX_CMD, password=creds.get("password"),
+                            key_path=creds.get("key_path"), port=creds.get("port", 22), timeout=AGENTLESS_TIMEOUT)
+    if not ok or not out or "@@stat" not in out:
+        raise RuntimeError((err or "").strip() or "coleta /proc sem resposta")
+    cur = parse_proc_sample(out)
+    values = agentless_values(target.get("prev"), cur)
+    target["prev"] = cur
+    return values
+
+
+WINDOWS_COUNTER_SAMPLES = int(os.environ.get("WINDOWS_COUNTER_SAMPLES", "3"))  # amostras por chamada Get-Counter
+WINDOWS_COUNTER_SAMPLE_INTERVAL = int(os.environ.get("WINDOWS_COUNTER_SAMPLE_INTERVAL", "1"))  # segundos entre amostras
+
+# Um Get-Counter com várias amostras por ida e volta. Caminhos de contadores são traduzidos no Windows
+# (ex.: "\Processador(_Total)\% Tempo de Processador"), então os nomes em inglês são convertidos pelo índice
+# do Perflib antes da consulta.
+WINDOWS_COUNTER_PS = r"""
+$ErrorActionPreference = 'SilentlyContinue'
+$perflib = 'HKLM:\SOFTWARE\Microsoft\Windows NT\CurrentVersion\Perflib'
+$en = (Get-ItemProperty "$perflib\009" -Name Counter).Counter
+$loc = (Get-ItemProperty "$perflib\CurrentLanguage" -Name Counter).Counter
+$idx = @{}; $names = @{}
+if ($en -and $loc) {
+  for ($i = 0; $i -lt $en.Count - 1; $i += 2) { if (-not $idx.ContainsKey($en[$i + 1])) { $idx[$en[$i + 1]] = $en[$i] } }
+  for ($i = 0; $i -lt $loc.Count - 1; $i += 2) { $names[$loc[$i]] = $loc[$i + 1] }
+}
+function L($n) { $i = $idx[$n]; if ($i -and $names[$i]) { $names[$i] } else { $n } }
+$defs = [ordered]@{
+  cpu = "\$(L 'Processor')(_Total)\$(L '% Processor Time')"
+  mem_available = "\$(L 'Memory')\$(L 'Available Bytes')"
+  disk_free = "\$(L 'LogicalDisk')(_Total)\$(L '% Free Space')"
+  net_rx = "\$(L 'Network Interface')(*)\$(L 'Bytes Received/sec')"
+  net_tx = "\$(L 'Network Interface')(*)\$(L 'Bytes Sent/sec')"
+}
+$sets = @(Get-Counter -Counter @($defs.Values) -SampleInterval __INTERVAL__ -MaxSamples __SAMPLES__)
+$values = @{}
+foreach ($k in $defs.Keys) {
+  $leaf = '\' + $defs[$k].Substring($defs[$k].LastIndexOf('\') + 1).ToLower()
+  $values[$k] = @(foreach ($set in $sets) {
+    $m = $set.CounterSamples | Where-Object { $_.Path.ToLower().EndsWith($leaf) } | Measure-Object -Property CookedValue -Sum
+    if ($m.Count) { [double]$m.Sum }
+  })
+}
+[pscustomobject]@{
+  samples = $sets.Count
+  mem_total_bytes = [double](Get-CimInstance Win32_ComputerSystem).TotalPhysicalMemory
+  counters = $values
+} | ConvertTo-Json -Depth 4 -Compress
+"""
+
+
+def parse_windows_counters(out: str) -> Dict[str, float]:
+    """Average WINDOWS_COUNTER_PS samples into the series of /api/discovery/metrics."""
+    doc = json.loads(out[out.find("{"):])
+    counters = doc.get("counters") or {}
+
+    def avg(key: str) -> Optional[float]:
+        vals = counters.get(key)
+        if vals is None:
+            return None
+        vals = [float(v) for v in (vals if isinstance(vals, list) else [vals]) if v is not None]
+        return sum(vals) / len(vals) if vals else None
+
+    values: Dict[str, float] = {}
+    cpu = avg("cpu")
+    if cpu is not None:
+        values["cpu_usage_percent"] = max(0.0, min(100.0, cpu))
+    mem_total = doc.get("mem_total_bytes")
+    mem_available = avg("mem_available")
+    if mem_total and mem_available is not None:
+        values["mem_used_percent"] = (mem_total - mem_available) / mem_total * 100.0
+    disk_free = avg("disk_free")
+    if disk_free is not None:
+        values["fs_used_percent"] = max(0.0, 100.0 - disk_free)
+    for direction in ("rx", "tx"):
+        rate = avg(f"net_{direction}")
+        if rate is not None:
+            values[f"net_{direction}_bps"] = rate
+    return values
+
+
+def agentless_collect_windows(ip: str, target: Dict[str, Any]) -> Dict[str, float]:
+    creds = target["creds"]
+    script = (WINDOWS_COUNTER_PS
+              .replace("__SAMPLES__", str(max(1, WINDOWS_COUNTER_SAMPLES)))
+              .replace("__INTERVAL__", str(max(1, WINDOWS_COUNTER_SAMPLE_INTERVAL))))
+    timeout = AGENTLESS_TIMEOUT + WINDOWS_COUNTER_SAMPLES * WINDOWS_COUNTER_SAMPLE_INTERVAL
+    ok, out, err = winrm_exec(ip, creds["user"], script, password=creds.get("password"),
+                              use_tls=creds.get("use_tls", False), port=creds.get("port", 5985), timeout=timeout)
+    if not ok or not out or "{" not in out:
+        raise RuntimeError((err or "").strip() or "Get-Counter sem resposta")
+    values = parse_windows_counters(out)
+    if not values:
+        raise RuntimeError("Get-Counter não retornou contadores")
+    return values
+
+
+AGENTLESS_COLLECTORS = {"ssh": agentless_collect_linux, "winrm": agentless_collect_windows}
+
+
+def _agentless_run(ip: str, target: Dict[str, Any]) -> None:
+    try:
+        values = AGENTLESS_COLLECTORS[target["kind"]](ip, target)
+        ts = int(time.time())
+        stored = record_metrics_batch(ip, [(metric, value, {}, ts) for metric, value in values.items()])
+        with AGENTLESS_LOCK:
+            target.update({"failures": 0, "last_ok": time.time(), "last_error": None, "last_values": values,
+                           "next_due": time.time() + target["interval"]})
+            target["samples"] += 1
+            target["stored"] += stored
     except Exception as e:
+        with AGENTLESS_LOCK:
+            target["failures"] += 1
+            backoff = min(AGENTLESS_BACKOFF_MAX, target["interval"] * (2 ** min(target["failures"], 10)))
+            target.update({"last_error": str(e), "next_due": time.time() + backoff * random.uniform(0.8, 1.0)})
+    finally:
+        with AGENTLESS_LOCK:
+            target["running"] = False
+
+
+def agentless_scheduler_loop() -> None:
+    """Submit due hosts to a fixed-size pool; a host never has two collections in flight."""
+    executor = ThreadPoolExecutor(max_workers=max(1, AGENTLESS_WORKERS), thread_name_prefix="agentless")
+    while True:
+        now = time.time()
+        with AGENTLESS_LOCK:
+            due = [(ip, t) for ip, t in AGENTLESS_HOSTS.items() if not t["running"] and t["next_due"] <= now]
+            for _, t in due:
+                t["running"] = True
+        for ip, t in due:
+            executor.submit(_agentless_run, ip, t)
+        time.sleep(0.5)
+
+
+def agentless_add(ip: str, kind: str, creds: Dict[str, Any], interval: Optional[float] = None) -> Dict[str, Any]:
+    if not pg_get_device(ip=ip):
         try:
-            conn.disconnect()  # type: ignore
+            pg_upsert_device({"ip": ip, "hostname": ip, "status": "Unknown", "os": "Unknown", "services": [],
+                              "lastSeen": time.strftime("%Y-%m-%d %H:%M:%S"), "real": True})
         except Exception:
             pass
-        return {"ok": False, "error": str(e)}
+    interval = max(1.0, float(interval or AGENTLESS_INTERVAL))
+    target = {
+        "kind": kind, "creds": creds, "interval": interval, "running": False, "failures": 0, "samples": 0,
+        "stored": 0, "last_ok": None, "last_error": None, "last_values": None, "prev": None,
+        # espalha a primeira coleta da frota pelo intervalo
+        "next_due": time.time() + random.uniform(0, min(interval, 5.0)),
+    }
+    with AGENTLESS_LOCK:
+        AGENTLESS_HOSTS[ip] = target
+        thread = AGENTLESS_SCHEDULER["thread"]
+        if thread is None or not thread.is_alive():
+            thread = threading.Thread(target=agentless_scheduler_loop, name="agentless-scheduler", daemon=True)
+            AGENTLESS_SCHEDULER["thread"] = thread
+            thread.start()
+    return agentless_view(ip)
 
 
-def build_snmp_hostinfo(ip: str, community: str, version: str = "v2c", v3: Dict[str, Any] | None = None) -> Dict[str, Any]:
-    info: Dict[str, Any] = {"ip": ip, "community": community, "version": version, "available": HAS_PYSNMP}
-    if not HAS_PYSNMP:
-        return info
-    sys_descr = snmp_get_ext(ip, version, community, '1.3.6.1.2.1.1.1.0', v3)
-    sys_name = snmp_get_ext(ip, version, community, '1.3.6.1.2.1.1.5.0', v3)
-    sys_uptime = snmp_get_ext(ip, version, community, '1.3.6.1.2.1.1.3.0', v3)
-    hr_mem = snmp_get_ext(ip, version, community, '1.3.6.1.2.1.25.2.2.0', v3)  # hrMemorySize (in KB)
-    cpu_loads = snmp_walk_ext(ip, version, community, '1.3.6.1.2.1.25.3.3.1.2', v3)  # hrProcessorLoad
-    if_list = snmp_walk_ext(ip, version, community, '1.3.6.1.2.1.2.2.1.2', v3)  # ifDescr
-    if_speed = snmp_walk_ext(ip, version, community, '1.3.6.1.2.1.2.2.1.5', v3)  # ifSpeed
-    if_oper = snmp_walk_ext(ip, version, community, '1.3.6.1.2.1.2.2.1.8', v3)  # ifOperStatus
+def agentless_remove(ip: str) -> bool:
+    with AGENTLESS_LOCK:
+        return AGENTLESS_HOSTS.pop(ip, None) is not None
 
-    try:
-        cpu_vals = [int(v) for _, v in cpu_loads]
-        cpu_avg = sum(cpu_vals) / max(1, len(cpu_vals))
-    except Exception:
-        cpu_avg = None
 
-    interfaces: List[Dict[str, Any]] = []
-    for idx, (oid, name) in enumerate(if_list):
-        speed = None
-        oper = None
-        try:
-            speed = int(if_speed[idx][1]) if idx < len(if_speed) else None
-        except Exception:
-            speed = None
+def agentless_view(ip: Optional[str] = None) -> Any:
+    now = time.time()
+    with AGENTLESS_LOCK:
+        if ip is None:
+            items = list(AGENTLESS_HOSTS.items())
+        else:
+            items = [(ip, AGENTLESS_HOSTS[ip])] if ip in AGENTLESS_HOSTS else []
+        views = [{
+            "ip": host, "kind": t["kind"], "interval": t["interval"],
+            "state": "collecting" if t["running"] else ("backoff" if t["failures"] else ("ok" if t["samples"] else "pending")),
+            "failures": t["failures"], "samples": t["samples"], "stored": t["stored"],
+            "last_ok": t["last_ok"], "last_error": t["last_error"], "last_values": t["last_values"],
+            "next_in": round(max(0.0, t["next_due"] - now), 1),
+        } for host, t in items]
+    if ip is not None:
+        return views[0] if views else None
+    return views
+
+
+def agentless_autostart() -> None:
+    for t in AGENTLESS_TARGETS:
+        if t.startswith("winrm:"):
+            host, _, port = t[6:].partition(":")
+            if AGENTLESS_WINRM_USER and winrm:
+                agentless_add(host, "winrm", {"user": AGENTLESS_WINRM_USER, "password": AGENTLESS_WINRM_PASS,
+                                              "use_tls": port == "5986", "port": int(port or 5985)})
+        elif AGENTLESS_SSH_USER:
+            host, _, port = t.partition(":")
+            agentless_add(host, "ssh", {"user": AGENTLESS_SSH_USER, "key_path": AGENTLESS_SSH_KEY, "password": None,
+                                        "port": int(port or 22)})
+
+
+# ----------------------
+# Discovery Endpoints
+# ----------------------
+
+# ----------------------
+# Incremental rescans (based on "AUTOMACAO"."Devices" freshness)
+# ----------------------
+
+DISCOVERY_INCREMENTAL_MAX_AGE = float(os.environ.get("DISCOVERY_INCREMENTAL_MAX_AGE_HOURS", "24")) * 3600
+DISCOVERY_INCREMENTAL_SAMPLE = int(os.environ.get("DISCOVERY_INCREMENTAL_SAMPLE", "64"))  # portas extras por host
+# Portas sempre verificadas em modo incremental (apenas as presentes no método escolhido)
+DISCOVERY_LIVENESS_PORTS: List[int] = [22, 80, 443, 8080, 5985, 5986]
+DISCOVERY_INCREMENTAL_SWEEPS = itertools.count()
+
+
+def device_open_ports(device: Dict[str, Any]) -> List[int]:
+    """Ports recorded as open for a stored device (services entries with an int port)."""
+    ports: List[int] = []
+    for s in device.get("services") or []:
+        if isinstance(s, dict) and isinstance(s.get("port"), int) and s["port"] not in ports:
+            ports.append(s["port"])
+    return ports
+
+
+def device_age_seconds(device: Dict[str, Any]) -> Optional[float]:
+    last_seen = device.get("last_seen")
+    if isinstance(last_seen, str):
         try:
-            oper = int(if_oper[idx][1]) if idx < len(if_oper) else None
+            last_seen = datetime.datetime.fromisoformat(last_seen)
         except Exception:
-            oper = None
-        interfaces.append({"name": name, "speed": speed, "operStatus": oper})
+            return None
+    if not isinstance(last_seen, datetime.datetime):
+        return None
+    if last_seen.tzinfo is None:
+        return time.time() - time.mktime(last_seen.timetuple())
+    return (datetime.datetime.now(datetime.timezone.utc) - last_seen).total_seconds()
 
-    info.update({
-        "sysDescr": sys_descr,
-        "sysName": sys_name,
-        "sysUpTime": sys_uptime,
-        "hrMemoryKB": int(hr_mem) if hr_mem and str(hr_mem).isdigit() else None,
-        "cpuAvgLoad": cpu_avg,
-        "interfaces": interfaces,
-    })
-    # Disks (hrStorage)
-    try:
-        descrs = snmp_walk_ext(ip, version, community, '1.3.6.1.2.1.25.2.3.1.3', v3)
-        units = snmp_walk_ext(ip, version, community, '1.3.6.1.2.1.25.2.3.1.4', v3)
-        sizes = snmp_walk_ext(ip, version, community, '1.3.6.1.2.1.25.2.3.1.5', v3)
-        useds = snmp_walk_ext(ip, version, community, '1.3.6.1.2.1.25.2.3.1.6', v3)
-        def idx_map(items: List[Tuple[str, Any]]):
-            m: Dict[str, Any] = {}
-            for oid, val in items:
-                idx = oid.split('.')[-1]
-                m[idx] = val
-            return m
-        mDescr = idx_map(descrs)
-        mUnits = {k: int(v) if str(v).isdigit() else 0 for k, v in idx_map(units).items()}
-        mSize = {k: int(v) if str(v).isdigit() else 0 for k, v in idx_map(sizes).items()}
-        mUsed = {k: int(v) if str(v).isdigit() else 0 for k, v in idx_map(useds).items()}
-        disks: List[Dict[str, Any]] = []
-        for k, desc in mDescr.items():
-            unit = mUnits.get(k, 0)
-            size = mSize.get(k, 0)
-            used = mUsed.get(k, 0)
-            if unit and size:
-                total_bytes = unit * size
-                used_bytes = unit * used
-                pct = (used_bytes / total_bytes * 100.0) if total_bytes > 0 else None
-                disks.append({
-                    "descr": desc,
-                    "total_bytes": total_bytes,
-                    "used_bytes": used_bytes,
-                    "used_percent": round(pct, 2) if pct is not None else None,
-                })
-        info["disks"] = disks
-    except Exception:
-        info["disks"] = []
 
-    # Processes (hrSWRun)
+def plan_incremental_ports(ip: str, ports: List[int], device: Optional[Dict[str, Any]], sweep: int) -> Tuple[List[int], bool]:
+    """Return (ports to scan, is_incremental) for one host.
+    Unknown or stale hosts get the full list; recently seen hosts get their previously open
+    ports, the liveness ports and a sample of the others that rotates on every sweep.
+    """
+    if not device:
+        return ports, False
+    age = device_age_seconds(device)
+    if age is None or age > DISCOVERY_INCREMENTAL_MAX_AGE:
+        return ports, False
+    allowed = set(ports)
+    previous = [p for p in device_open_ports(device) if p in allowed]
+    chosen = set(previous)
+    chosen.update(p for p in DISCOVERY_LIVENESS_PORTS if p in allowed)
+    others = [p for p in ports if p not in chosen]
+    if others and DISCOVERY_INCREMENTAL_SAMPLE > 0:
+        n = min(DISCOVERY_INCREMENTAL_SAMPLE, len(others))
+        # Deslocamento estável por IP que avança a cada varredura, cobrindo todas as portas ao longo do tempo
+        start = (zlib.crc32(ip.encode()) + sweep * n) % len(others)
+        chosen.update(others[(start + i) % len(others)] for i in range(n))
+    return [p for p in ports if p in chosen], True
+
+
+def record_discovery_diff(device: Dict[str, Any], host: Dict[str, Any], scanned: List[int]) -> Dict[str, Any]:
+    """Persist only what changed since the stored inventory for an incrementally scanned host."""
+    previous = set(device_open_ports(device))
+    now_open = set(host.get("open_ports") or [])
+    scanned_set = set(scanned)
+    added = sorted(now_open - previous)
+    removed = sorted(p for p in previous if p in scanned_set and p not in now_open)
+    # Estado e last_seen vêm só do que respondeu nesta varredura (portas fora do perfil não contam)
+    status = "Online" if now_open else "Offline"
+    changes: Dict[str, Any] = {"added": added, "removed": removed}
+    if status != device.get("status"):
+        changes["status"] = {"from": device.get("status"), "to": status}
+    host["status"] = status
+    if not added and not removed and "status" not in changes:
+        if now_open:
+            pg_touch_device(device["ip"])
+        return changes
+    names = dict(zip(host.get("open_ports") or [], host.get("services") or []))
+    services = [s for s in (device.get("services") or [])
+                if not (isinstance(s, dict) and s.get("port") in removed)]
+    services.extend({"service": names.get(p, SERVICE_MAP.get(p, f"port-{p}")), "port": p} for p in added)
+    pg_apply_device_diff(device["ip"], services, status, seen=bool(now_open))
+    if device.get("id"):
+        pg_add_event(device["id"], "SERVICES_CHANGED", "info",
+                     f"Serviços alterados (+{len(added)}/-{len(removed)})", changes, source="discovery")
+    return changes
+
+
+DISCOVERY_HOST_WORKERS = int(os.environ.get("DISCOVERY_HOST_WORKERS", "64"))  # hosts varridos em paralelo
+DISCOVERY_WINDOW = int(os.environ.get("DISCOVERY_WINDOW", "256"))  # hosts submetidos e ainda não concluídos
+
+
+def discovery_target_bounds(target: Optional[str]) -> Optional[Tuple[int, int, int]]:
+    """Describe a target ("start-end" or CIDR) as (first address as int, host count, IP version)
+    without materialising it. CIDR bounds follow ip_network().hosts().
+    """
+    if not target:
+        return None
+    target = target.strip()
     try:
-        names = snmp_walk_ext(ip, version, community, '1.3.6.1.2.1.25.4.2.1.2', v3)
-        statuses = snmp_walk_ext(ip, version, community, '1.3.6.1.2.1.25.4.2.1.7', v3)
-        total = len(names)
-        running = 0
-        for _, st in statuses:
-            try:
-                val = int(st)
-                if val == 1:
-                    running += 1
-            except Exception:
-                pass
-        info["processes"] = {"total": total, "running": running}
+        if "/" in target:
+            net = ipaddress.ip_network(target, strict=False)
+            first = int(net.network_address)
+            count = net.num_addresses
+            if net.version == 4 and net.prefixlen <= 30:
+                first, count = first + 1, count - 2  # sem rede e broadcast
+            elif net.version == 6 and net.prefixlen <= 126:
+                first, count = first + 1, count - 1  # sem o anycast Subnet-Router
+            return first, count, net.version
+        if "-" in target:
+            start, end = target.split("-")
+            start_ip = ipaddress.ip_address(start.strip())
+            end_ip = ipaddress.ip_address(end.strip())
+            if start_ip.version != end_ip.version:
+                return None
+            return int(start_ip), max(0, int(end_ip) - int(start_ip) + 1), start_ip.version
     except Exception:
-        info["processes"] = {"total": None, "running": None}
-    return info
+        return None
+    return None
 
-@app.post("/api/discovery/snmp")
-def discovery_snmp(payload: Dict[str, Any] = Body(...)):
-    target = payload.get("target")
-    community = payload.get("community", "public")
-    version = payload.get("version", "v2c")
-    v3 = payload.get("v3") or None
-    # resolve IP
-    try:
-        ip = socket.gethostbyname(target)
-    except Exception:
-        ip = target
-    host = discover_host(ip)
-    snmp_info = build_snmp_hostinfo(ip, community, version, v3)
+
+def _shard_slice(count: int, shard_index: int, shard_count: int) -> Tuple[int, int]:
+    shard_count = max(1, shard_count)
+    shard_index = min(max(0, shard_index), shard_count - 1)
+    lo = count * shard_index // shard_count
+    hi = count * (shard_index + 1) // shard_count
+    return lo, hi - lo
+
+
+def count_discovery_targets(target: Optional[str], shard_index: int = 0, shard_count: int = 1) -> int:
+    bounds = discovery_target_bounds(target)
+    if not bounds:
+        return 0
+    return _shard_slice(bounds[1], shard_index, shard_count)[1]
+
+
+def iter_discovery_targets(target: Optional[str], shuffle: bool = False, shard_index: int = 0,
+                           shard_count: int = 1, seed: Optional[int] = None):
+    """Lazily yield the IPs of a target (or of one shard of it).
+    shuffle visits addresses in a pseudo-random order using an affine permutation of the
+    index space, so no list of the range is ever built.
+    """
+    bounds = discovery_target_bounds(target)
+    if not bounds:
+        return
+    first, count, version = bounds
+    offset, n = _shard_slice(count, shard_index, shard_count)
+    if n <= 0:
+        return
+    make = ipaddress.IPv4Address if version == 4 else ipaddress.IPv6Address
+    if not shuffle or n < 3:
+        for i in range(n):
+            yield str(make(first + offset + i))
+        return
+    rnd = random.Random(seed)
+    a = rnd.randrange(1, n)
+    while math.gcd(a, n) != 1:
+        a = rnd.randrange(1, n)
+    c = rnd.randrange(0, n)
+    for i in range(n):
+        yield str(make(first + offset + (a * i + c) % n))
+
+
+DISCOVERY_MAX_SHARDS = int(os.environ.get("DISCOVERY_MAX_SHARDS", "256"))  # teto de fatias por alvo
+
+
+def split_discovery_target(target: Optional[str], shards: int) -> List[str]:
+    """Split a target into up to `shards` contiguous "start-end" ranges (never more ranges than hosts)."""
+    bounds = discovery_target_bounds(target)
+    if not bounds:
+        return []
+    first, count, version = bounds
+    make = ipaddress.IPv4Address if version == 4 else ipaddress.IPv6Address
+    shards = max(1, min(shards, count))
+    parts: List[str] = []
+    for i in range(shards):
+        lo, n = _shard_slice(count, i, shards)
+        if n > 0:
+            parts.append(f"{make(first + lo)}-{make(first + lo + n - 1)}")
+    return parts
+
+
+def discovery_shard_target(target: str, shard_index: int, shard_count: int) -> str:
+    """Contiguous "start-end" range covered by one shard of a target."""
+    bounds = discovery_target_bounds(target)
+    if not bounds or shard_count <= 1:
+        return target
+    first, count, version = bounds
+    make = ipaddress.IPv4Address if version == 4 else ipaddress.IPv6Address
+    lo, n = _shard_slice(count, shard_index, shard_count)
+    return f"{make(first + lo)}-{make(first + lo + max(n, 1) - 1)}"
+
+
+def parse_discovery_target(target: Optional[str]) -> List[str]:
+    """Expand a discovery target ("start-end" or CIDR) into a list of IPs."""
+    return list(iter_discovery_targets(target))
+
+
+# ----------------------
+# Scan bitmaps (compact open-port matrix for large sweeps)
+# ----------------------
+# Hosts são ordinais dentro do alvo e portas são índices numa tabela. Cada porta com algum host aberto
+# ganha uma coluna (bytearray com 1 bit por host do alvo, criada sob demanda) e cada host online guarda
+# um int com os bits das suas portas (linha). Consultas agregadas convertem colunas inteiras em int e
+# usam &, | e bit_count, sem percorrer hosts.
+
+
+DISCOVERY_SUMMARY_TOP_PORTS = int(os.environ.get("DISCOVERY_SUMMARY_TOP_PORTS", "50"))
+# alvos maiores (ex.: IPv6 /64) não ganham bitmap: 1 bit por endereço em cada coluna seria inviável
+SCAN_BITMAP_MAX_HOSTS = int(os.environ.get("SCAN_BITMAP_MAX_HOSTS", str(1 << 22)))
+
+
+def scan_bitmap_new(target: Optional[str], ports: List[int]) -> Optional[Dict[str, Any]]:
+    """Empty bitmap for target, or None when it has no range bounds or exceeds SCAN_BITMAP_MAX_HOSTS."""
+    bounds = discovery_target_bounds(target)
+    if not bounds:
+        return None
+    first, count, version = bounds
+    if count > SCAN_BITMAP_MAX_HOSTS:
+        return None
+    size = (count + 7) // 8
     return {
-        "target": ip,
-        "timestamp": host["timestamp"],
-        "systemInfo": {
-            "hostname": snmp_info.get("sysName") or host["hostname"],
-            "description": snmp_info.get("sysDescr") or host["os"],
-            "uptime": snmp_info.get("sysUpTime"),
-        },
-        "snmp": snmp_info,
+        "first": first,
+        "count": count,
+        "version": version,
+        "ports": list(ports),
+        "index": {p: i for i, p in enumerate(ports)},
+        "columns": {},  # índice da porta -> bytearray
+        "rows": {},  # ordinal do host -> bits das portas abertas
+        "scanned": bytearray(size),
+        "online": bytearray(size),
+        "lock": threading.Lock(),
+    }
+
+
+def _bitmap_int(column: Optional[bytearray]) -> int:
+    return int.from_bytes(column, "little") if column else 0
+
+
+def scan_bitmap_add(bm: Dict[str, Any], ip: str, open_ports: List[int]) -> None:
+    ordinal = int(ipaddress.ip_address(ip)) - bm["first"]
+    if not 0 <= ordinal < bm["count"]:
+        return
+    byte, bit = ordinal >> 3, 1 << (ordinal & 7)
+    row = 0
+    with bm["lock"]:
+        for p in open_ports:
+            i = bm["index"][p]
+            column = bm["columns"].get(i)
+            if column is None:
+                column = bm["columns"][i] = bytearray(len(bm["scanned"]))
+            column[byte] |= bit
+            row |= 1 << i
+        bm["scanned"][byte] |= bit
+        if row:
+            bm["rows"][ordinal] = row
+            bm["online"][byte] |= bit
+        else:
+            bm["rows"].pop(ordinal, None)
+            bm["online"][byte] &= ~bit & 0xFF
+
+
+def _iter_bits(data: bytes, offset: int = 0, limit: Optional[int] = None) -> List[int]:
+    """Positions of the set bits of a little-endian bitmap, skipping the first `offset` of them."""
+    found: List[int] = []
+    for n, byte in enumerate(data):
+        if not byte:
+            continue
+        ones = byte.bit_count()
+        if offset >= ones:
+            offset -= ones
+            continue
+        for bit in range(8):
+            if byte >> bit & 1:
+                if offset:
+                    offset -= 1
+                    continue
+                found.append(n * 8 + bit)
+                if limit is not None and len(found) >= limit:
+                    return found
+    return found
+
+
+def scan_bitmap_ip(bm: Dict[str, Any], ordinal: int) -> str:
+    make = ipaddress.IPv4Address if bm["version"] == 4 else ipaddress.IPv6Address
+    return str(make(bm["first"] + ordinal))
+
+
+def scan_bitmap_memory(bm: Dict[str, Any]) -> int:
+    return (sum(sys.getsizeof(c) for c in bm["columns"].values()) + sum(sys.getsizeof(r) for r in bm["rows"].values())
+            + sys.getsizeof(bm["rows"]) + sys.getsizeof(bm["scanned"]) + sys.getsizeof(bm["online"]))
+
+
+def scan_bitmap_summary(bm: Dict[str, Any], top: Optional[int] = None) -> Dict[str, Any]:
+    """Scanned/online counts and port popularity (hosts with each port open), most common first."""
+    with bm["lock"]:
+        popularity = [(bm["ports"][i], _bitmap_int(col).bit_count()) for i, col in bm["columns"].items()]
+        summary = {
+            "scanned": _bitmap_int(bm["scanned"]).bit_count(),
+            "online": _bitmap_int(bm["online"]).bit_count(),
+            "memory_bytes": scan_bitmap_memory(bm),
+        }
+    popularity = sorted((x for x in popularity if x[1]), key=lambda x: (-x[1], x[0]))
+    summary["ports"] = [{"port": p, "hosts": n} for p, n in (popularity[:top] if top else popularity)]
+    return summary
+
+
+def scan_bitmap_hosts(bm: Dict[str, Any], ports: Optional[List[int]] = None, match: str = "all",
+                      offset: int = 0, limit: int = 500) -> Dict[str, Any]:
+    """Hosts having all (or any) of `ports` open; without ports, every online host."""
+    # Cópias tiradas sob o lock; o cruzamento e a paginação correm fora dele para não travar a varredura
+    with bm["lock"]:
+        if ports:
+            cols = [bytes(bm["columns"].get(bm["index"].get(p, -1)) or b"") for p in ports]
+        else:
+            cols = [bytes(bm["online"])]
+    mask = _bitmap_int(cols[0])
+    for col in cols[1:]:
+        mask = (mask | _bitmap_int(col)) if match == "any" else (mask & _bitmap_int(col))
+    ordinals = _iter_bits(mask.to_bytes(len(bm["scanned"]), "little"), offset, limit) if limit > 0 else []
+    with bm["lock"]:
+        rows = [bm["rows"].get(ordinal, 0) for ordinal in ordinals]
+    port_table = bm["ports"]
+    hosts = [{
+        "ip": scan_bitmap_ip(bm, ordinal),
+        "open_ports": sorted(port_table[i] for i in _iter_bits(row.to_bytes((row.bit_length() + 7) // 8, "little"))),
+    } for ordinal, row in zip(ordinals, rows)]
+    return {"total": mask.bit_count(), "offset": offset, "hosts": hosts}
+
+
+def discovery_sweep_options(payload: Dict[str, Any]) -> Dict[str, Any]:
+    """Normalise the sweep parameters shared by network sweeps, jobs and shard workers."""
+    method = payload.get("method", "tcp")
+    profile = resolve_scan_profile(payload.get("profile") or method)
+    return {
+        "method": method,
+        "profile": profile,
+        "ports": profile["ports"],
+        "sshUser": payload.get("sshUser"),
+        "sshPass": payload.get("sshPass"),
+        "sshKey": payload.get("sshKey"),
+        "sshPort": int(payload.get("sshPort", 22)),
+        "sshTimeout": float(payload.get("sshTimeout", 3.0)),
+        "winrmUser": payload.get("winrmUser"),
+        "winrmPass": payload.get("winrmPass"),
+        "winrmUseTls": bool(payload.get("winrmUseTls", False)),
+        "winrmPort": int(payload.get("winrmPort", 5985)),
+        "winrmTimeout": float(payload.get("winrmTimeout", 4.0)),
+        "fresh": bool(payload.get("fresh", False)),
+        "incremental": bool(payload.get("incremental", False)),
+        "onlyOnline": bool(payload.get("onlyOnline", False)),
+        "shuffle": bool(payload.get("shuffle", False)),
+        "seed": payload.get("seed"),
+        "shardIndex": int(payload.get("shardIndex", 0)),
+        "shardCount": int(payload.get("shardCount", 1)),
+        "compact": bool(payload.get("compact", False)),
+    }
+
+
+def discover_network_host(ip: str, opts: Dict[str, Any], known: Dict[str, Dict[str, Any]], sweep: int) -> Dict[str, Any]:
+    """Scan, enrich and shape one host of a network sweep."""
+    ports: List[int] = opts["ports"]
+    plan_ports, is_incremental = ports, False
+    if opts["incremental"]:
+        plan_ports, is_incremental = plan_incremental_ports(ip, ports, known.get(ip), sweep)
+    # No modo incremental a fatia já é reduzida; parada antecipada deixaria portas fora do diff
+    profile = dict(opts["profile"], earlyStop=None) if is_incremental else opts["profile"]
+    host = discover_host_with_ports(ip, plan_ports, persist=not is_incremental, fresh=opts["fresh"], profile=profile)
+    if is_incremental:
+        host["changes"] = record_discovery_diff(known[ip], host, plan_ports)
+    # Linux enrichment if SSH creds provided
+    host = enrich_linux_details(host["ip"], host, ssh_user=opts["sshUser"], ssh_pass=opts["sshPass"], ssh_key=opts["sshKey"], ssh_port=opts["sshPort"], ssh_timeout=opts["sshTimeout"])
+    # Windows enrichment if WinRM creds provided
+    host = enrich_windows_details(host["ip"], host, winrm_user=opts["winrmUser"], winrm_pass=opts["winrmPass"], winrm_use_tls=opts["winrmUseTls"], winrm_port=opts["winrmPort"], winrm_timeout=opts["winrmTimeout"])
+    host["os"] = compose_os_label(host)
+    device = {
+        "ip": host["ip"],
+        "hostname": host["hostname"],
+        "status": host["status"],
         "services": [{"service": s} for s in host["services"]],
+        "services_detailed": host.get("services_detailed", []),
+        "open_ports": host.get("open_ports", []),
+        "linux_ports": host.get("linux_ports"),
+        "windows_ports": host.get("windows_ports"),
+        "os": host["os"],
+        "virtualization": host.get("virtualization"),
+        "scan": {k: v for k, v in (host.get("scan") or {}).items() if k != "unscanned"},
+        "timestamp": host["timestamp"],
     }
+    if opts["incremental"]:
+        device["scan_mode"] = "incremental" if is_incremental else "full"
+        device["changes"] = host.get("changes")
+        device["ports_scanned"] = len(plan_ports)
+    return device
 
 
-def _discover_snmp_neighbors(ip: str, version: str, community: str, v3: Dict[str, Any] | None = None, timeout: int = 1, retries: int = 0) -> List[Dict[str, Any]]:
-    neighbors: List[Dict[str, Any]] = []
+def sweep_discovery_hosts(ips, opts: Dict[str, Any], known: Dict[str, Dict[str, Any]], sweep: int,
+                          cancel: Optional[threading.Event] = None):
+    """Scan hosts from a (lazy) iterator keeping at most DISCOVERY_WINDOW submitted at a time.
+    Yields (ip, device or None on failure) as hosts complete.
+    """
+    window = max(DISCOVERY_WINDOW, DISCOVERY_HOST_WORKERS)
+    ips = iter(ips)
+    executor = ThreadPoolExecutor(max_workers=DISCOVERY_HOST_WORKERS)
+    in_flight: Dict[Future, str] = {}
+    exhausted = False
     try:
-        # LLDP primeiro
-        rem_sys = snmp_walk_ext(ip, version, community, LLDP_REM_SYSNAME, v3, timeout, retries)
-        if rem_sys:
-            rem_port = snmp_walk_ext(ip, version, community, LLDP_REM_PORTID, v3, timeout, retries)
-            rem_loc_num = snmp_walk_ext(ip, version, community, LLDP_REM_LOCAL_PORTNUM, v3, timeout, retries)
-            loc_desc = snmp_walk_ext(ip, version, community, LLDP_LOC_PORT_DESC, v3, timeout, retries)
-            rem_map: Dict[str, Dict[str, Any]] = {}
-            for oid, val in rem_sys:
-                key = oid.split(LLDP_REM_SYSNAME + ".")[-1]
-                rem_map[key] = {"remote_hostname": _snmp_decode(val)}
-            port_map: Dict[str, str] = {}
-            for oid, val in rem_port:
-                key = oid.split(LLDP_REM_PORTID + ".")[-1]
-                port_map[key] = _snmp_decode(val)
-            desc_by_num: Dict[str, str] = {}
-            for oid, val in loc_desc:
-                suf = oid.split(LLDP_LOC_PORT_DESC + ".")[-1]
-                desc_by_num[suf] = _snmp_decode(val)
-            for oid, val in rem_loc_num:
-                key = oid.split(LLDP_REM_LOCAL_PORTNUM + ".")[-1]
-                local_num = _snmp_decode(val)
-                local_if = desc_by_num.get(local_num) or f"port-{local_num}"
-                ent = rem_map.get(key, {})
-                rport = port_map.get(key)
-                if ent:
-                    neighbors.append({"local_if": local_if, "remote_hostname": ent.get("remote_hostname"), "remote_port": rport, "protocol": "LLDP"})
-        # Se LLDP vazio, tenta CDP
-        if not neighbors:
-            dev_ids = snmp_walk_ext(ip, version, community, CDP_CACHE_DEVICEID, v3, timeout, retries)
-            dev_ports = snmp_walk_ext(ip, version, community, CDP_CACHE_DEVICEPORT, v3, timeout, retries)
-            if_idxs = snmp_walk_ext(ip, version, community, CDP_CACHE_IFINDEX, v3, timeout, retries)
-            if_names = snmp_walk_ext(ip, version, community, IF_NAME, v3, timeout, retries)
-            names_map: Dict[str, str] = {}
-            for oid, val in if_names:
-                suf = oid.split(IF_NAME + ".")[-1]
-                names_map[suf] = _snmp_decode(val)
-            ports_map: Dict[str, str] = {}
-            for oid, val in dev_ports:
-                suf = oid.split(CDP_CACHE_DEVICEPORT + ".")[-1]
-                ports_map[suf] = _snmp_decode(val)
-            for oid, val in dev_ids:
-                suf = oid.split(CDP_CACHE_DEVICEID + ".")[-1]
-                loc_index = None
+        while True:
+            while not exhausted and len(in_flight) < window and not (cancel and cancel.is_set()):
+                ip = next(ips, None)
+                if ip is None:
+                    exhausted = True
+                    break
+                dns_lookup_async("rdns", ip)  # DNS reverso do lote resolve enquanto as portas são varridas
+                in_flight[executor.submit(discover_network_host, ip, opts, known, sweep)] = ip
+            if not in_flight:
+                break
+            done, _ = wait(list(in_flight), return_when=FIRST_COMPLETED)
+            for fut in done:
+                ip = in_flight.pop(fut)
                 try:
-                    loc_index = suf.split(".")[0]
+                    yield ip, fut.result()
                 except Exception:
-                    pass
-                loc_name = (loc_index and names_map.get(loc_index)) or (loc_index and f"if-{loc_index}") or None
-                neighbors.append({"local_if": loc_name, "remote_hostname": _snmp_decode(val), "remote_port": ports_map.get(suf), "protocol": "CDP"})
-    except Exception:
-        pass
-    return neighbors
+                    yield ip, None
+            if cancel and cancel.is_set():
+                break
+    finally:
+        # Em cancelamento, descarta hosts ainda não iniciados sem aguardar
+        cancelled = bool(cancel and cancel.is_set())
+        executor.shutdown(wait=not cancelled, cancel_futures=True)
 
 
-@app.post("/api/topologia/snmp")
-def topologia_snmp(payload: Dict[str, Any] = Body(...)):
-    target = payload.get("target")
-    community = payload.get("community", "public")
-    version = payload.get("version", "v2c")
-    v3 = payload.get("v3") or None
-    timeout = int(payload.get("timeout", 1))
-    retries = int(payload.get("retries", 0))
-    try:
-        ip = socket.gethostbyname(target)
-    except Exception:
-        ip = target
-    neighbors = _discover_snmp_neighbors(ip, version, community, v3, timeout=timeout, retries=retries)
-    src_dev = pg_upsert_device({"ip": ip, "os": "Network", "status": "Online"})
-    src_id = src_dev.get("id")
-    persisted: List[Dict[str, Any]] = []
-    for n in neighbors:
-        dst_dev = pg_upsert_device({"hostname": n.get("remote_hostname"), "os": "Network"})
-        dst_id = dst_dev.get("id")
-        src_if_id = pg_upsert_interface(src_id, n.get("local_if"))
-        dst_if_id = pg_upsert_interface(dst_id, n.get("remote_port"))
-        pg_upsert_link(src_id, src_if_id, dst_id, dst_if_id, n.get("protocol") or "SNMP")
-        persisted.append({"src": src_id, "src_if": n.get("local_if"), "dst": dst_id, "dst_if": n.get("remote_port"), "protocol": n.get("protocol")})
-    return {"target": ip, "neighbors": neighbors, "persisted": persisted}
+# ----------------------
+# Multi-process sweeps (one scan loop per worker process)
+# ----------------------
 
+DISCOVERY_PROCESS_WORKERS = int(os.environ.get("DISCOVERY_PROCESS_WORKERS", str(os.cpu_count() or 1)))  # limite de processos
+DISCOVERY_MP_START_METHOD = os.environ.get("DISCOVERY_MP_START_METHOD", "spawn")
 
-@app.post("/api/snmp/set")
-def api_snmp_set(payload: Dict[str, Any] = Body(...), request: Request = None):
-    # Rate limiting
-    client_ip = request.client.host if request else "unknown"
-    if not rate_limit_check(client_ip, "SNMP_SET", RATE_LIMIT_SNMP_SET):
-        raise HTTPException(status_code=429, detail="Rate limit exceeded for SNMP_SET")
-    
-    target = payload.get("target")
-    community = payload.get("community", "private")
-    version = payload.get("version", "v2c")
-    v3 = payload.get("v3") or None
-    oid = payload.get("oid")
-    value_type = payload.get("type", "OctetString")
-    value = payload.get("value")
-    timeout = int(payload.get("timeout", 2))
-    retries = int(payload.get("retries", 0))
-    
-    # Validate SNMPv3 if needed
-    if version == "v3" and v3:
-        validation_errors = validate_snmp_v3(v3)
-        if validation_errors:
-            raise HTTPException(status_code=400, detail={"errors": validation_errors})
-    
+
+def _discovery_process_worker(target: str, payload: Dict[str, Any], sweep: int, out_queue, cancel) -> None:
+    """Worker process entry point: sweep one shard and stream each host back as compact JSON."""
     try:
-        ip = socket.gethostbyname(target)
-    except Exception:
-        ip = target
-    
-    result = snmp_set_ext(ip, version, community, oid, value_type, value, v3, timeout, retries)
-    
+        opts = discovery_sweep_options(payload)
+        known: Dict[str, Dict[str, Any]] = {}
+        if opts["incremental"]:
+            known = {d["ip"]: d for d in pg_list_devices() if d.get("ip")}
+        ips = iter_discovery_targets(target, shuffle=opts["shuffle"], seed=opts["seed"])
+        for ip, device in sweep_discovery_hosts(ips, opts, known, sweep, cancel=cancel):
+            if device is None:
+                out_queue.put(("x", ip))
+            else:
+                out_queue.put(("h", json.dumps(device, separators=(",", ":"), default=str)))
+    except Exception as e:
+        out_queue.put(("e", str(e)))
+    finally:
+        out_queue.put(("d", None))
+
+
+def sweep_discovery_processes(target: str, payload: Dict[str, Any], workers: int, sweep: int,
+                              cancel: Optional[threading.Event] = None):
+    """Split a target across worker processes and yield (ip, device or None) as they stream back."""
+    ctx = multiprocessing.get_context(DISCOVERY_MP_START_METHOD)
+    out_queue = ctx.Queue(maxsize=max(DISCOVERY_WINDOW, 1) * max(workers, 1))
+    mp_cancel = ctx.Event()
+    # Cada processo recebe sua fatia como faixa própria; shard/embaralhamento já vêm resolvidos
+    worker_payload = {k: v for k, v in payload.items() if k not in ("target", "shardIndex", "shardCount", "workers")}
+    procs = []
+    for shard in split_discovery_target(target, workers):
+        proc = ctx.Process(target=_discovery_process_worker, args=(shard, worker_payload, sweep, out_queue, mp_cancel), daemon=True)
+        proc.start()
+        procs.append(proc)
+    running = len(procs)
     try:
-        dev = pg_get_device(ip=ip) or pg_upsert_device({"ip": ip, "hostname": payload.get("hostname")})
-        dev_id = dev.get("id") if isinstance(dev, dict) else None
-        if dev_id:
-            ev = pg_add_event(
-                dev_id, "SNMP_SET", "info" if result.get("ok") else "error",
-                f"SET {oid} ({value_type})", 
-                mask_secrets({
-                    "oid": oid, "type": value_type, "value": value,
-                    "version": version, "timeout": timeout, "retries": retries
-                }),
-                actor=payload.get("actor", "api"),
-                source=client_ip
-            )
-            result["event_id"] = ev.get("id")
-    except Exception:
-        pass
-    return result
-
-
-@app.post("/api/netmiko/command")
-def api_netmiko_command(payload: Dict[str, Any] = Body(...), request: Request = None):
+        while running:
+            if cancel is not None and cancel.is_set():
+                mp_cancel.set()
+            try:
+                kind, data = out_queue.get(timeout=0.5)
+            except queue.Empty:
+                if not any(p.is_alive() for p in procs):
+                    break
+                continue
+            if kind == "h":
+                device = json.loads(data)
+                yield device["ip"], device
+            elif kind == "x":
+                yield data, None
+            elif kind == "d":
+                running -= 1
+    finally:
+        mp_cancel.set()
+        for proc in procs:
+            proc.join(timeout=5)
+            if proc.is_alive():
+                proc.terminate()
+
+
+def run_discovery_network(payload: Dict[str, Any], job: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """Network sweep shared by the synchronous endpoint and background jobs.
+    When a job record is given, progress and partial results are published on it
+    and its cancel event is honoured between hosts. With workers > 1 the range is
+    split across that many processes.
+    """
+    target = payload.get("target")  # expected "start-end" or CIDR
+    opts = discovery_sweep_options(payload)
+    method = opts["method"]
+    discovered: List[Dict[str, Any]] = []
+
+    if not target:
+        return {"discoveredDevices": []}
+
+    total = count_discovery_targets(target, opts["shardIndex"], opts["shardCount"])
+    if job is not None:
+        discovery_job_progress(job, total=total)
+
+    known: Dict[str, Dict[str, Any]] = {}
+    sweep = 0
+    if opts["incremental"]:
+        sweep = next(DISCOVERY_INCREMENTAL_SWEEPS)
+    stats = {"full": 0, "incremental": 0, "ports_scanned": 0, "ports_full": len(opts["ports"]) * total}
+    cancel = job["cancel"] if job is not None else None
+    bitmap = scan_bitmap_new(target, opts["ports"])
+    if job is not None:
+        with DISCOVERY_JOBS_LOCK:
+            job["bitmap"] = bitmap
+    workers = min(max(1, int(payload.get("workers", 1))), max(1, DISCOVERY_PROCESS_WORKERS), max(1, total))
+
+    if workers > 1:
+        # A fatia pedida (shardIndex/shardCount) vira a faixa dividida entre os processos
+        shard = discovery_shard_target(target, opts["shardIndex"], opts["shardCount"])
+        results = sweep_discovery_processes(shard, payload, workers, sweep, cancel=cancel)
+    else:
+        if opts["incremental"]:
+            known = {d["ip"]: d for d in pg_list_devices() if d.get("ip")}
+        ips = iter_discovery_targets(target, shuffle=opts["shuffle"], shard_index=opts["shardIndex"],
+                                     shard_count=opts["shardCount"], seed=opts["seed"])
+        results = sweep_discovery_hosts(ips, opts, known, sweep, cancel=cancel)
+
+    # Scan ips com lista de portas conforme método
+    for ip, device in results:
+        if device is None:
+            if job is not None:
+                discovery_job_progress(job, done=1)
+            continue
+        if opts["incremental"]:
+            stats[device["scan_mode"]] += 1
+            stats["ports_scanned"] += device.pop("ports_scanned", 0)
+        if bitmap is not None:
+            scan_bitmap_add(bitmap, ip, device["open_ports"])
+        # compact: só o bitmap guarda o resultado; os registros por host não são retidos
+        if (opts["compact"] and bitmap is not None) or (opts["onlyOnline"] and device["status"] != "Online"):
+            device = None
+        else:
+            discovered.append(device)
+        if job is not None:
+            discovery_job_progress(job, done=1, result=device)
+
+    result: Dict[str, Any] = {"method": method, "profile": opts["profile"]["name"], "discoveredDevices": discovered}
+    if bitmap is not None:
+        result["summary"] = scan_bitmap_summary(bitmap, top=DISCOVERY_SUMMARY_TOP_PORTS)
+    if opts["incremental"]:
+        result["incremental"] = stats
+    return result
+
+
+@app.get("/api/discovery/profiles")
+def discovery_profiles_list():
+    builtin = [dict(p, builtin=True, ports_count=len(p["ports"]), ports=None if len(p["ports"]) > 100 else p["ports"])
+               for p in BUILTIN_SCAN_PROFILES.values()]
+    stored = [dict(p, builtin=False) for p in load_scan_profiles(force=True).values()]
+    return {"profiles": builtin + stored}
+
+
+@app.post("/api/discovery/profiles")
+def discovery_profiles_save(payload: Dict[str, Any] = Body(...)):
+    profile = normalize_scan_profile(payload)
+    if not pg_save_scan_profile(profile):
+        raise HTTPException(status_code=503, detail="PostgreSQL indisponível")
+    load_scan_profiles(force=True)
+    resolved = resolve_scan_profile(profile["name"])
+    return {"ok": True, "profile": profile, "ports_count": len(resolved["ports"]), "scan_order_head": resolved["scanOrder"][:20]}
+
+
+@app.delete("/api/discovery/profiles/{name}")
+def discovery_profiles_delete(name: str):
+    if not pg_delete_scan_profile(name):
+        raise HTTPException(status_code=404, detail="Perfil não encontrado")
+    load_scan_profiles(force=True)
+    return {"ok": True, "name": name}
+
+
+@app.get("/api/discovery/port-stats")
+def discovery_port_stats(top: int = Query(50)):
+    devices, counts = port_hit_counts()
+    ranked = sorted(counts.items(), key=lambda x: (-x[1], x[0]))[:max(1, top)]
+    return {
+        "devices": devices,
+        "ttl": PORT_STATS_TTL,
+        "ports": [{"port": p, "devices": n, "hit_rate": round(n / devices, 4) if devices else None} for p, n in ranked],
+    }
+
+
+@app.get("/api/discovery/targets/split")
+def discovery_targets_split(target: str = Query(...), shards: int = Query(2, ge=1, le=DISCOVERY_MAX_SHARDS)):
+    return {
+        "target": target,
+        "total": count_discovery_targets(target),
+        "shards": [{"target": t, "count": count_discovery_targets(t)} for t in split_discovery_target(target, shards)],
+    }
+
+
+@app.post("/api/discovery/network")
+def discovery_network(payload: Dict[str, Any] = Body(...)):
+    return run_discovery_network(payload)
+
+
+@app.post("/api/discovery/cross-platform")
+def discovery_cross_platform(payload: Dict[str, Any] = Body(...)):
+    targets: List[str] = payload.get("targets", [])
+    check_ports: bool = bool(payload.get("checkPorts", True))
+    discovered: List[Dict[str, Any]] = []
+    for t in targets:
+        ip = resolve_host(t)
+        if not ip:
+            continue
+        host = discover_host(ip) if check_ports else {
+            "ip": ip,
+            "hostname": t,
+            "status": "Unknown",
+            "services": [],
+            "os": "Unknown",
+            "virtualization": None,
+            "timestamp": time.strftime("%Y-%m-%d %H:%M:%S"),
+        }
+        discovered.append(host)
+    return {"discoveredDevices": discovered}
+
+
+# ----------------------
+# Discovery Jobs (background sweeps)
+# ----------------------
+
+DISCOVERY_JOB_WORKERS = int(os.environ.get("DISCOVERY_JOB_WORKERS", "2"))  # sweeps em paralelo
+DISCOVERY_JOB_QUEUE_LIMIT = int(os.environ.get("DISCOVERY_JOB_QUEUE_LIMIT", "8"))  # jobs aguardando
+DISCOVERY_JOB_RETENTION = int(os.environ.get("DISCOVERY_JOB_RETENTION", "50"))  # jobs finalizados em memória
+DISCOVERY_JOB_PERSIST_INTERVAL = float(os.environ.get("DISCOVERY_JOB_PERSIST_INTERVAL", "5"))  # segundos
+DISCOVERY_JOBS: Dict[str, Dict[str, Any]] = {}
+DISCOVERY_JOBS_LOCK = threading.Lock()
+DISCOVERY_JOB_EXECUTOR = ThreadPoolExecutor(max_workers=max(1, DISCOVERY_JOB_WORKERS), thread_name_prefix="discovery-job")
+DISCOVERY_JOB_FINAL_STATES = {"completed", "cancelled", "failed"}
+
+
+def discovery_job_view(job: Dict[str, Any], offset: int = 0) -> Dict[str, Any]:
+    """Public representation of a job; results are returned from `offset` on."""
+    with DISCOVERY_JOBS_LOCK:
+        total = job.get("total") or 0
+        done = job.get("done") or 0
+        results = list(job.get("results") or [])[max(0, offset):]
+        return {
+            "id": job["id"],
+            "status": job["status"],
+            "kind": job.get("kind", "network"),
+            "target": job.get("target"),
+            "method": job.get("method"),
+            "progress": {
+                "total": total,
+                "done": done,
+                "percent": round(done / total * 100.0, 2) if total else (100.0 if job["status"] == "completed" else 0.0),
+            },
+            "offset": max(0, offset),
+            "results": results,
+            "summary": scan_bitmap_summary(job["bitmap"], top=DISCOVERY_SUMMARY_TOP_PORTS) if job.get("bitmap") else None,
+            "error": job.get("error"),
+            "created_at": _job_time_iso(job.get("created_at")),
+            "started_at": _job_time_iso(job.get("started_at")),
+            "finished_at": _job_time_iso(job.get("finished_at")),
+        }
+
+
+def _job_time_iso(value: Any) -> Optional[str]:
+    """Job timestamp as ISO 8601 with offset (in-memory jobs keep local "%Y-%m-%d %H:%M:%S" strings, PG returns datetimes)."""
+    if value is None:
+        return None
+    if isinstance(value, datetime.datetime):
+        return (value if value.tzinfo else value.astimezone()).isoformat()
+    try:
+        return datetime.datetime.strptime(str(value), "%Y-%m-%d %H:%M:%S").astimezone().isoformat()
+    except ValueError:
+        return str(value)
+
+
+def _job_time_key(value: Optional[str]) -> float:
+    try:
+        return datetime.datetime.fromisoformat(value).timestamp() if value else 0.0
+    except ValueError:
+        return 0.0
+
+
+def discovery_job_progress(job: Dict[str, Any], total: Optional[int] = None, done: int = 0,
+                           result: Optional[Dict[str, Any]] = None) -> None:
+    """Update job counters/partial results; counters are persisted at most every DISCOVERY_JOB_PERSIST_INTERVAL
+    (results are written once, when the job finishes)."""
+    with DISCOVERY_JOBS_LOCK:
+        if total is not None:
+            job["total"] = total
+        job["done"] = (job.get("done") or 0) + done
+        if result is not None:
+            job["results"].append(result)
+        persist = (time.time() - job.get("_persisted_at", 0.0)) >= DISCOVERY_JOB_PERSIST_INTERVAL
+        if persist:
+            job["_persisted_at"] = time.time()
+    if persist:
+        pg_save_discovery_job(job, with_results=False)
+
+
+def _finish_discovery_job(job: Dict[str, Any], status: str, error: Optional[str] = None) -> None:
+    with DISCOVERY_JOBS_LOCK:
+        job["status"] = status
+        job["error"] = error
+        job["finished_at"] = time.strftime("%Y-%m-%d %H:%M:%S")
+    pg_save_discovery_job(job)
+    _prune_discovery_jobs()
+
+
+def _prune_discovery_jobs() -> None:
+    """Keep only the most recent finished jobs in memory (older ones stay in PostgreSQL)."""
+    with DISCOVERY_JOBS_LOCK:
+        finished = [j for j in DISCOVERY_JOBS.values() if j["status"] in DISCOVERY_JOB_FINAL_STATES]
+        excess = len(finished) - DISCOVERY_JOB_RETENTION
+        if excess > 0:
+            finished.sort(key=lambda j: j.get("finished_at") or "")
+            for j in finished[:excess]:
+                DISCOVERY_JOBS.pop(j["id"], None)
+
+
+def _run_discovery_job(job: Dict[str, Any]) -> None:
+    if job["cancel"].is_set():
+        _finish_discovery_job(job, "cancelled")
+        return
+    with DISCOVERY_JOBS_LOCK:
+        job["status"] = "running"
+        job["started_at"] = time.strftime("%Y-%m-%d %H:%M:%S")
+    pg_save_discovery_job(job, with_results=False)
+    try:
+        run_discovery_network(job["payload"], job=job)
+    except Exception as e:
+        _finish_discovery_job(job, "failed", str(e))
+        return
+    _finish_discovery_job(job, "cancelled" if job["cancel"].is_set() else "completed")
+
+
+def submit_discovery_job(payload: Dict[str, Any]) -> Dict[str, Any]:
+    """Queue a network sweep on the bounded job executor. Raises 429 when the queue is full."""
+    with DISCOVERY_JOBS_LOCK:
+        active = sum(1 for j in DISCOVERY_JOBS.values() if j["status"] not in DISCOVERY_JOB_FINAL_STATES)
+        if active >= DISCOVERY_JOB_WORKERS + DISCOVERY_JOB_QUEUE_LIMIT:
+            raise HTTPException(status_code=429, detail="Discovery job queue is full")
+        job: Dict[str, Any] = {
+            "id": uuid.uuid4().hex,
+            "kind": "network",
+            "status": "queued",
+            "target": payload.get("target"),
+            "method": payload.get("method", "tcp"),
+            "payload": dict(payload),
+            "total": 0,
+            "done": 0,
+            "results": [],
+            "error": None,
+            "created_at": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "started_at": None,
+            "finished_at": None,
+            "cancel": threading.Event(),
+        }
+        DISCOVERY_JOBS[job["id"]] = job
+    pg_save_discovery_job(job)
+    job["future"] = DISCOVERY_JOB_EXECUTOR.submit(_run_discovery_job, job)
+    return job
+
+
+def cancel_discovery_job(job_id: str) -> Optional[Dict[str, Any]]:
+    with DISCOVERY_JOBS_LOCK:
+        job = DISCOVERY_JOBS.get(job_id)
+    if not job:
+        return None
+    if job["status"] in DISCOVERY_JOB_FINAL_STATES:
+        return job
+    job["cancel"].set()
+    fut = job.get("future")
+    # Job ainda na fila: nunca vai rodar, finaliza aqui
+    if fut is not None and fut.cancel():
+        _finish_discovery_job(job, "cancelled")
+    else:
+        with DISCOVERY_JOBS_LOCK:
+            if job["status"] == "running":
+                job["status"] = "cancelling"
+    return job
+
+
+@app.post("/api/discovery/jobs")
+def api_discovery_jobs_create(payload: Dict[str, Any] = Body(...)):
+    if not payload.get("target"):
+        raise HTTPException(status_code=400, detail="target é obrigatório")
+    resolve_scan_profile(payload.get("profile") or payload.get("method", "tcp"))  # perfil inválido: 400 já aqui
+    job = submit_discovery_job(payload)
+    return {"ok": True, "id": job["id"], "status": job["status"]}
+
+
+@app.get("/api/discovery/jobs")
+def api_discovery_jobs_list(limit: int = Query(50, ge=1, le=500)):
+    with DISCOVERY_JOBS_LOCK:
+        in_memory = list(DISCOVERY_JOBS.values())
+    jobs = [{k: v for k, v in discovery_job_view(j).items() if k != "results"} for j in in_memory]
+    known = {j["id"] for j in jobs}
+    for row in pg_list_discovery_jobs(limit):
+        if row["id"] not in known:
+            jobs.append(row)
+    jobs.sort(key=lambda j: _job_time_key(j.get("created_at")), reverse=True)
+    return {"jobs": jobs[:limit]}
+
+
+@app.get("/api/discovery/jobs/{job_id}")
+def api_discovery_jobs_get(job_id: str, offset: int = Query(0)):
+    with DISCOVERY_JOBS_LOCK:
+        job = DISCOVERY_JOBS.get(job_id)
+    if job:
+        return discovery_job_view(job, offset)
+    stored = pg_get_discovery_job(job_id)
+    if not stored:
+        raise HTTPException(status_code=404, detail="Job não encontrado")
+    stored["results"] = (stored.get("results") or [])[max(0, offset):]
+    stored["offset"] = max(0, offset)
+    return stored
+
+
+def _discovery_job_bitmap(job_id: str) -> Dict[str, Any]:
+    with DISCOVERY_JOBS_LOCK:
+        job = DISCOVERY_JOBS.get(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job não encontrado (bitmap disponível apenas para jobs em memória)")
+    if not job.get("bitmap"):
+        raise HTTPException(status_code=404, detail="Job sem bitmap de portas")
+    return job["bitmap"]
+
+
+@app.get("/api/discovery/jobs/{job_id}/ports")
+def api_discovery_jobs_ports(job_id: str, top: Optional[int] = Query(None)):
+    return scan_bitmap_summary(_discovery_job_bitmap(job_id), top=top)
+
+
+@app.get("/api/discovery/jobs/{job_id}/hosts")
+def api_discovery_jobs_hosts(job_id: str, ports: Optional[str] = Query(None), match: str = Query("all"),
+                             offset: int = Query(0), limit: int = Query(500)):
+    bitmap = _discovery_job_bitmap(job_id)
+    try:
+        port_list = [int(x) for x in ports.split(",") if x.strip()] if ports else None
+    except ValueError:
+        raise HTTPException(status_code=400, detail="ports must be a comma separated list of integers")
+    if match not in ("all", "any"):
+        raise HTTPException(status_code=400, detail="match must be 'all' or 'any'")
+    return scan_bitmap_hosts(bitmap, port_list, match, max(0, offset), max(1, min(limit, 10000)))
+
+
+@app.delete("/api/discovery/jobs/{job_id}")
+def api_discovery_jobs_cancel(job_id: str):
+    job = cancel_discovery_job(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail="Job não encontrado")
+    return {"ok": True, "id": job_id, "status": job["status"]}
+
+
+# ----------------------
+# SNMP (pysnmp)
+# ----------------------
+try:
+    from pysnmp.hlapi import (
+        SnmpEngine,
+        CommunityData,
+        UdpTransportTarget,
+        ContextData,
+        ObjectType,
+        ObjectIdentity,
+        getCmd,
+        nextCmd,
+        setCmd,
+        OctetString,
+        Integer,
+        IpAddress,
+        Gauge32,
+        Counter32,
+        ObjectIdentifier,
+    )
+    # v3 auth imports (optional)
+    try:
+        from pysnmp.hlapi import (
+            UsmUserData,
+            usmHMACMD5AuthProtocol,
+            usmHMACSHAAuthProtocol,
+            usmHMACSHA256AuthProtocol,
+            usmHMACSHA384AuthProtocol,
+            usmHMACSHA512AuthProtocol,
+            usmNoAuthProtocol,
+            usmDESPrivProtocol,
+            usmAesCfb128Protocol,
+            usmAesCfb192Protocol,
+            usmAesCfb256Protocol,
+            usmNoPrivProtocol,
+        )
+    except Exception:
+        UsmUserData = None  # type: ignore
+        usmHMACMD5AuthProtocol = None  # type: ignore
+        usmHMACSHAAuthProtocol = None  # type: ignore
+        usmHMACSHA256AuthProtocol = None  # type: ignore
+        usmHMACSHA384AuthProtocol = None  # type: ignore
+        usmHMACSHA512AuthProtocol = None  # type: ignore
+        usmNoAuthProtocol = None  # type: ignore
+        usmDESPrivProtocol = None  # type: ignore
+        usmAesCfb128Protocol = None  # type: ignore
+        usmAesCfb192Protocol = None  # type: ignore
+        usmAesCfb256Protocol = None  # type: ignore
+        usmNoPrivProtocol = None  # type: ignore
+    HAS_PYSNMP = True
+except Exception:
+    HAS_PYSNMP = False
+
+# --- LLDP/CDP OIDs ---
+LLDP_REM_SYSNAME = "1.0.8802.1.1.2.1.4.1.1.9"
+LLDP_REM_PORTID = "1.0.8802.1.1.2.1.4.1.1.7"
+LLDP_REM_LOCAL_PORTNUM = "1.0.8802.1.1.2.1.4.1.1.2"
+LLDP_LOC_PORT_DESC = "1.0.8802.1.1.2.1.3.7.1.3"
+LLDP_LOC_PORT_ID = "1.0.8802.1.1.2.1.3.7.1.1"
+IF_NAME = "1.3.6.1.2.1.31.1.1.1.1"
+IF_DESCR = "1.3.6.1.2.1.2.2.1.2"
+
+CDP_CACHE_DEVICEID = "1.3.6.1.4.1.9.9.23.1.2.1.1.6"
+CDP_CACHE_DEVICEPORT = "1.3.6.1.4.1.9.9.23.1.2.1.1.7"
+CDP_CACHE_PLATFORM = "1.3.6.1.4.1.9.9.23.1.2.1.1.8"
+CDP_CACHE_ADDRESS = "1.3.6.1.4.1.9.9.23.1.2.1.1.4"
+CDP_CACHE_IFINDEX = "1.3.6.1.4.1.9.9.23.1.2.1.1.2"
+
+
+def _snmp_decode(val: Any) -> str:
+    try:
+        s = str(val)
+        return s.strip('"')
+    except Exception:
+        try:
+            return val.prettyPrint()  # type: ignore
+        except Exception:
+            return str(val)
+
+def snmp_get(ip: str, community: str, oid: str, timeout: int = 1, retries: int = 0) -> Any:
+    if not HAS_PYSNMP:
+        return None
+    try:
+        iterator = getCmd(
+            SnmpEngine(),
+            CommunityData(community, mpModel=0),
+            UdpTransportTarget((ip, 161), timeout=timeout, retries=retries),
+            ContextData(),
+            ObjectType(ObjectIdentity(oid))
+        )
+        errorIndication, errorStatus, errorIndex, varBinds = next(iterator)
+        if errorIndication or errorStatus:
+            return None
+        for varBind in varBinds:
+            return varBind[1].prettyPrint()
+    except Exception:
+        return None
+
+def snmp_walk(ip: str, community: str, oid: str, timeout: int = 1, retries: int = 0) -> List[Tuple[str, Any]]:
+    results: List[Tuple[str, Any]] = []
+    if not HAS_PYSNMP:
+        return results
+    try:
+        for (errorIndication, errorStatus, errorIndex, varBinds) in nextCmd(
+            SnmpEngine(),
+            CommunityData(community, mpModel=0),
+            UdpTransportTarget((ip, 161), timeout=timeout, retries=retries),
+            ContextData(),
+            ObjectType(ObjectIdentity(oid)),
+            lexicographicMode=False
+        ):
+            if errorIndication or errorStatus:
+                break
+            for varBind in varBinds:
+                results.append((str(varBind[0]), varBind[1].prettyPrint()))
+    except Exception:
+        pass
+    return results
+
+# Extended SNMP (v1/v2c/v3)
+def _snmp_auth(version: str, community: str, v3: Dict[str, Any] | None):
+    if version in ("v1", "v2c"):
+        mp = 0 if version == "v1" else 1
+        return CommunityData(community, mpModel=mp)
+    if version == "v3" and UsmUserData:
+        user = (v3 or {}).get("user") or ""
+        auth_pass = (v3 or {}).get("authPassword")
+        priv_pass = (v3 or {}).get("privPassword")
+        auth_proto_name = ((v3 or {}).get("authProtocol") or "").upper()
+        priv_proto_name = ((v3 or {}).get("privProtocol") or "").upper()
+        auth_proto = {
+            "MD5": usmHMACMD5AuthProtocol,
+            "SHA": usmHMACSHAAuthProtocol,
+            "SHA256": usmHMACSHA256AuthProtocol,
+            "SHA384": usmHMACSHA384AuthProtocol,
+            "SHA512": usmHMACSHA512AuthProtocol,
+        }.get(auth_proto_name, usmNoAuthProtocol)
+        priv_proto = {
+            "DES": usmDESPrivProtocol,
+            "AES128": usmAesCfb128Protocol,
+            "AES192": usmAesCfb192Protocol,
+            "AES256": usmAesCfb256Protocol,
+        }.get(priv_proto_name, usmNoPrivProtocol)
+        return UsmUserData(user, auth_pass, auth_proto, priv_pass, priv_proto)
+    # default v2c
+    return CommunityData(community, mpModel=1)
+
+def snmp_get_ext(ip: str, version: str, community: str, oid: str, v3: Dict[str, Any] | None = None, timeout: int = 1, retries: int = 0) -> Any:
+    if not HAS_PYSNMP:
+        return None
+    try:
+        iterator = getCmd(
+            SnmpEngine(),
+            _snmp_auth(version, community, v3),
+            UdpTransportTarget((ip, 161), timeout=timeout, retries=retries),
+            ContextData(),
+            ObjectType(ObjectIdentity(oid))
+        )
+        errorIndication, errorStatus, errorIndex, varBinds = next(iterator)
+        if errorIndication or errorStatus:
+            return None
+        for varBind in varBinds:
+            return varBind[1].prettyPrint()
+    except Exception:
+        return None
+
+def snmp_walk_ext(ip: str, version: str, community: str, oid: str, v3: Dict[str, Any] | None = None, timeout: int = 1, retries: int = 0) -> List[Tuple[str, Any]]:
+    results: List[Tuple[str, Any]] = []
+    if not HAS_PYSNMP:
+        return results
+    try:
+        for (errorIndication, errorStatus, errorIndex, varBinds) in nextCmd(
+            SnmpEngine(),
+            _snmp_auth(version, community, v3),
+            UdpTransportTarget((ip, 161), timeout=timeout, retries=retries),
+            ContextData(),
+            ObjectType(ObjectIdentity(oid)),
+            lexicographicMode=False
+        ):
+            if errorIndication or errorStatus:
+                break
+            for varBind in varBinds:
+                results.append((str(varBind[0]), varBind[1].prettyPrint()))
+    except Exception:
+        pass
+    return results
+
+# SNMP SET seguro (v1/v2c/v3)
+def snmp_set_ext(ip: str, version: str, community: str, oid: str, value_type: str, value: Any, v3: Dict[str, Any] | None = None, timeout: int = 2, retries: int = 0) -> Dict[str, Any]:
+    if not HAS_PYSNMP:
+        return {"ok": False, "error": "pysnmp não disponível"}
+    if not oid:
+        return {"ok": False, "error": "OID ausente"}
+    type_map = {
+        "OctetString": OctetString,
+        "Integer": Integer,
+        "IpAddress": IpAddress,
+        "Gauge32": Gauge32,
+        "Counter32": Counter32,
+        "ObjectIdentifier": ObjectIdentifier,
+    }
+    tcls = type_map.get(str(value_type))
+    if not tcls:
+        return {"ok": False, "error": f"Tipo inválido: {value_type}"}
+    try:
+        if tcls in (Integer, Gauge32, Counter32):
+            vobj = tcls(int(value))
+        elif tcls is IpAddress:
+            vobj = tcls(str(value))
+        else:
+            vobj = tcls(value)
+    except Exception as e:
+        return {"ok": False, "error": f"Falha convertendo valor: {e}"}
+    try:
+        iterator = setCmd(
+            SnmpEngine(),
+            _snmp_auth(version, community, v3),
+            UdpTransportTarget((ip, 161), timeout=timeout, retries=retries),
+            ContextData(),
+            ObjectType(ObjectIdentity(oid), vobj)
+        )
+        errorIndication, errorStatus, errorIndex, varBinds = next(iterator)
+        if errorIndication:
+            return {"ok": False, "error": str(errorIndication)}
+        if errorStatus:
+            return {"ok": False, "error": f"{errorStatus.prettyPrint()} at {errorIndex}"}
+        result_binds: List[Tuple[str, str]] = []
+        for varBind in varBinds:
+            result_binds.append((str(varBind[0]), varBind[1].prettyPrint()))
+        return {"ok": True, "response": result_binds}
+    except Exception as e:
+        return {"ok": False, "error": str(e)}
+
+# Execução de comandos via Netmiko
+
+def run_netmiko_command(host: str, device_type: str, username: str, password: str, command: str, secret: Optional[str] = None, port: int = 22, timeout: int = 8) -> Dict[str, Any]:
+    if ConnectHandler is None:
+        return {"ok": False, "error": "netmiko não disponível"}
+    if not host or not device_type or not username or not command:
+        return {"ok": False, "error": "Parâmetros obrigatórios ausentes"}
+    try:
+        params: Dict[str, Any] = {
+            "device_type": device_type,
+            "host": host,
+            "username": username,
+            "password": password,
+            "port": port,
+            "timeout": timeout,
+        }
+        if secret:
+            params["secret"] = secret
+        conn = ConnectHandler(**params)
+        if secret:
+            try:
+                conn.enable()
+            except Exception:
+                pass
+        output = conn.send_command(command)
+        try:
+            conn.disconnect()
+        except Exception:
+            pass
+        return {"ok": True, "output": output}
+    except Exception as e:
+        try:
+            conn.disconnect()  # type: ignore
+        except Exception:
+            pass
+        return {"ok": False, "error": str(e)}
+
+
+def build_snmp_hostinfo(ip: str, community: str, version: str = "v2c", v3: Dict[str, Any] | None = None) -> Dict[str, Any]:
+    info: Dict[str, Any] = {"ip": ip, "community": community, "version": version, "available": HAS_PYSNMP}
+    if not HAS_PYSNMP:
+        return info
+    sys_descr = snmp_get_ext(ip, version, community, '1.3.6.1.2.1.1.1.0', v3)
+    sys_name = snmp_get_ext(ip, version, community, '1.3.6.1.2.1.1.5.0', v3)
+    sys_uptime = snmp_get_ext(ip, version, community, '1.3.6.1.2.1.1.3.0', v3)
+    hr_mem = snmp_get_ext(ip, version, community, '1.3.6.1.2.1.25.2.2.0', v3)  # hrMemorySize (in KB)
+    cpu_loads = snmp_walk_ext(ip, version, community, '1.3.6.1.2.1.25.3.3.1.2', v3)  # hrProcessorLoad
+    if_list = snmp_walk_ext(ip, version, community, '1.3.6.1.2.1.2.2.1.2', v3)  # ifDescr
+    if_speed = snmp_walk_ext(ip, version, community, '1.3.6.1.2.1.2.2.1.5', v3)  # ifSpeed
+    if_oper = snmp_walk_ext(ip, version, community, '1.3.6.1.2.1.2.2.1.8', v3)  # ifOperStatus
+
+    try:
+        cpu_vals = [int(v) for _, v in cpu_loads]
+        cpu_avg = sum(cpu_vals) / max(1, len(cpu_vals))
+    except Exception:
+        cpu_avg = None
+
+    interfaces: List[Dict[str, Any]] = []
+    for idx, (oid, name) in enumerate(if_list):
+        speed = None
+        oper = None
+        try:
+            speed = int(if_speed[idx][1]) if idx < len(if_speed) else None
+        except Exception:
+            speed = None
+        try:
+            oper = int(if_oper[idx][1]) if idx < len(if_oper) else None
+        except Exception:
+            oper = None
+        interfaces.append({"name": name, "speed": speed, "operStatus": oper})
+
+    info.update({
+        "sysDescr": sys_descr,
+        "sysName": sys_name,
+        "sysUpTime": sys_uptime,
+        "hrMemoryKB": int(hr_mem) if hr_mem and str(hr_mem).isdigit() else None,
+        "cpuAvgLoad": cpu_avg,
+        "interfaces": interfaces,
+    })
+    # Disks (hrStorage)
+    try:
+        descrs = snmp_walk_ext(ip, version, community, '1.3.6.1.2.1.25.2.3.1.3', v3)
+        units = snmp_walk_ext(ip, version, community, '1.3.6.1.2.1.25.2.3.1.4', v3)
+        sizes = snmp_walk_ext(ip, version, community, '1.3.6.1.2.1.25.2.3.1.5', v3)
+        useds = snmp_walk_ext(ip, version, community, '1.3.6.1.2.1.25.2.3.1.6', v3)
+        def idx_map(items: List[Tuple[str, Any]]):
+            m: Dict[str, Any] = {}
+            for oid, val in items:
+                idx = oid.split('.')[-1]
+                m[idx] = val
+            return m
+        mDescr = idx_map(descrs)
+        mUnits = {k: int(v) if str(v).isdigit() else 0 for k, v in idx_map(units).items()}
+        mSize = {k: int(v) if str(v).isdigit() else 0 for k, v in idx_map(sizes).items()}
+        mUsed = {k: int(v) if str(v).isdigit() else 0 for k, v in idx_map(useds).items()}
+        disks: List[Dict[str, Any]] = []
+        for k, desc in mDescr.items():
+            unit = mUnits.get(k, 0)
+            size = mSize.get(k, 0)
+            used = mUsed.get(k, 0)
+            if unit and size:
+                total_bytes = unit * size
+                used_bytes = unit * used
+                pct = (used_bytes / total_bytes * 100.0) if total_bytes > 0 else None
+                disks.append({
+                    "descr": desc,
+                    "total_bytes": total_bytes,
+                    "used_bytes": used_bytes,
+                    "used_percent": round(pct, 2) if pct is not None else None,
+                })
+        info["disks"] = disks
+    except Exception:
+        info["disks"] = []
+
+    # Processes (hrSWRun)
+    try:
+        names = snmp_walk_ext(ip, version, community, '1.3.6.1.2.1.25.4.2.1.2', v3)
+        statuses = snmp_walk_ext(ip, version, community, '1.3.6.1.2.1.25.4.2.1.7', v3)
+        total = len(names)
+        running = 0
+        for _, st in statuses:
+            try:
+                val = int(st)
+                if val == 1:
+                    running += 1
+            except Exception:
+                pass
+        info["processes"] = {"total": total, "running": running}
+    except Exception:
+        info["processes"] = {"total": None, "running": None}
+    return info
+
+@app.post("/api/discovery/snmp")
+def discovery_snmp(payload: Dict[str, Any] = Body(...)):
+    target = payload.get("target")
+    community = payload.get("community", "public")
+    version = payload.get("version", "v2c")
+    v3 = payload.get("v3") or None
+    fresh = bool(payload.get("fresh", False))
+    # resolve IP
+    ip = resolve_host(target) or target
+    host = discover_host(ip, fresh=fresh)
+    snmp_info = build_snmp_hostinfo(ip, community, version, v3)
+    return {
+        "target": ip,
+        "timestamp": host["timestamp"],
+        "systemInfo": {
+            "hostname": snmp_info.get("sysName") or host["hostname"],
+            "description": snmp_info.get("sysDescr") or host["os"],
+            "uptime": snmp_info.get("sysUpTime"),
+        },
+        "snmp": snmp_info,
+        "services": [{"service": s} for s in host["services"]],
+    }
+
+
+def _discover_snmp_neighbors(ip: str, version: str, community: str, v3: Dict[str, Any] | None = None, timeout: int = 1, retries: int = 0) -> List[Dict[str, Any]]:
+    neighbors: List[Dict[str, Any]] = []
+    try:
+        # LLDP primeiro
+        rem_sys = snmp_walk_ext(ip, version, community, LLDP_REM_SYSNAME, v3, timeout, retries)
+        if rem_sys:
+            rem_port = snmp_walk_ext(ip, version, community, LLDP_REM_PORTID, v3, timeout, retries)
+            rem_loc_num = snmp_walk_ext(ip, version, community, LLDP_REM_LOCAL_PORTNUM, v3, timeout, retries)
+            loc_desc = snmp_walk_ext(ip, version, community, LLDP_LOC_PORT_DESC, v3, timeout, retries)
+            rem_map: Dict[str, Dict[str, Any]] = {}
+            for oid, val in rem_sys:
+                key = oid.split(LLDP_REM_SYSNAME + ".")[-1]
+                rem_map[key] = {"remote_hostname": _snmp_decode(val)}
+            port_map: Dict[str, str] = {}
+            for oid, val in rem_port:
+                key = oid.split(LLDP_REM_PORTID + ".")[-1]
+                port_map[key] = _snmp_decode(val)
+            desc_by_num: Dict[str, str] = {}
+            for oid, val in loc_desc:
+                suf = oid.split(LLDP_LOC_PORT_DESC + ".")[-1]
+                desc_by_num[suf] = _snmp_decode(val)
+            for oid, val in rem_loc_num:
+                key = oid.split(LLDP_REM_LOCAL_PORTNUM + ".")[-1]
+                local_num = _snmp_decode(val)
+                local_if = desc_by_num.get(local_num) or f"port-{local_num}"
+                ent = rem_map.get(key, {})
+                rport = port_map.get(key)
+                if ent:
+                    neighbors.append({"local_if": local_if, "remote_hostname": ent.get("remote_hostname"), "remote_port": rport, "protocol": "LLDP"})
+        # Se LLDP vazio, tenta CDP
+        if not neighbors:
+            dev_ids = snmp_walk_ext(ip, version, community, CDP_CACHE_DEVICEID, v3, timeout, retries)
+            dev_ports = snmp_walk_ext(ip, version, community, CDP_CACHE_DEVICEPORT, v3, timeout, retries)
+            if_idxs = snmp_walk_ext(ip, version, community, CDP_CACHE_IFINDEX, v3, timeout, retries)
+            if_names = snmp_walk_ext(ip, version, community, IF_NAME, v3, timeout, retries)
+            names_map: Dict[str, str] = {}
+            for oid, val in if_names:
+                suf = oid.split(IF_NAME + ".")[-1]
+                names_map[suf] = _snmp_decode(val)
+            ports_map: Dict[str, str] = {}
+            for oid, val in dev_ports:
+                suf = oid.split(CDP_CACHE_DEVICEPORT + ".")[-1]
+                ports_map[suf] = _snmp_decode(val)
+            for oid, val in dev_ids:
+                suf = oid.split(CDP_CACHE_DEVICEID + ".")[-1]
+                loc_index = None
+                try:
+                    loc_index = suf.split(".")[0]
+                except Exception:
+                    pass
+                loc_name = (loc_index and names_map.get(loc_index)) or (loc_index and f"if-{loc_index}") or None
+                neighbors.append({"local_if": loc_name, "remote_hostname": _snmp_decode(val), "remote_port": ports_map.get(suf), "protocol": "CDP"})
+    except Exception:
+        pass
+    return neighbors
+
+
+@app.post("/api/topologia/snmp")
+def topologia_snmp(payload: Dict[str, Any] = Body(...)):
+    target = payload.get("target")
+    community = payload.get("community", "public")
+    version = payload.get("version", "v2c")
+    v3 = payload.get("v3") or None
+    timeout = int(payload.get("timeout", 1))
+    retries = int(payload.get("retries", 0))
+    ip = resolve_host(target) or target
+    neighbors = _discover_snmp_neighbors(ip, version, community, v3, timeout=timeout, retries=retries)
+    src_dev = pg_upsert_device({"ip": ip, "os": "Network", "status": "Online"})
+    src_id = src_dev.get("id")
+    persisted: List[Dict[str, Any]] = []
+    for n in neighbors:
+        dst_dev = pg_upsert_device({"hostname": n.get("remote_hostname"), "os": "Network"})
+        dst_id = dst_dev.get("id")
+        src_if_id = pg_upsert_interface(src_id, n.get("local_if"))
+        dst_if_id = pg_upsert_interface(dst_id, n.get("remote_port"))
+        pg_upsert_link(src_id, src_if_id, dst_id, dst_if_id, n.get("protocol") or "SNMP")
+        persisted.append({"src": src_id, "src_if": n.get("local_if"), "dst": dst_id, "dst_if": n.get("remote_port"), "protocol": n.get("protocol")})
+    return {"target": ip, "neighbors": neighbors, "persisted": persisted}
+
+
+@app.post("/api/snmp/set")
+def api_snmp_set(payload: Dict[str, Any] = Body(...), request: Request = None):
+    # Rate limiting
+    client_ip = request.client.host if request else "unknown"
+    if not rate_limit_check(client_ip, "SNMP_SET", RATE_LIMIT_SNMP_SET):
+        raise HTTPException(status_code=429, detail="Rate limit exceeded for SNMP_SET")
+    
+    target = payload.get("target")
+    community = payload.get("community", "private")
+    version = payload.get("version", "v2c")
+    v3 = payload.get("v3") or None
+    oid = payload.get("oid")
+    value_type = payload.get("type", "OctetString")
+    value = payload.get("value")
+    timeout = int(payload.get("timeout", 2))
+    retries = int(payload.get("retries", 0))
+    
+    # Validate SNMPv3 if needed
+    if version == "v3" and v3:
+        validation_errors = validate_snmp_v3(v3)
+        if validation_errors:
+            raise HTTPException(status_code=400, detail={"errors": validation_errors})
+    
+    ip = resolve_host(target) or target
+    
+    result = snmp_set_ext(ip, version, community, oid, value_type, value, v3, timeout, retries)
+    
+    try:
+        dev = pg_get_device(ip=ip) or pg_upsert_device({"ip": ip, "hostname": payload.get("hostname")})
+        dev_id = dev.get("id") if isinstance(dev, dict) else None
+        if dev_id:
+            ev = pg_add_event(
+                dev_id, "SNMP_SET", "info" if result.get("ok") else "error",
+                f"SET {oid} ({value_type})", 
+                mask_secrets({
+                    "oid": oid, "type": value_type, "value": value,
+                    "version": version, "timeout": timeout, "retries": retries
+                }),
+                actor=payload.get("actor", "api"),
+                source=client_ip
+            )
+            result["event_id"] = ev.get("id")
+    except Exception:
+        pass
+    return result
+
+
+@app.post("/api/netmiko/command")
+def api_netmiko_command(payload: Dict[str, Any] = Body(...), request: Request = None):
     # Rate limiting
     client_ip = request.client.host if request else "unknown"
     if not rate_limit_check(client_ip, "NETMIKO_CMD", RATE_LIMIT_NETMIKO_CMD):
         raise HTTPException(status_code=429, detail="Rate limit exceeded for NETMIKO_CMD")
     
-    host = payload.get("host")
-    device_type = payload.get("deviceType")
-    username = payload.get("username")
+    host = payload.get("host")
+    device_type = payload.get("deviceType")
+    username = payload.get("username")
+    password = payload.get("password")
+    secret = payload.get("secret")
+    command = payload.get("command")
+    port = int(payload.get("port", 22))
+    timeout = int(payload.get("timeout", 8))
+    
+    allowed_types = {
+        "cisco_ios", "cisco_xe", "cisco_nxos", "cisco_xr",
+        "arista_eos", "juniper_junos", "huawei", "hp_procurve",
+        "mikrotik_routeros", "ubiquiti_edgerouter", "linux",
+    }
+    if not device_type or device_type not in allowed_types:
+        return {"ok": False, "error": f"deviceType inválido. Permitidos: {sorted(list(allowed_types))}"}
+    
+    res = run_netmiko_command(host, device_type, username, password, command, secret, port, timeout)
+    
+    try:
+        ip = resolve_host(host) or host
+        dev = pg_get_device(ip=ip) or pg_upsert_device({"ip": ip, "hostname": payload.get("hostname")})
+        dev_id = dev.get("id") if isinstance(dev, dict) else None
+        if dev_id:
+            ev = pg_add_event(
+                dev_id, "NETMIKO_CMD", "info" if res.get("ok") else "error",
+                f"CMD: {command}", 
+                mask_secrets({
+                    "deviceType": device_type, "port": port, "timeout": timeout
+                }),
+                actor=payload.get("actor", "api"),
+                source=client_ip
+            )
+            res["event_id"] = ev.get("id")
+    except Exception:
+        pass
+    return res
+
+
+@app.get("/api/discovery/hostinfo")
+def discovery_hostinfo(ip: str = Query(...), method: str = Query("tcp"),
+                       sshUser: Optional[str] = Query(None), sshPass: Optional[str] = Query(None),
+                       sshKey: Optional[str] = Query(None), sshPort: int = Query(22), sshTimeout: float = Query(3.0),
+                       winrmUser: Optional[str] = Query(None), winrmPass: Optional[str] = Query(None),
+                       winrmUseTls: bool = Query(False), winrmPort: int = Query(5985), winrmTimeout: float = Query(4.0),
+                       fresh: bool = Query(False)):
+    profile = resolve_scan_profile(method)
+    base = discover_host_with_ports(ip, profile["ports"], fresh=fresh, profile=profile)
+    # Attempt Linux enrichment if SSH credentials are provided
+    base = enrich_linux_details(ip, base, ssh_user=sshUser, ssh_pass=sshPass, ssh_key=sshKey, ssh_port=sshPort, ssh_timeout=sshTimeout)
+    # Attempt Windows enrichment if WinRM credentials are provided
+    base = enrich_windows_details(ip, base, winrm_user=winrmUser, winrm_pass=winrmPass, winrm_use_tls=winrmUseTls, winrm_port=winrmPort, winrm_timeout=winrmTimeout)
+    base["os"] = compose_os_label(base)
+    return base
+
+
+@app.get("/api/discovery/docker")
+def discovery_docker(ip: str = Query(...),
+                     sshUser: Optional[str] = Query(None), sshPass: Optional[str] = Query(None),
+                     sshKey: Optional[str] = Query(None), sshPort: int = Query(22), sshTimeout: float = Query(3.0),
+                     fresh: bool = Query(False)):
+    # Host acompanhado pelo watcher de eventos: inventário já está atualizado
+    watched = None if fresh else docker_inventory_view(ip)
+    if watched is not None:
+        return watched
+    # Prefer SSH probe if credentials provided; otherwise API probe
+    via_api = cached_probe(ip, 0, "docker", lambda: probe_docker(ip), fresh)
+    via_ssh: Dict[str, Any] = {}
+    if sshUser and (sshPass or sshKey):
+        via_ssh = cached_probe(ip, sshPort, f"docker_ssh:{sshUser}:{ssh_credential_fingerprint(sshPass, sshKey)}", lambda: probe_docker_via_ssh(
+            ip, ssh_user=sshUser, ssh_pass=sshPass, ssh_key=sshKey, ssh_port=sshPort, ssh_timeout=sshTimeout), fresh)
+    # Combine: prefer SSH if present, else API
+    chosen = via_ssh if via_ssh.get("present") else via_api
+    persist_docker_containers(ip, chosen)
+    return chosen
+
+
+@app.get("/api/discovery/docker/logs")
+def discovery_docker_logs(ip: str = Query(...), ids: str = Query(..., description="IDs ou nomes separados por vírgula"),
+                          tail: int = Query(DOCKER_LOGS_TAIL), maxBytes: int = Query(DOCKER_LOGS_MAX_BYTES),
+                          sshUser: Optional[str] = Query(None), sshPass: Optional[str] = Query(None),
+                          sshKey: Optional[str] = Query(None), sshPort: int = Query(22), sshTimeout: float = Query(3.0),
+                          fresh: bool = Query(False)):
+    container_ids = list(dict.fromkeys(x.strip() for x in ids.split(",") if x.strip()))
+    if not container_ids or len(container_ids) > DOCKER_LOGS_MAX_CONTAINERS:
+        raise HTTPException(status_code=400, detail=f"ids deve ter entre 1 e {DOCKER_LOGS_MAX_CONTAINERS} containers")
+    if any(not DOCKER_CONTAINER_REF_RE.match(c) for c in container_ids):
+        raise HTTPException(status_code=400, detail="id de container inválido")
+    tail = max(1, min(tail, 5000))
+    max_bytes = max(1024, min(maxBytes, DOCKER_LOGS_MAX_BYTES))
+    ssh = None
+    if sshUser and (sshPass or sshKey):
+        ssh = {"ssh_user": sshUser, "ssh_pass": sshPass, "ssh_key": sshKey, "ssh_port": sshPort, "ssh_timeout": sshTimeout}
+    return fetch_container_logs(ip, container_ids, tail=tail, max_bytes=max_bytes, ssh=ssh, fresh=fresh)
+
+
+@app.get("/api/discovery/docker/watchers")
+def discovery_docker_watchers():
+    with DOCKER_WATCH_LOCK:
+        watchers = list(DOCKER_WATCHERS.values())
+    return {"enabled": DOCKER_WATCH_ENABLED, "watchers": [docker_watch_view(w) for w in watchers]}
+
+
+@app.post("/api/discovery/docker/watchers")
+def discovery_docker_watch_start(payload: Dict[str, Any] = Body(...)):
+    ip = str(payload.get("ip") or "").strip()
+    if not ip:
+        raise HTTPException(status_code=400, detail="ip é obrigatório")
+    ssh = None
+    if payload.get("sshUser") and (payload.get("sshPass") or payload.get("sshKey")):
+        ssh = {"user": payload["sshUser"], "password": payload.get("sshPass"), "key_path": payload.get("sshKey"),
+               "port": int(payload.get("sshPort") or 22)}
+    return docker_watch_start(ip, ssh)
+
+
+@app.delete("/api/discovery/docker/watchers/{ip}")
+def discovery_docker_watch_stop(ip: str):
+    if not docker_watch_stop(ip):
+        raise HTTPException(status_code=404, detail="Watcher não encontrado")
+    return {"ok": True, "ip": ip}
+
+
+@app.get("/api/discovery/docker/containers")
+def discovery_docker_containers(ip: Optional[str] = Query(None)):
+    """Container inventory: live from watchers, else the last persisted state."""
+    with DOCKER_WATCH_LOCK:
+        live = {h: [dict(c) for c in conts.values()] for h, conts in CONTAINER_INVENTORY.items() if ip is None or h == ip}
+    if ip is not None and ip not in live:
+        return {"ip": ip, "source": "pg", "containers": pg_list_containers(ip)}
+    return {"source": "watch", "hosts": [{"ip": h, "containers": conts} for h, conts in live.items()]}
+
+
+@app.get("/api/discovery/docker/stats")
+def discovery_docker_stats(ip: str = Query(...), ids: Optional[str] = Query(None), persist: bool = Query(True)):
+    container_ids = [x.strip() for x in (ids or "").split(",") if x.strip()] or None
+    if container_ids and any(not DOCKER_CONTAINER_REF_RE.match(c) for c in container_ids):
+        raise HTTPException(status_code=400, detail="id de container inválido")
+    return collect_container_stats(ip, container_ids, persist=persist)
+
+
+@app.get("/api/discovery/docker/stats/series")
+def discovery_docker_stats_series(ip: str = Query(...), container: str = Query(...), points: int = Query(60)):
+    metrics = ("container_cpu_percent", "container_mem_used_bytes", "container_mem_used_percent",
+               "container_net_rx_bytes", "container_net_tx_bytes", "container_blk_read_bytes", "container_blk_write_bytes")
+    return {"ip": ip, "container": container,
+            "series": {m: get_container_series(ip, m, container.lstrip("/"), points) for m in metrics}}
+
+
+@app.get("/api/discovery/probe-plan")
+def discovery_probe_plan():
+    with PROBE_PLAN_LOCK:
+        stats = {name: dict(counts) for name, counts in PROBE_PLAN_STATS.items()}
+    return {
+        "probes": [{"name": p["name"], "ports": p["ports"], "stats": stats.get(p["name"], {"run": 0, "skipped": 0})} for p in PROBE_PLAN],
+    }
+
+
+@app.get("/api/discovery/fingerprint")
+def discovery_fingerprint(ip: str = Query(...), ports: Optional[str] = Query(None), fresh: bool = Query(False)):
+    """Fingerprint the given ports (comma separated) or, when omitted, the open common ports."""
+    if ports:
+        try:
+            port_list = sorted({int(x) for x in ports.split(",") if x.strip()})
+        except ValueError:
+            raise HTTPException(status_code=400, detail="ports must be a comma separated list of integers")
+    else:
+        scan = scan_ports(ip, COMMON_PORTS, fresh=fresh, banners=FINGERPRINT_PASSIVE_BANNERS)
+        port_list = sorted(p for p, ok in scan.items() if ok)
+    results = fingerprint_host(ip, port_list, fresh)
+    return {"ip": ip, "services": [results[p] for p in port_list]}
+
+
+@app.get("/api/discovery/winrm-pool/stats")
+def discovery_winrm_pool_stats():
+    return winrm_pool_stats()
+
+
+@app.get("/api/discovery/ssh-pool/stats")
+def discovery_ssh_pool_stats():
+    return ssh_pool_stats()
+
+
+@app.get("/api/discovery/ssh-known-hosts")
+def discovery_ssh_known_hosts(host: Optional[str] = Query(None)):
+    return {"policy": SSH_HOSTKEY_POLICY, "hosts": pg_list_known_hosts(host)}
+
+
+@app.delete("/api/discovery/ssh-known-hosts/{host}")
+def discovery_ssh_known_hosts_delete(host: str, port: Optional[int] = Query(None)):
+    """Forget a host's stored keys (e.g. after a planned reinstall); the next connection re-learns them."""
+    return {"ok": True, "deleted": ssh_forget_host(host, port)}
+
+
+@app.get("/api/discovery/http-pool/stats")
+def discovery_http_pool_stats():
+    return http_pool_stats()
+
+
+@app.get("/api/discovery/tls")
+def discovery_tls(ip: str = Query(...), port: int = Query(443), fresh: bool = Query(False)):
+    return {"ip": ip, "port": port, **probe_tls(ip, port, fresh=fresh)}
+
+
+@app.get("/api/discovery/cache/stats")
+def discovery_cache_stats():
+    with PROBE_CACHE_LOCK:
+        stats = dict(PROBE_CACHE_STATS)
+        stats["entries"] = len(PROBE_CACHE)
+    stats.update({"ttl": PROBE_CACHE_TTL, "negative_ttl": PROBE_CACHE_NEGATIVE_TTL, "max_entries": PROBE_CACHE_MAX_ENTRIES})
+    return stats
+
+
+@app.delete("/api/discovery/cache")
+def discovery_cache_invalidate(ip: Optional[str] = Query(None)):
+    return {"ok": True, "removed": probe_cache_invalidate(ip)}
+
+
+# ----------------------
+# DB Connectivity Probes (PostgreSQL, MySQL, SQL Server, MongoDB, Redis, RabbitMQ)
+# ----------------------
+
+# Identificados pelo motor de fingerprint (mesmas sondas, prazo por host e cache da descoberta)
+DB_PROBE_PORTS: List[Tuple[str, int]] = [
+    ("postgresql", 5432),
+    ("postgresql", 5433),
+    ("mysql", 3306),
+    ("sqlserver", 1433),
+    ("mongodb", 27017),
+    ("redis", 6379),
+    ("rabbitmq", 5672),
+]
+
+
+@app.get("/api/discovery/dbprobe")
+def discovery_dbprobe(ip: str = Query(...), onlyOnline: bool = Query(True), fresh: bool = Query(False)):
+    results: Dict[int, Dict[str, Any]] = {}
+    pending: List[int] = []
+    for name, port in DB_PROBE_PORTS:
+        # Porta já vista fechada por uma varredura recente: não reconecta
+        hit, is_open = (False, None) if fresh else probe_cache_get(ip, port, "tcp")
+        if hit and not is_open:
+            results[port] = {"reachable": False, "error": "port closed (cached)"}
+        else:
+            pending.append(port)
+    for port, fp in fingerprint_host(ip, pending, fresh).items():
+        results[port] = {k: fp.get(k) for k in ("reachable", "service", "product", "version", "confidence", "method")}
+        results[port]["identified"] = fp.get("confidence", 0) >= FINGERPRINT_MIN_CONFIDENCE
+        if fp.get("error"):
+            results[port]["error"] = fp["error"]
+    databases = [dict(results[port], name=name, port=port) for name, port in DB_PROBE_PORTS]
+    if onlyOnline:
+        databases = [r for r in databases if r.get("reachable")]
+    return {"databases": databases}
+
+
+# ----------------------
+# Metrics Aggregation (Node Exporter)
+# ----------------------
+
+def compute_cpu_usage(ip: str, idle_cum: float, total_cum: float) -> float | None:
+    # usage = 1 - idle_delta / total_delta (PostgreSQL)
+    conn = get_pg_conn()
+    if not conn:
+        return None
+    prev_idle_val: float | None = None
+    prev_total_val: float | None = None
+    try:
+        with conn.cursor() as cur:
+            cur.execute('''
+                SELECT m.value
+                FROM "AUTOMACAO"."Metrics" m
+                JOIN "AUTOMACAO"."Devices" d ON m.device_id = d.id
+                WHERE d.ip = %s AND m.metric_name = 'cpu_idle_cum'
+                ORDER BY m.ts DESC
+                LIMIT 1
+            ''', (ip,))
+            row = cur.fetchone()
+            if row:
+                prev_idle_val = float(row[0])
+            cur.execute('''
+                SELECT m.value
+                FROM "AUTOMACAO"."Metrics" m
+                JOIN "AUTOMACAO"."Devices" d ON m.device_id = d.id
+                WHERE d.ip = %s AND m.metric_name = 'cpu_total_cum'
+                ORDER BY m.ts DESC
+                LIMIT 1
+            ''', (ip,))
+            row = cur.fetchone()
+            if row:
+                prev_total_val = float(row[0])
+    except Exception:
+        pass
+    finally:
+        try:
+            conn.close()
+        except Exception:
+            pass
+    if prev_idle_val is None or prev_total_val is None:
+        return None
+    idle_delta = idle_cum - prev_idle_val
+    total_delta = total_cum - prev_total_val
+    if total_delta <= 0:
+        return None
+    usage = max(0.0, min(100.0, (1.0 - (idle_delta / total_delta)) * 100.0))
+    return usage
+
+def metric_series(ip: str, points: int) -> Dict[str, List[Dict[str, Any]]]:
+    return {
+        "cpu_usage_percent": get_series(ip, "cpu_usage_percent", points),
+        "mem_used_percent": get_series(ip, "mem_used_percent", points),
+        "fs_used_percent": get_series(ip, "fs_used_percent", points),
+        "net_rx_bps": get_series(ip, "net_rx_bps", points),
+        "net_tx_bps": get_series(ip, "net_tx_bps", points),
+    }
+
+@app.get("/api/discovery/metrics")
+def discovery_metrics(ip: str = Query(...), points: int = Query(30)):
+    # Poll node exporter and store metrics
+    node = probe_node_exporter(ip)
+    if not node.get("present"):
+        # séries já gravadas (coletor agentless ou node_exporter anterior); o registro agentless fica só em
+        # memória, então após um restart o histórico continua servido a partir do PG
+        series = metric_series(ip, points)
+        if ip in AGENTLESS_HOSTS:
+            return {"present": True, "source": "agentless", "series": series}
+        if any(series.values()):
+            return {"present": True, "source": "stored", "series": series}
+        return {"present": False, "series": {}}
+    # Store raw counters
+    idle_cum = node.get("cpu_idle_cum") or 0.0
+    total_cum = node.get("cpu_total_cum") or 0.0
+    record_metric(ip, "cpu_idle_cum", idle_cum)
+    record_metric(ip, "cpu_total_cum", total_cum)
+
+    # Compute and store aggregates
+    cpu_usage = compute_cpu_usage(ip, idle_cum, total_cum)
+    if cpu_usage is not None:
+        record_metric(ip, "cpu_usage_percent", cpu_usage)
+    mem_used = node.get("mem_used_percent")
+    if mem_used is not None:
+        record_metric(ip, "mem_used_percent", mem_used)
+    fs_used = node.get("fs_used_percent")
+    if fs_used is not None:
+        record_metric(ip, "fs_used_percent", fs_used)
+    rx_cum = node.get("net_rx_cum") or 0.0
+    tx_cum = node.get("net_tx_cum") or 0.0
+    # compute bps via delta from previous sample (PostgreSQL)
+    conn = get_pg_conn()
+    prev_rx_val: float | None = None
+    prev_rx_ts: int | None = None
+    prev_tx_val: float | None = None
+    prev_tx_ts: int | None = None
+    if conn:
+        try:
+            with conn.cursor() as cur:
+                cur.execute('''
+                    SELECT m.value, EXTRACT(EPOCH FROM m.ts)::bigint AS ts_epoch
+                    FROM "AUTOMACAO"."Metrics" m
+                    JOIN "AUTOMACAO"."Devices" d ON m.device_id = d.id
+                    WHERE d.ip = %s AND m.metric_name = 'net_rx_cum'
+                    ORDER BY m.ts DESC
+                    LIMIT 1
+                ''', (ip,))
+                row = cur.fetchone()
+                if row:
+                    prev_rx_val, prev_rx_ts = float(row[0]), int(row[1])
+                cur.execute('''
+                    SELECT m.value, EXTRACT(EPOCH FROM m.ts)::bigint AS ts_epoch
+                    FROM "AUTOMACAO"."Metrics" m
+                    JOIN "AUTOMACAO"."Devices" d ON m.device_id = d.id
+                    WHERE d.ip = %s AND m.metric_name = 'net_tx_cum'
+                    ORDER BY m.ts DESC
+                    LIMIT 1
+                ''', (ip,))
+                row = cur.fetchone()
+                if row:
+                    prev_tx_val, prev_tx_ts = float(row[0]), int(row[1])
+        except Exception:
+            pass
+        finally:
+            try:
+                conn.close()
+            except Exception:
+                pass
+    now_ts = int(time.time())
+    record_metric(ip, "net_rx_cum", rx_cum, now_ts)
+    record_metric(ip, "net_tx_cum", tx_cum, now_ts)
+    if prev_rx_val is not None and prev_rx_ts is not None:
+        dt = max(1, now_ts - prev_rx_ts)
+        bps = (rx_cum - prev_rx_val) / dt
+        record_metric(ip, "net_rx_bps", bps, now_ts)
+    if prev_tx_val is not None and prev_tx_ts is not None:
+        dt = max(1, now_ts - prev_tx_ts)
+        bps = (tx_cum - prev_tx_val) / dt
+        record_metric(ip, "net_tx_bps", bps, now_ts)
+
+    return {"present": True, "series": metric_series(ip, points)}
+
+
+@app.get("/api/discovery/agentless")
+def discovery_agentless():
+    thread = AGENTLESS_SCHEDULER["thread"]
+    return {"running": bool(thread and thread.is_alive()), "autostart": AGENTLESS_ENABLED,
+            "interval": AGENTLESS_INTERVAL, "workers": AGENTLESS_WORKERS, "backoff_max": AGENTLESS_BACKOFF_MAX,
+            "hosts": agentless_view()}
+
+
+@app.post("/api/discovery/agentless")
+def discovery_agentless_add(payload: Dict[str, Any] = Body(...)):
+    ip = payload.get("ip")
+    if payload.get("winrmUser"):
+        if not winrm:
+            return {"ok": False, "error": "pywinrm não disponível"}
+        if not ip or not payload.get("winrmPass"):
+            return {"ok": False, "error": "Parâmetros obrigatórios ausentes: ip/winrmUser/winrmPass"}
+        use_tls = bool(payload.get("winrmUseTls", False))
+        creds = {"user": payload["winrmUser"], "password": payload["winrmPass"], "use_tls": use_tls,
+                 "port": int(payload.get("winrmPort") or (5986 if use_tls else 5985))}
+        return {"ok": True, "host": agentless_add(ip, "winrm", creds, payload.get("interval"))}
+    if not paramiko:
+        return {"ok": False, "error": "paramiko não disponível"}
+    user = payload.get("sshUser")
+    if not ip or not user or not (payload.get("sshPass") or payload.get("sshKey")):
+        return {"ok": False, "error": "Parâmetros obrigatórios ausentes: ip/sshUser/sshPass ou sshKey"}
+    if not payload.get("force") and probe_node_exporter(ip).get("present"):
+        return {"ok": False, "error": "node_exporter ativo no host; use force para coletar mesmo assim"}
+    creds = {"user": user, "password": payload.get("sshPass"), "key_path": payload.get("sshKey"),
+             "port": int(payload.get("sshPort") or 22)}
+    return {"ok": True, "host": agentless_add(ip, "ssh", creds, payload.get("interval"))}
+
+
+@app.delete("/api/discovery/agentless/{ip}")
+def discovery_agentless_remove(ip: str):
+    return {"ok": agentless_remove(ip)}
+
+# ----------------------
+# Inventory endpoints
+# ----------------------
+
+@app.get("/api/inventory/hosts")
+def inventory_hosts():
+    conn = get_pg_conn()
+    if not conn:
+        return {"hosts": []}
+    try:
+        with conn.cursor() as cur:
+            cur.execute('SELECT ip, hostname, os, status, last_seen FROM "AUTOMACAO"."Devices" ORDER BY COALESCE(updated_at, created_at) DESC')
+            rows = cur.fetchall()
+        conn.close()
+        hosts = []
+        for r in rows:
+            hosts.append({
+                "ip": r[0], "hostname": r[1], "os": r[2], "status": r[3], "last_seen": r[4],
+            })
+        return {"hosts": hosts}
+    except Exception:
+        try:
+            conn.close()
+        except Exception:
+            pass
+        return {"hosts": []}
+
+@app.get("/api/inventory/services")
+def inventory_services(ip: str | None = Query(None)):
+    conn = get_pg_conn()
+    if not conn:
+        return {"services": []}
+    try:
+        with conn.cursor() as cur:
+            if ip:
+                cur.execute('SELECT ip, services FROM "AUTOMACAO"."Devices" WHERE ip = %s', (ip,))
+            else:
+                cur.execute('SELECT ip, services FROM "AUTOMACAO"."Devices" ORDER BY ip')
+            rows = cur.fetchall()
+        conn.close()
+        services_list: List[Dict[str, Any]] = []
+        for row in rows:
+            device_ip = row[0]
+            services = row[1]
+            if isinstance(services, str):
+                try:
+                    services = json.loads(services or "[]")
+                except Exception:
+                    services = []
+            for s in services or []:
+                if isinstance(s, dict):
+                    name = s.get("service") or s.get("name") or None
+                    port = s.get("port") if isinstance(s.get("port"), int) else None
+                    status = s.get("status") or "Unknown"
+                else:
+                    name = str(s)
+                    port = None
+                    status = "Unknown"
+                services_list.append({"service": name, "port": port, "status": status, "ip": device_ip})
+        services_list.sort(key=lambda x: ((x.get("ip") or ""), (x.get("port") or 0)))
+        return {"services": services_list}
+    except Exception:
+        try:
+            conn.close()
+        except Exception:
+            pass
+        return {"services": []}
+
+@app.get("/api/inventory/metrics")
+def inventory_metrics(ip: str = Query(...), metric: str = Query(...), limit: int = Query(60)):
+    return {"series": get_series(ip, metric, limit)}
+
+# ----------------------
+# Quick connectivity tests
+# ----------------------
+@app.get("/api/test/ping")
+def test_ping(ip: str = Query(...), count: int = Query(1), timeout: float = Query(1.0)):
+    """Teste de conectividade usando socket TCP ao invés de ping ICMP"""
+    start = time.time()
+    try:
+        # Tenta conectar na porta 80 primeiro, depois 443, depois 22
+        test_ports = [80, 443, 22, 8080, 3000]
+        reachable = False
+        
+        for port in test_ports:
+            try:
+                sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                sock.settimeout(timeout)
+                result = sock.connect_ex((ip, port))
+                sock.close()
+                if result == 0:
+                    reachable = True
+                    break
+            except:
+                continue
+        
+        latency = (time.time() - start) * 1000
+        return {
+            "reachable": reachable, 
+            "latency_ms": round(latency, 2), 
+            "output": f"TCP connectivity test to {ip} - {'SUCCESS' if reachable else 'FAILED'}"
+        }
+    except Exception as e:
+        return {"reachable": False, "error": str(e)}
+
+@app.get("/api/test/ssh")
+def test_ssh(ip: str = Query(...), user: Optional[str] = Query(None), password: Optional[str] = Query(None),
+             keyPath: Optional[str] = Query(None), port: int = Query(22), timeout: float = Query(2.5)):
+    """Teste de conectividade SSH - se não tiver credenciais, testa apenas a porta"""
+    
+    # Se não tiver usuário, faz apenas teste de conectividade na porta SSH
+    if not user:
+        try:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.settimeout(timeout)
+            result = sock.connect_ex((ip, port))
+            sock.close()
+            reachable = result == 0
+            return {
+                "reachable": reachable, 
+                "output": f"SSH port {port} connectivity test - {'SUCCESS' if reachable else 'FAILED'}",
+                "error": None if reachable else f"Cannot connect to port {port}"
+            }
+        except Exception as e:
+            return {"reachable": False, "output": None, "error": str(e)}
+    
+    # Se tiver usuário, tenta autenticação SSH
+    if not paramiko:
+        return {"reachable": False, "error": "paramiko não disponível"}
+    
+    ok, out, err = ssh_run_command(ip, user, password=password, key_path=keyPath, port=port, timeout=timeout)
+    return {"reachable": ok, "output": out, "error": err}
+
+@app.get("/api/test/snmp")
+def test_snmp(ip: str = Query(...), community: str = Query("public"), version: str = Query("v2c")):
+    """Teste de conectividade SNMP"""
+    if not HAS_PYSNMP:
+        return {"reachable": False, "error": "SNMP indisponível - biblioteca pysnmp não instalada", "info": {}}
+    
+    try:
+        info = build_snmp_hostinfo(ip, community, version)
+        ok = bool(info.get("sysDescr") or info.get("sysName"))
+        return {"reachable": ok, "info": info, "error": None if ok else "Nenhuma resposta SNMP obtida"}
+    except Exception as e:
+        return {"reachable": False, "error": f"Erro SNMP: {str(e)}", "info": {}}
+
+# ----------------------
+# Node Exporter install and fleet rollout via SSH
+# ----------------------
+NODE_EXPORTER_VERSION = os.environ.get("NODE_EXPORTER_VERSION", "1.9.1")
+NODE_EXPORTER_MIRROR = os.environ.get("NODE_EXPORTER_MIRROR", "https://github.com/prometheus/node_exporter/releases/download").rstrip("/")
+# tarballs baixados uma vez por versão/arquitetura; em redes isoladas basta copiá-los para cá
+NODE_EXPORTER_CACHE_DIR = Path(os.environ.get("NODE_EXPORTER_CACHE_DIR", "/tmp/node_exporter_artifacts"))
+NODE_EXPORTER_DOWNLOAD_TIMEOUT = float(os.environ.get("NODE_EXPORTER_DOWNLOAD_TIMEOUT", "60"))
+NODE_EXPORTER_UPLOAD_TIMEOUT = float(os.environ.get("NODE_EXPORTER_UPLOAD_TIMEOUT", "60"))
+NODE_EXPORTER_ROLLOUT_CONCURRENCY = int(os.environ.get("NODE_EXPORTER_ROLLOUT_CONCURRENCY", "8"))
+NODE_EXPORTER_ROLLOUT_BATCH = int(os.environ.get("NODE_EXPORTER_ROLLOUT_BATCH", "0"))  # 0 = todos num único lote
+NODE_EXPORTER_ROLLOUT_MAX_CONCURRENCY = int(os.environ.get("NODE_EXPORTER_ROLLOUT_MAX_CONCURRENCY", "64"))  # teto do payload
+# Sem sha256sums.txt o tarball não é aceito, a menos que a verificação seja dispensada explicitamente
+NODE_EXPORTER_ALLOW_UNVERIFIED = os.environ.get("NODE_EXPORTER_ALLOW_UNVERIFIED", "0").lower() in ("1", "true", "yes")
+NODE_EXPORTER_VERSION_RE = re.compile(r"^\d+\.\d+\.\d+$")
+NODE_EXPORTER_ARCHES = {
+    "x86_64": "amd64", "amd64": "amd64",
+    "aarch64": "arm64", "arm64": "arm64",
+    "armv7l": "armv7", "armv6l": "armv6",
+    "i386": "386", "i686": "386",
+    "ppc64le": "ppc64le", "s390x": "s390x",
+}
+NODE_EXPORTER_ARTIFACT_LOCKS: Dict[Tuple[str, str], threading.Lock] = {}
+NODE_EXPORTER_ARTIFACT_LOCK = threading.Lock()
+
+NODE_EXPORTER_CHECK_CMD = (
+    'echo "arch=$(uname -m)"; '
+    'echo "state=$(systemctl is-active node_exporter 2>/dev/null)"; '
+    'echo "version=$(/usr/local/bin/node_exporter --version 2>&1 | head -n1)"'
+)
+
+NODE_EXPORTER_INSTALL_SCRIPT = """
+set -e
+WORK="$(mktemp -d)"
+tar -xzf __TARBALL__ -C "$WORK"
+if ! id -u node_exporter >/dev/null 2>&1; then sudo -n useradd --no-create-home --shell /bin/false node_exporter || true; fi
+sudo -n install -m 0755 "$WORK"/__DIR__/node_exporter /usr/local/bin/node_exporter
+sudo -n chown node_exporter:node_exporter /usr/local/bin/node_exporter || true
+sudo -n sh -c 'cat > /etc/systemd/system/node_exporter.service <<EOF
+[Unit]
+Description=Node Exporter
+Wants=network-online.target
+After=network-online.target
+
+[Service]
+User=node_exporter
+Group=node_exporter
+Type=simple
+ExecStart=/usr/local/bin/node_exporter --web.listen-address=:9100
+Restart=always
+
+[Install]
+WantedBy=multi-user.target
+EOF'
+sudo -n systemctl daemon-reload
+sudo -n systemctl enable node_exporter >/dev/null 2>&1 || true
+sudo -n systemctl restart node_exporter || sudo -n systemctl start node_exporter
+rm -rf "$WORK" __TARBALL__
+echo NODE_EXPORTER_INSTALLED
+"""
+
+
+def node_exporter_artifact(version: str, arch: str) -> Path:
+    """Local path of node_exporter-<version>.linux-<arch>.tar.gz, downloaded and checksum-verified once.
+    A file already present in NODE_EXPORTER_CACHE_DIR is used as-is, so air-gapped setups can pre-seed it.
+    Raises ValueError when no checksum is published for it, unless NODE_EXPORTER_ALLOW_UNVERIFIED is set.
+    """
+    name = f"node_exporter-{version}.linux-{arch}.tar.gz"
+    path = NODE_EXPORTER_CACHE_DIR / name
+    with NODE_EXPORTER_ARTIFACT_LOCK:
+        lock = NODE_EXPORTER_ARTIFACT_LOCKS.setdefault((version, arch), threading.Lock())
+    # hosts da mesma arquitetura esperam o mesmo download em vez de repeti-lo
+    with lock:
+        if path.is_file() and path.stat().st_size > 0:
+            return path
+        NODE_EXPORTER_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        base = f"{NODE_EXPORTER_MIRROR}/v{version}"
+        expected = None
+        try:
+            r = HTTP_SESSION.get(f"{base}/sha256sums.txt", timeout=NODE_EXPORTER_DOWNLOAD_TIMEOUT)
+            if r.status_code == 200:
+                for ln in r.text.splitlines():
+                    parts = ln.split()
+                    if len(parts) == 2 and parts[1] == name:
+                        expected = parts[0].lower()
+        except Exception:
+            pass
+        if expected is None and not NODE_EXPORTER_ALLOW_UNVERIFIED:
+            raise ValueError(f"no checksum for {name} in {base}/sha256sums.txt "
+                             "(set NODE_EXPORTER_ALLOW_UNVERIFIED=1 to install it unverified)")
+        tmp = path.with_name(f"{name}.{uuid.uuid4().hex}.part")
+        digest = hashlib.sha256()
+        try:
+            with HTTP_SESSION.get(f"{base}/{name}", timeout=NODE_EXPORTER_DOWNLOAD_TIMEOUT, stream=True) as r:
+                r.raise_for_status()
+                with open(tmp, "wb") as fh:
+                    for chunk in r.iter_content(65536):
+                        digest.update(chunk)
+                        fh.write(chunk)
+            if expected and digest.hexdigest() != expected:
+                raise ValueError(f"checksum mismatch for {name}")
+            os.replace(tmp, path)
+        finally:
+            if tmp.exists():
+                tmp.unlink()
+        return path
+
+
+def node_exporter_install_host(ip: str, user: str, password: Optional[str] = None, key_path: Optional[str] = None,
+                               port: int = 22, timeout: float = 3.0, version: str = NODE_EXPORTER_VERSION,
+                               force: bool = False, progress: Any = None) -> Dict[str, Any]:
+    """Install node_exporter on one host from the locally cached tarball (pushed over SFTP) and record
+    the outcome in Devices.node_exporter. progress(stage) is called before each step.
+    """
+    started = time.time()
+    result: Dict[str, Any] = {"ip": ip, "ok": False, "status": None, "version": version, "arch": None,
+                              "previous_version": None, "probe": None, "output": None, "error": None}
+
+    def step(stage: str) -> None:
+        if progress:
+            progress(stage)
+
+    def finish(status: str, ok: bool = False, error: Optional[str] = None) -> Dict[str, Any]:
+        result.update({"status": status, "ok": ok, "error": error, "seconds": round(time.time() - started, 2)})
+        info: Dict[str, Any] = {"last_rollout": {
+            "status": status, "ok": ok, "error": error, "version": version, "arch": result["arch"],
+            "timestamp": time.strftime("%Y-%m-%d %H:%M:%S"),
+        }}
+        if ok:
+            installed = result["previous_version"] if status == "already_running" else version
+            info.update({"installed": True, "arch": result["arch"], "timestamp": time.strftime("%Y-%m-%d %H:%M:%S")})
+            if installed:
+                info["version"] = installed
+        try:
+            pg_set_node_exporter(ip, info, insert=ok)
+        except Exception:
+            pass
+        return result
+
+    step("check")
+    ok_pre, out_pre, err_pre = ssh_exec(ip, user, NODE_EXPORTER_CHECK_CMD, password=password, key_path=key_path, port=port, timeout=timeout)
+    if not ok_pre:
+        return finish("unreachable", error=err_pre)
+    facts = dict(ln.split("=", 1) for ln in (out_pre or "").splitlines() if "=" in ln)
+    m = re.search(r"version (\d+\.\d+\.\d+)", facts.get("version", ""))
+    result["previous_version"] = m.group(1) if m else None
+    machine = facts.get("arch", "").strip()
+    result["arch"] = NODE_EXPORTER_ARCHES.get(machine)
+    if not force and facts.get("state", "").strip() == "active" and result["previous_version"] in (None, version):
+        result["probe"] = probe_node_exporter(ip)
+        return finish("already_running", ok=True)
+    if not result["arch"]:
+        return finish("unsupported_arch", error=f"arquitetura não suportada: {machine or 'desconhecida'}")
+
+    step("artifact")
+    try:
+        artifact = node_exporter_artifact(version, result["arch"])
+    except Exception as e:
+        return finish("artifact_error", error=str(e))
+
+    step("upload")
+    remote = f"/tmp/{uuid.uuid4().hex[:8]}-{artifact.name}"
+    ok_up, err_up = ssh_sftp_put(ip, user, str(artifact), remote, password=password, key_path=key_path,
+                                 port=port, timeout=max(timeout, NODE_EXPORTER_UPLOAD_TIMEOUT))
+    if not ok_up:
+        return finish("upload_failed", error=err_up)
+
+    step("install")
+    script = (NODE_EXPORTER_INSTALL_SCRIPT
+              .replace("__DIR__", shlex.quote(artifact.name[:-len(".tar.gz")]))
+              .replace("__TARBALL__", shlex.quote(remote)))
+    ok_inst, out_inst, err_inst = ssh_exec(ip, user, script, password=password, key_path=key_path, port=port, timeout=max(timeout, 30.0))
+    result["output"] = out_inst
+    if not ok_inst or "NODE_EXPORTER_INSTALLED" not in (out_inst or ""):
+        return finish("install_failed", error=(err_inst or "").strip() or "script de instalação falhou")
+
+    step("verify")
+    probe: Dict[str, Any] = {"present": False}
+    for _ in range(5):
+        probe = probe_node_exporter(ip)
+        if probe.get("present"):
+            break
+        time.sleep(1.0)
+    result["probe"] = probe
+    if not probe.get("present"):
+        return finish("not_present", error=(err_inst or "").strip() or None)
+    return finish("installed", ok=True)
+
+
+def node_exporter_rollout_hosts(payload: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """Normalize payload["hosts"] (IPs or {ip, user, password, keyPath, port}) using top-level defaults."""
+    hosts: List[Dict[str, Any]] = []
+    seen = set()
+    for h in payload.get("hosts") or []:
+        h = {"ip": h} if isinstance(h, str) else dict(h or {})
+        ip = str(h.get("ip") or "").strip()
+        if not ip or ip in seen:
+            continue
+        seen.add(ip)
+        hosts.append({
+            "ip": ip,
+            "user": h.get("user") or payload.get("user"),
+            "password": h.get("password", payload.get("password")),
+            "key_path": h.get("keyPath", payload.get("keyPath")),
+            "port": int(h.get("port") or payload.get("port") or 22),
+        })
+    return hosts
+
+
+def node_exporter_rollout(hosts: List[Dict[str, Any]], version: str, force: bool, timeout: float,
+                          concurrency: int, batch_size: int, max_failures: Optional[int], emit: Any) -> Dict[str, Any]:
+    """Install on hosts in rolling batches (each batch runs with bounded concurrency and must finish
+    before the next starts). Stops early once more than max_failures hosts have failed. emit(event) gets progress.
+    """
+    started = time.time()
+    batches = [hosts[i:i + batch_size] for i in range(0, len(hosts), batch_size)]
+    emit({"event": "rollout", "total": len(hosts), "batches": len(batches), "concurrency": concurrency, "version": version})
+    results: List[Dict[str, Any]] = []
+    failures = 0
+    aborted = False
+    for index, batch in enumerate(batches):
+        emit({"event": "batch", "batch": index + 1, "hosts": [h["ip"] for h in batch]})
+
+        def run(h: Dict[str, Any]) -> Dict[str, Any]:
+            if not h["user"]:
+                return {"ip": h["ip"], "ok": False, "status": "invalid", "error": "Parâmetro obrigatório ausente: user"}
+            try:
+                return node_exporter_install_host(
+                    h["ip"], h["user"], password=h["password"], key_path=h["key_path"], port=h["port"],
+                    timeout=timeout, version=version, force=force,
+                    progress=lambda stage, ip=h["ip"]: emit({"event": "host", "ip": ip, "stage": stage}),
+                )
+            except Exception as e:
+                return {"ip": h["ip"], "ok": False, "status": "error", "error": str(e)}
+
+        with ThreadPoolExecutor(max_workers=max(1, min(concurrency, len(batch))), thread_name_prefix="node-exporter") as ex:
+            for fut in as_completed([ex.submit(run, h) for h in batch]):
+                res = fut.result()
+                results.append(res)
+                failures += 0 if res.get("ok") else 1
+                emit({"event": "result", **res})
+        if max_failures is not None and failures > max_failures and index + 1 < len(batches):
+            aborted = True
+            skipped = [h["ip"] for b in batches[index + 1:] for h in b]
+            emit({"event": "aborted", "batch": index + 1, "failures": failures, "skipped": skipped})
+            break
+    counts: Dict[str, int] = {}
+    for res in results:
+        counts[res.get("status") or "unknown"] = counts.get(res.get("status") or "unknown", 0) + 1
+    summary = {
+        "event": "summary", "ok": failures == 0 and not aborted, "total": len(hosts), "done": len(results),
+        "failed": failures, "aborted": aborted, "counts": counts, "seconds": round(time.time() - started, 2),
+    }
+    emit(summary)
+    return {"summary": summary, "results": results}
+
+
+@app.post("/api/actions/node-exporter/install")
+def actions_node_exporter_install(payload: Dict[str, Any] = Body(...)):
+    if not paramiko:
+        return {"ok": False, "error": "paramiko não disponível"}
+    ip = payload.get("ip")
+    user = payload.get("user")
+    password = payload.get("password")
+    key_path = payload.get("keyPath")
+    port = int(payload.get("port", 22))
+    timeout = float(payload.get("timeout", 3.0))
+    version = str(payload.get("version", NODE_EXPORTER_VERSION))
+    if isinstance(version, str) and version.lower() in ("latest", "stable"):
+        version = NODE_EXPORTER_VERSION
+    force = bool(payload.get("force", False))
+    if not ip or not user:
+        return {"ok": False, "error": "Parâmetros obrigatórios ausentes: ip/user"}
+    if not NODE_EXPORTER_VERSION_RE.match(version):
+        return {"ok": False, "error": f"Versão inválida: {version}"}
+    return node_exporter_install_host(ip, user, password=password, key_path=key_path, port=port,
+                                      timeout=timeout, version=version, force=force)
+
+
+@app.post("/api/actions/node-exporter/rollout")
+def actions_node_exporter_rollout(payload: Dict[str, Any] = Body(...)):
+    """Bulk install: streams NDJSON progress (rollout, batch, host, result, aborted, summary events)."""
+    if not paramiko:
+        return {"ok": False, "error": "paramiko não disponível"}
+    hosts = node_exporter_rollout_hosts(payload)
+    if not hosts:
+        return {"ok": False, "error": "Parâmetros obrigatórios ausentes: hosts"}
+    version = str(payload.get("version", NODE_EXPORTER_VERSION))
+    if version.lower() in ("latest", "stable"):
+        version = NODE_EXPORTER_VERSION
+    if not NODE_EXPORTER_VERSION_RE.match(version):
+        return {"ok": False, "error": f"Versão inválida: {version}"}
+    force = bool(payload.get("force", False))
+    timeout = float(payload.get("timeout", 3.0))
+    concurrency = max(1, min(int(payload.get("concurrency", NODE_EXPORTER_ROLLOUT_CONCURRENCY)),
+                             NODE_EXPORTER_ROLLOUT_MAX_CONCURRENCY))
+    batch_size = int(payload.get("batchSize", NODE_EXPORTER_ROLLOUT_BATCH)) or len(hosts)
+    batch_size = max(1, min(batch_size, len(hosts)))
+    max_failures = payload.get("maxFailures")
+    max_failures = int(max_failures) if max_failures is not None else None
+    args = (hosts, version, force, timeout, concurrency, batch_size, max_failures)
+
+    if payload.get("stream") is False:
+        out = node_exporter_rollout(*args, emit=lambda event: None)
+        return {"ok": out["summary"]["ok"], **out}
+
+    events: "queue.Queue[Optional[Dict[str, Any]]]" = queue.Queue()
+
+    def run() -> None:
+        try:
+            node_exporter_rollout(*args, emit=events.put)
+        except Exception as e:
+            events.put({"event": "error", "error": str(e)})
+        finally:
+            events.put(None)
+
+    # o rollout continua em background mesmo que o cliente desconecte; os resultados ficam no Devices
+    threading.Thread(target=run, daemon=True, name="node-exporter-rollout").start()
+
+    def stream():
+        while True:
+            event = events.get()
+            if event is None:
+                break
+            yield json.dumps(event, default=str) + "\n"
+
+    return StreamingResponse(stream(), media_type="application/x-ndjson")
+
+@app.post("/api/actions/node-exporter/stop")
+def actions_node_exporter_stop(payload: Dict[str, Any] = Body(...)):
+    if not paramiko:
+        return {"ok": False, "error": "paramiko não disponível"}
+    ip = payload.get("ip")
+    user = payload.get("user")
     password = payload.get("password")
-    secret = payload.get("secret")
-    command = payload.get("command")
+    key_path = payload.get("keyPath")
     port = int(payload.get("port", 22))
-    timeout = int(payload.get("timeout", 8))
-    
-    allowed_types = {
-        "cisco_ios", "cisco_xe", "cisco_nxos", "cisco_xr",
-        "arista_eos", "juniper_junos", "huawei", "hp_procurve",
-        "mikrotik_routeros", "ubiquiti_edgerouter", "linux",
-    }
-    if not device_type or device_type not in allowed_types:
-        return {"ok": False, "error": f"deviceType inválido. Permitidos: {sorted(list(allowed_types))}"}
-    
-    res = run_netmiko_command(host, device_type, username, password, command, secret, port, timeout)
-    
+    timeout = float(payload.get("timeout", 3.0))
+    if not ip or not user:
+        return {"ok": False, "error": "Parâmetros obrigatórios ausentes: ip/user"}
+    ok1, out1, err1 = ssh_exec(ip, user, "sudo -n systemctl stop node_exporter || true && systemctl is-active node_exporter || true", password=password, key_path=key_path, port=port, timeout=timeout)
+    status = (out1 or "").strip()
+    probe = probe_node_exporter(ip)
+    return {"ok": ok1 and status != "active", "status": status or "unknown", "probe": probe, "output": out1, "error": err1}
+
+@app.post("/api/actions/node-exporter/uninstall")
+def actions_node_exporter_uninstall(payload: Dict[str, Any] = Body(...)):
+    if not paramiko:
+        return {"ok": False, "error": "paramiko não disponível"}
+    ip = payload.get("ip")
+    user = payload.get("user")
+    password = payload.get("password")
+    key_path = payload.get("keyPath")
+    port = int(payload.get("port", 22))
+    timeout = float(payload.get("timeout", 3.0))
+    if not ip or not user:
+        return {"ok": False, "error": "Parâmetros obrigatórios ausentes: ip/user"}
+    script = """
+sudo -n systemctl stop node_exporter || true
+sudo -n systemctl disable node_exporter || true
+sudo -n rm -f /etc/systemd/system/node_exporter.service || true
+sudo -n systemctl daemon-reload || true
+sudo -n rm -f /usr/local/bin/node_exporter || true
+sudo -n userdel node_exporter 2>/dev/null || true
+"""
+    ok, out, err = ssh_exec(ip, user, script, password=password, key_path=key_path, port=port, timeout=max(timeout, 5.0))
+    probe = probe_node_exporter(ip)
+    try:
+        payload = {
+            "ip": ip,
+            "node_exporter": {"installed": False, "version": None, "timestamp": time.strftime("%Y-%m-%d %H:%M:%S")},
+            "real": True,
+        }
+        pg_upsert_device(payload)
+    except Exception:
+        pass
+    return {"ok": ok and not probe.get("present"), "status": "uninstalled", "probe": probe, "output": out, "error": err}
+
+# ----------------------
+# Inventory Persistence (PostgreSQL first, JSON fallback)
+# ----------------------
+
+
+
+# --- PostgreSQL helpers ---
+def pg_ready() -> bool:
+    c = get_pg_conn()
+    if not c:
+        return False
+    try:
+        c.close()
+    except Exception:
+        pass
+    return True
+
+def pg_list_devices() -> List[Dict[str, Any]]:
+    conn = get_pg_conn()
+    if not conn:
+        return []
+    try:
+        with conn.cursor() as cur:
+            cur.execute('SELECT id, ip, hostname, os, status, services, last_seen, node_exporter, virtualization, real FROM "AUTOMACAO"."Devices" ORDER BY COALESCE(updated_at, created_at) DESC')
+            rows = cur.fetchall()
+        conn.close()
+        devices: List[Dict[str, Any]] = []
+        for r in rows:
+            services = r[5]
+            node_exporter = r[7]
+            if isinstance(services, str):
+                try:
+                    services = json.loads(services or "[]")
+                except Exception:
+                    services = []
+            if isinstance(node_exporter, str):
+                try:
+                    node_exporter = json.loads(node_exporter or "{}")
+                except Exception:
+                    node_exporter = None
+            devices.append({
+                "id": r[0],
+                "ip": r[1],
+                "hostname": r[2],
+                "os": r[3],
+                "status": r[4],
+                "services": services or [],
+                "last_seen": r[6],
+                "node_exporter": node_exporter,
+                "virtualization": r[8],
+                "real": bool(r[9]) if r[9] is not None else True,
+            })
+        return devices
+    except Exception:
+        try:
+            conn.close()
+        except Exception:
+            pass
+        return []
+
+def pg_get_device(ip: Optional[str] = None, hostname: Optional[str] = None) -> Optional[Dict[str, Any]]:
+    conn = get_pg_conn()
+    if not conn:
+        return None
+    try:
+        with conn.cursor() as cur:
+            if ip:
+                cur.execute('SELECT id, ip, hostname, os, status, services, last_seen, node_exporter, virtualization, real FROM "AUTOMACAO"."Devices" WHERE ip = %s', (ip,))
+            else:
+                cur.execute('SELECT id, ip, hostname, os, status, services, last_seen, node_exporter, virtualization, real FROM "AUTOMACAO"."Devices" WHERE hostname = %s', (hostname,))
+            row = cur.fetchone()
+        conn.close()
+        if not row:
+            return None
+        services = row[5]
+        node_exporter = row[7]
+        if isinstance(services, str):
+            try:
+                services = json.loads(services or "[]")
+            except Exception:
+                services = []
+        if isinstance(node_exporter, str):
+            try:
+                node_exporter = json.loads(node_exporter or "{}")
+            except Exception:
+                node_exporter = None
+        return {
+            "id": row[0], "ip": row[1], "hostname": row[2], "os": row[3], "status": row[4],
+            "services": services or [], "last_seen": row[6], "node_exporter": node_exporter,
+            "virtualization": row[8], "real": bool(row[9]) if row[9] is not None else True,
+        }
+    except Exception:
+        try:
+            conn.close()
+        except Exception:
+            pass
+        return None
+
+def pg_upsert_device(device: Dict[str, Any]) -> Dict[str, Any]:
+    ensure_pg_schema()
+    ip = device.get("ip")
+    hostname = device.get("hostname")
+    os_label = device.get("os") or "Unknown"
+    status = device.get("status") or "Unknown"
+    last_seen = device.get("lastSeen") or time.strftime("%Y-%m-%d %H:%M:%S")
+    # Normalize services to list[str]
+    raw_services = device.get("services") or []
+    normalized_services: List[Any] = []
+    for s in raw_services:
+        if isinstance(s, str):
+            normalized_services.append(s)
+        elif isinstance(s, dict) and ("service" in s or "port" in s):
+            normalized_services.append(s)
+    node_exporter = device.get("node_exporter") or None
+    virtualization = device.get("virtualization")
+    real = bool(device.get("real", True))
+
+    # Merge services with existing
+    existing = pg_get_device(ip=ip) if ip else pg_get_device(hostname=hostname)
+    if existing:
+        base_services = existing.get("services") or []
+        merged: List[Any] = []
+        for s in list(base_services) + list(normalized_services):
+            if s not in merged:
+                merged.append(s)
+        normalized_services = merged
+
+    conn = get_pg_conn()
+    if not conn:
+        return {
+            "ip": ip, "hostname": hostname, "os": os_label, "status": status,
+            "services": normalized_services, "last_seen": last_seen,
+            "node_exporter": node_exporter, "virtualization": virtualization, "real": real,
+        }
     try:
-        ip = host
+        with conn.cursor() as cur:
+            if ip:
+                # Try upsert via ip
+                cur.execute('''
+                    INSERT INTO "AUTOMACAO"."Devices" (ip, hostname, os, status, services, last_seen, node_exporter, virtualization, real, updated_at)
+                    VALUES (%s, %s, %s, %s, %s::jsonb, %s, %s::jsonb, %s, %s, NOW())
+                    ON CONFLICT (ip) DO UPDATE SET
+                        hostname = EXCLUDED.hostname,
+                        os = EXCLUDED.os,
+                        status = EXCLUDED.status,
+                        services = EXCLUDED.services,
+                        last_seen = EXCLUDED.last_seen,
+                        node_exporter = EXCLUDED.node_exporter,
+                        virtualization = EXCLUDED.virtualization,
+                        real = EXCLUDED.real,
+                        updated_at = NOW()
+                    RETURNING id, ip, hostname, os, status, services, last_seen, node_exporter, virtualization, real
+                ''', (ip, hostname, os_label, status, json.dumps(normalized_services), last_seen, json.dumps(node_exporter or {}), virtualization, real))
+            else:
+                # Upsert via hostname
+                cur.execute('''
+                    INSERT INTO "AUTOMACAO"."Devices" (hostname, ip, os, status, services, last_seen, node_exporter, virtualization, real, updated_at)
+                    VALUES (%s, %s, %s, %s, %s::jsonb, %s, %s::jsonb, %s, %s, NOW())
+                    ON CONFLICT (hostname) DO UPDATE SET
+                        ip = EXCLUDED.ip,
+                        os = EXCLUDED.os,
+                        status = EXCLUDED.status,
+                        services = EXCLUDED.services,
+                        last_seen = EXCLUDED.last_seen,
+                        node_exporter = EXCLUDED.node_exporter,
+                        virtualization = EXCLUDED.virtualization,
+                        real = EXCLUDED.real,
+                        updated_at = NOW()
+                    RETURNING id, ip, hostname, os, status, services, last_seen, node_exporter, virtualization, real
+                ''', (hostname, ip, os_label, status, json.dumps(normalized_services), last_seen, json.dumps(node_exporter or {}), virtualization, real))
+            row = cur.fetchone()
+        conn.close()
+        if not row:
+            return {
+                "ip": ip, "hostname": hostname, "os": os_label, "status": status,
+                "services": normalized_services, "last_seen": last_seen,
+                "node_exporter": node_exporter, "virtualization": virtualization, "real": real,
+            }
+        # Decode possible JSON strings
+        services = row[5]
+        node_exporter = row[7]
+        if isinstance(services, str):
+            try:
+                services = json.loads(services or "[]")
+            except Exception:
+                services = []
+        if isinstance(node_exporter, str):
+            try:
+                node_exporter = json.loads(node_exporter or "{}")
+            except Exception:
+                node_exporter = None
+        return {
+            "id": row[0], "ip": row[1], "hostname": row[2], "os": row[3], "status": row[4],
+            "services": services or [], "last_seen": row[6], "node_exporter": node_exporter,
+            "virtualization": row[8], "real": bool(row[9]) if row[9] is not None else True,
+        }
+    except Exception:
         try:
-            ip = socket.gethostbyname(host)
+            conn.close()
         except Exception:
             pass
-        dev = pg_get_device(ip=ip) or pg_upsert_device({"ip": ip, "hostname": payload.get("hostname")})
-        dev_id = dev.get("id") if isinstance(dev, dict) else None
-        if dev_id:
-            ev = pg_add_event(
-                dev_id, "NETMIKO_CMD", "info" if res.get("ok") else "error",
-                f"CMD: {command}", 
-                mask_secrets({
-                    "deviceType": device_type, "port": port, "timeout": timeout
-                }),
-                actor=payload.get("actor", "api"),
-                source=client_ip
-            )
-            res["event_id"] = ev.get("id")
-    except Exception:
-        pass
-    return res
-
-
-@app.get("/api/discovery/hostinfo")
-def discovery_hostinfo(ip: str = Query(...), method: str = Query("tcp"),
-                       sshUser: Optional[str] = Query(None), sshPass: Optional[str] = Query(None),
-                       sshKey: Optional[str] = Query(None), sshPort: int = Query(22), sshTimeout: float = Query(3.0),
-                       winrmUser: Optional[str] = Query(None), winrmPass: Optional[str] = Query(None),
-                       winrmUseTls: bool = Query(False), winrmPort: int = Query(5985), winrmTimeout: float = Query(4.0)):
-    ports = get_ports_for_method(method)
-    base = discover_host_with_ports(ip, ports)
-    # Attempt Linux enrichment if SSH credentials are provided
-    base = enrich_linux_details(ip, base, ssh_user=sshUser, ssh_pass=sshPass, ssh_key=sshKey, ssh_port=sshPort, ssh_timeout=sshTimeout)
-    # Attempt Windows enrichment if WinRM credentials are provided
-    base = enrich_windows_details(ip, base, winrm_user=winrmUser, winrm_pass=winrmPass, winrm_use_tls=winrmUseTls, winrm_port=winrmPort, winrm_timeout=winrmTimeout)
-    base["os"] = compose_os_label(base)
-    return base
-
-
-@app.get("/api/discovery/docker")
-def discovery_docker(ip: str = Query(...),
-                     sshUser: Optional[str] = Query(None), sshPass: Optional[str] = Query(None),
-                     sshKey: Optional[str] = Query(None), sshPort: int = Query(22), sshTimeout: float = Query(3.0)):
-    # Prefer SSH probe if credentials provided; otherwise API probe
-    via_api = probe_docker(ip)
-    via_ssh: Dict[str, Any] = {}
-    if sshUser and (sshPass or sshKey):
-        via_ssh = probe_docker_via_ssh(ip, ssh_user=sshUser, ssh_pass=sshPass, ssh_key=sshKey, ssh_port=sshPort, ssh_timeout=sshTimeout)
-    # Combine: prefer SSH if present, else API
-    if via_ssh.get("present"):
-        return via_ssh
-    return via_api
-
-
-# ----------------------
-# DB Connectivity Probes (PostgreSQL, MySQL, SQL Server)
-# ----------------------
+        return {
+            "ip": ip, "hostname": hostname, "os": os_label, "status": status,
+            "services": normalized_services, "last_seen": last_seen,
+            "node_exporter": node_exporter, "virtualization": virtualization, "real": real,
+        }
 
-def probe_postgres(ip: str, port: int = 5432, timeout: float = 0.8) -> Dict[str, Any]:
-    start = time.time()
+def pg_touch_device(ip: str) -> bool:
+    """Refresh last_seen for an unchanged device without rewriting its record."""
+    conn = get_pg_conn()
+    if not conn:
+        return False
     try:
-        with socket.create_connection((ip, port), timeout=timeout) as s:
-            # Send SSLRequest: length=8, code=80877103
-            msg = (8).to_bytes(4, 'big') + (80877103).to_bytes(4, 'big')
-            s.sendall(msg)
-            resp = s.recv(1)
-            latency = (time.time() - start) * 1000
-            tls_supported = resp == b'S'
-            return {"reachable": True, "latency_ms": round(latency, 2), "tls_supported": tls_supported}
-    except Exception as e:
-        return {"reachable": False, "error": str(e)}
+        with conn.cursor() as cur:
+            cur.execute('UPDATE "AUTOMACAO"."Devices" SET last_seen = NOW() WHERE ip = %s', (ip,))
+        conn.close()
+        return True
+    except Exception:
+        try:
+            conn.close()
+        except Exception:
+            pass
+        return False
 
-def probe_mysql(ip: str, port: int = 3306, timeout: float = 0.8) -> Dict[str, Any]:
-    start = time.time()
+def pg_apply_device_diff(ip: str, services: List[Any], status: str, seen: bool = True) -> bool:
+    """Replace services/status of a device (unlike pg_upsert_device, closed ports are removed).
+    last_seen is only refreshed when the host responded (seen=True).
+    """
+    conn = get_pg_conn()
+    if not conn:
+        return False
     try:
-        with socket.create_connection((ip, port), timeout=timeout) as s:
-            s.settimeout(timeout)
-            data = s.recv(128)
-            latency = (time.time() - start) * 1000
-            server_version = None
-            if data and len(data) > 5:
-                # MySQL sends protocol version (1 byte) then version string null-terminated
-                try:
-                    idx = 1
-                    end = data.find(b'\x00', idx)
-                    if end != -1:
-                        server_version = data[idx:end].decode(errors='ignore')
-                except Exception:
-                    server_version = None
-            return {"reachable": True, "latency_ms": round(latency, 2), "version": server_version}
-    except Exception as e:
-        return {"reachable": False, "error": str(e)}
+        with conn.cursor() as cur:
+            cur.execute('''
+                UPDATE "AUTOMACAO"."Devices"
+                SET services = %s::jsonb, status = %s,
+                    last_seen = CASE WHEN %s THEN NOW() ELSE last_seen END, updated_at = NOW()
+                WHERE ip = %s
+            ''', (json.dumps(services), status, seen, ip))
+        conn.close()
+        return True
+    except Exception:
+        try:
+            conn.close()
+        except Exception:
+            pass
+        return False
 
-def probe_sqlserver(ip: str, port: int = 1433, timeout: float = 0.8) -> Dict[str, Any]:
-    start = time.time()
+def pg_set_node_exporter(ip: str, info: Dict[str, Any], insert: bool = False) -> bool:
+    """Merge info into Devices.node_exporter without touching the rest of the record.
+    With insert=True a device that is not in the inventory yet is created.
+    """
+    ensure_pg_schema()
+    conn = get_pg_conn()
+    if not conn:
+        return False
     try:
-        with socket.create_connection((ip, port), timeout=timeout):
-            latency = (time.time() - start) * 1000
-            return {"reachable": True, "latency_ms": round(latency, 2)}
-    except Exception as e:
-        return {"reachable": False, "error": str(e)}
+        with conn.cursor() as cur:
+            cur.execute('''
+                UPDATE "AUTOMACAO"."Devices"
+                SET node_exporter = COALESCE(node_exporter, '{}'::jsonb) || %s::jsonb, updated_at = NOW()
+                WHERE ip = %s
+            ''', (json.dumps(info), ip))
+            updated = cur.rowcount
+        conn.close()
+    except Exception:
+        try:
+            conn.close()
+        except Exception:
+            pass
+        return False
+    if not updated and insert:
+        pg_upsert_device({"ip": ip, "services": [{"service": "node_exporter", "port": 9100}], "node_exporter": info, "real": True})
+    return True
 
-def probe_mongodb(ip: str, port: int = 27017, timeout: float = 0.8) -> Dict[str, Any]:
-    start = time.time()
+def pg_upsert_interface(device_id: Optional[int], name: Optional[str], mac: Optional[str] = None, ipv4: Optional[str] = None, ipv6: Optional[str] = None, speed_mbps: Optional[int] = None, status: Optional[str] = None, type_label: Optional[str] = None) -> Optional[int]:
+    ensure_pg_schema()
+    if not device_id or not name:
+        return None
+    conn = get_pg_conn()
+    if not conn:
+        return None
     try:
-        with socket.create_connection((ip, port), timeout=timeout) as s:
-            s.settimeout(timeout)
-            try:
-                data = s.recv(64)
-            except Exception:
-                data = b""
-            latency = (time.time() - start) * 1000
-            return {"reachable": True, "latency_ms": round(latency, 2), "banner": data[:16].hex() if data else None}
-    except Exception as e:
-        return {"reachable": False, "error": str(e)}
+        with conn.cursor() as cur:
+            cur.execute('''
+                INSERT INTO "AUTOMACAO"."DeviceInterfaces" (device_id, name, mac, ipv4, ipv6, speed_mbps, status, type, last_seen, updated_at)
+                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, NOW(), NOW())
+                ON CONFLICT (device_id, name) DO UPDATE SET
+                    mac = EXCLUDED.mac,
+                    ipv4 = EXCLUDED.ipv4,
+                    ipv6 = EXCLUDED.ipv6,
+                    speed_mbps = EXCLUDED.speed_mbps,
+                    status = EXCLUDED.status,
+                    type = EXCLUDED.type,
+                    last_seen = NOW(),
+                    updated_at = NOW()
+                RETURNING id
+            ''', (device_id, name, mac, ipv4, ipv6, speed_mbps, status, type_label))
+            row = cur.fetchone()
+        conn.close()
+        return int(row[0]) if row else None
+    except Exception:
+        try:
+            conn.close()
+        except Exception:
+            pass
+        return None
 
-def probe_redis(ip: str, port: int = 6379, timeout: float = 0.8) -> Dict[str, Any]:
-    start = time.time()
+
+def pg_upsert_link(src_device_id: Optional[int], src_interface_id: Optional[int], dst_device_id: Optional[int], dst_interface_id: Optional[int], link_type: str = "SNMP", latency_ms: Optional[float] = None, bandwidth_mbps: Optional[int] = None, status: Optional[str] = "discovered") -> Optional[int]:
+    ensure_pg_schema()
+    if not src_device_id or not dst_device_id:
+        return None
+    conn = get_pg_conn()
+    if not conn:
+        return None
     try:
-        with socket.create_connection((ip, port), timeout=timeout) as s:
-            s.settimeout(timeout)
-            s.sendall(b"*1\r\n$4\r\nPING\r\n")
-            data = s.recv(64)
-            latency = (time.time() - start) * 1000
-            pong = data.startswith(b"+PONG") if data else False
-            return {"reachable": True, "latency_ms": round(latency, 2), "pong": pong}
-    except Exception as e:
-        return {"reachable": False, "error": str(e)}
+        with conn.cursor() as cur:
+            cur.execute('''
+                INSERT INTO "AUTOMACAO"."NetworkLinks"
+                    (src_device_id, src_interface_id, dst_device_id, dst_interface_id, link_type, latency_ms, bandwidth_mbps, status, discovered_at, updated_at)
+                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, NOW(), NOW())
+                ON CONFLICT (src_device_id, dst_device_id, link_type) DO UPDATE SET
+                    src_interface_id = EXCLUDED.src_interface_id,
+                    dst_interface_id = EXCLUDED.dst_interface_id,
+                    latency_ms = EXCLUDED.latency_ms,
+                    bandwidth_mbps = EXCLUDED.bandwidth_mbps,
+                    status = EXCLUDED.status,
+                    updated_at = NOW()
+                RETURNING id
+            ''', (src_device_id, src_interface_id, dst_device_id, dst_interface_id, link_type, latency_ms, bandwidth_mbps, status))
+            row = cur.fetchone()
+        conn.close()
+        return int(row[0]) if row else None
+    except Exception:
+        try:
+            conn.close()
+        except Exception:
+            pass
+        return None
 
-def probe_rabbitmq(ip: str, port: int = 5672, timeout: float = 0.8) -> Dict[str, Any]:
-    start = time.time()
+
+def pg_delete_device(device_id: str) -> Dict[str, Any]:
+    conn = get_pg_conn()
+    if not conn:
+        return {"ok": False, "message": "PostgreSQL connection not available"}
     try:
-        with socket.create_connection((ip, port), timeout=timeout) as s:
-            s.settimeout(timeout)
-            s.sendall(b"AMQP\x00\x00\x09\x01")
+        with conn.cursor() as cur:
+            # If numeric id
             try:
-                data = s.recv(64)
+                num_id = int(device_id)
+                cur.execute('DELETE FROM "AUTOMACAO"."Devices" WHERE id = %s', (num_id,))
             except Exception:
-                data = b""
-            latency = (time.time() - start) * 1000
-            ready = bool(data)
-            return {"reachable": True, "latency_ms": round(latency, 2), "amqp_ready": ready}
-    except Exception as e:
-        return {"reachable": False, "error": str(e)}
-
-@app.get("/api/discovery/dbprobe")
-def discovery_dbprobe(ip: str = Query(...), onlyOnline: bool = Query(True)):
-    results: List[Dict[str, Any]] = []
-    # Ports mapping
-    checks = [
-        ("postgresql", 5432, probe_postgres),
-        ("postgresql", 5433, probe_postgres),
-        ("mysql", 3306, probe_mysql),
-        ("sqlserver", 1433, probe_sqlserver),
-        ("mongodb", 27017, probe_mongodb),
-        ("redis", 6379, probe_redis),
-        ("rabbitmq", 5672, probe_rabbitmq),
-    ]
-    for name, port, fn in checks:
-        res = fn(ip, port)
-        res.update({"name": name, "port": port})
-        results.append(res)
-    if onlyOnline:
-        results = [r for r in results if r.get("reachable")]
-    return {"databases": results}
+                # Remove by ip or hostname
+                cur.execute('DELETE FROM "AUTOMACAO"."Devices" WHERE ip = %s OR hostname = %s', (device_id, device_id))
+        conn.close()
+        # Return remaining count
+        # Best-effort: recount
+        rem = pg_list_devices()
+        return {"ok": True, "message": "Device removed successfully", "count": len(rem)}
+    except Exception:
+        try:
+            conn.close()
+        except Exception:
+            pass
+        return {"ok": False, "message": "Failed to remove device"}
 
+# --- JSON fallback helpers ---
 
-# ----------------------
-# Metrics Aggregation (Node Exporter)
-# ----------------------
+# Eventos e manutenção de topologia
 
-def compute_cpu_usage(ip: str, idle_cum: float, total_cum: float) -> float | None:
-    # usage = 1 - idle_delta / total_delta (PostgreSQL)
+def pg_add_event(device_id: int, event_type: str, severity: str = "info", description: Optional[str] = None, 
+                 attributes: Optional[Dict[str, Any]] = None, actor: Optional[str] = None, 
+                 source: Optional[str] = None) -> Dict[str, Any]:
+    ensure_pg_schema()
     conn = get_pg_conn()
-    if not conn:
-        return None
-    prev_idle_val: float | None = None
-    prev_total_val: float | None = None
+    if not conn or not device_id or not event_type:
+        return {"ok": False}
     try:
+        # Mask sensitive information in attributes
+        masked_attributes = mask_secrets(attributes or {})
+        
         with conn.cursor() as cur:
-            cur.execute('''
-                SELECT m.value
-                FROM "AUTOMACAO"."Metrics" m
-                JOIN "AUTOMACAO"."Devices" d ON m.device_id = d.id
-                WHERE d.ip = %s AND m.metric_name = 'cpu_idle_cum'
-                ORDER BY m.ts DESC
-                LIMIT 1
-            ''', (ip,))
-            row = cur.fetchone()
-            if row:
-                prev_idle_val = float(row[0])
-            cur.execute('''
-                SELECT m.value
-                FROM "AUTOMACAO"."Metrics" m
-                JOIN "AUTOMACAO"."Devices" d ON m.device_id = d.id
-                WHERE d.ip = %s AND m.metric_name = 'cpu_total_cum'
-                ORDER BY m.ts DESC
-                LIMIT 1
-            ''', (ip,))
-            row = cur.fetchone()
-            if row:
-                prev_total_val = float(row[0])
+            cur.execute(
+                'INSERT INTO "AUTOMACAO"."Events"(device_id, event_type, severity, description, attributes, actor, source, ts) VALUES (%s, %s, %s, %s, %s, %s, %s, NOW()) RETURNING id',
+                (device_id, event_type, severity, description, json.dumps(masked_attributes), actor, source)
+            )
+            rid = cur.fetchone()
+        conn.close()
+        return {"ok": True, "id": rid[0]}
     except Exception:
-        pass
-    finally:
         try:
             conn.close()
         except Exception:
             pass
-    if prev_idle_val is None or prev_total_val is None:
-        return None
-    idle_delta = idle_cum - prev_idle_val
-    total_delta = total_cum - prev_total_val
-    if total_delta <= 0:
-        return None
-    usage = max(0.0, min(100.0, (1.0 - (idle_delta / total_delta)) * 100.0))
-    return usage
+        return {"ok": False}
 
-@app.get("/api/discovery/metrics")
-def discovery_metrics(ip: str = Query(...), points: int = Query(30)):
-    # Poll node exporter and store metrics
-    node = probe_node_exporter(ip)
-    if not node.get("present"):
-        return {"present": False, "series": {}}
-    # Store raw counters
-    idle_cum = node.get("cpu_idle_cum") or 0.0
-    total_cum = node.get("cpu_total_cum") or 0.0
-    record_metric(ip, "cpu_idle_cum", idle_cum)
-    record_metric(ip, "cpu_total_cum", total_cum)
 
-    # Compute and store aggregates
-    cpu_usage = compute_cpu_usage(ip, idle_cum, total_cum)
-    if cpu_usage is not None:
-        record_metric(ip, "cpu_usage_percent", cpu_usage)
-    mem_used = node.get("mem_used_percent")
-    if mem_used is not None:
-        record_metric(ip, "mem_used_percent", mem_used)
-    fs_used = node.get("fs_used_percent")
-    if fs_used is not None:
-        record_metric(ip, "fs_used_percent", fs_used)
-    rx_cum = node.get("net_rx_cum") or 0.0
-    tx_cum = node.get("net_tx_cum") or 0.0
-    # compute bps via delta from previous sample (PostgreSQL)
+def pg_list_events(device_id: Optional[int] = None, event_type: Optional[str] = None, limit: int = 200) -> List[Dict[str, Any]]:
+    ensure_pg_schema()
     conn = get_pg_conn()
-    prev_rx_val: float | None = None
-    prev_rx_ts: int | None = None
-    prev_tx_val: float | None = None
-    prev_tx_ts: int | None = None
-    if conn:
+    if not conn:
+        return []
+    try:
+        with conn.cursor() as cur:
+            sql = 'SELECT id, device_id, event_type, severity, description, attributes, actor, source, ts FROM "AUTOMACAO"."Events"'
+            params: List[Any] = []
+            if device_id is not None or event_type is not None:
+                sql += ' WHERE '
+                conds: List[str] = []
+                if device_id is not None:
+                    conds.append('device_id = %s')
+                    params.append(device_id)
+                if event_type is not None:
+                    conds.append('event_type = %s')
+                    params.append(event_type)
+                sql += ' AND '.join(conds)
+            sql += ' ORDER BY ts DESC LIMIT %s'
+            params.append(limit)
+            cur.execute(sql, tuple(params))
+            rows = cur.fetchall()
+        conn.close()
+        return [
+            {
+                "id": r[0],
+                "device_id": r[1],
+                "event_type": r[2],
+                "severity": r[3],
+                "description": r[4],
+                "attributes": json.loads(r[5]) if isinstance(r[5], (str, bytes)) else (r[5] or {}),
+                "actor": r[6],
+                "source": r[7],
+                "ts": r[8],
+            }
+            for r in rows
+        ]
+    except Exception:
         try:
-            with conn.cursor() as cur:
-                cur.execute('''
-                    SELECT m.value, EXTRACT(EPOCH FROM m.ts)::bigint AS ts_epoch
-                    FROM "AUTOMACAO"."Metrics" m
-                    JOIN "AUTOMACAO"."Devices" d ON m.device_id = d.id
-                    WHERE d.ip = %s AND m.metric_name = 'net_rx_cum'
-                    ORDER BY m.ts DESC
-                    LIMIT 1
-                ''', (ip,))
-                row = cur.fetchone()
-                if row:
-                    prev_rx_val, prev_rx_ts = float(row[0]), int(row[1])
-                cur.execute('''
-                    SELECT m.value, EXTRACT(EPOCH FROM m.ts)::bigint AS ts_epoch
-                    FROM "AUTOMACAO"."Metrics" m
-                    JOIN "AUTOMACAO"."Devices" d ON m.device_id = d.id
-                    WHERE d.ip = %s AND m.metric_name = 'net_tx_cum'
-                    ORDER BY m.ts DESC
-                    LIMIT 1
-                ''', (ip,))
-                row = cur.fetchone()
-                if row:
-                    prev_tx_val, prev_tx_ts = float(row[0]), int(row[1])
+            conn.close()
         except Exception:
             pass
-        finally:
-            try:
-                conn.close()
-            except Exception:
-                pass
-    now_ts = int(time.time())
-    record_metric(ip, "net_rx_cum", rx_cum, now_ts)
-    record_metric(ip, "net_tx_cum", tx_cum, now_ts)
-    if prev_rx_val is not None and prev_rx_ts is not None:
-        dt = max(1, now_ts - prev_rx_ts)
-        bps = (rx_cum - prev_rx_val) / dt
-        record_metric(ip, "net_rx_bps", bps, now_ts)
-    if prev_tx_val is not None and prev_tx_ts is not None:
-        dt = max(1, now_ts - prev_tx_ts)
-        bps = (tx_cum - prev_tx_val) / dt
-        record_metric(ip, "net_tx_bps", bps, now_ts)
-
-    # Build series output
-    series = {
-        "cpu_usage_percent": get_series(ip, "cpu_usage_percent", points),
-        "mem_used_percent": get_series(ip, "mem_used_percent", points),
-        "fs_used_percent": get_series(ip, "fs_used_percent", points),
-        "net_rx_bps": get_series(ip, "net_rx_bps", points),
-        "net_tx_bps": get_series(ip, "net_tx_bps", points),
-    }
-    return {"present": True, "series": series}
+        return []
 
-# ----------------------
-# Inventory endpoints
-# ----------------------
 
-@app.get("/api/inventory/hosts")
-def inventory_hosts():
+def pg_purge_links(days: int = 30, device_id: Optional[int] = None) -> int:
+    ensure_pg_schema()
     conn = get_pg_conn()
     if not conn:
-        return {"hosts": []}
+        return 0
     try:
         with conn.cursor() as cur:
-            cur.execute('SELECT ip, hostname, os, status, last_seen FROM "AUTOMACAO"."Devices" ORDER BY COALESCE(updated_at, created_at) DESC')
+            sql = 'DELETE FROM "AUTOMACAO"."NetworkLinks" WHERE updated_at < NOW() - %s::interval'
+            params: List[Any] = [f'{max(1, int(days))} days']
+            if device_id is not None:
+                sql += ' AND (src_device_id = %s OR dst_device_id = %s)'
+                params.extend([device_id, device_id])
+            cur.execute(sql, tuple(params))
+            deleted = cur.rowcount
+        conn.close()
+        return deleted
+    except Exception:
+        try:
+            conn.close()
+        except Exception:
+            pass
+        return 0
+
+# Listagem de interfaces e links (topologia)
+
+def pg_list_interfaces(device_id: int) -> List[Dict[str, Any]]:
+    ensure_pg_schema()
+    conn = get_pg_conn()
+    if not conn or not device_id:
+        return []
+    try:
+        with conn.cursor() as cur:
+            cur.execute(
+                'SELECT id, name, mac, ipv4, ipv6, speed_mbps, status, type, last_seen, updated_at FROM "AUTOMACAO"."DeviceInterfaces" WHERE device_id = %s ORDER BY name',
+                (device_id,)
+            )
             rows = cur.fetchall()
         conn.close()
-        hosts = []
-        for r in rows:
-            hosts.append({
-                "ip": r[0], "hostname": r[1], "os": r[2], "status": r[3], "last_seen": r[4],
-            })
-        return {"hosts": hosts}
+        return [
+            {
+                "id": r[0],
+                "name": r[1],
+                "mac": r[2],
+                "ipv4": r[3],
+                "ipv6": r[4],
+                "speed_mbps": r[5],
+                "status": r[6],
+                "type": r[7],
+                "last_seen": r[8],
+                "updated_at": r[9],
+            }
+            for r in rows
+        ]
     except Exception:
         try:
             conn.close()
         except Exception:
             pass
-        return {"hosts": []}
+        return []
 
-@app.get("/api/inventory/services")
-def inventory_services(ip: str | None = Query(None)):
+
+def pg_list_links(device_id: Optional[int] = None) -> List[Dict[str, Any]]:
+    ensure_pg_schema()
     conn = get_pg_conn()
     if not conn:
-        return {"services": []}
+        return []
     try:
         with conn.cursor() as cur:
-            if ip:
-                cur.execute('SELECT ip, services FROM "AUTOMACAO"."Devices" WHERE ip = %s', (ip,))
+            sql = '''
+                SELECT
+                    l.id,
+                    l.src_device_id, sd.hostname AS src_hostname, sd.ip AS src_ip,
+                    l.src_interface_id, si.name AS src_if_name,
+                    l.dst_device_id, dd.hostname AS dst_hostname, dd.ip AS dst_ip,
+                    l.dst_interface_id, di.name AS dst_if_name,
+                    l.link_type, l.latency_ms, l.bandwidth_mbps, l.status, l.discovered_at, l.updated_at
+                FROM "AUTOMACAO"."NetworkLinks" l
+                LEFT JOIN "AUTOMACAO"."Devices" sd ON l.src_device_id = sd.id
+                LEFT JOIN "AUTOMACAO"."DeviceInterfaces" si ON l.src_interface_id = si.id
+                LEFT JOIN "AUTOMACAO"."Devices" dd ON l.dst_device_id = dd.id
+                LEFT JOIN "AUTOMACAO"."DeviceInterfaces" di ON l.dst_interface_id = di.id
+            '''
+            if device_id is not None:
+                sql += ' WHERE l.src_device_id = %s OR l.dst_device_id = %s'
+                cur.execute(sql + ' ORDER BY l.updated_at DESC', (device_id, device_id))
             else:
-                cur.execute('SELECT ip, services FROM "AUTOMACAO"."Devices" ORDER BY ip')
+                cur.execute(sql + ' ORDER BY l.updated_at DESC')
             rows = cur.fetchall()
         conn.close()
-        services_list: List[Dict[str, Any]] = []
-        for row in rows:
-            device_ip = row[0]
-            services = row[1]
-            if isinstance(services, str):
-                try:
-                    services = json.loads(services or "[]")
-                except Exception:
-                    services = []
-            for s in services or []:
-                if isinstance(s, dict):
-                    name = s.get("service") or s.get("name") or None
-                    port = s.get("port") if isinstance(s.get("port"), int) else None
-                    status = s.get("status") or "Unknown"
-                else:
-                    name = str(s)
-                    port = None
-                    status = "Unknown"
-                services_list.append({"service": name, "port": port, "status": status, "ip": device_ip})
-        services_list.sort(key=lambda x: ((x.get("ip") or ""), (x.get("port") or 0)))
-        return {"services": services_list}
+        return [
+            {
+                "id": r[0],
+                "src_device_id": r[1],
+                "src_hostname": r[2],
+                "src_ip": r[3],
+                "src_interface_id": r[4],
+                "src_if_name": r[5],
+                "dst_device_id": r[6],
+                "dst_hostname": r[7],
+                "dst_ip": r[8],
+                "dst_interface_id": r[9],
+                "dst_if_name": r[10],
+                "link_type": r[11],
+                "latency_ms": r[12],
+                "bandwidth_mbps": r[13],
+                "status": r[14],
+                "discovered_at": r[15],
+                "updated_at": r[16],
+            }
+            for r in rows
+        ]
     except Exception:
         try:
             conn.close()
         except Exception:
             pass
-        return {"services": []}
-
-@app.get("/api/inventory/metrics")
-def inventory_metrics(ip: str = Query(...), metric: str = Query(...), limit: int = Query(60)):
-    return {"series": get_series(ip, metric, limit)}
+        return []
 
-# ----------------------
-# Quick connectivity tests
-# ----------------------
-@app.get("/api/test/ping")
-def test_ping(ip: str = Query(...), count: int = Query(1), timeout: float = Query(1.0)):
-    """Teste de conectividade usando socket TCP ao invés de ping ICMP"""
-    start = time.time()
-    try:
-        # Tenta conectar na porta 80 primeiro, depois 443, depois 22
-        test_ports = [80, 443, 22, 8080, 3000]
-        reachable = False
-        
-        for port in test_ports:
-            try:
-                sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                sock.settimeout(timeout)
-                result = sock.connect_ex((ip, port))
-                sock.close()
-                if result == 0:
-                    reachable = True
-                    break
-            except:
-                continue
-        
-        latency = (time.time() - start) * 1000
-        return {
-            "reachable": reachable, 
-            "latency_ms": round(latency, 2), 
-            "output": f"TCP connectivity test to {ip} - {'SUCCESS' if reachable else 'FAILED'}"
-        }
-    except Exception as e:
-        return {"reachable": False, "error": str(e)}
 
-@app.get("/api/test/ssh")
-def test_ssh(ip: str = Query(...), user: Optional[str] = Query(None), password: Optional[str] = Query(None),
-             keyPath: Optional[str] = Query(None), port: int = Query(22), timeout: float = Query(2.5)):
-    """Teste de conectividade SSH - se não tiver credenciais, testa apenas a porta"""
-    
-    # Se não tiver usuário, faz apenas teste de conectividade na porta SSH
-    if not user:
-        try:
-            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            sock.settimeout(timeout)
-            result = sock.connect_ex((ip, port))
-            sock.close()
-            reachable = result == 0
-            return {
-                "reachable": reachable, 
-                "output": f"SSH port {port} connectivity test - {'SUCCESS' if reachable else 'FAILED'}",
-                "error": None if reachable else f"Cannot connect to port {port}"
-            }
-        except Exception as e:
-            return {"reachable": False, "output": None, "error": str(e)}
-    
-    # Se tiver usuário, tenta autenticação SSH
-    if not paramiko:
-        return {"reachable": False, "error": "paramiko não disponível"}
-    
-    ok, out, err = ssh_run_command(ip, user, password=password, key_path=keyPath, port=port, timeout=timeout)
-    return {"reachable": ok, "output": out, "error": err}
 
-@app.get("/api/test/snmp")
-def test_snmp(ip: str = Query(...), community: str = Query("public"), version: str = Query("v2c")):
-    """Teste de conectividade SNMP"""
-    if not HAS_PYSNMP:
-        return {"reachable": False, "error": "SNMP indisponível - biblioteca pysnmp não instalada", "info": {}}
-    
-    try:
-        info = build_snmp_hostinfo(ip, community, version)
-        ok = bool(info.get("sysDescr") or info.get("sysName"))
-        return {"reachable": ok, "info": info, "error": None if ok else "Nenhuma resposta SNMP obtida"}
-    except Exception as e:
-        return {"reachable": False, "error": f"Erro SNMP: {str(e)}", "info": {}}
 
-# ----------------------
-# Node Exporter install via SSH (Ubuntu)
-# ----------------------
-@app.post("/api/actions/node-exporter/install")
-def actions_node_exporter_install(payload: Dict[str, Any] = Body(...)):
-    if not paramiko:
-        return {"ok": False, "error": "paramiko não disponível"}
-    ip = payload.get("ip")
-    user = payload.get("user")
-    password = payload.get("password")
-    key_path = payload.get("keyPath")
-    port = int(payload.get("port", 22))
-    timeout = float(payload.get("timeout", 3.0))
-    version = str(payload.get("version", "1.9.1"))
-    if isinstance(version, str) and version.lower() in ("latest", "stable"):
-        version = "1.9.1"
-    force = bool(payload.get("force", False))
-    if not ip or not user:
-        return {"ok": False, "error": "Parâmetros obrigatórios ausentes: ip/user"}
 
-    # Pre-check: if already active, skip unless force
-    if not force:
-        ok_pre, out_pre, err_pre = ssh_exec(ip, user, "systemctl is-active node_exporter || true", password=password, key_path=key_path, port=port, timeout=timeout)
-        if ok_pre and (out_pre or "") .strip() == "active":
-            probe = probe_node_exporter(ip)
-            return {"ok": True, "status": "already_running", "probe": probe}
 
-    install_script = f"""
-set -e
-PM=""
-if command -v apt-get >/dev/null 2>&1; then PM="apt"; fi
-if command -v dnf >/dev/null 2>&1; then PM="dnf"; fi
-if command -v yum >/dev/null 2>&1; then PM="yum"; fi
-if command -v zypper >/dev/null 2>&1; then PM="zypper"; fi
-install_pkgs() {{
-  case "$PM" in
-    apt) sudo -n apt-get update -y || true; sudo -n apt-get install -y curl wget || true ;;
-    dnf) sudo -n dnf -y install curl wget || true ;;
-    yum) sudo -n yum -y install curl wget || true ;;
-    zypper) sudo -n zypper -n install -y curl wget || true ;;
-    *) true ;;
-  esac
-}}
-install_pkgs
-VER="{version}"
-ARCH="$(uname -m)"
-case "$ARCH" in
-  x86_64) PKG_ARCH="amd64" ;;
-  aarch64|arm64) PKG_ARCH="arm64" ;;
-  armv7l) PKG_ARCH="armv7" ;;
-  *) PKG_ARCH="amd64" ;;
-esac
-if ! id -u node_exporter >/dev/null 2>&1; then sudo -n useradd --no-create-home --shell /bin/false node_exporter || true; fi
-cd /tmp
-URL="https://github.com/prometheus/node_exporter/releases/download/v${{VER}}/node_exporter-${{VER}}.linux-${{PKG_ARCH}}.tar.gz"
-(curl -fsSL "$URL" -o node_exporter.tar.gz) || (wget -q "$URL" -O node_exporter.tar.gz)
-rm -rf node_exporter-${{VER}}.linux-${{PKG_ARCH}}
-tar -xzf node_exporter.tar.gz
-sudo -n install -m 0755 "node_exporter-${{VER}}.linux-${{PKG_ARCH}}/node_exporter" /usr/local/bin/node_exporter
-sudo -n chown node_exporter:node_exporter /usr/local/bin/node_exporter || true
-sudo -n bash -c 'cat > /etc/systemd/system/node_exporter.service <<EOF
-[Unit]
-Description=Node Exporter
-Wants=network-online.target
-After=network-online.target
 
-[Service]
-User=node_exporter
-Group=node_exporter
-Type=simple
-ExecStart=/usr/local/bin/node_exporter --web.listen-address=:9100
-Restart=always
 
-[Install]
-WantedBy=multi-user.target
-EOF'
-sudo -n systemctl daemon-reload
-sudo -n systemctl enable node_exporter >/dev/null 2>&1 || true
-sudo -n systemctl restart node_exporter || sudo -n systemctl start node_exporter
-sleep 1
-(ss -tulnp 2>/dev/null | grep 9100) || (netstat -tulnp 2>/dev/null | grep 9100) || true
-"""
 
-    ok_inst, out_inst, err_inst = ssh_exec(ip, user, install_script, password=password, key_path=key_path, port=port, timeout=max(timeout, 6.0))
-    probe = probe_node_exporter(ip)
-    # Persist JSON inventory with node_exporter version
+def pg_purge_orphan_links() -> Dict[str, Any]:
+    """Remove links that reference non-existent devices or interfaces"""
+    ensure_pg_schema()
+    conn = get_pg_conn()
+    if not conn:
+        return {"ok": False, "error": "Database connection failed"}
+    
     try:
-        payload = {
-            "ip": ip,
-            "services": [{"service": "node_exporter", "port": 9100}],
-            "node_exporter": {"installed": True, "version": version, "timestamp": time.strftime("%Y-%m-%d %H:%M:%S")},
-            "real": True,
+        with conn.cursor() as cur:
+            # Remove links with invalid source devices
+            cur.execute('''
+                DELETE FROM "AUTOMACAO"."NetworkLinks" 
+                WHERE src_device_id IS NOT NULL 
+                AND src_device_id NOT IN (SELECT id FROM "AUTOMACAO"."Devices")
+            ''')
+            orphan_src_devices = cur.rowcount
+            
+            # Remove links with invalid destination devices
+            cur.execute('''
+                DELETE FROM "AUTOMACAO"."NetworkLinks" 
+                WHERE dst_device_id IS NOT NULL 
+                AND dst_device_id NOT IN (SELECT id FROM "AUTOMACAO"."Devices")
+            ''')
+            orphan_dst_devices = cur.rowcount
+            
+            # Remove links with invalid source interfaces
+            cur.execute('''
+                DELETE FROM "AUTOMACAO"."NetworkLinks" 
+                WHERE src_interface_id IS NOT NULL 
+                AND src_interface_id NOT IN (SELECT id FROM "AUTOMACAO"."DeviceInterfaces")
+            ''')
+            orphan_src_interfaces = cur.rowcount
+            
+            # Remove links with invalid destination interfaces
+            cur.execute('''
+                DELETE FROM "AUTOMACAO"."NetworkLinks" 
+                WHERE dst_interface_id IS NOT NULL 
+                AND dst_interface_id NOT IN (SELECT id FROM "AUTOMACAO"."DeviceInterfaces")
+            ''')
+            orphan_dst_interfaces = cur.rowcount
+            
+            total_removed = orphan_src_devices + orphan_dst_devices + orphan_src_interfaces + orphan_dst_interfaces
+            
+        conn.close()
+        return {
+            "ok": True,
+            "total_removed": total_removed,
+            "details": {
+                "orphan_src_devices": orphan_src_devices,
+                "orphan_dst_devices": orphan_dst_devices,
+                "orphan_src_interfaces": orphan_src_interfaces,
+                "orphan_dst_interfaces": orphan_dst_interfaces
+            }
         }
-        pg_upsert_device(payload)
-    except Exception:
-        pass
-    return {
-        "ok": ok_inst,
-        "status": "installed" if probe.get("present") else "not_present",
-        "probe": probe,
-        "output": out_inst,
-        "error": err_inst,
-        "version": version
-    }
+    except Exception as e:
+        try:
+            conn.close()
+        except Exception:
+            pass
+        return {"ok": False, "error": str(e)}
 
-@app.post("/api/actions/node-exporter/stop")
-def actions_node_exporter_stop(payload: Dict[str, Any] = Body(...)):
-    if not paramiko:
-        return {"ok": False, "error": "paramiko não disponível"}
-    ip = payload.get("ip")
-    user = payload.get("user")
-    password = payload.get("password")
-    key_path = payload.get("keyPath")
-    port = int(payload.get("port", 22))
-    timeout = float(payload.get("timeout", 3.0))
-    if not ip or not user:
-        return {"ok": False, "error": "Parâmetros obrigatórios ausentes: ip/user"}
-    ok1, out1, err1 = ssh_exec(ip, user, "sudo -n systemctl stop node_exporter || true && systemctl is-active node_exporter || true", password=password, key_path=key_path, port=port, timeout=timeout)
-    status = (out1 or "").strip()
-    probe = probe_node_exporter(ip)
-    return {"ok": ok1 and status != "active", "status": status or "unknown", "probe": probe, "output": out1, "error": err1}
 
-@app.post("/api/actions/node-exporter/uninstall")
-def actions_node_exporter_uninstall(payload: Dict[str, Any] = Body(...)):
-    if not paramiko:
-        return {"ok": False, "error": "paramiko não disponível"}
-    ip = payload.get("ip")
-    user = payload.get("user")
-    password = payload.get("password")
-    key_path = payload.get("keyPath")
-    port = int(payload.get("port", 22))
-    timeout = float(payload.get("timeout", 3.0))
-    if not ip or not user:
-        return {"ok": False, "error": "Parâmetros obrigatórios ausentes: ip/user"}
-    script = """
-sudo -n systemctl stop node_exporter || true
-sudo -n systemctl disable node_exporter || true
-sudo -n rm -f /etc/systemd/system/node_exporter.service || true
-sudo -n systemctl daemon-reload || true
-sudo -n rm -f /usr/local/bin/node_exporter || true
-sudo -n userdel node_exporter 2>/dev/null || true
-"""
-    ok, out, err = ssh_exec(ip, user, script, password=password, key_path=key_path, port=port, timeout=max(timeout, 5.0))
-    probe = probe_node_exporter(ip)
+def pg_update_link_latency(link_id: int, latency_ms: float) -> bool:
+    """Update latency for a specific link"""
+    ensure_pg_schema()
+    conn = get_pg_conn()
+    if not conn:
+        return False
+    
     try:
-        payload = {
-            "ip": ip,
-            "node_exporter": {"installed": False, "version": None, "timestamp": time.strftime("%Y-%m-%d %H:%M:%S")},
-            "real": True,
-        }
-        pg_upsert_device(payload)
+        with conn.cursor() as cur:
+            cur.execute('''
+                UPDATE "AUTOMACAO"."NetworkLinks" 
+                SET latency_ms = %s, updated_at = NOW() 
+                WHERE id = %s
+            ''', (latency_ms, link_id))
+            updated = cur.rowcount > 0
+        conn.close()
+        return updated
     except Exception:
-        pass
-    return {"ok": ok and not probe.get("present"), "status": "uninstalled", "probe": probe, "output": out, "error": err}
-
-# ----------------------
-# Inventory Persistence (PostgreSQL first, JSON fallback)
-# ----------------------
-
+        try:
+            conn.close()
+        except Exception:
+            pass
+        return False
 
 
-# --- PostgreSQL helpers ---
-def pg_ready() -> bool:
-    c = get_pg_conn()
-    if not c:
+def pg_save_discovery_job(job: Dict[str, Any], with_results: bool = True) -> bool:
+    """Upsert a discovery job snapshot (credentials masked). with_results=False writes only status and
+    counters, so periodic progress saves do not rewrite the growing results list."""
+    ensure_pg_schema()
+    conn = get_pg_conn()
+    if not conn:
         return False
     try:
-        c.close()
+        with DISCOVERY_JOBS_LOCK:
+            snapshot = (
+                job["id"], job.get("kind", "network"), job["status"], job.get("target"), job.get("method"),
+                json.dumps(mask_secrets(job.get("payload") or {}), default=str),
+                int(job.get("total") or 0), int(job.get("done") or 0),
+                json.dumps(job.get("results") or [] if with_results else [], default=str), job.get("error"),
+                job.get("created_at"), job.get("started_at"), job.get("finished_at"),
+            )
+        with conn.cursor() as cur:
+            cur.execute('''
+                INSERT INTO "AUTOMACAO"."DiscoveryJobs"
+                    (id, kind, status, target, method, params, total, done, results, error, created_at, started_at, finished_at, updated_at)
+                VALUES (%s, %s, %s, %s, %s, %s::jsonb, %s, %s, %s::jsonb, %s, %s, %s, %s, NOW())
+                ON CONFLICT (id) DO UPDATE SET
+                    status = EXCLUDED.status,
+                    total = EXCLUDED.total,
+                    done = EXCLUDED.done,
+                    results = CASE WHEN %s THEN EXCLUDED.results ELSE "DiscoveryJobs".results END,
+                    error = EXCLUDED.error,
+                    started_at = EXCLUDED.started_at,
+                    finished_at = EXCLUDED.finished_at,
+                    updated_at = NOW()
+            ''', snapshot + (with_results,))
+        conn.close()
+        return True
     except Exception:
-        pass
-    return True
+        try:
+            conn.close()
+        except Exception:
+            pass
+        return False
 
-def pg_list_devices() -> List[Dict[str, Any]]:
+
+def pg_fail_interrupted_discovery_jobs() -> int:
+    """Jobs left queued/running by a previous process can never finish; mark them failed."""
+    ensure_pg_schema()
     conn = get_pg_conn()
     if not conn:
-        return []
+        return 0
     try:
         with conn.cursor() as cur:
-            cur.execute('SELECT id, ip, hostname, os, status, services, last_seen, node_exporter, virtualization, real FROM "AUTOMACAO"."Devices" ORDER BY COALESCE(updated_at, created_at) DESC')
-            rows = cur.fetchall()
+            cur.execute('''
+                UPDATE "AUTOMACAO"."DiscoveryJobs"
+                SET status = 'failed', error = 'interrupted by API restart', finished_at = NOW(), updated_at = NOW()
+                WHERE status IN ('queued', 'running', 'cancelling')
+            ''')
+            updated = cur.rowcount
         conn.close()
-        devices: List[Dict[str, Any]] = []
-        for r in rows:
-            services = r[5]
-            node_exporter = r[7]
-            if isinstance(services, str):
-                try:
-                    services = json.loads(services or "[]")
-                except Exception:
-                    services = []
-            if isinstance(node_exporter, str):
-                try:
-                    node_exporter = json.loads(node_exporter or "{}")
-                except Exception:
-                    node_exporter = None
-            devices.append({
-                "id": r[0],
-                "ip": r[1],
-                "hostname": r[2],
-                "os": r[3],
-                "status": r[4],
-                "services": services or [],
-                "last_seen": r[6],
-                "node_exporter": node_exporter,
-                "virtualization": r[8],
-                "real": bool(r[9]) if r[9] is not None else True,
-            })
-        return devices
+        return updated
     except Exception:
         try:
             conn.close()
         except Exception:
             pass
-        return []
+        return 0
 
-def pg_get_device(ip: Optional[str] = None, hostname: Optional[str] = None) -> Optional[Dict[str, Any]]:
+
+def _pg_discovery_job_row(r: Tuple[Any, ...], with_results: bool) -> Dict[str, Any]:
+    total = r[5] or 0
+    done = r[6] or 0
+    job: Dict[str, Any] = {
+        "id": r[0],
+        "kind": r[1],
+        "status": r[2],
+        "target": r[3],
+        "method": r[4],
+        "progress": {"total": total, "done": done, "percent": round(done / total * 100.0, 2) if total else 0.0},
+        "error": r[7],
+        "created_at": _job_time_iso(r[8]),
+        "started_at": _job_time_iso(r[9]),
+        "finished_at": _job_time_iso(r[10]),
+    }
+    if with_results:
+        results = r[11]
+        if isinstance(results, str):
+            try:
+                results = json.loads(results or "[]")
+            except Exception:
+                results = []
+        job["results"] = results or []
+    return job
+
+
+def _pg_json(value: Any, default: Any) -> Any:
+    if isinstance(value, str):
+        try:
+            return json.loads(value)
+        except Exception:
+            return default
+    return default if value is None else value
+
+
+def pg_list_scan_profiles() -> Optional[List[Dict[str, Any]]]:
+    """Stored scan profiles, or None when PostgreSQL is unavailable or the query fails."""
+    ensure_pg_schema()
     conn = get_pg_conn()
     if not conn:
         return None
     try:
         with conn.cursor() as cur:
-            if ip:
-                cur.execute('SELECT id, ip, hostname, os, status, services, last_seen, node_exporter, virtualization, real FROM "AUTOMACAO"."Devices" WHERE ip = %s', (ip,))
-            else:
-                cur.execute('SELECT id, ip, hostname, os, status, services, last_seen, node_exporter, virtualization, real FROM "AUTOMACAO"."Devices" WHERE hostname = %s', (hostname,))
-            row = cur.fetchone()
+            cur.execute('''
+                SELECT name, description, ports, timeouts, default_timeout, port_order, early_stop, updated_at
+                FROM "AUTOMACAO"."ScanProfiles" ORDER BY name
+            ''')
+            rows = cur.fetchall()
         conn.close()
-        if not row:
-            return None
-        services = row[5]
-        node_exporter = row[7]
-        if isinstance(services, str):
-            try:
-                services = json.loads(services or "[]")
-            except Exception:
-                services = []
-        if isinstance(node_exporter, str):
-            try:
-                node_exporter = json.loads(node_exporter or "{}")
-            except Exception:
-                node_exporter = None
-        return {
-            "id": row[0], "ip": row[1], "hostname": row[2], "os": row[3], "status": row[4],
-            "services": services or [], "last_seen": row[6], "node_exporter": node_exporter,
-            "virtualization": row[8], "real": bool(row[9]) if row[9] is not None else True,
-        }
+        return [{
+            "name": r[0],
+            "description": r[1],
+            "ports": _pg_json(r[2], []),
+            "timeouts": _pg_json(r[3], {}),
+            "defaultTimeout": float(r[4]) if r[4] is not None else 0.35,
+            "order": r[5] or "learned",
+            "earlyStop": _pg_json(r[6], None),
+            "updated_at": r[7].isoformat() if hasattr(r[7], "isoformat") else r[7],
+        } for r in rows]
     except Exception:
         try:
             conn.close()
@@ -2648,174 +6944,75 @@ def pg_get_device(ip: Optional[str] = None, hostname: Optional[str] = None) -> O
             pass
         return None
 
-def pg_upsert_device(device: Dict[str, Any]) -> Dict[str, Any]:
-    ensure_pg_schema()
-    ip = device.get("ip")
-    hostname = device.get("hostname")
-    os_label = device.get("os") or "Unknown"
-    status = device.get("status") or "Unknown"
-    last_seen = device.get("lastSeen") or time.strftime("%Y-%m-%d %H:%M:%S")
-    # Normalize services to list[str]
-    raw_services = device.get("services") or []
-    normalized_services: List[Any] = []
-    for s in raw_services:
-        if isinstance(s, str):
-            normalized_services.append(s)
-        elif isinstance(s, dict) and ("service" in s or "port" in s):
-            normalized_services.append(s)
-    node_exporter = device.get("node_exporter") or None
-    virtualization = device.get("virtualization")
-    real = bool(device.get("real", True))
-
-    # Merge services with existing
-    existing = pg_get_device(ip=ip) if ip else pg_get_device(hostname=hostname)
-    if existing:
-        base_services = existing.get("services") or []
-        merged: List[Any] = []
-        for s in list(base_services) + list(normalized_services):
-            if s not in merged:
-                merged.append(s)
-        normalized_services = merged
 
+def pg_save_scan_profile(profile: Dict[str, Any]) -> bool:
+    ensure_pg_schema()
     conn = get_pg_conn()
     if not conn:
-        return {
-            "ip": ip, "hostname": hostname, "os": os_label, "status": status,
-            "services": normalized_services, "last_seen": last_seen,
-            "node_exporter": node_exporter, "virtualization": virtualization, "real": real,
-        }
+        return False
     try:
         with conn.cursor() as cur:
-            if ip:
-                # Try upsert via ip
-                cur.execute('''
-                    INSERT INTO "AUTOMACAO"."Devices" (ip, hostname, os, status, services, last_seen, node_exporter, virtualization, real, updated_at)
-                    VALUES (%s, %s, %s, %s, %s::jsonb, %s, %s::jsonb, %s, %s, NOW())
-                    ON CONFLICT (ip) DO UPDATE SET
-                        hostname = EXCLUDED.hostname,
-                        os = EXCLUDED.os,
-                        status = EXCLUDED.status,
-                        services = EXCLUDED.services,
-                        last_seen = EXCLUDED.last_seen,
-                        node_exporter = EXCLUDED.node_exporter,
-                        virtualization = EXCLUDED.virtualization,
-                        real = EXCLUDED.real,
-                        updated_at = NOW()
-                    RETURNING id, ip, hostname, os, status, services, last_seen, node_exporter, virtualization, real
-                ''', (ip, hostname, os_label, status, json.dumps(normalized_services), last_seen, json.dumps(node_exporter or {}), virtualization, real))
-            else:
-                # Upsert via hostname
-                cur.execute('''
-                    INSERT INTO "AUTOMACAO"."Devices" (hostname, ip, os, status, services, last_seen, node_exporter, virtualization, real, updated_at)
-                    VALUES (%s, %s, %s, %s, %s::jsonb, %s, %s::jsonb, %s, %s, NOW())
-                    ON CONFLICT (hostname) DO UPDATE SET
-                        ip = EXCLUDED.ip,
-                        os = EXCLUDED.os,
-                        status = EXCLUDED.status,
-                        services = EXCLUDED.services,
-                        last_seen = EXCLUDED.last_seen,
-                        node_exporter = EXCLUDED.node_exporter,
-                        virtualization = EXCLUDED.virtualization,
-                        real = EXCLUDED.real,
-                        updated_at = NOW()
-                    RETURNING id, ip, hostname, os, status, services, last_seen, node_exporter, virtualization, real
-                ''', (hostname, ip, os_label, status, json.dumps(normalized_services), last_seen, json.dumps(node_exporter or {}), virtualization, real))
-            row = cur.fetchone()
+            cur.execute('''
+                INSERT INTO "AUTOMACAO"."ScanProfiles" (name, description, ports, timeouts, default_timeout, port_order, early_stop, updated_at)
+                VALUES (%s, %s, %s::jsonb, %s::jsonb, %s, %s, %s::jsonb, NOW())
+                ON CONFLICT (name) DO UPDATE SET
+                    description = EXCLUDED.description,
+                    ports = EXCLUDED.ports,
+                    timeouts = EXCLUDED.timeouts,
+                    default_timeout = EXCLUDED.default_timeout,
+                    port_order = EXCLUDED.port_order,
+                    early_stop = EXCLUDED.early_stop,
+                    updated_at = NOW()
+            ''', (profile["name"], profile.get("description"), json.dumps(profile["ports"]), json.dumps(profile.get("timeouts") or {}),
+                  profile.get("defaultTimeout", 0.35), profile.get("order", "learned"),
+                  json.dumps(profile["earlyStop"]) if profile.get("earlyStop") else None))
         conn.close()
-        if not row:
-            return {
-                "ip": ip, "hostname": hostname, "os": os_label, "status": status,
-                "services": normalized_services, "last_seen": last_seen,
-                "node_exporter": node_exporter, "virtualization": virtualization, "real": real,
-            }
-        # Decode possible JSON strings
-        services = row[5]
-        node_exporter = row[7]
-        if isinstance(services, str):
-            try:
-                services = json.loads(services or "[]")
-            except Exception:
-                services = []
-        if isinstance(node_exporter, str):
-            try:
-                node_exporter = json.loads(node_exporter or "{}")
-            except Exception:
-                node_exporter = None
-        return {
-            "id": row[0], "ip": row[1], "hostname": row[2], "os": row[3], "status": row[4],
-            "services": services or [], "last_seen": row[6], "node_exporter": node_exporter,
-            "virtualization": row[8], "real": bool(row[9]) if row[9] is not None else True,
-        }
+        return True
     except Exception:
         try:
             conn.close()
         except Exception:
             pass
-        return {
-            "ip": ip, "hostname": hostname, "os": os_label, "status": status,
-            "services": normalized_services, "last_seen": last_seen,
-            "node_exporter": node_exporter, "virtualization": virtualization, "real": real,
-        }
+        return False
 
-def pg_upsert_interface(device_id: Optional[int], name: Optional[str], mac: Optional[str] = None, ipv4: Optional[str] = None, ipv6: Optional[str] = None, speed_mbps: Optional[int] = None, status: Optional[str] = None, type_label: Optional[str] = None) -> Optional[int]:
-    ensure_pg_schema()
-    if not device_id or not name:
-        return None
+
+def pg_delete_scan_profile(name: str) -> bool:
     conn = get_pg_conn()
     if not conn:
-        return None
+        return False
     try:
         with conn.cursor() as cur:
-            cur.execute('''
-                INSERT INTO "AUTOMACAO"."DeviceInterfaces" (device_id, name, mac, ipv4, ipv6, speed_mbps, status, type, last_seen, updated_at)
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, NOW(), NOW())
-                ON CONFLICT (device_id, name) DO UPDATE SET
-                    mac = EXCLUDED.mac,
-                    ipv4 = EXCLUDED.ipv4,
-                    ipv6 = EXCLUDED.ipv6,
-                    speed_mbps = EXCLUDED.speed_mbps,
-                    status = EXCLUDED.status,
-                    type = EXCLUDED.type,
-                    last_seen = NOW(),
-                    updated_at = NOW()
-                RETURNING id
-            ''', (device_id, name, mac, ipv4, ipv6, speed_mbps, status, type_label))
-            row = cur.fetchone()
+            cur.execute('DELETE FROM "AUTOMACAO"."ScanProfiles" WHERE name = %s', (name,))
+            deleted = cur.rowcount > 0
         conn.close()
-        return int(row[0]) if row else None
+        return deleted
     except Exception:
         try:
             conn.close()
         except Exception:
             pass
-        return None
+        return False
 
 
-def pg_upsert_link(src_device_id: Optional[int], src_interface_id: Optional[int], dst_device_id: Optional[int], dst_interface_id: Optional[int], link_type: str = "SNMP", latency_ms: Optional[float] = None, bandwidth_mbps: Optional[int] = None, status: Optional[str] = "discovered") -> Optional[int]:
-    ensure_pg_schema()
-    if not src_device_id or not dst_device_id:
-        return None
+def pg_port_hit_counts() -> Optional[Tuple[int, Dict[int, int]]]:
+    """How many inventoried devices have each port open; None when PostgreSQL is unavailable."""
     conn = get_pg_conn()
     if not conn:
         return None
     try:
         with conn.cursor() as cur:
+            cur.execute('SELECT COUNT(*) FROM "AUTOMACAO"."Devices"')
+            devices = int(cur.fetchone()[0] or 0)
             cur.execute('''
-                INSERT INTO "AUTOMACAO"."NetworkLinks"
-                    (src_device_id, src_interface_id, dst_device_id, dst_interface_id, link_type, latency_ms, bandwidth_mbps, status, discovered_at, updated_at)
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, NOW(), NOW())
-                ON CONFLICT (src_device_id, dst_device_id, link_type) DO UPDATE SET
-                    src_interface_id = EXCLUDED.src_interface_id,
-                    dst_interface_id = EXCLUDED.dst_interface_id,
-                    latency_ms = EXCLUDED.latency_ms,
-                    bandwidth_mbps = EXCLUDED.bandwidth_mbps,
-                    status = EXCLUDED.status,
-                    updated_at = NOW()
-                RETURNING id
-            ''', (src_device_id, src_interface_id, dst_device_id, dst_interface_id, link_type, latency_ms, bandwidth_mbps, status))
-            row = cur.fetchone()
+                SELECT (s->>'port')::int AS port, COUNT(DISTINCT d.id)
+                FROM "AUTOMACAO"."Devices" d,
+                     jsonb_array_elements(CASE WHEN jsonb_typeof(d.services) = 'array' THEN d.services ELSE '[]'::jsonb END) s
+                WHERE jsonb_typeof(s) = 'object' AND (s->>'port') ~ '^[0-9]+$'
+                GROUP BY 1
+            ''')
+            counts = {int(r[0]): int(r[1]) for r in cur.fetchall()}
         conn.close()
-        return int(row[0]) if row else None
+        return devices, counts
     except Exception:
         try:
             conn.close()
@@ -2824,100 +7021,125 @@ def pg_upsert_link(src_device_id: Optional[int], src_interface_id: Optional[int]
         return None
 
 
-def pg_delete_device(device_id: str) -> Dict[str, Any]:
+def pg_upsert_container(device_id: int, c: Dict[str, Any], cur: Any = None) -> bool:
+    if cur is None:
+        conn = get_pg_conn()
+        if not conn:
+            return False
+        try:
+            with conn.cursor() as own:
+                ok = pg_upsert_container(device_id, c, own)
+            conn.close()
+            return ok
+        except Exception:
+            try:
+                conn.close()
+            except Exception:
+                pass
+            return False
+    cur.execute('''
+        INSERT INTO "AUTOMACAO"."Containers" (device_id, container_id, name, image, state, status, ports, labels, last_seen, updated_at)
+        VALUES (%s, %s, %s, %s, %s, %s, %s::jsonb, %s::jsonb, NOW(), NOW())
+        ON CONFLICT (device_id, container_id) DO UPDATE SET
+            name = COALESCE(EXCLUDED.name, "Containers".name),
+            image = COALESCE(EXCLUDED.image, "Containers".image),
+            state = COALESCE(EXCLUDED.state, "Containers".state),
+            status = COALESCE(EXCLUDED.status, "Containers".status),
+            ports = CASE WHEN %s THEN EXCLUDED.ports ELSE "Containers".ports END,
+            labels = CASE WHEN %s THEN EXCLUDED.labels ELSE "Containers".labels END,
+            last_seen = NOW(),
+            updated_at = NOW()
+    ''', (device_id, c["id"], c.get("name"), c.get("image"), c.get("state"), c.get("status"),
+          json.dumps(c.get("ports") or []), json.dumps(c.get("labels") or {}),
+          c.get("ports") is not None, c.get("labels") is not None))
+    return True
+
+
+def pg_delete_container(device_id: int, container_id: str) -> bool:
     conn = get_pg_conn()
     if not conn:
-        return {"ok": False, "message": "PostgreSQL connection not available"}
+        return False
     try:
         with conn.cursor() as cur:
-            # If numeric id
-            try:
-                num_id = int(device_id)
-                cur.execute('DELETE FROM "AUTOMACAO"."Devices" WHERE id = %s', (num_id,))
-            except Exception:
-                # Remove by ip or hostname
-                cur.execute('DELETE FROM "AUTOMACAO"."Devices" WHERE ip = %s OR hostname = %s', (device_id, device_id))
+            cur.execute('DELETE FROM "AUTOMACAO"."Containers" WHERE device_id = %s AND container_id = %s', (device_id, container_id))
         conn.close()
-        # Return remaining count
-        # Best-effort: recount
-        rem = pg_list_devices()
-        return {"ok": True, "message": "Device removed successfully", "count": len(rem)}
+        return True
     except Exception:
         try:
             conn.close()
         except Exception:
             pass
-        return {"ok": False, "message": "Failed to remove device"}
+        return False
 
-# --- JSON fallback helpers ---
 
-# Eventos e manutenção de topologia
+CONTAINER_DIFF_FIELDS = ("name", "image", "state", "status", "ports", "labels")
 
-def pg_add_event(device_id: int, event_type: str, severity: str = "info", description: Optional[str] = None, 
-                 attributes: Optional[Dict[str, Any]] = None, actor: Optional[str] = None, 
-                 source: Optional[str] = None) -> Dict[str, Any]:
+
+def pg_sync_containers(device_id: int, containers: List[Dict[str, Any]]) -> Optional[Dict[str, int]]:
+    """Make the device's rows match a full container listing, writing only what changed.
+    Returns {"added", "changed", "removed", "unchanged"} or None when PostgreSQL is unavailable.
+    """
     ensure_pg_schema()
     conn = get_pg_conn()
-    if not conn or not device_id or not event_type:
-        return {"ok": False}
+    if not conn:
+        return None
     try:
-        # Mask sensitive information in attributes
-        masked_attributes = mask_secrets(attributes or {})
-        
+        listed = {c["id"]: c for c in containers if c.get("id")}
         with conn.cursor() as cur:
-            cur.execute(
-                'INSERT INTO "AUTOMACAO"."Events"(device_id, event_type, severity, description, attributes, actor, source, ts) VALUES (%s, %s, %s, %s, %s, %s, %s, NOW()) RETURNING id',
-                (device_id, event_type, severity, description, json.dumps(masked_attributes), actor, source)
-            )
-            rid = cur.fetchone()
+            cur.execute('''
+                SELECT container_id, name, image, state, status, ports, labels
+                FROM "AUTOMACAO"."Containers" WHERE device_id = %s
+            ''', (device_id,))
+            stored = {r[0]: {"name": r[1], "image": r[2], "state": r[3], "status": r[4],
+                             "ports": r[5] if r[5] is not None else [], "labels": r[6] if r[6] is not None else {}}
+                      for r in cur.fetchall()}
+            added = [c for cid, c in listed.items() if cid not in stored]
+            changed_ids = {cid for cid, c in listed.items() if cid in stored and any(
+                c.get(f) is not None and c.get(f) != stored[cid][f] for f in CONTAINER_DIFF_FIELDS)}
+            changed = [listed[cid] for cid in changed_ids]
+            removed = [cid for cid in stored if cid not in listed]
+            for c in added + changed:
+                pg_upsert_container(device_id, c, cur)
+            unchanged = [cid for cid in listed if cid in stored and cid not in changed_ids]
+            if unchanged:
+                cur.execute('''
+                    UPDATE "AUTOMACAO"."Containers" SET last_seen = NOW()
+                    WHERE device_id = %s AND container_id = ANY(%s)
+                ''', (device_id, unchanged))
+            if removed:
+                cur.execute('''
+                    DELETE FROM "AUTOMACAO"."Containers" WHERE device_id = %s AND container_id = ANY(%s)
+                ''', (device_id, removed))
         conn.close()
-        return {"ok": True, "id": rid[0]}
+        return {"added": len(added), "changed": len(changed), "removed": len(removed), "unchanged": len(unchanged)}
     except Exception:
         try:
             conn.close()
         except Exception:
             pass
-        return {"ok": False}
+        return None
 
 
-def pg_list_events(device_id: Optional[int] = None, event_type: Optional[str] = None, limit: int = 200) -> List[Dict[str, Any]]:
-    ensure_pg_schema()
+def pg_list_containers(ip: str) -> List[Dict[str, Any]]:
     conn = get_pg_conn()
     if not conn:
         return []
     try:
         with conn.cursor() as cur:
-            sql = 'SELECT id, device_id, event_type, severity, description, attributes, actor, source, ts FROM "AUTOMACAO"."Events"'
-            params: List[Any] = []
-            if device_id is not None or event_type is not None:
-                sql += ' WHERE '
-                conds: List[str] = []
-                if device_id is not None:
-                    conds.append('device_id = %s')
-                    params.append(device_id)
-                if event_type is not None:
-                    conds.append('event_type = %s')
-                    params.append(event_type)
-                sql += ' AND '.join(conds)
-            sql += ' ORDER BY ts DESC LIMIT %s'
-            params.append(limit)
-            cur.execute(sql, tuple(params))
+            cur.execute('''
+                SELECT c.container_id, c.name, c.image, c.state, c.status, c.ports, c.labels, c.first_seen, c.last_seen
+                FROM "AUTOMACAO"."Containers" c JOIN "AUTOMACAO"."Devices" d ON c.device_id = d.id
+                WHERE d.ip = %s ORDER BY c.name
+            ''', (ip,))
             rows = cur.fetchall()
         conn.close()
-        return [
-            {
-                "id": r[0],
-                "device_id": r[1],
-                "event_type": r[2],
-                "severity": r[3],
-                "description": r[4],
-                "attributes": json.loads(r[5]) if isinstance(r[5], (str, bytes)) else (r[5] or {}),
-                "actor": r[6],
-                "source": r[7],
-                "ts": r[8],
-            }
-            for r in rows
-        ]
+        return [{
+            "id": r[0], "name": r[1], "image": r[2], "state": r[3], "status": r[4],
+            "ports": _pg_json(r[5], []), "labels": _pg_json(r[6], {}),
+            "running": r[3] == "running",
+            "first_seen": r[7].isoformat() if hasattr(r[7], "isoformat") else r[7],
+            "last_seen": r[8].isoformat() if hasattr(r[8], "isoformat") else r[8],
+        } for r in rows]
     except Exception:
         try:
             conn.close()
@@ -2926,217 +7148,143 @@ def pg_list_events(device_id: Optional[int] = None, event_type: Optional[str] =
         return []
 
 
-def pg_purge_links(days: int = 30, device_id: Optional[int] = None) -> int:
-    ensure_pg_schema()
+def pg_get_known_hosts(host: str, port: int) -> Optional[Dict[str, Dict[str, str]]]:
+    """Stored keys of host:port by key type; None when PostgreSQL is unavailable."""
     conn = get_pg_conn()
     if not conn:
-        return 0
+        return None
     try:
         with conn.cursor() as cur:
-            sql = 'DELETE FROM "AUTOMACAO"."NetworkLinks" WHERE updated_at < NOW() - %s::interval'
-            params: List[Any] = [f'{max(1, int(days))} days']
-            if device_id is not None:
-                sql += ' AND (src_device_id = %s OR dst_device_id = %s)'
-                params.extend([device_id, device_id])
-            cur.execute(sql, tuple(params))
-            deleted = cur.rowcount
+            cur.execute('''
+                SELECT key_type, key_data, fingerprint FROM "AUTOMACAO"."SshKnownHosts"
+                WHERE host = %s AND port = %s
+            ''', (host, port))
+            rows = cur.fetchall()
         conn.close()
-        return deleted
+        return {r[0]: {"key_data": r[1], "fingerprint": r[2]} for r in rows}
     except Exception:
         try:
             conn.close()
         except Exception:
             pass
-        return 0
+        return None
 
-# Listagem de interfaces e links (topologia)
 
-def pg_list_interfaces(device_id: int) -> List[Dict[str, Any]]:
-    ensure_pg_schema()
+def pg_save_known_host(host: str, port: int, key_type: str, key_data: str, fingerprint: str) -> bool:
     conn = get_pg_conn()
-    if not conn or not device_id:
-        return []
+    if not conn:
+        return False
     try:
         with conn.cursor() as cur:
-            cur.execute(
-                'SELECT id, name, mac, ipv4, ipv6, speed_mbps, status, type, last_seen, updated_at FROM "AUTOMACAO"."DeviceInterfaces" WHERE device_id = %s ORDER BY name',
-                (device_id,)
-            )
-            rows = cur.fetchall()
+            cur.execute('''
+                INSERT INTO "AUTOMACAO"."SshKnownHosts" (host, port, key_type, key_data, fingerprint)
+                VALUES (%s, %s, %s, %s, %s)
+                ON CONFLICT (host, port, key_type) DO UPDATE SET
+                    key_data = EXCLUDED.key_data,
+                    fingerprint = EXCLUDED.fingerprint,
+                    changed_at = CASE WHEN "SshKnownHosts".key_data <> EXCLUDED.key_data THEN NOW() ELSE "SshKnownHosts".changed_at END,
+                    last_seen = NOW()
+            ''', (host, port, key_type, key_data, fingerprint))
         conn.close()
-        return [
-            {
-                "id": r[0],
-                "name": r[1],
-                "mac": r[2],
-                "ipv4": r[3],
-                "ipv6": r[4],
-                "speed_mbps": r[5],
-                "status": r[6],
-                "type": r[7],
-                "last_seen": r[8],
-                "updated_at": r[9],
-            }
-            for r in rows
-        ]
+        return True
     except Exception:
         try:
             conn.close()
         except Exception:
             pass
-        return []
+        return False
 
 
-def pg_list_links(device_id: Optional[int] = None) -> List[Dict[str, Any]]:
-    ensure_pg_schema()
+def pg_list_known_hosts(host: Optional[str] = None) -> List[Dict[str, Any]]:
     conn = get_pg_conn()
     if not conn:
         return []
     try:
         with conn.cursor() as cur:
-            sql = '''
-                SELECT
-                    l.id,
-                    l.src_device_id, sd.hostname AS src_hostname, sd.ip AS src_ip,
-                    l.src_interface_id, si.name AS src_if_name,
-                    l.dst_device_id, dd.hostname AS dst_hostname, dd.ip AS dst_ip,
-                    l.dst_interface_id, di.name AS dst_if_name,
-                    l.link_type, l.latency_ms, l.bandwidth_mbps, l.status, l.discovered_at, l.updated_at
-                FROM "AUTOMACAO"."NetworkLinks" l
-                LEFT JOIN "AUTOMACAO"."Devices" sd ON l.src_device_id = sd.id
-                LEFT JOIN "AUTOMACAO"."DeviceInterfaces" si ON l.src_interface_id = si.id
-                LEFT JOIN "AUTOMACAO"."Devices" dd ON l.dst_device_id = dd.id
-                LEFT JOIN "AUTOMACAO"."DeviceInterfaces" di ON l.dst_interface_id = di.id
-            '''
-            if device_id is not None:
-                sql += ' WHERE l.src_device_id = %s OR l.dst_device_id = %s'
-                cur.execute(sql + ' ORDER BY l.updated_at DESC', (device_id, device_id))
-            else:
-                cur.execute(sql + ' ORDER BY l.updated_at DESC')
+            cur.execute('''
+                SELECT host, port, key_type, fingerprint, first_seen, last_seen, changed_at
+                FROM "AUTOMACAO"."SshKnownHosts"
+                WHERE %s::text IS NULL OR host = %s
+                ORDER BY host, port, key_type
+            ''', (host, host))
             rows = cur.fetchall()
         conn.close()
-        return [
-            {
-                "id": r[0],
-                "src_device_id": r[1],
-                "src_hostname": r[2],
-                "src_ip": r[3],
-                "src_interface_id": r[4],
-                "src_if_name": r[5],
-                "dst_device_id": r[6],
-                "dst_hostname": r[7],
-                "dst_ip": r[8],
-                "dst_interface_id": r[9],
-                "dst_if_name": r[10],
-                "link_type": r[11],
-                "latency_ms": r[12],
-                "bandwidth_mbps": r[13],
-                "status": r[14],
-                "discovered_at": r[15],
-                "updated_at": r[16],
-            }
-            for r in rows
-        ]
     except Exception:
         try:
             conn.close()
         except Exception:
             pass
         return []
+    return [{
+        "host": r[0], "port": r[1], "key_type": r[2], "fingerprint": r[3],
+        "first_seen": r[4].isoformat() if r[4] else None,
+        "last_seen": r[5].isoformat() if r[5] else None,
+        "changed_at": r[6].isoformat() if r[6] else None,
+    } for r in rows]
 
 
+def pg_delete_known_hosts(host: str, port: Optional[int] = None) -> int:
+    conn = get_pg_conn()
+    if not conn:
+        return 0
+    try:
+        with conn.cursor() as cur:
+            cur.execute('''
+                DELETE FROM "AUTOMACAO"."SshKnownHosts" WHERE host = %s AND (%s::integer IS NULL OR port = %s)
+            ''', (host, port, port))
+            deleted = cur.rowcount
+        conn.close()
+        return deleted
+    except Exception:
+        try:
+            conn.close()
+        except Exception:
+            pass
+        return 0
 
 
-
-
-
-
-
-def pg_purge_orphan_links() -> Dict[str, Any]:
-    """Remove links that reference non-existent devices or interfaces"""
+def pg_get_discovery_job(job_id: str) -> Optional[Dict[str, Any]]:
     ensure_pg_schema()
     conn = get_pg_conn()
     if not conn:
-        return {"ok": False, "error": "Database connection failed"}
-    
+        return None
     try:
         with conn.cursor() as cur:
-            # Remove links with invalid source devices
-            cur.execute('''
-                DELETE FROM "AUTOMACAO"."NetworkLinks" 
-                WHERE src_device_id IS NOT NULL 
-                AND src_device_id NOT IN (SELECT id FROM "AUTOMACAO"."Devices")
-            ''')
-            orphan_src_devices = cur.rowcount
-            
-            # Remove links with invalid destination devices
-            cur.execute('''
-                DELETE FROM "AUTOMACAO"."NetworkLinks" 
-                WHERE dst_device_id IS NOT NULL 
-                AND dst_device_id NOT IN (SELECT id FROM "AUTOMACAO"."Devices")
-            ''')
-            orphan_dst_devices = cur.rowcount
-            
-            # Remove links with invalid source interfaces
-            cur.execute('''
-                DELETE FROM "AUTOMACAO"."NetworkLinks" 
-                WHERE src_interface_id IS NOT NULL 
-                AND src_interface_id NOT IN (SELECT id FROM "AUTOMACAO"."DeviceInterfaces")
-            ''')
-            orphan_src_interfaces = cur.rowcount
-            
-            # Remove links with invalid destination interfaces
             cur.execute('''
-                DELETE FROM "AUTOMACAO"."NetworkLinks" 
-                WHERE dst_interface_id IS NOT NULL 
-                AND dst_interface_id NOT IN (SELECT id FROM "AUTOMACAO"."DeviceInterfaces")
-            ''')
-            orphan_dst_interfaces = cur.rowcount
-            
-            total_removed = orphan_src_devices + orphan_dst_devices + orphan_src_interfaces + orphan_dst_interfaces
-            
+                SELECT id, kind, status, target, method, total, done, error, created_at, started_at, finished_at, results
+                FROM "AUTOMACAO"."DiscoveryJobs" WHERE id = %s
+            ''', (job_id,))
+            row = cur.fetchone()
         conn.close()
-        return {
-            "ok": True,
-            "total_removed": total_removed,
-            "details": {
-                "orphan_src_devices": orphan_src_devices,
-                "orphan_dst_devices": orphan_dst_devices,
-                "orphan_src_interfaces": orphan_src_interfaces,
-                "orphan_dst_interfaces": orphan_dst_interfaces
-            }
-        }
-    except Exception as e:
+        return _pg_discovery_job_row(row, with_results=True) if row else None
+    except Exception:
         try:
             conn.close()
         except Exception:
             pass
-        return {"ok": False, "error": str(e)}
+        return None
 
 
-def pg_update_link_latency(link_id: int, latency_ms: float) -> bool:
-    """Update latency for a specific link"""
+def pg_list_discovery_jobs(limit: int = 50) -> List[Dict[str, Any]]:
     ensure_pg_schema()
     conn = get_pg_conn()
     if not conn:
-        return False
-    
+        return []
     try:
         with conn.cursor() as cur:
             cur.execute('''
-                UPDATE "AUTOMACAO"."NetworkLinks" 
-                SET latency_ms = %s, updated_at = NOW() 
-                WHERE id = %s
-            ''', (latency_ms, link_id))
-            updated = cur.rowcount > 0
+                SELECT id, kind, status, target, method, total, done, error, created_at, started_at, finished_at
+                FROM "AUTOMACAO"."DiscoveryJobs" ORDER BY created_at DESC LIMIT %s
+            ''', (limit,))
+            rows = cur.fetchall()
         conn.close()
-        return updated
+        return [_pg_discovery_job_row(r, with_results=False) for r in rows]
     except Exception:
         try:
             conn.close()
         except Exception:
             pass
-        return False
+        return []
 
 
 # --- Inventory API using PG first ---
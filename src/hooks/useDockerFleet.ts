@@ -9,7 +9,6 @@ type FleetContainer = {
   state?: string;
   ports?: any;
   running?: boolean;
-  logs_tail?: string | null;
   host?: string; // hostname or ip
   ip?: string;
 };
@@ -90,7 +89,6 @@ export function useDockerFleet() {
                 state: c.state,
                 ports: c.ports,
                 running,
-                logs_tail: c.logs_tail,
                 host: hostLabel,
                 ip,
               });
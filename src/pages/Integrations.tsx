@@ -1,5 +1,5 @@
 import React, { useEffect, useState } from 'react';
-import { Card, Typography, Row, Col, Tabs, Table, Tag, Space, Button, Statistic, Progress, Input, Select, Form, Alert, Divider, message, Drawer, Descriptions, Collapse, Badge } from 'antd';
+import { Card, Typography, Row, Col, Tabs, Table, Tag, Space, Button, Statistic, Progress, Input, Select, Form, Alert, Divider, message, Drawer, Descriptions, Collapse, Badge, Spin } from 'antd';
 import {
   DatabaseOutlined,
   SettingOutlined,
@@ -61,6 +61,7 @@ const Integrations: React.FC = () => {
   const [selectedHost, setSelectedHost] = useState<any | null>(null);
   const [hostDetails, setHostDetails] = useState<any | null>(null);
   const [dockerDetails, setDockerDetails] = useState<any | null>(null);
+  const [containerLogs, setContainerLogs] = useState<Record<string, { loading: boolean; text?: string | null; error?: string | null }>>({});
   const [dbProbes, setDbProbes] = useState<any[] | null>(null);
   const [metricsSeries, setMetricsSeries] = useState<Record<string, Array<{ time: string; value: number }>>>({});
   const [metricsAvailable, setMetricsAvailable] = useState(false);
@@ -69,6 +70,11 @@ const Integrations: React.FC = () => {
   const [metricsTimer, setMetricsTimer] = useState<any>(null);
   const [addedDevices, setAddedDevices] = useState<any[]>([]);
 
+  // Logs carregados pertencem ao host/coleta atual
+  useEffect(() => {
+    setContainerLogs({});
+  }, [dockerDetails]);
+
   // Cleanup timer on unmount
   useEffect(() => {
     return () => {
@@ -556,6 +562,34 @@ const Integrations: React.FC = () => {
     }
   };
 
+  // Logs são buscados sob demanda ao expandir a linha do container
+  const loadContainerLogs = async (container: any, fresh = false) => {
+    const ip = selectedHost?.ip;
+    const cid = container?.id;
+    if (!ip || !cid || containerLogs[cid]?.loading) return;
+    setContainerLogs((prev) => ({ ...prev, [cid]: { loading: true } }));
+    try {
+      const qs = new URLSearchParams({ ip, ids: cid });
+      if (fresh) qs.append('fresh', 'true');
+      if (dockerDetails?.source === 'ssh' || dockerDetails?.source === 'watch:ssh') {
+        if (sshUser) qs.append('sshUser', sshUser);
+        if (sshPass) qs.append('sshPass', sshPass);
+        if (sshKey) qs.append('sshKey', sshKey);
+        if (sshPort) qs.append('sshPort', String(sshPort));
+        if (sshTimeout) qs.append('sshTimeout', String(sshTimeout));
+      }
+      const r = await fetch(`/api/discovery/docker/logs?${qs.toString()}`);
+      if (!r.ok) {
+        throw new Error(`HTTP ${r.status}`);
+      }
+      const j = await r.json();
+      const entry = j?.logs?.[cid];
+      setContainerLogs((prev) => ({ ...prev, [cid]: { loading: false, text: entry?.text ?? null, error: entry?.error || j?.error || null } }));
+    } catch (e: any) {
+      setContainerLogs((prev) => ({ ...prev, [cid]: { loading: false, text: null, error: e?.message || 'erro desconhecido' } }));
+    }
+  };
+
   const persistDevice = async (record: any) => {
     try {
       const payload = {
@@ -1917,16 +1951,23 @@ const Integrations: React.FC = () => {
                       ]}
                       dataSource={(dockerDetails.containers || []).map((c: any) => ({ key: c.id, ...c }))}
                       expandable={{
+                        onExpand: (expanded: boolean, c: any) => {
+                          if (expanded && !containerLogs[c.id]) loadContainerLogs(c);
+                        },
                         expandedRowRender: (c: any) => (
                           <Space direction="vertical" style={{ width: '100%' }}>
                             <Descriptions bordered size="small" column={2}>
                               <Descriptions.Item label="ID">{c.id}</Descriptions.Item>
                               <Descriptions.Item label="Ports">{(c.ports || []).map((p: any) => `${p.PublicPort ?? ''}->${p.PrivatePort ?? ''}/${p.Type ?? ''}`).join(', ') || 'N/A'}</Descriptions.Item>
                             </Descriptions>
-                            {c.logs_tail ? (
-                              <Card size="small" title="Logs (tail)"><pre style={{ whiteSpace: 'pre-wrap' }}>{c.logs_tail}</pre></Card>
+                            {containerLogs[c.id]?.loading ? (
+                              <Spin size="small" />
+                            ) : containerLogs[c.id]?.text ? (
+                              <Card size="small" title="Logs (tail)" extra={<Button size="small" onClick={() => loadContainerLogs(c, true)}>Atualizar</Button>}>
+                                <pre style={{ whiteSpace: 'pre-wrap' }}>{containerLogs[c.id]?.text}</pre>
+                              </Card>
                             ) : (
-                              <Alert message="Logs indisponíveis" type="info" />
+                              <Alert message="Logs indisponíveis" description={containerLogs[c.id]?.error || undefined} type="info" />
                             )}
                           </Space>
                         )